@@ -0,0 +1,167 @@
+import atexit
+import copy as copy_module
+import os
+import queue
+import threading
+import time
+import traceback
+
+import imageio
+import numpy as np
+import torch
+
+
+def to_host(obj):
+    '''copy the tensors in obj (possibly nested in dicts / lists / tuples) to host memory
+
+    CUDA tensors are copied into pinned buffers with non_blocking=True, so the training stream
+    is not stalled; the returned event must be synchronized before the copies are read.
+    CPU tensors are cloned since the caller may keep updating them in place.
+    - return:
+        - host_obj: obj with every tensor replaced by its host copy
+        - event: torch.cuda.Event recorded after the copies, None if nothing was on the GPU
+    '''
+    on_gpu = [False]
+
+    def copy(x):
+        if isinstance(x, torch.Tensor):
+            x = x.detach()
+            if x.is_cuda:
+                on_gpu[0] = True
+                host = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+                return host.copy_(x, non_blocking=True)
+            return x.clone()
+        if isinstance(x, dict):
+            # a shallow copy keeps the attributes of the mapping, e.g. the _metadata of a state_dict
+            out = copy_module.copy(x)
+            for k, v in x.items():
+                out[k] = copy(v)
+            return out
+        if isinstance(x, tuple) and hasattr(x, '_fields'):
+            return type(x)(*[copy(v) for v in x])
+        if isinstance(x, (list, tuple)):
+            return type(x)(copy(v) for v in x)
+        return x
+
+    host_obj = copy(obj)
+    event = None
+    if on_gpu[0]:
+        event = torch.cuda.Event()
+        event.record()
+    return host_obj, event
+
+
+def atomic_save(obj, path):
+    '''torch.save to a temporary file and rename it, so an interrupted write never leaves a truncated checkpoint'''
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def atomic_imwrite(path, img):
+    root, ext = os.path.splitext(path)
+    tmp_path = f'{root}.{os.getpid()}.tmp{ext}'
+    imageio.imwrite(tmp_path, img)
+    os.replace(tmp_path, path)
+
+
+class AsyncWriter():
+    '''Writes checkpoints, images and meshes from background threads.
+
+    Jobs go through a bounded queue: submit() blocks once max_queue jobs are pending, which
+    keeps host memory bounded when the disk cannot keep up. Threads are enough here since
+    torch.save, PNG encoding and file writes release the GIL. With num_workers=0 every job
+    runs inline, which is the behaviour of the training scripts without the writer.
+
+    Tensors passed to submit() are copied to host memory first, so the caller can keep
+    training; numpy arrays are not copied and must not be modified after submission.
+    '''
+    def __init__(self, num_workers=2, max_queue=32):
+        self.num_workers = num_workers
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.errors = []
+        self.stats = {'jobs': 0, 'wait_seconds': 0., 'write_seconds': 0.}
+        self.lock = threading.Lock()
+        self.workers = []
+        for _ in range(num_workers):
+            worker = threading.Thread(target=self.work, daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        if num_workers > 0:
+            atexit.register(self.close)
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            fn, args, kwargs, event = job
+            try:
+                tt = time.time()
+                if event is not None:
+                    event.synchronize()
+                fn(*args, **kwargs)
+                with self.lock:
+                    self.stats['write_seconds'] += time.time() - tt
+            except Exception as e:
+                traceback.print_exc()
+                with self.lock:
+                    self.errors.append(f'{getattr(fn, "__name__", fn)}: {e!r}')
+            finally:
+                self.queue.task_done()
+
+    def check(self):
+        '''re-raise the failures of finished jobs in the training thread'''
+        if self.errors:
+            with self.lock:
+                errors, self.errors = self.errors, []
+            raise RuntimeError('AsyncWriter: %d job(s) failed\n%s' % (len(errors), '\n'.join(errors)))
+
+    def submit(self, fn, *args, **kwargs):
+        '''run fn(*args, **kwargs) in the background, blocking while the queue is full'''
+        self.check()
+        self.stats['jobs'] += 1
+        if not self.workers:
+            fn(*args, **kwargs)
+            return
+        (args, kwargs), event = to_host((args, kwargs))
+        tt = time.time()
+        self.queue.put((fn, args, kwargs, event))
+        self.stats['wait_seconds'] += time.time() - tt
+
+    def save_checkpoint(self, obj, path):
+        self.submit(atomic_save, obj, path)
+
+    def save_image(self, path, img):
+        '''img: uint8 array, written with imageio'''
+        self.submit(atomic_imwrite, path, np.asarray(img))
+
+    def flush(self):
+        '''wait until every submitted job is written'''
+        if self.workers:
+            self.queue.join()
+        self.check()
+
+    def close(self):
+        if not self.workers:
+            return
+        self.queue.join()
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        print(f"AsyncWriter: {self.stats['jobs']} jobs, {self.stats['write_seconds']:.2f}s writing, "
+              f"{self.stats['wait_seconds']:.2f}s blocked on a full queue")
+        self.check()
+
+
+# runs every job inline, used when async_writer is disabled and as the default of the models
+sync_writer = AsyncWriter(num_workers=0)
+
+
+def build_writer(conf):
+    if getattr(conf, 'async_writer', False):
+        return AsyncWriter(getattr(conf, 'writer_workers', 2), getattr(conf, 'writer_queue', 32))
+    return sync_writer
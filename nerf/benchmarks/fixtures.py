@@ -0,0 +1,130 @@
+import torch
+import torch.nn.functional as F
+
+from models.tensorBase import AlphaGridMask
+
+
+class SyntheticField():
+    '''Analytic stand-in for a trained TensoIR: a few solid spheres with a smooth color field.
+
+    It implements the part of the TensoIR interface used by the secondary-ray code in
+    models/tensoIR/relight_utils.py, so the benchmarks run without a checkpoint or a GPU.
+    '''
+    def __init__(self, device='cpu', alpha_res=128, seed=0):
+        self.device = device
+        self.distance_scale = 25.
+        self.alphaMask_thres = 1e-3
+        self.aabb = torch.tensor([[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]], device=device)
+        self.invaabbSize = 2.0 / (self.aabb[1] - self.aabb[0])
+        generator = torch.Generator().manual_seed(seed)
+        self.centers = ((torch.rand((4, 3), generator=generator) - 0.5) * 1.2).to(device)
+        self.radii = (0.25 + 0.2 * torch.rand((4,), generator=generator)).to(device)
+
+        samples = torch.stack(torch.meshgrid(
+            torch.linspace(0, 1, alpha_res), torch.linspace(0, 1, alpha_res), torch.linspace(0, 1, alpha_res),
+            indexing='ij'), -1).to(device)
+        dense_xyz = self.aabb[0] * (1 - samples) + self.aabb[1] * samples
+        alpha = (self.sdf(dense_xyz.view(-1, 3)) < 0.05).float().view(alpha_res, alpha_res, alpha_res)
+        self.alphaMask = AlphaGridMask(device, self.aabb, alpha.transpose(0, 2).contiguous())
+
+    def sdf(self, xyz):
+        return torch.min(torch.norm(xyz[:, None, :] - self.centers, dim=-1) - self.radii, dim=-1)[0]
+
+    def normalize_coord(self, xyz_sampled):
+        return (xyz_sampled - self.aabb[0]) * self.invaabbSize - 1
+
+    def compute_densityfeature(self, xyz_sampled):
+        xyz = (xyz_sampled + 1) / self.invaabbSize + self.aabb[0]
+        return -self.sdf(xyz) * 200.
+
+    def feature2density(self, density_features):
+        return F.relu(density_features)
+
+    def compute_appfeature(self, xyz_sampled, light_idx=None):
+        return xyz_sampled
+
+    def renderModule(self, xyz_sampled, viewdirs, features):
+        return torch.sigmoid(3 * features)
+
+
+def surface_rays(tensoIR, n_pts, seed=0):
+    '''random points on the boundary of the occupied alphaMask voxels with directions in their outer hemisphere
+    - return:
+        - surface_pts: [n_pts, 3]
+        - surf2light: [n_pts, 3]
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    device = tensoIR.aabb.device
+    alpha = tensoIR.alphaMask.alpha_volume  # [1, 1, D, H, W], indexed (z, y, x)
+    boundary = (alpha > 0) & (-F.max_pool3d(-alpha, kernel_size=3, padding=1, stride=1) == 0)
+    boundary = torch.nonzero(boundary[0, 0]).flip(-1).float()  # [M, 3] as (x, y, z)
+    pick = torch.randint(0, boundary.shape[0], (n_pts,), generator=generator).to(device)
+    grid_size = torch.tensor(alpha.shape[-3:][::-1], device=device).float()
+    voxel = (boundary[pick] + torch.rand((n_pts, 3), generator=generator).to(device) - 0.5) / (grid_size - 1)
+    surface_pts = tensoIR.aabb[0] + voxel * (tensoIR.aabb[1] - tensoIR.aabb[0])
+
+    # outer normal from the gradient of the blurred occupancy
+    blurred = F.avg_pool3d(alpha, kernel_size=5, padding=2, stride=1)
+    eps = (tensoIR.aabb[1] - tensoIR.aabb[0]) / (grid_size - 1)
+    grads = []
+    for i in range(3):
+        offset = torch.zeros(3, device=device)
+        offset[i] = eps[i]
+        pos = F.grid_sample(blurred, tensoIR.alphaMask.normalize_coord(surface_pts + offset).view(1, -1, 1, 1, 3),
+                            align_corners=True).view(-1)
+        neg = F.grid_sample(blurred, tensoIR.alphaMask.normalize_coord(surface_pts - offset).view(1, -1, 1, 1, 3),
+                            align_corners=True).view(-1)
+        grads.append(pos - neg)
+    normal = -F.normalize(torch.stack(grads, dim=-1), dim=-1, eps=1e-6)
+
+    surf2light = F.normalize(torch.randn((n_pts, 3), generator=generator).to(device), dim=-1)
+    surf2light = torch.where(torch.sum(surf2light * normal, dim=-1, keepdim=True) < 0, -surf2light, surf2light)
+    return surface_pts, surf2light
+
+
+def tiny_tensoIR(device='cpu', grid_size=64, seed=0):
+    '''an untrained TensoIR built from config/model/TensoIR.yaml with the vanilla sampler and the
+    alphaMask of SyntheticField, so that every code path has both empty and occupied space'''
+    from omegaconf import OmegaConf
+    import models
+
+    torch.manual_seed(seed)
+    conf = OmegaConf.load('config/model/TensoIR.yaml').model
+    conf.sampler = 'vanilla'
+    conf.white_bg = True
+    conf.near_far = [2.0, 6.0]
+    field = SyntheticField(device, alpha_res=grid_size, seed=seed)
+    tensoIR = models.TensoIR(conf, device, field.aabb.cpu(), [grid_size] * 3).to(device)
+    tensoIR.alphaMask = field.alphaMask
+    return tensoIR
+
+
+def random_rays(n_rays, radius=4.0, seed=0, device='cpu'):
+    '''rays from a sphere of cameras towards jittered points around the origin, [n_rays, 6]'''
+    generator = torch.Generator().manual_seed(seed)
+    rays_o = F.normalize(torch.randn((n_rays, 3), generator=generator), dim=-1) * radius
+    target = (torch.rand((n_rays, 3), generator=generator) - 0.5) * 2.0
+    rays_d = F.normalize(target - rays_o, dim=-1)
+    return torch.cat([rays_o, rays_d], dim=-1).to(device)
+
+
+def tet_grid(res, device='cpu'):
+    '''Freudenthal tetrahedralization of a res^3 cube grid in [-0.5, 0.5]^3 (6 * res^3 tets), a
+    stand-in for data/tets/{res}_tets.npz
+    - return:
+        - verts: [(res + 1)^3, 3]
+        - tets: [6 * res^3, 4]
+    '''
+    n = res + 1
+    lin = torch.linspace(-0.5, 0.5, n)
+    verts = torch.stack(torch.meshgrid(lin, lin, lin, indexing='ij'), -1).view(-1, 3)
+
+    idx = torch.arange(n ** 3).view(n, n, n)[:-1, :-1, :-1].reshape(-1)
+    offset = {0: 0, 1: n * n, 2: n, 3: 1}  # step along x, y, z
+    tets = []
+    for a, b, c in [(1, 2, 3), (1, 3, 2), (2, 1, 3), (2, 3, 1), (3, 1, 2), (3, 2, 1)]:
+        v1 = idx + offset[a]
+        v2 = v1 + offset[b]
+        v3 = v2 + offset[c]
+        tets.append(torch.stack([idx, v1, v2, v3], dim=-1))
+    return verts.to(device), torch.cat(tets).to(device)
@@ -0,0 +1,138 @@
+import json
+import os
+import platform
+import resource
+import subprocess
+import time
+
+import numpy as np
+import torch
+
+import chunking
+
+
+def synchronize(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize()
+
+
+def rss_mb(peak=False):
+    '''current or peak (VmHWM, across the resets of the chunk planner) resident set size of the process in MB, Linux only'''
+    if peak:
+        hwm = chunking.host_peak()
+        if hwm is not None:
+            return hwm / 2 ** 20
+        # ru_maxrss is in KB on Linux and never reset
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def measure(fn, items, device='cpu', warmup=2, repeat=10):
+    '''time fn() and report throughput in items/s, latency percentiles and peak memory
+    - args:
+        - items: work done by one call (rays, points, tets...)
+    The peaks are taken above the memory in use before the timed calls, the counters of the process are
+    not reset (other code reads them too): exact when the calls raised the peak, an upper bound otherwise.
+    '''
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+
+    cuda = torch.device(device).type == 'cuda'
+    rss_before = rss_mb()
+    if cuda:
+        cuda_before = torch.cuda.memory_allocated(device)
+    latency = []
+    for _ in range(repeat):
+        tt = time.perf_counter()
+        fn()
+        synchronize(device)
+        latency.append(time.perf_counter() - tt)
+    latency = np.asarray(latency) * 1000
+
+    record = {
+        'items': items,
+        'throughput': items / (np.median(latency) / 1000),
+        'latency_ms': {
+            'mean': float(latency.mean()),
+            'p50': float(np.percentile(latency, 50)),
+            'p90': float(np.percentile(latency, 90)),
+            'p99': float(np.percentile(latency, 99)),
+        },
+        'peak_rss_mb': rss_mb(peak=True) - (rss_before or 0),
+        'repeat': repeat,
+    }
+    if cuda:
+        record['peak_cuda_mb'] = (torch.cuda.max_memory_allocated(device) - cuda_before) / 2**20
+    return record
+
+
+def environment(device):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = ''
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'host': platform.node(),
+        'cpu': platform.processor() or platform.machine(),
+        'torch': torch.__version__,
+        'device': str(device),
+        'threads': torch.get_num_threads(),
+    }
+
+
+def compare(results, baselines, threshold):
+    '''throughput regressions against the stored baselines, a case that failed or has no baseline is one too
+    - args:
+        - results, baselines: {name: record}
+        - threshold: allowed relative slowdown, a baseline entry can override it with its own 'threshold'
+    - return:
+        - list of {name, reason, ...}, with throughput, baseline and ratio for the slowdowns
+    '''
+    regressions = []
+    for name, record in results.items():
+        if 'error' in record:
+            regressions.append({'name': name, 'reason': 'error', 'error': record['error']})
+            continue
+        base = baselines.get(name)
+        if base is None or 'throughput' not in base:
+            regressions.append({'name': name, 'reason': 'no baseline'})
+            continue
+        ratio = record['throughput'] / base['throughput']
+        record['baseline_ratio'] = ratio
+        if ratio < 1 - base.get('threshold', threshold):
+            regressions.append({'name': name, 'reason': 'slower', 'throughput': record['throughput'],
+                                'baseline': base['throughput'], 'ratio': ratio})
+    return regressions
+
+
+def load_baselines(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f).get('results', {})
+
+
+def save_baselines(path, results, env):
+    '''keep only what compare() needs, the entries of the cases that did not run and the per-entry thresholds
+    of the previous baselines are preserved'''
+    previous = load_baselines(path)
+    stored = {name: base for name, base in previous.items() if name not in results}
+    for name, record in results.items():
+        if 'throughput' not in record:
+            continue
+        stored[name] = {'throughput': record['throughput'], 'latency_ms_p50': record['latency_ms']['p50']}
+        if 'threshold' in previous.get(name, {}):
+            stored[name]['threshold'] = previous[name]['threshold']
+    with open(path, 'w') as f:
+        json.dump({'environment': env, 'results': stored}, f, indent=2, sort_keys=True)
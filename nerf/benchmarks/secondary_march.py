@@ -0,0 +1,93 @@
+'''Samples per secondary ray and throughput of the radiance_marchers in relight_utils.
+
+usage (from nerf/):
+    python -m benchmarks.secondary_march                                   # synthetic scene
+    python -m benchmarks.secondary_march ckpt=log/xxx/model.pt n_pts=100000  # trained TensoIR
+'''
+import json
+import time
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from benchmarks.fixtures import SyntheticField, surface_rays
+from models.tensoIR.relight_utils import radiance_marchers
+
+
+def load_tensoIR(ckpt_path, device):
+    import models
+    from models.tensorBase import AlphaGridMask
+
+    ckpt = torch.load(ckpt_path, map_location=device)
+    conf = OmegaConf.load('config/model/TensoIR.yaml').model
+    conf.density.n_comp = ckpt['kwargs']['density_n_comp']
+    conf.app.n_comp = ckpt['kwargs']['app_n_comp']
+    conf.app.feature_dim = ckpt['kwargs']['app_dim']
+    conf.near_far = ckpt['kwargs']['near_far']
+    conf.step_ratio = ckpt['kwargs']['step_ratio']
+    conf.white_bg = True
+    tensoIR = models.TensoIR(conf, device, ckpt['kwargs']['aabb'], ckpt['kwargs']['grid_size']).to(device)
+    if 'alphaMask.aabb' in ckpt.keys():
+        length = np.prod(ckpt['alphaMask.shape'])
+        alpha_volume = torch.from_numpy(np.unpackbits(
+            ckpt['alphaMask.mask'])[:length].reshape(ckpt['alphaMask.shape']))
+        tensoIR.alphaMask = AlphaGridMask(device, ckpt['alphaMask.aabb'], alpha_volume.float().to(device))
+    tensoIR.load_state_dict(ckpt['state_dict'])
+    return tensoIR
+
+
+@torch.no_grad()
+def run(tensoIR, surface_pts, surf2light, nSample=96, vis_near=0.05, vis_far=1.5, chunk_size=20000):
+    light_idx = torch.zeros((surface_pts.shape[0], 1), dtype=torch.long, device=surface_pts.device)
+    results, outputs = {}, {}
+    for name, marcher in radiance_marchers.items():
+        stats = {}
+        kwargs = {'stats': stats} if name == 'skipping' else {}
+        vis, indirect = [], []
+        tt = time.time()
+        for chunk_idx in torch.split(torch.arange(surface_pts.shape[0]), chunk_size):
+            nerv_vis, _, indirect_light = marcher(tensoIR, surface_pts[chunk_idx], surf2light[chunk_idx],
+                                                  light_idx[chunk_idx], nSample=nSample, vis_near=vis_near,
+                                                  vis_far=vis_far, device=surface_pts.device, **kwargs)
+            vis.append(nerv_vis)
+            indirect.append(indirect_light)
+        if surface_pts.is_cuda:
+            torch.cuda.synchronize()
+        elapsed = time.time() - tt
+        outputs[name] = (torch.cat(vis), torch.cat(indirect))
+        results[name] = {'seconds': elapsed, 'rays_per_s': surface_pts.shape[0] / elapsed}
+        if name == 'skipping':
+            n_rays = stats['rays']
+            results['samples_per_ray'] = {
+                'linspace': nSample,
+                'in_aabb': stats['samples_dense'] / n_rays,
+                'in_occupied_cells': stats['samples_cells'] / n_rays,
+                'alpha_mask_lookups': stats['samples_masked'] / n_rays,
+                'skipping': stats['samples'] / n_rays,
+            }
+
+    ref_vis, ref_indirect = outputs['linspace']
+    vis, indirect = outputs['skipping']
+    results['max_abs_err'] = {'visibility': (vis - ref_vis).abs().max().item(),
+                              'indirect': (indirect - ref_indirect).abs().max().item()}
+    return results
+
+
+if __name__ == '__main__':
+    conf = OmegaConf.merge(OmegaConf.create({
+        'ckpt': '', 'n_pts': 20000, 'nSample': 96, 'vis_near': 0.05, 'vis_far': 1.5,
+        'chunk_size': 20000, 'device': 'cuda' if torch.cuda.is_available() else 'cpu', 'output': '',
+    }), OmegaConf.from_cli())
+    device = torch.device(conf.device)
+
+    tensoIR = load_tensoIR(conf.ckpt, device) if conf.ckpt else SyntheticField(device)
+    surface_pts, surf2light = surface_rays(tensoIR, conf.n_pts)
+    results = run(tensoIR, surface_pts, surf2light, conf.nSample, conf.vis_near, conf.vis_far, conf.chunk_size)
+    results['scene'] = conf.ckpt if conf.ckpt else 'synthetic'
+    results['n_pts'] = conf.n_pts
+
+    print(json.dumps(results, indent=2))
+    if conf.output:
+        with open(conf.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,291 @@
+'''Throughput, latency percentiles and peak RSS of the hot paths on synthetic fixtures.
+
+usage (from nerf/):
+    python -m benchmarks.suite                                  # everything, compared to benchmarks/baselines.json
+    python -m benchmarks.suite only=vm,dmtet output=bench.json  # names starting with vm or dmtet
+    python -m benchmarks.suite update_baseline=True             # store the current numbers as the baseline
+
+Exits with status 1 when a throughput drops below (1 - threshold) x baseline, when a case fails, or when a
+case has no baseline yet. update_baseline=True stores every case that ran, and still fails on the ones that
+did not.
+'''
+import json
+import os
+import sys
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from benchmarks.fixtures import SyntheticField, random_rays, tet_grid, tiny_tensoIR
+from benchmarks.harness import compare, environment, load_baselines, measure, save_baselines
+
+
+def bench_samplers(conf, device, case):
+    from models.sampler import Occgrid_sampler, Vanilla_Sampler
+
+    field = SyntheticField(device)
+    rays = random_rays(conf.n_rays, device=device)
+    rays_o, rays_d = rays[:, :3], rays[:, 3:]
+    step_size = (field.aabb[1] - field.aabb[0]).norm().item() / 256
+    sampler_conf = OmegaConf.create({'occ_grid_reso': 128})
+
+    vanilla = Vanilla_Sampler(sampler_conf, field.aabb)
+    case('sampler/vanilla', lambda: vanilla.sample(rays_o, rays_d, [2.0, 6.0], step_size, 256), conf.n_rays)
+    case('sampler/vanilla_alphamask',
+         lambda: vanilla.sample(rays_o, rays_d, [2.0, 6.0], step_size, 256, alphaMask=field.alphaMask), conf.n_rays)
+
+    def occgrid():
+        sampler = Occgrid_sampler(sampler_conf, field.aabb).to(device)
+        grid = sampler.occ_grid
+        # mark the occupied cells of the synthetic scene
+        res = sampler_conf.occ_grid_reso
+        lin = (torch.arange(res, device=device) + 0.5) / res
+        xyz = torch.stack(torch.meshgrid(lin, lin, lin, indexing='ij'), -1).view(-1, 3)
+        xyz = field.aabb[0] + xyz * (field.aabb[1] - field.aabb[0])
+        grid.binaries = (field.sdf(xyz) < 0.05).view(grid.binaries.shape)
+        return lambda: sampler.sample(rays_o, rays_d, None, None, [2.0, 6.0], step_size)
+    case('sampler/occgrid', occgrid, conf.n_rays, lazy=True)
+
+
+def bench_vm(conf, device, case):
+    from models.decompose_field import DensityVM
+
+    n_pts = conf.n_points
+    xyz = (torch.rand((n_pts, 3), generator=torch.Generator().manual_seed(0)) * 2 - 1).to(device)
+    for sampler in ['grid_sample', 'fused']:
+        torch.manual_seed(0)
+        module = DensityVM([16, 16, 16], [conf.grid_size] * 3, sampler=sampler).to(device)
+        with torch.no_grad():
+            case(f'vm/{sampler}', lambda: module.compute(xyz), n_pts)
+
+    module = DensityVM([16, 16, 16], [conf.grid_size] * 3).to(device)
+
+    def with_grad():
+        pts = xyz.clone().requires_grad_(True)
+        sigma = module.compute_with_grad(pts)
+        torch.autograd.grad(sigma.sum(), pts)
+    case('vm/with_grad', with_grad, n_pts)
+
+
+def bench_alpha(conf, device, case):
+    tensoIR = tiny_tensoIR(device, conf.grid_size)
+    tensoIR.alphaMask = None
+    grid_size = [conf.grid_size] * 3
+    with torch.no_grad():
+        case('tensorbase/getDenseAlpha', lambda: tensoIR.getDenseAlpha(grid_size), int(np.prod(grid_size)))
+        case('tensorbase/getBrickedAlphaMask', lambda: tensoIR.getBrickedAlphaMask(grid_size, 32),
+             int(np.prod(grid_size)))
+
+
+def bench_relight(conf, device, case):
+    from models.tensoIR.relight_utils import render_with_BRDF
+    from benchmarks.fixtures import surface_rays
+
+    tensoIR = tiny_tensoIR(device, conf.grid_size)
+    args = tensoIR.config
+    n = conf.n_shading_pts
+    # the outward directions of surface_rays stand in for the normals
+    surface_pts, normal = surface_rays(tensoIR, n)
+    rays_o = surface_pts + normal * 2.0
+    rays = torch.cat([rays_o, -normal], dim=-1)
+    depth = torch.full((n,), 2.0, device=device)
+    albedo = torch.full((n, 3), 0.5, device=device)
+    roughness = torch.full((n, 3), 0.5, device=device)
+    fresnel = torch.full((n, 3), 0.04, device=device)
+
+    sampler = tensoIR.get_envmap_sampler(device)
+    n_draws = 32768
+    case('relight/envmap/multinomial', lambda: torch.multinomial(sampler.pmf, n_draws, replacement=True), n_draws)
+    case('relight/envmap/alias', lambda: sampler.draw(n_draws), n_draws)
+
+    # secondary rays of the envmap pixels, exact and answered by a warm SecondaryShadingCache
+    from models.tensoIR.relight_utils import compute_secondary_shading_effects
+    from models.tensoIR.secondary_cache import SecondaryShadingCache
+    cache = SecondaryShadingCache(res=32, envmap_h=16, envmap_w=32, refresh_every=0, check_ratio=0., device=device)
+    n_secondary = conf.n_filter_rays // 16
+    secondary_pts, _ = surface_rays(tensoIR, n_secondary, seed=1)
+    secondary_dirs = cache.bin_dirs[torch.randint(0, cache.n_dirs, (n_secondary,),
+                                                  generator=torch.Generator().manual_seed(1)).to(device)]
+    secondary_light_idx = torch.zeros((n_secondary, 1), dtype=torch.long, device=device)
+    march_kwargs = dict(nSample=args.second_nSample, vis_near=args.second_near, vis_far=args.second_far,
+                        chunk_size=args.relight_chunk_size, device=device)
+    with torch.no_grad():
+        case('relight/secondary/march', lambda: compute_secondary_shading_effects(
+            tensoIR, secondary_pts, secondary_dirs, secondary_light_idx, **march_kwargs), n_secondary)
+
+        def warm_cache():
+            for _ in range(2):
+                cache.query(tensoIR, secondary_pts, secondary_dirs, secondary_light_idx, **march_kwargs)
+            return lambda: cache.query(tensoIR, secondary_pts, secondary_dirs, secondary_light_idx, **march_kwargs)
+        case('relight/secondary/cached', warm_cache, n_secondary, lazy=True)
+
+    for method in ['fixed_envirmap', 'stratified_sampling', 'stratifed_sample_equal_areas', 'importance_sample',
+                   'adaptive']:
+        with torch.no_grad():
+            case(f'relight/render_with_BRDF/{method}',
+                 lambda: render_with_BRDF(depth, normal, albedo, roughness, fresnel, rays, tensoIR,
+                                          sample_method=method, chunk_size=args.relight_chunk_size,
+                                          device=device, args=args),
+                 n)
+
+
+def bench_dmtet(conf, device, case):
+    from geometry import dmtet
+
+    marching_tets = dmtet.DMTet()
+    for res in conf.dmtet_res:
+        path = f'data/tets/{res}_tets.npz'
+        if os.path.exists(path):
+            tets = np.load(path)
+            verts = torch.tensor(tets['vertices'], dtype=torch.float32, device=dmtet.device)
+            indices = torch.tensor(tets['indices'], dtype=torch.long, device=dmtet.device)
+        else:
+            verts, indices = tet_grid(res, dmtet.device)
+        sdf = 0.3 - verts.norm(dim=-1) + 0.02 * torch.sin(20 * verts[:, 0])
+        case(f'dmtet/{res}', lambda: marching_tets(verts, sdf, indices), indices.shape[0])
+
+        # alternate between two nearby sdfs, as between two optimizer steps
+        incremental = dmtet.DMTet(incremental=True)
+        sdfs = [sdf, sdf + 0.002]
+        incremental(verts, sdf, indices)
+
+        def step():
+            sdfs.reverse()
+            return incremental(verts, sdfs[0], indices)
+        case(f'dmtet/{res}/incremental', step, indices.shape[0])
+
+
+def bench_marching_cubes(conf, device, case):
+    from geometry.marching_cubes import extract_isosurface, marching_cubes
+
+    field = SyntheticField(device)
+    level_fn = lambda x: -field.sdf(x)
+    for res in conf.mc_res:
+        lin = torch.linspace(-1, 1, res, device=device)
+        xyz = torch.stack(torch.meshgrid(lin, lin, lin, indexing='ij'), -1).view(-1, 3)
+        level = level_fn(xyz).view(res, res, res)
+        case(f'marching_cubes/{res}/dense', lambda: marching_cubes(level), res ** 3)
+        case(f'marching_cubes/{res}/sparse',
+             lambda: extract_isosurface(level_fn, (-1, -1, -1), (1, 1, 1), res, device=device), res ** 3)
+
+
+def bench_raster(conf, device, case):
+    from render import raster
+
+    res = conf.raster_res
+    lat, lon = torch.meshgrid(torch.linspace(0, np.pi, 33, device=device)[1:-1],
+                              torch.linspace(0, 2 * np.pi, 65, device=device)[:-1], indexing='ij')
+    ring = torch.stack([lat.sin() * lon.cos(), lat.cos(), lat.sin() * lon.sin()], -1).view(-1, 3)
+    verts = torch.cat([ring, torch.tensor([[0., 1., 0.], [0., -1., 0.]], device=device)])
+    n_lat, n_lon = lat.shape
+    i = torch.arange(n_lat - 1, device=device)[:, None] * n_lon
+    j = torch.arange(n_lon, device=device)[None]
+    a, b, c, d = i + j, i + (j + 1) % n_lon, i + n_lon + j, i + n_lon + (j + 1) % n_lon
+    faces = torch.cat([torch.stack([a, c, b], -1).view(-1, 3), torch.stack([b, c, d], -1).view(-1, 3),
+                       torch.stack([torch.full_like(j[0], len(ring)), j[0], (j[0] + 1) % n_lon], -1),
+                       torch.stack([torch.full_like(j[0], len(ring) + 1), (j[0] + 1) % n_lon + (n_lat - 1) * n_lon,
+                                    j[0] + (n_lat - 1) * n_lon], -1)]).int()
+    # a perspective view from z = 3
+    pos = torch.cat([verts * 0.5, torch.ones_like(verts[:, :1])], -1)
+    pos[:, 2] -= 3.0
+    pos = torch.stack([pos[:, 0] * 2, pos[:, 1] * 2, -pos[:, 2] * 1.02 - 0.2, -pos[:, 2]], -1)[None].contiguous()
+    tex = torch.rand((1, 256, 256, 3), generator=torch.Generator().manual_seed(0)).to(device)
+    attr = verts[None] * 0.5 + 0.5
+
+    # the same calls on both backends, the cuda one only where nvdiffrast can run
+    backends = ['torch'] + (['cuda'] if device.type == 'cuda' and raster.dr is not None else [])
+    for backend in backends:
+        raster.set_backend(backend)
+        ctx = raster.make_context(device, backend)
+        rast, rast_db = raster.rasterize(ctx, pos, faces, [res, res])
+        uv, uv_da = raster.interpolate(attr[..., :2], rast, faces, rast_db=rast_db, diff_attrs='all')
+        color = raster.interpolate(attr, rast, faces)[0]
+        with torch.no_grad():
+            case(f'raster/{backend}/rasterize', lambda: raster.rasterize(ctx, pos, faces, [res, res]), res * res)
+            case(f'raster/{backend}/interpolate',
+                 lambda: raster.interpolate(attr[..., :2], rast, faces, rast_db=rast_db, diff_attrs='all'), res * res)
+            case(f'raster/{backend}/texture',
+                 lambda: raster.texture(tex, uv, uv_da, filter_mode='linear-mipmap-linear'), res * res)
+            case(f'raster/{backend}/antialias', lambda: raster.antialias(color, rast, pos, faces), res * res)
+    raster.set_backend('auto')
+
+
+def bench_filtering(conf, device, case):
+    from utils import filtering_rays
+
+    tensoIR = tiny_tensoIR(device, conf.grid_size)
+    rays = random_rays(conf.n_filter_rays)
+    rgbs = torch.zeros((rays.shape[0], 3))
+    case('filtering_rays/bbox', lambda: filtering_rays(tensoIR, rays, rgbs, device, bbox_only=True), rays.shape[0])
+    case('filtering_rays/alpha', lambda: filtering_rays(tensoIR, rays, rgbs, device, bbox_only=False), rays.shape[0])
+
+
+benchmarks = {
+    'sampler': bench_samplers,
+    'vm': bench_vm,
+    'tensorbase': bench_alpha,
+    'relight': bench_relight,
+    'dmtet': bench_dmtet,
+    'marching_cubes': bench_marching_cubes,
+    'raster': bench_raster,
+    'filtering_rays': bench_filtering,
+}
+
+
+def run(conf):
+    device = torch.device(conf.device)
+    only = [s for s in str(conf.only).split(',') if s]
+    results = {}
+
+    def case(name, fn, items, lazy=False):
+        '''lazy: fn builds the callable to time, so that setup failures are recorded too'''
+        if only and not any(name.startswith(s) for s in only):
+            return
+        try:
+            record = measure(fn() if lazy else fn, items, device, conf.warmup, conf.repeat)
+        except Exception as e:
+            record = {'error': f'{type(e).__name__}: {e}'}
+        results[name] = record
+        if 'error' in record:
+            print(f'{name:45s} failed: {record["error"]}')
+        else:
+            print(f'{name:45s} {record["throughput"]:14.1f} items/s  p50 {record["latency_ms"]["p50"]:9.2f} ms  '
+                  f'p99 {record["latency_ms"]["p99"]:9.2f} ms  rss {record["peak_rss_mb"]:8.1f} MB')
+
+    for group, bench in benchmarks.items():
+        if only and not any(s.startswith(group) or group.startswith(s) for s in only):
+            continue
+        bench(conf, device, case)
+    return results
+
+
+if __name__ == '__main__':
+    conf = OmegaConf.merge(OmegaConf.create({
+        'only': '', 'device': 'cpu', 'threads': 0, 'warmup': 1, 'repeat': 5,
+        'n_rays': 4096, 'n_points': 262144, 'grid_size': 64, 'n_shading_pts': 64,
+        'n_filter_rays': 262144, 'dmtet_res': [32, 64, 96], 'mc_res': [64, 128],
+        'raster_res': 512,
+        'output': '', 'baseline': 'benchmarks/baselines.json', 'threshold': 0.3, 'update_baseline': False,
+    }), OmegaConf.from_cli())
+    if conf.threads > 0:
+        torch.set_num_threads(conf.threads)
+    torch.manual_seed(0)
+
+    env = environment(conf.device)
+    results = run(conf)
+    regressions = compare(results, load_baselines(conf.baseline), conf.threshold)
+    report = {'environment': env, 'config': OmegaConf.to_container(conf), 'results': results,
+              'regressions': regressions}
+
+    print(json.dumps(report, indent=2))
+    if conf.output:
+        with open(conf.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if conf.update_baseline:
+        save_baselines(conf.baseline, results, env)
+        print(f'baselines written to {conf.baseline}')
+        regressions = [r for r in regressions if r['reason'] == 'error']
+    if regressions:
+        print('performance regressions: ' + ', '.join(f'{r["name"]} ({r["reason"]})' for r in regressions))
+        sys.exit(1)
@@ -0,0 +1,261 @@
+import json
+import os
+import threading
+import time
+
+import torch
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def available_memory(device):
+    '''bytes that can still be allocated on device, None when unknown
+    cuda: free device memory plus the blocks held by the caching allocator, cpu: MemAvailable of /proc/meminfo
+    '''
+    if device.type == 'cuda':
+        free, _ = torch.cuda.mem_get_info(device)
+        return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _host_rss(peak):
+    '''current or peak resident set size of the process in bytes (Linux only, None elsewhere)'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:' if peak else 'VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+# VmHWM before the last reset by a measured chunk, the peak of the process is the larger of the two
+_host_peak_floor = 0
+
+
+def _reset_host_peak():
+    '''reset VmHWM to the current RSS (Linux only), whether it could be'''
+    global _host_peak_floor
+    _host_peak_floor = max(_host_peak_floor, _host_rss(peak=True) or 0)
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def host_rss():
+    '''current resident set size of the process in bytes, None when unknown'''
+    return _host_rss(peak=False)
+
+
+def host_peak():
+    '''peak resident set size of the process in bytes across the resets of the measured chunks, None when unknown'''
+    hwm = _host_rss(peak=True)
+    return None if hwm is None else max(hwm, _host_peak_floor)
+
+
+def _restore_cuda_peak(device, peak):
+    '''raise max_memory_allocated back to peak after a reset_peak_memory_stats, by allocating the
+    difference once; other gauges take their peaks from the same counter'''
+    missing = peak - torch.cuda.memory_allocated(device)
+    if missing > 0 and torch.cuda.max_memory_allocated(device) < peak:
+        try:
+            torch.empty(missing, dtype=torch.uint8, device=device)
+        except RuntimeError:
+            pass
+
+
+class ChunkPlanner():
+    '''Chunk sizes of the chunked loops, planned per function and device.
+
+    split() yields the slices of a loop over n items. A function starts from the default of its
+    call site; while autotune is on, the peak memory and the time of its full chunks give the
+    bytes per item and the throughput, and the chunk doubles as long as it fits in
+    memory_fraction of the available memory, stays below max_scale x default and speeds up by
+    more than min_gain. The settled sizes are written to cache_path, so later runs start from
+    them, and are still capped by the free memory of the moment.
+    fixed ({name: size}, None entries are planned) pins the size of a function; with autotune
+    off every call site uses its default, which keeps the chunking (and the random numbers
+    drawn per chunk) reproducible.
+    The bytes of a chunk are its own peak minus the memory allocated before it, so an earlier large
+    allocation of the process does not count. On cuda the peak counter is reset for the chunk and
+    raised back to the previous peak afterwards, since other gauges read it too. On the host VmHWM
+    is reset through /proc/self/clear_refs and cannot be set back: host_peak() keeps the peak across
+    the resets for the other gauges. Where VmHWM cannot be reset a chunk only gives a measurement
+    when it raised VmHWM, otherwise only its time is kept; without a measurement the chunk still
+    grows, once one is known the settled size is the largest one that fits. Only the loop itself is measured, a backward through the chunks
+    is not, so autotune is meant for the no_grad loops (rendering, extraction, evaluation).
+    '''
+    def __init__(self, autotune=False, cache_path='', fixed=None, memory_fraction=0.5, max_scale=16,
+                 min_gain=0.05, samples=2):
+        self.autotune = autotune
+        self.cache_path = os.path.expanduser(cache_path) if cache_path else ''
+        self.fixed = {k: v for k, v in dict(fixed or {}).items() if v is not None}
+        self.memory_fraction = memory_fraction
+        self.max_scale = max_scale
+        self.min_gain = min_gain
+        self.samples = samples
+        self.lock = threading.Lock()
+        # only the outermost loop measures, the peak memory of a nested loop is part of it
+        self.measuring = threading.local()
+        self.plans = {}
+        if self.cache_path and os.path.exists(self.cache_path):
+            try:
+                with open(self.cache_path) as f:
+                    self.plans = json.load(f)
+            except (OSError, ValueError):
+                print(f'ChunkPlanner: ignoring unreadable {self.cache_path}')
+
+    def key(self, name, device):
+        if device.type == 'cuda':
+            return f'{name}@{torch.cuda.get_device_name(device)}'
+        return f'{name}@cpu'
+
+    def chunk(self, name, default, device):
+        '''the chunk size to use now for name'''
+        if name in self.fixed:
+            return int(self.fixed[name])
+        if not self.autotune:
+            return default
+        plan = self.plans.get(self.key(name, device))
+        if plan is None:
+            return default
+        chunk = plan['chunk']
+        if plan.get('bytes_per_item', 0) > 0:
+            free = available_memory(device)
+            if free is not None:
+                chunk = min(chunk, int(free * self.memory_fraction / plan['bytes_per_item']))
+        return max(chunk, 1)
+
+    def split(self, name, n, default, device='cuda'):
+        '''yield slice(start, end) covering range(n) in chunks planned for name'''
+        device = torch.device(device)
+        chunk = self.chunk(name, default, device)
+        start = 0
+        while start < n:
+            end = min(start + chunk, n)
+            plan = self.plans.get(self.key(name, device), {})
+            if not self.should_measure(name, end - start, chunk, plan):
+                yield slice(start, end)
+            else:
+                self.measuring.active = True
+                try:
+                    before = self.begin(device)
+                    tt = time.perf_counter()
+                    yield slice(start, end)
+                    synchronize(device)
+                    seconds = time.perf_counter() - tt
+                    nbytes = self.end(device, before)
+                finally:
+                    self.measuring.active = False
+                self.record(name, device, default, chunk, nbytes, seconds)
+                chunk = self.chunk(name, default, device)
+            start = end
+
+    def should_measure(self, name, size, chunk, plan):
+        return self.autotune and name not in self.fixed and size == chunk and not plan.get('settled', False) \
+            and not getattr(self.measuring, 'active', False)
+
+    def begin(self, device):
+        '''(allocated, peak) before a measured chunk, peak is None once the counter was reset for the chunk'''
+        synchronize(device)
+        if device.type == 'cuda':
+            before = torch.cuda.memory_allocated(device), torch.cuda.max_memory_allocated(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            return before
+        allocated = _host_rss(peak=False)
+        if _reset_host_peak():
+            return allocated, None
+        return allocated, _host_rss(peak=True)
+
+    def end(self, device, before):
+        '''bytes allocated by the chunk at its peak, None when it cannot be told'''
+        allocated, peak = before
+        if device.type == 'cuda':
+            nbytes = torch.cuda.max_memory_allocated(device) - allocated
+            _restore_cuda_peak(device, peak)
+            return nbytes
+        hwm = _host_rss(peak=True)
+        if allocated is None or hwm is None or (peak is not None and hwm <= peak):
+            # below an earlier peak of the process, the bytes of the chunk are unknown
+            return None
+        return hwm - allocated
+
+    def fits(self, plan, chunk, free):
+        return plan['bytes_per_item'] == 0 or free is None or \
+            chunk * plan['bytes_per_item'] <= free * self.memory_fraction
+
+    def record(self, name, device, default, chunk, nbytes, seconds):
+        '''add a measurement of a full chunk and move the plan of name to its next size'''
+        key = self.key(name, device)
+        with self.lock:
+            plan = self.plans.setdefault(key, {'chunk': chunk, 'settled': False, 'bytes_per_item': 0.,
+                                               'throughput': {}, 'samples': {}})
+            if nbytes is not None and nbytes > 0:
+                # the largest estimate, the allocator keeps memory freed by previous chunks
+                plan['bytes_per_item'] = max(plan['bytes_per_item'], nbytes / chunk)
+            size = str(chunk)
+            plan['throughput'][size] = max(plan['throughput'].get(size, 0.), chunk / max(seconds, 1e-9))
+            plan['samples'][size] = plan['samples'].get(size, 0) + 1
+            if plan['samples'][size] < self.samples:
+                return
+
+            # the best of a few samples, the first chunk of a function pays for the warmup
+            smaller = plan['throughput'].get(str(chunk // 2))
+            larger = chunk * 2
+            free = available_memory(device)
+            if smaller is not None and plan['throughput'][size] < smaller * (1 + self.min_gain):
+                plan['chunk'], plan['settled'] = chunk // 2, True
+            elif larger <= default * self.max_scale and self.fits(plan, larger, free):
+                plan['chunk'] = larger
+            else:
+                plan['chunk'], plan['settled'] = chunk, True
+            if plan['settled']:
+                # a size grown without a measurement may turn out too large once one comes in
+                while plan['chunk'] > default and not self.fits(plan, plan['chunk'], free):
+                    plan['chunk'] //= 2
+                print(f'ChunkPlanner: {key} settled at {plan["chunk"]} (default {default})')
+                self.save()
+
+    def save(self):
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or '.', exist_ok=True)
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.plans, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.cache_path)
+
+
+# call site defaults until configure() is called
+planner = ChunkPlanner()
+
+
+def configure(conf):
+    '''replace the planner with the chunk_* options of conf'''
+    global planner
+    planner = ChunkPlanner(
+        autotune=getattr(conf, 'chunk_autotune', False),
+        cache_path=getattr(conf, 'chunk_cache', ''),
+        fixed=getattr(conf, 'chunk_fixed', None),
+        memory_fraction=getattr(conf, 'chunk_memory_fraction', 0.5),
+    )
+    return planner
+
+
+def split(name, n, default, device='cuda'):
+    '''slices of range(n) in the chunks planned for name, default is the size the call site was written for'''
+    return planner.split(name, n, default, device)
@@ -0,0 +1,142 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import default_collate
+
+from render import util
+
+
+class CropScheduler():
+    '''Crops of the stage-2 training images, growing in size and spp over the run.
+
+    stages is a list of [end, size, spp]: until end x iterations the crops are size x size image
+    pixels wide (null: image / downsample, the fixed crop of the plain loop) and keep the aspect of
+    the image, rendered at spp. The widths are rounded to multiples of bucket, so the renders of a
+    stage allocate the same blocks and the caching allocator only needs emptying when the stage
+    changes.
+    A share importance of the crops is centred on a cell drawn by edge_weight x the silhouette
+    edges of the image (alpha gradient) + error_weight x the validation error of the cell; the
+    rest is uniform. The validation renders are other cameras: observe() projects the surface
+    points they hit into every training view, without an occlusion test, so a point also counts
+    for whatever hides it there. refresh() folds the errors of a validation into the maps, the
+    older ones weighted by error_decay.
+    '''
+    def __init__(self, dataset, conf, iterations, anti_aliasing=False, seed=0):
+        self.dataset = dataset
+        self.iterations = iterations
+        self.default_size = dataset.w // dataset.downsample
+        self.bucket = getattr(conf, 'bucket', 32)
+        self.stages = [(float(end), self.bucket_size(size, anti_aliasing), int(spp))
+                       for end, size, spp in getattr(conf, 'stages', [[1.0, None, 1]])]
+        self.importance = getattr(conf, 'importance', 0.5)
+        self.edge_weight = getattr(conf, 'edge_weight', 1.0)
+        self.error_weight = getattr(conf, 'error_weight', 1.0)
+        self.error_decay = getattr(conf, 'error_decay', 0.5)
+        self.cell = getattr(conf, 'cell', 16)
+        self.rng = np.random.default_rng(seed)
+        self.stage = None
+
+        H, W = dataset.h, dataset.w
+        self.map_res = (H // self.cell, W // self.cell)
+        alpha = torch.stack([img[..., 3] for img in dataset.all_images])[:, None]    # [N, 1, H, W]
+        edges = (alpha[..., 1:, :-1] - alpha[..., :-1, :-1]).abs() + (alpha[..., :-1, 1:] - alpha[..., :-1, :-1]).abs()
+        edges = F.adaptive_max_pool2d(edges, self.map_res)[:, 0]
+        self.edges = edges / edges.flatten(1).max(-1)[0].clamp(min=1e-6)[:, None, None]
+        self.errors = torch.zeros_like(self.edges)
+        self.error_sum = torch.zeros_like(self.edges)
+        self.error_count = torch.zeros_like(self.edges)
+        self.max_points = getattr(conf, 'max_points', 4096)
+        proj = util.perspective(dataset.camera_angle_y, dataset.aspect, 0.1, 1000)
+        self.mvps = torch.stack([proj @ torch.as_tensor(mv, dtype=torch.float32) for mv in dataset.all_mvs])
+
+    def bucket_size(self, size, anti_aliasing):
+        if size is None or anti_aliasing:
+            # prepare_batch derives the resolution of the anti-aliased path from downsample
+            return self.default_size
+        size = max(int(round(size / self.bucket)) * self.bucket, self.bucket)
+        return min(size, self.dataset.w - self.dataset.w % 2)
+
+    def crop_shape(self, size):
+        '''(rows, cols) of a crop size pixels wide, as get_crop cuts it'''
+        return size * self.dataset.h // self.dataset.w // 2 * 2, size
+
+    def current(self, iteration):
+        '''(size, spp) of the stage iteration falls in'''
+        progress = iteration / max(self.iterations, 1)
+        for end, size, spp in self.stages:
+            if progress < end:
+                return size, spp
+        return self.stages[-1][1:]
+
+    def step(self, iteration):
+        '''whether iteration starts a stage, the caller can then return the cached blocks of the previous one'''
+        stage = self.current(iteration)
+        changed = self.stage is not None and stage != self.stage
+        self.stage = stage
+        return changed
+
+    def score(self, idx):
+        errors = self.errors[idx] / self.errors.max().clamp(min=1e-6)
+        return self.edge_weight * self.edges[idx] + self.error_weight * errors
+
+    def center(self, idx, size):
+        '''(row, col) of a crop centre, the crop stays inside the image'''
+        H, W = self.dataset.h, self.dataset.w
+        half = np.array(self.crop_shape(size)) // 2
+        lo, hi = half, np.array([H, W]) - half
+        score = self.score(idx)
+        if self.rng.random() < self.importance and score.sum() > 0:
+            p = (score.flatten() / score.sum()).double().numpy()
+            cell = self.rng.choice(p.size, p=p / p.sum())
+            c = (np.array(divmod(cell, self.map_res[1])) + self.rng.random(2)) * self.cell
+        else:
+            c = self.rng.random(2) * np.array([H, W])
+        return np.clip(c.astype(np.int64), lo, hi)
+
+    def draw(self, iteration):
+        '''a cropped training batch: {img, mv, mvp, campos, spp, view}'''
+        size, spp = self.current(iteration)
+        idx = int(self.rng.integers(len(self.dataset.all_images)))
+        cx, cy = self.center(idx, size)
+        data = self.dataset.get_crop(default_collate([self.dataset[idx]]), int(cx), int(cy), size=size)
+        data['spp'] = spp
+        data['view'] = idx
+        return data
+
+    @torch.no_grad()
+    def observe(self, pos, shaded, ref):
+        '''add the error of a validation render to the cells of the training views its surface points fall in.
+        pos: [1, h, w, 3] world positions, shaded: [h, w, 4] render with its coverage, ref: [h, w, 3]'''
+        covered = shaded[..., 3] > 0
+        points = pos[0][covered].float()
+        err = (shaded[..., :3] - ref[..., :3]).abs().mean(-1)[covered].float()
+        if points.shape[0] > self.max_points:
+            keep = torch.from_numpy(self.rng.choice(points.shape[0], self.max_points, replace=False)).to(points.device)
+            points, err = points[keep], err[keep]
+        points, err = points.cpu(), err.cpu()
+        if points.shape[0] == 0:
+            return
+
+        clip = torch.einsum('vij,nj->vni', self.mvps, torch.cat([points, torch.ones_like(points[:, :1])], -1))
+        ndc = clip[..., :2] / clip[..., 3:4].clamp(min=1e-6)
+        # row r of an image is at ndc y = 2 r / H - 1, as in get_crop
+        rows = ((ndc[..., 1] + 1) / 2 * self.map_res[0]).floor().long()
+        cols = ((ndc[..., 0] + 1) / 2 * self.map_res[1]).floor().long()
+        seen = (clip[..., 3] > 0) & (rows >= 0) & (rows < self.map_res[0]) & (cols >= 0) & (cols < self.map_res[1])
+        view = torch.arange(self.mvps.shape[0])[:, None].expand_as(rows)
+        cell = (view * self.map_res[0] + rows) * self.map_res[1] + cols
+        self.error_sum.view(-1).index_add_(0, cell[seen], err[None].expand_as(rows)[seen])
+        self.error_count.view(-1).index_add_(0, cell[seen], torch.ones_like(err)[None].expand_as(rows)[seen])
+
+    def refresh(self):
+        '''called after a validation: the mean error of every cell it saw, the older errors weighted by error_decay'''
+        seen = self.error_count > 0
+        mean = self.error_sum / self.error_count.clamp(min=1)
+        self.errors = torch.where(seen, self.error_decay * self.errors + (1 - self.error_decay) * mean,
+                                  self.errors * self.error_decay)
+        self.error_sum.zero_()
+        self.error_count.zero_()
+
+    def stats(self):
+        size, spp = self.stage or self.current(0)
+        return {'crop_size': float(size), 'crop_spp': float(spp)}
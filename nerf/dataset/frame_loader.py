@@ -0,0 +1,115 @@
+import hashlib
+import io
+import numpy as np
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from tqdm import tqdm
+
+# bump when the cached layout or the decode pipeline changes
+CACHE_VERSION = 2
+# entries are keyed by the file hash, so one directory serves every dataset; outside the data
+# directory, which may be a read-only mount
+DEFAULT_CACHE_DIR = '~/.cache/nerf/frames'
+
+
+def decode_frame(data, img_wh=None):
+    '''decode an encoded image into a uint8 (h, w, 4) RGBA array, resized to img_wh if given'''
+    img = Image.open(io.BytesIO(data))
+    if img_wh is not None and img.size != tuple(img_wh):
+        img = img.resize(tuple(img_wh), Image.LANCZOS)
+    return np.asarray(img.convert('RGBA'))
+
+
+def frame_key(data, img_wh, white_bg):
+    h = hashlib.sha1(data)
+    h.update(f'v{CACHE_VERSION}-{img_wh}-{int(white_bg)}'.encode())
+    return h.hexdigest()
+
+
+def composite(rgba, white_bg):
+    '''rgb of a float (h, w, 4) rgba blended over the background'''
+    alpha = rgba[..., -1:]
+    if white_bg:
+        return rgba[..., :3] * alpha + (1 - alpha)  # blend A to RGB
+    return rgba[..., :3] * alpha
+
+
+def load_frame(args):
+    '''returns (rgba, rgb, bytes_read, cache_hit) with float16 (h, w, 4) / (h, w, 3) arrays'''
+    image_path, img_wh, white_bg, cache_dir = args
+    with open(image_path, 'rb') as f:
+        data = f.read()
+    bytes_read = len(data)
+
+    cache_path = None
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, frame_key(data, img_wh, white_bg) + '.npy')
+        if os.path.exists(cache_path):
+            bytes_read += os.path.getsize(cache_path)
+            rgba = np.load(cache_path)
+            # only rgba is cached, the blend is cheap next to the decode
+            rgb = composite(rgba.astype(np.float32), white_bg).astype(np.float16)
+            return rgba, rgb, bytes_read, True
+
+    rgba = (decode_frame(data, img_wh).astype(np.float32) / 255.0).astype(np.float16)
+    # blended from the rounded rgba, like a cache hit
+    rgb = composite(rgba.astype(np.float32), white_bg).astype(np.float16)
+
+    if cache_path is not None:
+        # write to a temporary file first so that concurrent runs never see partial entries
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, rgba)
+            os.replace(tmp_path, cache_path)
+        except OSError:
+            pass
+    return rgba, rgb, bytes_read, False
+
+
+def load_frames(image_paths, img_wh=None, white_bg=True, cache_dir=None, num_workers=8, desc='Loading frames'):
+    '''decode, resize and alpha-composite frames in a process pool
+
+    Decoded frames are stored in cache_dir (None: DEFAULT_CACHE_DIR, '': no cache) under a key made
+    of the file hash, the target resolution and white_bg, so later runs (and stage 2 restarts) skip
+    decoding. The cache is skipped when cache_dir cannot be created.
+
+    - return:
+        - rgbas: list of float16 (h, w, 4), straight (not blended) RGBA in [0, 1]
+        - rgbs: list of float16 (h, w, 3), RGB blended over the background
+        - stats: dict with load-time instrumentation
+    '''
+    if cache_dir is None:
+        cache_dir = DEFAULT_CACHE_DIR
+    if cache_dir:
+        cache_dir = os.path.expanduser(cache_dir)
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+        except OSError:
+            print(f'{desc}: cannot create the frame cache {cache_dir}, decoding without it')
+            cache_dir = ''
+    jobs = [(path, img_wh, white_bg, cache_dir) for path in image_paths]
+
+    tt = time.time()
+    if num_workers > 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_workers, len(jobs))) as pool:
+            results = list(tqdm(pool.map(load_frame, jobs), total=len(jobs), desc=desc))
+    else:
+        results = [load_frame(job) for job in tqdm(jobs, desc=desc)]
+    elapsed = max(time.time() - tt, 1e-6)
+
+    rgbas = [r[0] for r in results]
+    rgbs = [r[1] for r in results]
+    stats = {
+        'frames': len(results),
+        'seconds': elapsed,
+        'frames_per_s': len(results) / elapsed,
+        'bytes_read': sum(r[2] for r in results),
+        'cache_hits': sum(int(r[3]) for r in results),
+    }
+    print(f"{desc}: {stats['frames']} frames in {elapsed:.2f}s "
+          f"({stats['frames_per_s']:.1f} frames/s, {stats['bytes_read'] / 2**20:.1f} MB read, "
+          f"{stats['cache_hits']} cache hits)")
+    return rgbas, rgbs, stats
@@ -0,0 +1,262 @@
+import json
+import numpy as np
+import os
+import torch
+from torch.utils.data import Dataset, Sampler
+from tqdm import tqdm
+
+from dataset.frame_loader import decode_frame
+from dataset.utils import get_ray_directions_at, get_rays_batched
+
+
+blender2opencv = np.array([[1, 0, 0, 0],
+                           [0, -1, 0, 0],
+                           [0, 0, -1, 0],
+                           [0, 0, 0, 1]])
+
+# scene constants, kept in sync with the in-memory dataset classes
+scene_conf = {
+    'realdata': {
+        'scene_bbox': [[-1.2, -1.2, -1.2], [1.2, 1.2, 1.2]],
+        'near_far': [0.2, 4.0],
+    },
+    'nerf_synthetic': {
+        'scene_bbox': [[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]],
+        'near_far': [2.0, 6.0],
+    },
+    'tensoir_synthetic': {
+        'scene_bbox': [[-1.5, -1.5, -1.5], [1.5, 1.5, 1.5]],
+        'near_far': [2.0, 6.0],
+    },
+}
+
+
+def read_frames_realdata(meta, datadir, downsample):
+    '''yield (image_path, c2w, focal, img_wh) the same way as RealDataset.read_meta'''
+    img_wh = (int(4000 / downsample), int(6000 / downsample))
+    for key in meta['frames']:
+        frame = meta['frames'][key]
+        focal = 0.5 * img_wh[0] / np.tan(0.5 * frame['camera_angle_x'])
+        c2w = np.array(frame['transform_matrix'], dtype=np.float32)
+        image_path = os.path.join(datadir, f"{frame['file_path']}.png")
+        yield image_path, c2w, focal, img_wh
+
+
+def read_frames_synthetic(meta, datadir, downsample):
+    '''yield (image_path, c2w, focal, img_wh) the same way as NerfSyntheticDataset.read_meta'''
+    img_wh = (800, 800)
+    focal = 0.5 * img_wh[0] / np.tan(0.5 * meta['camera_angle_x'])
+    for frame in meta['frames']:
+        c2w = (np.array(frame['transform_matrix'], dtype=np.float32) @ blender2opencv).astype(np.float32)
+        image_path = os.path.join(datadir, f"{frame['file_path']}.png")
+        yield image_path, c2w, focal, None
+
+
+frame_readers = {
+    'realdata': read_frames_realdata,
+    'nerf_synthetic': read_frames_synthetic,
+    'tensoir_synthetic': read_frames_synthetic,
+}
+
+
+class PackedRayDataset(Dataset):
+    '''Training rays generated on demand from a packed on-disk pixel cache.
+
+    The first run decodes every frame once into `pixels.npy` (uint8 RGBA, memory-mapped)
+    together with the per-frame poses and focals. Afterwards only the pixels of the
+    requested batch are read and their rays are built on the fly, so resident memory is
+    bounded by the batch size instead of the number of frames.
+
+    Indexing takes a batch of flat pixel indices (see RandomRaySampler) and returns the
+    same keys as the in-memory datasets. Every ray is of light 0, and as there is no ray
+    table the rays are not filtered by the bbox or the alpha mask.
+    '''
+    def __init__(self, datadir, name, split='train', downsample=1, cache_dir='', white_bg=True, debug=False):
+        self.data_dir = datadir
+        self.name = name
+        self.split = split
+        self.downsample = downsample
+        self.is_stack = False
+        self.white_bg = white_bg
+        self.debug = debug
+        self.scene_bbox = torch.tensor(scene_conf[name]['scene_bbox'])
+        self.near_far = scene_conf[name]['near_far']
+        self.center = torch.mean(self.scene_bbox, dim=0).float().view(1, 1, 3)
+        self.radius = (self.scene_bbox[1] - self.center).float().view(1, 1, 3)
+
+        cache_root = cache_dir if cache_dir else os.path.join(datadir, 'packed_cache')
+        self.cache_path = os.path.join(cache_root, f'{split}_ds{downsample}' + ('_debug' if debug else ''))
+        if not os.path.exists(os.path.join(self.cache_path, 'meta.json')):
+            self.build_cache()
+        self.read_cache()
+
+    def build_cache(self):
+        with open(os.path.join(self.data_dir, f'transforms_{self.split}.json'), 'r') as f:
+            meta = json.load(f)
+        frames = list(frame_readers[self.name](meta, self.data_dir, self.downsample))
+        if self.debug:
+            frames = frames[:2]
+
+        os.makedirs(self.cache_path, exist_ok=True)
+        pixels = None
+        poses, focals = [], []
+        for i, (image_path, c2w, focal, img_wh) in enumerate(
+                tqdm(frames, desc=f'Packing {self.split} data')):
+            with open(image_path, 'rb') as f:
+                img = decode_frame(f.read(), img_wh if self.downsample != 1.0 else None)  # (h, w, 4)
+            if pixels is None:
+                pixels = np.lib.format.open_memmap(
+                    os.path.join(self.cache_path, 'pixels.npy'), mode='w+',
+                    dtype=np.uint8, shape=(len(frames), *img.shape))
+            pixels[i] = img
+            poses.append(c2w)
+            focals.append(focal)
+        pixels.flush()
+        h, w = pixels.shape[1:3]
+        del pixels
+
+        np.savez(os.path.join(self.cache_path, 'cameras.npz'),
+                 poses=np.stack(poses).astype(np.float32),
+                 focals=np.array(focals, dtype=np.float32))
+        # meta.json is written last and marks the cache as complete
+        with open(os.path.join(self.cache_path, 'meta.json'), 'w') as f:
+            json.dump({'n_images': len(frames), 'h': int(h), 'w': int(w),
+                       'name': self.name, 'downsample': self.downsample}, f)
+        print(f'packed {len(frames)} frames to {self.cache_path}')
+
+    def read_cache(self):
+        with open(os.path.join(self.cache_path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        self.n_images = meta['n_images']
+        self.h, self.w = meta['h'], meta['w']
+        self.img_wh = (self.w, self.h)
+        self.aspect = self.w / self.h
+
+        cameras = np.load(os.path.join(self.cache_path, 'cameras.npz'))
+        self.poses = torch.from_numpy(cameras['poses'])  # (number of frames, 4, 4)
+        self.focals = torch.from_numpy(cameras['focals'])  # (number of frames, )
+        self.n_rays = self.n_images * self.h * self.w
+        # opened lazily so that every DataLoader worker maps the file itself
+        self.pixels = None
+
+    def get_pixels(self, idx):
+        if self.pixels is None:
+            self.pixels = np.load(os.path.join(self.cache_path, 'pixels.npy'), mmap_mode='r')
+            self.pixels = self.pixels.reshape(-1, 4)
+        # sorted reads are much friendlier to the page cache
+        order = np.argsort(idx)
+        rgba = np.empty((len(idx), 4), dtype=np.uint8)
+        rgba[order] = self.pixels[idx[order]]
+        return torch.from_numpy(rgba).float() / 255.0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['pixels'] = None
+        return state
+
+    def __len__(self):
+        return self.n_rays
+
+    def __getitem__(self, idx):
+        idx = torch.as_tensor(idx, dtype=torch.long).view(-1)
+        frame_idx = idx // (self.h * self.w)
+        pix_idx = idx % (self.h * self.w)
+        ys, xs = pix_idx // self.w, pix_idx % self.w
+
+        focal = self.focals[frame_idx][:, None].expand(-1, 2)
+        directions = get_ray_directions_at(xs, ys, self.h, self.w, focal)
+        directions = directions / torch.norm(directions, dim=-1, keepdim=True)
+        rays_o, rays_d = get_rays_batched(directions, self.poses[frame_idx])
+
+        rgba = self.get_pixels(idx.numpy())
+        if self.white_bg:
+            rgbs = rgba[:, :3] * rgba[:, -1:] + (1 - rgba[:, -1:])  # blend A to RGB
+        else:
+            rgbs = rgba[:, :3] * rgba[:, -1:]
+
+        return {
+            'rays': torch.cat([rays_o, rays_d], 1),
+            'rgbs': rgbs,
+            'masks': rgba[:, -1],
+            'light_idx': torch.zeros((idx.shape[0], 1), dtype=torch.long),
+        }
+
+    def get_len(self):
+        return self.__len__()
+
+
+class RandomRaySampler(Sampler):
+    '''Draws random batches of flat ray indices without materializing a permutation.'''
+    def __init__(self, n_rays, batch_size):
+        self.n_rays = n_rays
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            yield torch.randint(0, self.n_rays, (self.batch_size,))
+
+    def __len__(self):
+        # a table smaller than a batch still gives one batch, drawn with replacement
+        return max(self.n_rays // self.batch_size, 1)
+
+
+class ActiveRaySampler(Sampler):
+    '''Shuffled batches of the active rays of a utils.RayIndex, as indices into the full ray table.
+    An epoch ends early when the index is filtered again, the next one draws from the new set.
+    With fewer active rays than batch_size an epoch is a single batch drawn with replacement.
+    With light_idx (the light index of every ray of the table) each batch holds the same number of
+    rays of every light, drawn at random within the light.
+    '''
+    def __init__(self, ray_index, batch_size, light_idx=None):
+        self.ray_index = ray_index
+        self.batch_size = batch_size
+        self.light_idx = light_idx.view(-1) if light_idx is not None else None
+
+    def light_groups(self, active):
+        '''active rays sorted by light, with the start and size of every light'''
+        active = active.long()
+        lights = self.light_idx[active]
+        order = torch.argsort(lights, stable=True)
+        counts = torch.bincount(lights)
+        counts = counts[counts > 0]
+        starts = torch.cumsum(counts, 0) - counts
+        return active[order], starts, counts
+
+    def snapshot(self):
+        active, version = self.ray_index.snapshot
+        if active.shape[0] == 0:
+            raise RuntimeError('No active rays left to train on, the ray filtering removed every ray')
+        return active, version
+
+    def stratified(self):
+        active, version = self.snapshot()
+        rays, starts, counts = self.light_groups(active)
+        n_lights = counts.shape[0]
+        # the remainder of the batch goes to the first lights
+        per_light = torch.full((n_lights,), self.batch_size // n_lights)
+        per_light[:self.batch_size % n_lights] += 1
+        owner = torch.repeat_interleave(torch.arange(n_lights), per_light)
+        # the draws are with replacement within a light, a short set still fills a batch
+        for i in range(max(active.shape[0] // self.batch_size, 1)):
+            if self.ray_index.version != version:
+                return
+            offset = (torch.rand(self.batch_size) * counts[owner]).long()
+            yield rays[starts[owner] + offset]
+
+    def __iter__(self):
+        if self.light_idx is not None:
+            yield from self.stratified()
+            return
+        # one snapshot per epoch, filter() publishes new tensors instead of compacting this one
+        active, version = self.snapshot()
+        if active.shape[0] < self.batch_size:
+            yield active[torch.randint(0, active.shape[0], (self.batch_size,))].long()
+            return
+        order = torch.randperm(active.shape[0])
+        for i in range(active.shape[0] // self.batch_size):
+            if self.ray_index.version != version:
+                return
+            yield active[order[i * self.batch_size:(i + 1) * self.batch_size]].long()
+
+    def __len__(self):
+        return max(len(self.ray_index) // self.batch_size, 1) if len(self.ray_index) > 0 else 0
@@ -0,0 +1,101 @@
+import queue
+import threading
+import time
+
+import torch
+
+
+class RayPrefetcher():
+    '''Ray batches gathered from the dataset tables on a background thread.
+
+    The thread draws index batches from sampler (restarted at the end of every epoch) and indexes
+    the dataset with them directly, there is no per-ray collate and no worker process holding its
+    own copy of the tables. On cuda the batches are copied into a ring of pinned buffers, which
+    the training loop sends to the device with non-blocking copies while the next batches are
+    gathered; depth batches are kept ready.
+    '''
+    def __init__(self, dataset, sampler, device, depth=2):
+        self.dataset = dataset
+        self.sampler = sampler
+        self.device = torch.device(device)
+        self.pin = self.device.type == 'cuda'
+        self.queue = queue.Queue(maxsize=depth)
+        # a buffer is reused once the copy of the batch handed out from it is done
+        self.buffers = [None] * (depth + 2)
+        self.events = [None] * (depth + 2)
+        self.stopped = False
+        self.n_batches = 0
+        self.wait_time = 0.
+        self.start_time = time.time()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __iter__(self):
+        return self
+
+    def put(self, item):
+        while not self.stopped:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def pinned(self, slot, batch):
+        buffers = self.buffers[slot]
+        if buffers is None or any(buffers[k].shape != v.shape or buffers[k].dtype != v.dtype for k, v in batch.items()):
+            buffers = self.buffers[slot] = {k: torch.empty(v.shape, dtype=v.dtype, pin_memory=True)
+                                            for k, v in batch.items()}
+        if self.events[slot] is not None:
+            self.events[slot].synchronize()
+        for k, v in batch.items():
+            buffers[k].copy_(v)
+        return buffers
+
+    def run(self):
+        slot = 0
+        try:
+            while not self.stopped:
+                n_batches = 0
+                for idx in self.sampler:
+                    if self.stopped:
+                        return
+                    batch = self.dataset[idx]
+                    if self.pin:
+                        batch = self.pinned(slot, batch)
+                    self.put((slot, batch))
+                    slot = (slot + 1) % len(self.buffers)
+                    n_batches += 1
+                # an epoch cut short by a new ray filter is simply restarted, one that can never
+                # give a batch would spin here while __next__ waits forever
+                if n_batches == 0 and len(self.sampler) == 0:
+                    raise RuntimeError('The ray sampler has no batch to give')
+        except Exception as e:
+            self.put((None, e))
+
+    def __next__(self):
+        tt = time.time()
+        slot, batch = self.queue.get()
+        self.wait_time += time.time() - tt
+        if slot is None:
+            raise batch
+        batch = {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+        if self.pin:
+            self.events[slot] = torch.cuda.Event()
+            self.events[slot].record()
+        self.n_batches += 1
+        return batch
+
+    def stats(self):
+        '''batches/s handed out and the share of that time the training loop waited, since the last call'''
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        stats = {'batches_per_s': self.n_batches / elapsed, 'batch_wait': self.wait_time / elapsed}
+        self.n_batches, self.wait_time, self.start_time = 0, 0., time.time()
+        return stats
+
+    def close(self):
+        self.stopped = True
+        self.thread.join()
@@ -7,6 +7,7 @@ from torch.utils.data import Dataset, DataLoader
 from torchvision import transforms as T
 from tqdm import tqdm
 
+from dataset.frame_loader import load_frames
 from dataset.utils import get_ray_directions, get_rays
 # from utils import get_ray_directions, get_rays
 
@@ -21,7 +22,7 @@ def scaled_perspective(fovy=0.7854, aspect=1.0, n=0.1, f=1000.0, downsample=1.0,
 
 
 class RealDataset(Dataset):
-    def __init__(self, datadir, split='train', downsample=4.0, is_stack=False):
+    def __init__(self, datadir, split='train', downsample=4.0, is_stack=False, cache_dir=None, num_workers=8):
         self.data_dir = datadir
         self.split = split
         self.downsample = downsample
@@ -37,6 +38,8 @@ class RealDataset(Dataset):
         self.near_far = [0.2, 4.0]
         self.center = torch.mean(self.scene_bbox, dim=0).float().view(1, 1, 3)
         self.radius = (self.scene_bbox[1] - self.center).float().view(1, 1, 3)
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers
 
         self.read_meta()
 
@@ -64,7 +67,18 @@ class RealDataset(Dataset):
 
         idxs = list(range(0, len(self.meta['frames'])))
 
-        for i, key in tqdm(enumerate(self.meta['frames'])):
+        self.image_paths = [os.path.join(self.data_dir, f"{self.meta['frames'][key]['file_path']}.png")
+                            for key in self.meta['frames']]
+        frames_rgba, frames_rgb, self.load_stats = load_frames(
+            self.image_paths,
+            img_wh=self.img_wh if self.downsample != 1.0 else None,
+            white_bg=self.white_bg,
+            cache_dir=self.cache_dir,
+            num_workers=self.num_workers,
+            desc=f'Loading {self.split} data',
+        )
+
+        for i, key in enumerate(self.meta['frames']):
             # if i == 2:
             #     break
             frame = self.meta['frames'][key]
@@ -80,13 +94,7 @@ class RealDataset(Dataset):
             c2w = torch.FloatTensor(pose)
             self.poses += [c2w]
 
-            image_path = os.path.join(self.data_dir, f"{frame['file_path']}.png")
-            self.image_paths += [image_path]
-            img = Image.open(image_path)  # (h, w, 4)
-            if self.downsample!=1.0:
-                img = img.resize(self.img_wh, Image.LANCZOS)
-
-            img = self.transform(img)  # (4, h, w) & normalize to [0,1]
+            img = torch.from_numpy(frames_rgba[i]).float()  # (h, w, 4) in [0,1]
 
             if self.is_stack:
                 mv = torch.linalg.inv(transform_mat)
@@ -98,17 +106,14 @@ class RealDataset(Dataset):
                 self.all_mvs.append(mv)
                 self.all_mvps.append(mvp)
                 self.all_campos.append(campos)
-                self.all_images.append(img.permute(1, 2, 0))
+                self.all_images.append(img)
 
-            img = img.view(4, -1).permute(1, 0)  # (h * w, 4) RGBA
+            img = img.view(-1, 4)  # (h * w, 4) RGBA
             self.all_masks += [img[:, -1]]  # (h * w, 1)
             img_mask = ~(img[:, -1] == 0)
             self.all_01_masks += [img_mask.squeeze(0)]
-            if self.white_bg:
-                img = img[:, :3] * img[:, -1:] + (1 - img[:, -1:])  # blend A to RGB
-            else:
-                img = img[:, :3] * img[:, -1:]
-            self.all_rgbs += [img]  # (h * w, 3)
+            # already blended with the background by the frame loader
+            self.all_rgbs += [torch.from_numpy(frames_rgb[i]).float().view(-1, 3)]  # (h * w, 3)
 
             # both (h * w, 3), origin and direction for each ray
             rays_o, rays_d = get_rays(self.directions, c2w)
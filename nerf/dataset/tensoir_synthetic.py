@@ -9,12 +9,13 @@ from torchvision import transforms as T
 from tqdm import tqdm
 
 # from utils import get_ray_directions, get_rays
+from dataset.frame_loader import load_frames
 from dataset.utils import get_ray_directions, get_rays
 from render.util import scaled_perspective
 
 
 class TensoirSyntheticDataset(Dataset):
-    def __init__(self, datadir, split='train', downsample=1, is_stack=False, crop=False, debug=False):
+    def __init__(self, datadir, split='train', downsample=1, is_stack=False, crop=False, debug=False, cache_dir=None, num_workers=8):
         self.data_dir = datadir
         self.split = split
         self.downsample = downsample
@@ -32,6 +33,8 @@ class TensoirSyntheticDataset(Dataset):
         self.center = torch.mean(self.scene_bbox, dim=0).float().view(1, 1, 3)
         self.radius = (self.scene_bbox[1] - self.center).float().view(1, 1, 3)
         self.debug = debug
+        self.cache_dir = cache_dir
+        self.num_workers = num_workers
 
         self.read_meta()
 
@@ -69,34 +72,38 @@ class TensoirSyntheticDataset(Dataset):
         if self.debug:
             idxs = idxs[:2]
 
-        for i in tqdm(idxs, desc=f'Loading {self.split} data'):
+        self.image_paths = [os.path.join(self.data_dir, f"{self.meta['frames'][i]['file_path']}.png")
+                            for i in idxs]
+        frames_rgba, frames_rgb, self.load_stats = load_frames(
+            self.image_paths,
+            white_bg=self.white_bg,
+            cache_dir=self.cache_dir,
+            num_workers=self.num_workers,
+            desc=f'Loading {self.split} data',
+        )
+
+        for n, i in enumerate(idxs):
             frame = self.meta['frames'][i]
             transform_mat = torch.tensor(frame['transform_matrix'], dtype=torch.float32)
             pose = np.array(transform_mat) @ self.blender2opencv
             c2w = torch.FloatTensor(pose)
             self.poses += [c2w]
 
-            image_path = os.path.join(self.data_dir, f"{frame['file_path']}.png")
-            self.image_paths += [image_path]
-            img = Image.open(image_path)  # (h, w, 4)
-            img = self.transform(img)  # (4, h, w) & normalize to [0,1]
+            img = torch.from_numpy(frames_rgba[n]).float()  # (h, w, 4) in [0,1]
 
             if self.is_stack:
                 mv = torch.linalg.inv(transform_mat)
                 campos = transform_mat[:3, 3]
                 self.all_mvs.append(mv)
                 self.all_campos.append(campos)
-                self.all_images.append(img.permute(1, 2, 0))
+                self.all_images.append(img)
 
-            img = img.reshape(4, -1).permute(1, 0)  # (h * w, 4) RGBA
+            img = img.reshape(-1, 4)  # (h * w, 4) RGBA
             self.all_masks += [img[:, -1]]  # (h * w, 1)
             img_mask = ~(img[:, -1] == 0)
             self.all_01_masks += [img_mask.squeeze(0)]
-            if self.white_bg:
-                img = img[:, :3] * img[:, -1:] + (1 - img[:, -1:])  # blend A to RGB
-            else:
-                img = img[:, :3] * img[:, -1:]
-            self.all_rgbs += [img]  # (h * w, 3)
+            # already blended with the background by the frame loader
+            self.all_rgbs += [torch.from_numpy(frames_rgb[n]).float().reshape(-1, 3)]  # (h * w, 3)
 
             # both (h * w, 3), origin and direction for each ray
             rays_o, rays_d = get_rays(self.directions, c2w)
@@ -149,16 +156,24 @@ class TensoirSyntheticDataset(Dataset):
     def get_len(self):
         return self.__len__()
 
-    def get_crop(self, nw_data, cx, cy):
-        new_w, new_h = self.w//self.downsample, self.h//self.downsample
+    def get_crop(self, nw_data, cx, cy, size=None):
+        '''crop centred on row cx, column cy. size: width of the crop in image pixels, w // downsample by default,
+        the height keeps the aspect of the image, rounded down to an even number of rows (exact when it is whole)'''
+        if size is None:
+            new_w, new_h = self.w//self.downsample, self.h//self.downsample
+            zoom = self.downsample
+        else:
+            new_w, new_h = size, size * self.h // self.w // 2 * 2
+            zoom = self.w / new_w
         ret = {}
         if nw_data['img'].dim() == 4:
             nw_data['img'] = nw_data['img'].squeeze(0)
-        ret['img'] = nw_data['img'][cx - new_w//2:cx + new_w//2, cy - new_h//2:cy + new_h//2, :]
+        ret['img'] = nw_data['img'][cx - new_h//2:cx + new_h//2, cy - new_w//2:cy + new_w//2, :]
         ret['img'] = ret['img'].unsqueeze(0)
         ret['mv'] = nw_data['mv']
+        # scaled_perspective takes the column as cx and the row as cy
         proj = scaled_perspective(self.camera_angle_y, self.aspect, 0.1, 1000,
-                                  self.downsample, cy, cx, new_w, new_h, crop=True)
+                                  zoom, cx=cy, cy=cx, h=new_h, w=new_w, crop=True)
         ret['mvp'] = proj @ ret['mv']
         ret['campos'] = nw_data['campos']
         return ret
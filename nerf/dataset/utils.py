@@ -85,6 +85,43 @@ def get_rays(directions, c2w):
     return rays_o, rays_d
 
 
+def get_ray_directions_at(xs, ys, H, W, focal, center=None):
+    """
+    Same convention as get_ray_directions, but only for the given pixels.
+    Inputs:
+        xs, ys: (N,) integer pixel coordinates
+        H, W: image height and width
+        focal: (N, 2) or [fx, fy] focal lengths
+    Outputs:
+        directions: (N, 3), the direction of the rays in camera coordinate
+    """
+    focal = torch.as_tensor(focal, dtype=torch.float32).view(-1, 2)
+    if center is None:
+        center = [W / 2, H / 2]
+    x = xs.float() + 0.5
+    y = ys.float() + 0.5
+    directions = torch.stack([(x - center[0]) / focal[:, 0],
+        (y - center[1]) / focal[:, 1], torch.ones_like(x)], -1)  # (N, 3)
+
+    return directions
+
+
+def get_rays_batched(directions, c2ws):
+    """
+    Batched version of get_rays where every ray has its own camera.
+    Inputs:
+        directions: (N, 3) ray directions in camera coordinate
+        c2ws: (N, 3, 4) or (N, 4, 4) camera to world matrices
+    Outputs:
+        rays_o: (N, 3), the origin of the rays in world coordinate
+        rays_d: (N, 3), the direction of the rays in world coordinate
+    """
+    rays_d = torch.einsum('nj,nij->ni', directions, c2ws[:, :3, :3])  # (N, 3)
+    rays_o = c2ws[:, :3, 3]  # (N, 3)
+
+    return rays_o, rays_d
+
+
 def ndc_rays_blender(H, W, focal, near, rays_o, rays_d):
     # Shift ray origins to near plane
     t = -(near + rays_o[..., 2]) / rays_d[..., 2]
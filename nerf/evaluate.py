@@ -0,0 +1,389 @@
+'''Evaluation engine: renders the views of a split with one loaded model per worker process / device.
+
+usage (from nerf/):
+    python evaluate.py ckpt=logs/exp/2023_01_01_00_00_00/model.pt                  # test split on cuda:0
+    python evaluate.py ckpt=... devices=[cuda:0,cuda:1] tile_rows=200              # 2 gpus, views cut in 200 row tiles
+    python evaluate.py ckpt=... split=val N_vis=5 lpips=[] out=logs/eval_val
+    python evaluate.py ckpt=... hdr_dir=data/light_probes lights=[bridge,city]   # TensoIR relighting
+
+The training config is read from the total_config.yaml next to (or above) the checkpoint.
+Tiles of tile_rows rows (0: whole views) are queued to the workers; the main process gathers
+the tiles of a view and hands it to the AsyncWriter threads, which compute its images and
+PSNR / SSIM / LPIPS and write them. A view is appended to <out>/views.jsonl once its images are
+on disk, and a rerun with resume=True only renders the views missing from it.
+<out>/summary.json holds the mean of every metric and the per-view render times.
+
+With hdr_dir the views are the (frame, HDR) pairs of the split and the lights of hdr_dir (all of
+them, or the ones listed in lights): every worker loads the HDRs once and renders the tiles of a pair
+under its HDR instead of the trained envmap. The ground truth of frame <file_path>.png under the
+light <name> is <file_path>_<name>.png, the relit images are named <frame>_<name>.
+'''
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from async_writer import AsyncWriter, atomic_imwrite
+import chunking
+from dataset.nerf_synthetic import NerfSyntheticDataset
+from dataset.frame_loader import load_frames
+from dataset.realdata import RealDataset
+import models
+from models.tensoIR.relight_utils import Environment_Light
+from render import light as envmaps
+from utils import cal_n_samples, rgb_lpips, rgb_ssim
+
+
+def find_train_config(ckpt):
+    '''total_config.yaml of the run, intermediate checkpoints are saved one directory below the logdir'''
+    path = os.path.dirname(os.path.abspath(ckpt))
+    for _ in range(3):
+        if os.path.exists(f'{path}/total_config.yaml'):
+            return f'{path}/total_config.yaml'
+        path = os.path.dirname(path)
+    raise FileNotFoundError(f'No total_config.yaml found above {ckpt}')
+
+
+def load_split(data_conf, split):
+    frame_cache = getattr(data_conf, 'frame_cache', None)
+    num_workers = getattr(data_conf, 'num_workers', 8)
+    if data_conf.name == 'nerf_synthetic' or data_conf.name == 'tensoir_synthetic':
+        return NerfSyntheticDataset(
+            datadir=data_conf.dir,
+            split=split,
+            downsample=data_conf.downsample,
+            is_stack=True,
+            debug=data_conf.debug,
+            cache_dir=frame_cache,
+            num_workers=num_workers,
+        )
+    elif data_conf.name == 'realdata':
+        return RealDataset(
+            datadir=data_conf.dir,
+            split=split,
+            downsample=data_conf.downsample,
+            is_stack=True,
+            cache_dir=frame_cache,
+            num_workers=num_workers,
+        )
+    raise NotImplementedError('Unknown dataset type: %s' % data_conf.name)
+
+
+def list_lights(hdr_dir, names):
+    '''names of the .hdr files of hdr_dir, restricted to names if given'''
+    available = sorted(os.path.splitext(f)[0] for f in os.listdir(hdr_dir) if f.endswith('.hdr'))
+    missing = [name for name in names if name not in available]
+    if missing:
+        raise FileNotFoundError(f'no {", ".join(missing)} .hdr in {hdr_dir}')
+    return list(names) or available
+
+
+def job_name(job):
+    '''file name stem of a (view, light) job, light is None outside relighting'''
+    view, light = job
+    return f'{view:03d}' if light is None else f'{view:03d}_{light}'
+
+
+def set_light(model, lights, light):
+    '''render with the HDR of lights named light instead of the trained envmap, None: the trained one'''
+    model.relight_envmap = lights.hdr_rgbs[light] if light is not None else None
+
+
+def load_model(conf, ckpt_path, device):
+    # the kwargs of TensorBase checkpoints hold omegaconf containers
+    ckpt = torch.load(ckpt_path, map_location=device, weights_only=False)
+    # TensorBase.save keeps aabb / grid_size in 'kwargs', BaseModel.save at the top level
+    kwargs = ckpt.get('kwargs', ckpt)
+    aabb = torch.as_tensor(kwargs['aabb'], dtype=torch.float32)
+    grid_size = [int(x) for x in kwargs['grid_size']]
+
+    model = eval('models.' + conf.model.name)(conf.model, device, aabb, grid_size).to(device)
+    if hasattr(model, 'load'):
+        model.load(ckpt)
+    else:
+        model.load_state_dict(ckpt['state_dict'])
+    model.nSamples = min(getattr(conf.model, 'nSamples', 1e6),
+                         cal_n_samples(grid_size, getattr(conf.model, 'step_ratio', 0.5)))
+    if conf.model.name == 'TensoIR':
+        model.is_relight = conf.model.relight_flag
+    model.eval()
+    return model
+
+
+def worker(rank, device, conf, ckpt, chunk, tasks, results, hdr_dir=''):
+    '''load the model (and the HDRs) once, then render the tiles of the task queue until a None arrives'''
+    try:
+        device = torch.device(device)
+        if device.type == 'cuda':
+            torch.cuda.set_device(device)
+        chunking.configure(conf)
+        envmaps.configure_cache(conf)
+        model = load_model(conf, ckpt, device)
+        lights = Environment_Light(hdr_dir, device) if hdr_dir else None
+        with torch.no_grad():
+            while True:
+                task = tasks.get()
+                if task is None:
+                    break
+                job, tile, rays, light_idx = task
+                tt = time.time()
+                if lights is not None:
+                    set_light(model, lights, job[1])
+                maps = model.render_view(rays, conf.model, light_idx, chunk)
+                # numpy arrays are pickled by value, shared tensors would need this process to outlive the read
+                results.put((job, tile, {k: v.numpy() for k, v in maps.items()}, time.time() - tt))
+    except Exception:
+        results.put(('error', rank, traceback.format_exc(), 0.))
+
+
+def render_inline(opt, conf, task_list):
+    '''the rendering loop of worker() in this process, for spawn=False'''
+    device = torch.device(opt.devices[0])
+    model = load_model(conf, opt.ckpt, device)
+    lights = Environment_Light(opt.hdr_dir, device) if opt.hdr_dir else None
+    with torch.no_grad():
+        for job, tile, rays, light_idx in task_list:
+            tt = time.time()
+            if lights is not None:
+                set_light(model, lights, job[1])
+            maps = model.render_view(rays, conf.model, light_idx, opt.chunk)
+            yield job, tile, maps, time.time() - tt
+
+
+def render_spawned(opt, conf, task_list, n_tasks):
+    '''yield the rendered tiles of task_list from one process per entry of opt.devices'''
+    ctx = torch.multiprocessing.get_context('spawn')
+    tasks, results = ctx.Queue(maxsize=2 * len(opt.devices)), ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(rank, device, conf, opt.ckpt, opt.chunk, tasks, results, opt.hdr_dir),
+                         daemon=True)
+             for rank, device in enumerate(opt.devices)]
+    for proc in procs:
+        proc.start()
+
+    def feed():
+        for task in task_list:
+            tasks.put(task)
+        for _ in procs:
+            tasks.put(None)
+    threading.Thread(target=feed, daemon=True).start()
+
+    try:
+        for _ in range(n_tasks):
+            while True:
+                try:
+                    item = results.get(timeout=10)
+                    break
+                except queue.Empty:
+                    if any(proc.exitcode not in (None, 0) for proc in procs):
+                        raise RuntimeError('an evaluation worker exited: ' +
+                                           ', '.join(f'{p.pid}: {p.exitcode}' for p in procs))
+            if item[0] == 'error':
+                raise RuntimeError(f'evaluation worker {item[1]} failed\n{item[2]}')
+            job, tile, maps, seconds = item
+            yield job, tile, {k: torch.from_numpy(v) for k, v in maps.items()}, seconds
+    finally:
+        for proc in procs:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+
+
+class ViewRecorder():
+    '''computes the images and metrics of finished views on the writer threads and appends them to views.jsonl
+    - args:
+        - metric_preds: names of the predictions of eval_images that are scored, None: all of them
+    '''
+    def __init__(self, out, eval_images, H, W, near_far, lpips_nets, lpips_device, records, metric_preds=None):
+        self.out = out
+        self.eval_images = eval_images
+        self.H, self.W = H, W
+        self.near_far = near_far
+        self.lpips_nets = lpips_nets
+        self.lpips_device = lpips_device
+        self.records = records
+        self.metric_preds = metric_preds
+        self.lock = threading.Lock()
+        self.lpips_lock = threading.Lock()
+
+    def finish(self, job, maps, load_gt, seconds):
+        '''load_gt() -> [H, W, 3], called here so that the relighting ground truth is read on the writer threads'''
+        gt_rgb = load_gt()
+        images, preds = self.eval_images(maps, gt_rgb, self.H, self.W, self.near_far)
+        for pattern, img in images.items():
+            path = f'{self.out}/' + pattern.format(job_name(job))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_imwrite(path, img)
+
+        view, light = job
+        record = {'view': view, 'render_seconds': seconds}
+        if light is not None:
+            record['light'] = light
+        gt = gt_rgb.numpy()
+        for name, pred in preds.items():
+            if self.metric_preds is not None and name not in self.metric_preds:
+                continue
+            pred = pred.numpy()
+            record[f'{name}/psnr'] = float(-10.0 * np.log10(np.mean((pred - gt) ** 2)))
+            record[f'{name}/ssim'] = float(rgb_ssim(pred, gt, 1))
+            for net in self.lpips_nets:
+                # one LPIPS network per process, shared by the writer threads
+                with self.lpips_lock:
+                    record[f'{name}/lpips_{net}'] = rgb_lpips(gt, pred, net, self.lpips_device)
+
+        with self.lock:
+            with open(f'{self.out}/views.jsonl', 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self.records[job] = record
+
+
+def load_records(path):
+    '''records of the (view, light) jobs already evaluated, a line cut by an interruption is ignored'''
+    records = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[(record['view'], record.get('light'))] = record
+    return records
+
+
+def summarize(records):
+    summary = {'views': len(records)}
+    keys = sorted({k for record in records.values() for k in record if '/' in k})
+    for k in keys:
+        summary[k] = float(np.mean([record[k] for record in records.values() if k in record]))
+    seconds = np.asarray([record['render_seconds'] for record in records.values()])
+    if len(seconds):
+        summary['render_seconds'] = {
+            'mean': float(seconds.mean()),
+            'p50': float(np.percentile(seconds, 50)),
+            'max': float(seconds.max()),
+            'total': float(seconds.sum()),
+        }
+    return summary
+
+
+def evaluate(opt):
+    conf = OmegaConf.load(find_train_config(opt.ckpt))
+    conf = OmegaConf.merge(conf, opt.conf)
+    if not hasattr(eval('models.' + conf.model.name), 'render_view'):
+        raise NotImplementedError(f'{conf.model.name} does not implement render_view')
+    chunking.configure(conf)
+    envmaps.configure_cache(conf)
+    if conf.model.name == 'TensoIR':
+        # training turns relighting on at the first alpha mask update, after total_config.yaml was written
+        conf.model.relight_flag = conf.model.relight_flag or conf.iteration > conf.update_AlphaMask_list[0]
+    if opt.hdr_dir:
+        if conf.model.name != 'TensoIR' or conf.data.name not in ['nerf_synthetic', 'tensoir_synthetic']:
+            raise NotImplementedError('relighting needs a TensoIR model and a synthetic dataset')
+        conf.model.relight_flag = True
+        lights = list_lights(opt.hdr_dir, opt.lights)
+    else:
+        lights = [None]
+
+    dataset = load_split(conf.data, opt.split)
+    conf.model.near_far = dataset.near_far
+    conf.model.white_bg = getattr(conf.data, 'white_bg', dataset.white_bg)
+    W, H = dataset.img_wh
+    n_views = dataset.all_rays.shape[0]
+    img_eval_interval = 1 if opt.N_vis < 0 else max(n_views // opt.N_vis, 1)
+    views = list(range(0, n_views, img_eval_interval))
+    # one light after the other, so that a worker rarely swaps its envmap
+    jobs = [(view, light) for light in lights for view in views]
+
+    out = opt.out or os.path.join(os.path.dirname(os.path.abspath(opt.ckpt)),
+                                  f'eval_{opt.split}' + ('_relight' if opt.hdr_dir else ''))
+    os.makedirs(out, exist_ok=True)
+    if not opt.resume and os.path.exists(f'{out}/views.jsonl'):
+        os.remove(f'{out}/views.jsonl')
+    records = load_records(f'{out}/views.jsonl')
+    todo = [job for job in jobs if job not in records]
+    print(f'evaluate: {len(jobs)} views, {len(jobs) - len(todo)} already done, output in {out}')
+
+    rows = opt.tile_rows if opt.tile_rows > 0 else H
+    tiles = [(r, min(r + rows, H)) for r in range(0, H, rows)]
+    light_idx = getattr(dataset, 'all_light_idx', None)
+
+    def task_list():
+        for job in todo:
+            view = job[0]
+            rays = dataset.all_rays[view].view(-1, dataset.all_rays.shape[-1])
+            view_light_idx = light_idx[view].reshape(rays.shape[0], -1) if light_idx is not None else None
+            for tile, (r0, r1) in enumerate(tiles):
+                # clone the tiles, sending a view of all_rays would move the whole split to shared memory
+                yield (job, tile, rays[r0 * W:r1 * W].clone(),
+                       view_light_idx[r0 * W:r1 * W].clone() if view_light_idx is not None else None)
+
+    def gt_loader(job):
+        view, light = job
+        if light is None:
+            return lambda: dataset.all_rgbs[view].view(H, W, 3)
+        path = os.path.splitext(dataset.image_paths[view])[0] + f'_{light}.png'
+        # one frame on a writer thread, no process pool
+        return lambda: torch.from_numpy(load_frames(
+            [path], img_wh=(W, H), white_bg=dataset.white_bg, cache_dir=getattr(conf.data, 'frame_cache', None),
+            num_workers=0, desc=f'Loading {os.path.basename(path)}')[1][0]).float()
+
+    lpips_nets = list(opt.lpips)
+    if lpips_nets:
+        try:
+            import lpips
+        except ImportError:
+            print('evaluate: lpips is not installed, LPIPS is skipped')
+            lpips_nets = []
+    lpips_device = opt.lpips_device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    # the radiance field prediction does not depend on the light, only the physically based one is scored
+    recorder = ViewRecorder(out, eval('models.' + conf.model.name).eval_images, H, W, dataset.near_far,
+                            lpips_nets, lpips_device, records,
+                            metric_preds=['rgb_with_brdf'] if opt.hdr_dir else None)
+    writer = AsyncWriter(opt.writer_workers, opt.writer_queue)
+
+    start = time.time()
+    if opt.spawn:
+        stream = render_spawned(opt, conf, task_list(), len(todo) * len(tiles))
+    else:
+        stream = render_inline(opt, conf, task_list())
+    pending = {}
+    for job, tile, maps, seconds in stream:
+        nw = pending.setdefault(job, {'tiles': {}, 'seconds': 0.})
+        nw['tiles'][tile] = maps
+        nw['seconds'] += seconds
+        if len(nw['tiles']) < len(tiles):
+            continue
+        del pending[job]
+        maps = {k: torch.cat([nw['tiles'][t][k] for t in range(len(tiles))]) for k in maps}
+        writer.submit(recorder.finish, job, maps, gt_loader(job), nw['seconds'])
+        print(f'evaluate: view {job_name(job)} rendered in {nw["seconds"]:.2f}s')
+    writer.close()
+
+    summary = summarize(records)
+    if opt.hdr_dir:
+        summary['lights'] = {light: summarize({job: record for job, record in records.items() if job[1] == light})
+                             for light in lights}
+    summary['wall_seconds'] = time.time() - start
+    with open(f'{out}/summary.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    print(json.dumps(summary, indent=2))
+    return summary
+
+
+if __name__ == '__main__':
+    opt = OmegaConf.merge(OmegaConf.create({
+        'ckpt': '', 'split': 'test', 'N_vis': -1, 'out': '', 'resume': True,
+        'devices': ['cuda:0'], 'spawn': True, 'tile_rows': 0, 'chunk': 4096,
+        'lpips': ['alex', 'vgg'], 'lpips_device': '', 'writer_workers': 4, 'writer_queue': 8,
+        # relighting: a directory of .hdr light probes, and the names of the ones to render ([]: all)
+        'hdr_dir': '', 'lights': [],
+        # overrides of the training config, e.g. conf.model.relight_chunk_size=40000
+        'conf': {},
+    }), OmegaConf.from_cli())
+    evaluate(opt)
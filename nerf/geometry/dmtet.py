@@ -21,7 +21,12 @@ from render import render
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 class DMTet:
-    def __init__(self):
+    '''
+    incremental: cache the edge list and edge-to-tet maps of the grid, and only re-extract the faces of the
+                 tets whose sdf sign pattern changed since the previous call. The output mesh is the same,
+                 up to the order of the faces.
+    '''
+    def __init__(self, incremental=False):
         self.triangle_table = torch.tensor([
                 [-1, -1, -1, -1, -1, -1],
                 [ 1,  0,  2, -1, -1, -1],
@@ -44,6 +49,12 @@ class DMTet:
         self.num_triangles_table = torch.tensor([0,1,1,2,1,2,2,1,1,2,2,1,2,1,1,0], dtype=torch.long, device=device)
         self.base_tet_edges = torch.tensor([0,1,0,2,0,3,1,2,1,3,2,3], dtype=torch.long, device=device)
 
+        self.incremental = incremental
+        self.topology = None
+        self.last_touched = 1.0     # fraction of the tets re-extracted by the last call
+        self.touched_tets = 0
+        self.total_tets = 0
+
     ###############################################################################
     # Utility functions
     ###############################################################################
@@ -58,7 +69,8 @@ class DMTet:
 
         return torch.stack([a, b],-1)
 
-    def map_uv(self, faces, face_gidx, max_idx):
+    def uv_layout(self, max_idx):
+        '''per-tet uv quads of the atlas, static for a grid'''
         N = int(np.ceil(np.sqrt((max_idx+1)//2)))
         tex_y, tex_x = torch.meshgrid(
             torch.linspace(0, 1 - (1 / N), N, dtype=torch.float32, device=device),
@@ -74,7 +86,9 @@ class DMTet:
             tex_x + pad, tex_y + pad,
             tex_x      , tex_y + pad
         ], dim=-1).view(-1, 2)
+        return uvs, N
 
+    def uv_index(self, face_gidx, N):
         def _idx(tet_idx, N):
             x = tet_idx % N
             y = torch.div(tet_idx, N, rounding_mode='trunc')
@@ -87,13 +101,19 @@ class DMTet:
             tet_idx * 4, tet_idx * 4 + tri_idx + 1, tet_idx * 4 + tri_idx + 2
         ), dim = -1). view(-1, 3)
 
-        return uvs, uv_idx
+        return uv_idx
+
+    def map_uv(self, faces, face_gidx, max_idx):
+        uvs, N = self.uv_layout(max_idx)
+        return uvs, self.uv_index(face_gidx, N)
 
     ###############################################################################
     # Marching tets implementation
     ###############################################################################
 
     def __call__(self, pos_nx3, sdf_n, tet_fx4):
+        if self.incremental:
+            return self.incremental_call(pos_nx3, sdf_n, tet_fx4)
         with torch.no_grad():
             occ_n = sdf_n > 0
             occ_fx4 = occ_n[tet_fx4.reshape(-1)].reshape(-1,4)
@@ -149,6 +169,103 @@ class DMTet:
     def run(self, pos_nx3, sdf_n, tet_fx4):
         return self.__call__(pos_nx3, sdf_n, tet_fx4)
 
+    ###############################################################################
+    # Incremental marching tets with a cached grid topology
+    ###############################################################################
+
+    @torch.no_grad()
+    def build_topology(self, tet_fx4):
+        '''edge list and edge-to-tet maps of a tet grid, computed once per grid'''
+        num_tets = tet_fx4.shape[0]
+        all_edges = self.sort_edges(tet_fx4[:,self.base_tet_edges].reshape(-1,2))
+        edges, tet_edges = torch.unique(all_edges, dim=0, return_inverse=True)
+        uvs, N = self.uv_layout(num_tets*2)
+        return {
+            'key'       : (tet_fx4.data_ptr(), tet_fx4.shape[0], tet_fx4.device),
+            'edges'     : edges.long(),                 # [E, 2] sorted vertex pairs
+            'tet_edges' : tet_edges.reshape(-1, 6),     # [T, 6] edge ids of every tet, in base_tet_edges order
+            'uvs'       : uvs,
+            'N'         : N,
+            # state of the previous extraction
+            'tetindex'  : None,                         # [T] sign pattern of every tet
+            'crossing'  : torch.zeros((edges.shape[0],), dtype=torch.bool, device=device),
+            'face_edges': torch.zeros((0, 3), dtype=torch.long, device=device),   # faces as edge ids, stable across calls
+            'face_tet'  : torch.zeros((0,), dtype=torch.long, device=device),
+            'uv_idx'    : torch.zeros((0, 3), dtype=torch.long, device=device),
+            'faces'     : None,                         # handed out again while no sign changes, see mesh.topology
+        }
+
+    def incremental_call(self, pos_nx3, sdf_n, tet_fx4):
+        with torch.no_grad():
+            key = (tet_fx4.data_ptr(), tet_fx4.shape[0], tet_fx4.device)
+            if self.topology is None or self.topology['key'] != key:
+                self.topology = self.build_topology(tet_fx4)
+            topo = self.topology
+
+            occ_n = sdf_n > 0
+            v_id = torch.pow(2, torch.arange(4, dtype=torch.long, device=device))
+            tetindex = (occ_n[tet_fx4.reshape(-1)].reshape(-1,4) * v_id.unsqueeze(0)).sum(-1)
+            if topo['tetindex'] is None:
+                changed = torch.ones_like(tetindex, dtype=torch.bool)
+            else:
+                changed = tetindex != topo['tetindex']
+            changed_tets = torch.nonzero(changed)[:, 0]
+
+            num_tets = tet_fx4.shape[0]
+            self.last_touched = changed_tets.shape[0] / max(num_tets, 1)
+            self.touched_tets += changed_tets.shape[0]
+            self.total_tets += num_tets
+
+            if changed_tets.shape[0] > 0:
+                # crossing state of the edges of the changed tets
+                touched_edges = topo['tet_edges'][changed_tets].reshape(-1)
+                topo['crossing'][touched_edges] = occ_n[topo['edges'][touched_edges].reshape(-1)].reshape(-1,2).sum(-1) == 1
+
+                # drop the faces of the changed tets and re-extract them from their new sign pattern
+                keep = ~changed[topo['face_tet']]
+                tetindex_c = tetindex[changed_tets]
+                num_triangles = self.num_triangles_table[tetindex_c]
+                one, two = changed_tets[num_triangles == 1], changed_tets[num_triangles == 2]
+                face_edges = torch.cat((
+                    topo['face_edges'][keep],
+                    torch.gather(input=topo['tet_edges'][one], dim=1, index=self.triangle_table[tetindex_c[num_triangles == 1]][:, :3]).reshape(-1,3),
+                    torch.gather(input=topo['tet_edges'][two], dim=1, index=self.triangle_table[tetindex_c[num_triangles == 2]][:, :6]).reshape(-1,3),
+                ), dim=0)
+                face_gidx = torch.cat((
+                    one*2,
+                    torch.stack((two*2, two*2 + 1), dim=-1).view(-1)
+                ), dim=0)
+                topo['face_tet'] = torch.cat((topo['face_tet'][keep], one, two.repeat_interleave(2)), dim=0)
+                topo['uv_idx'] = torch.cat((topo['uv_idx'][keep], self.uv_index(face_gidx, topo['N'])), dim=0)
+                topo['face_edges'] = face_edges
+                topo['tetindex'] = tetindex
+
+            # crossing edges are numbered in edge order, as in __call__
+            crossing = topo['crossing']
+            interp_v = topo['edges'][crossing]
+            if changed_tets.shape[0] > 0 or topo['faces'] is None:
+                mapping = torch.cumsum(crossing.long(), 0) - 1
+                topo['faces'] = mapping[topo['face_edges']]
+            faces = topo['faces']
+
+        edges_to_interp = pos_nx3[interp_v.reshape(-1)].reshape(-1,2,3)
+        edges_to_interp_sdf = sdf_n[interp_v.reshape(-1)].reshape(-1,2,1)
+        edges_to_interp_sdf[:,-1] *= -1
+
+        denominator = edges_to_interp_sdf.sum(1,keepdim = True)
+
+        edges_to_interp_sdf = torch.flip(edges_to_interp_sdf, [1])/denominator
+        verts = (edges_to_interp * edges_to_interp_sdf).sum(1)
+
+        return verts, faces, topo['uvs'], topo['uv_idx']
+
+    def touched_stats(self):
+        '''fraction of the tets re-extracted, by the last call and since the start'''
+        return {
+            'last': self.last_touched,
+            'mean': self.touched_tets / max(self.total_tets, 1),
+        }
+
 ###############################################################################
 # Regularizer
 ###############################################################################
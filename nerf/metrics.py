@@ -0,0 +1,103 @@
+import json
+import time
+
+import torch
+
+
+class MetricsAccumulator():
+    '''Windowed means of the training loss terms without a host sync per step.
+
+    update() adds the detached loss terms to running sums that stay on the device; they are
+    copied to the host in a single transfer every log_every steps, when the window means and
+    the throughput (it/s, rays/s, samples/s) are printed, logged to wandb and / or appended
+    to a JSONL file.
+    '''
+    def __init__(self, log_every=100, use_wandb=False, jsonl_path=None, console=True):
+        self.log_every = max(int(log_every), 1)
+        self.use_wandb = use_wandb
+        self.jsonl_path = jsonl_path
+        self.console = console
+        self.last = {}
+        # callables returning {name: float}, added to the means of every window
+        self.gauges = []
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.counts = {}
+        self.steps = 0
+        self.rays = 0
+        self.samples = 0
+        self.start_time = time.time()
+
+    def update(self, loss_dict, n_rays=0, n_samples=0):
+        '''
+        - args:
+            - loss_dict: {name: scalar tensor or number}, None entries are skipped
+            - n_rays, n_samples: python ints of the step, for the throughput
+        '''
+        for k, v in loss_dict.items():
+            if v is None:
+                continue
+            if isinstance(v, torch.Tensor):
+                v = v.detach().float()
+            self.sums[k] = self.sums[k] + v if k in self.sums else v
+            self.counts[k] = self.counts.get(k, 0) + 1
+        self.steps += 1
+        self.rays += n_rays
+        self.samples += n_samples
+
+    def step(self, global_step, loss_dict, n_rays=0, n_samples=0):
+        '''update, then flush at the end of every window. returns the flushed means or None'''
+        self.update(loss_dict, n_rays, n_samples)
+        if (global_step + 1) % self.log_every == 0:
+            return self.flush(global_step)
+        return None
+
+    def flush(self, global_step):
+        if self.steps == 0:
+            return self.last
+        elapsed = max(time.time() - self.start_time, 1e-6)
+
+        keys = list(self.sums.keys())
+        tensor_keys = [k for k in keys if isinstance(self.sums[k], torch.Tensor)]
+        means = {k: self.sums[k] / self.counts[k] for k in keys if k not in tensor_keys}
+        if tensor_keys:
+            # one device -> host copy for every term of the window
+            values = torch.stack([self.sums[k].to(self.sums[tensor_keys[0]].device).reshape(()) for k in tensor_keys])
+            for k, v in zip(tensor_keys, values.cpu().tolist()):
+                means[k] = v / self.counts[k]
+        means = {k: float(means[k]) for k in keys}
+
+        means['it_per_s'] = self.steps / elapsed
+        if self.rays:
+            means['rays_per_s'] = self.rays / elapsed
+        if self.samples:
+            means['samples_per_s'] = self.samples / elapsed
+        for gauge in self.gauges:
+            means.update(gauge())
+
+        if self.use_wandb:
+            import wandb
+            wandb.log(means, step=global_step)
+        if self.console:
+            print(f'Iter: {global_step:05d}', end=' | ')
+            for k, v in means.items():
+                print(k, ': ', f'{v:.6g}', end=' | ')
+            print()
+        if self.jsonl_path:
+            with open(self.jsonl_path, 'a') as f:
+                f.write(json.dumps({'step': global_step, **means}) + '\n')
+
+        self.last = means
+        self.reset()
+        return means
+
+
+def build_metrics(conf, logdir):
+    return MetricsAccumulator(
+        log_every=getattr(conf, 'log_every', 100),
+        use_wandb=conf.wandb,
+        jsonl_path=f'{logdir}/metrics.jsonl' if getattr(conf, 'metrics_jsonl', False) else None,
+        console=not conf.wandb,
+    )
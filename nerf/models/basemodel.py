@@ -1,13 +1,14 @@
 import os
 import sys
 
-import imageio
 import nerfacc
 import torch
 import torch.nn as nn
 from omegaconf import OmegaConf
 from tqdm import tqdm
 
+from async_writer import sync_writer
+import chunking
 from models import sampler
 
 
@@ -27,6 +28,8 @@ class BaseModel(nn.Module):
         self.use_alpha = False
         self.background_color = None
         self.alphaMask = None
+        # replaced by train.py with an AsyncWriter when async_writer is enabled
+        self.writer = sync_writer
         if config.sampler == 'occgrid':
             self.sampler = sampler.Occgrid_sampler(config, self.aabb)
         elif config.sampler == 'vanilla':
@@ -121,6 +124,47 @@ class BaseModel(nn.Module):
     def cal_loss(self, data, args):
         pass
 
+    # maps returned by render_tile, packed in this order by render_view
+    eval_keys = ['rgb_map', 'depth_map']
+
+    def render_tile(self, rays, args, light_idx=None):
+        '''- return: {key: [N, C]} for every key of eval_keys'''
+        rgb, _, depth, _ = self.forward(rays, is_train=False)
+        return {'rgb_map': rgb, 'depth_map': depth}
+
+    def render_view(self, rays, args, light_idx=None, chunk=4096):
+        '''render a view (or a tile of it) chunk by chunk, copying the maps to the host once
+        - args:
+            - rays: [N, 6], light_idx: [N, 1] or None, on any device
+        - return:
+            - {key: [N, C]} cpu tensors for every key of eval_keys
+        '''
+        device = self.aabb.device
+        chunk_maps = {k: [] for k in self.eval_keys}
+        for i in chunking.split('render_view', rays.shape[0], chunk, device):
+            nw_rays = rays[i].to(device)
+            nw_light_idx = light_idx[i].to(device) if light_idx is not None else None
+            ret = self.render_tile(nw_rays, args, nw_light_idx)
+            for k in self.eval_keys:
+                chunk_maps[k].append(ret[k].detach().reshape(nw_rays.shape[0], -1))
+
+        widths = [chunk_maps[k][0].shape[-1] for k in self.eval_keys]
+        packed = torch.cat([torch.cat(chunk_maps[k]) for k in self.eval_keys], dim=-1).cpu()
+        return dict(zip(self.eval_keys, torch.split(packed, widths, dim=-1)))
+
+    @staticmethod
+    def eval_images(maps, gt_rgb, H, W, near_far):
+        '''images and predictions of a rendered view, a staticmethod so that evaluate.py can call it without a model
+        - args:
+            - maps: output of render_view for the whole view
+            - gt_rgb: [H, W, 3]
+        - return:
+            - images: {path pattern: uint8 image}, '{}' is replaced with the view name
+            - preds: {name: [H, W, 3] in [0, 1]}, compared to gt_rgb
+        '''
+        rgb = maps['rgb_map'].clamp(0.0, 1.0).reshape(H, W, 3)
+        return {'{}.png': (rgb.numpy() * 255).astype('uint8')}, {'rgb': rgb}
+
     def evaluation(
         self,
         dataset,
@@ -137,33 +181,16 @@ class BaseModel(nn.Module):
 
         with torch.no_grad():
             self.eval()
-            for idx, samples in tqdm(enumerate(dataset.all_rays[0::img_eval_interval]),
-                                        file=sys.stdout):
-                rays = samples.view(-1,samples.shape[-1])
-
-                chunk = 4096
-                N_rays = rays.shape[0]
-                rgb = []
-                depth = []
-                for i in range(N_rays // chunk + int(N_rays % chunk > 0)):
-                    nw_rays = rays[i * chunk:(i + 1) * chunk].to(device)
-                    nw_rgb, _, nw_depth, _ = self.forward(
-                        nw_rays,
-                        is_train=False,
-                    )
-                    rgb.append(nw_rgb.cpu())
-                    depth.append(nw_depth.cpu())
-
-                rgb = torch.cat(rgb)
-                depth = torch.cat(depth)
-                rgb = rgb.clamp(0.0, 1.0)
-                rgb, depth = rgb.reshape(H, W, 3), depth.reshape(H, W)
-                gt_rgb = dataset.all_rgbs[idxs[idx]].view(H, W, 3)
-                loss = torch.mean((rgb - gt_rgb) ** 2)
+            for idx, view in enumerate(tqdm(idxs, file=sys.stdout)):
+                rays = dataset.all_rays[view].view(-1, dataset.all_rays.shape[-1])
+                maps = self.render_view(rays, args)
+                gt_rgb = dataset.all_rgbs[view].view(H, W, 3)
+                images, preds = self.eval_images(maps, gt_rgb, H, W, dataset.near_far)
+                loss = torch.mean((preds['rgb'] - gt_rgb) ** 2)
                 PSNRs.append(-10.0 * torch.log10(loss))
-                rgb = (rgb.numpy() * 255).astype('uint8')
                 if savePath is not None:
-                    imageio.imwrite(f'{savePath}/{prefix}{idx:03d}.png', rgb)
+                    for pattern, img in images.items():
+                        self.writer.save_image(f'{savePath}/' + pattern.format(f'{prefix}{idx:03d}'), img)
             self.train()
 
         return PSNRs
@@ -172,7 +199,7 @@ class BaseModel(nn.Module):
         # save config
         os.makedirs(dir, exist_ok=True)
         OmegaConf.save(self.config, os.path.join(dir, 'config.yaml'))
-        torch.save({
+        self.writer.save_checkpoint({
             'state_dict': self.state_dict(),
             'aabb': self.aabb,
             'grid_size': self.grid_size,
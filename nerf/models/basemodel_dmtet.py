@@ -17,7 +17,7 @@ class Basemodel_dmtet(nn.Module):
         self.conf = conf
         self.init_scale = init_scale
 
-        self.marching_tets = dmtet.DMTet()
+        self.marching_tets = dmtet.DMTet(incremental=getattr(conf.dmtet, 'incremental', False))
         self.grid_res = conf.dmtet.dmtet_grid
         self.scale = conf.dmtet.mesh_scale
         if conf.unbounded:
@@ -80,7 +80,10 @@ class Basemodel_dmtet(nn.Module):
 
     def tick(self, glctx, target, opt_material, loss_fn, iteration):
         buffers = self.render(glctx, target, opt_material)
-        return self.cal_loss(buffers, target, loss_fn, iteration, opt_material)
+        loss_dict = self.cal_loss(buffers, target, loss_fn, iteration, opt_material)
+        if self.marching_tets.incremental:
+            loss_dict['dmtet_touched'] = self.marching_tets.last_touched
+        return loss_dict
 
     def cal_loss(self, buffers, target, loss_fn, iteration, mat=None):
         raise NotImplementedError("Please implement cal_loss function")
\ No newline at end of file
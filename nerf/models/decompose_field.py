@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from models.tensoIR.relight_utils import grid_sample
+from models.vm_sampler import vm_sample, vm_samplers
 
 
 class CPModule(nn.Module):
@@ -88,13 +89,16 @@ class AppLine(CPModule):
 
 class VMModule(nn.Module):
     '''Plane + line, for VM decomposition.
+    sampler: 'grid_sample' uses F.grid_sample per plane and line (relight_utils.grid_sample for the
+    features with grad), 'fused' / 'compiled' sample all of them in one pass (see models/vm_sampler.py).
     '''
-    def __init__(self, n_comp, gridSize, scale=0.1, dim=3):
+    def __init__(self, n_comp, gridSize, scale=0.1, dim=3, sampler='grid_sample'):
         super(VMModule, self).__init__()
         self.n_comp = n_comp
         self.gridSize = gridSize
         self.scale = scale
         self.dim = dim
+        self.sampler = sampler
 
         self.matMode = []
         for i in range(dim):
@@ -116,6 +120,9 @@ class VMModule(nn.Module):
         self.line = nn.ParameterList(self.line)
 
     def compute_feature(self, xyz_sampled):
+        if self.sampler in vm_samplers:
+            return vm_samplers[self.sampler](self.plane, self.line, self.matMode, xyz_sampled.detach())
+
         coordinate_plane = torch.stack([xyz_sampled[..., self.matMode[i]]
             for i in range(self.dim)]).detach().view(3, -1, 1, 2)
         coordinate_line = torch.stack([xyz_sampled[:, i] for i in range(self.dim)])
@@ -135,6 +142,10 @@ class VMModule(nn.Module):
         return plane_coef_point * line_coef_point
 
     def compute_feature_with_grad(self, xyz_sampled):
+        if self.sampler in vm_samplers:
+            # same sampling as relight_utils.grid_sample, twice differentiable w.r.t. xyz_sampled
+            return vm_sample(self.plane, self.line, self.matMode, xyz_sampled, padding='border')
+
         coordinate_plane = torch.stack([xyz_sampled[..., self.matMode[i]]
             for i in range(self.dim)]).view(3, -1, 1, 2)
         coordinate_line = torch.stack([xyz_sampled[:, i] for i in range(self.dim)])
@@ -202,8 +213,8 @@ class VMModule(nn.Module):
 
 
 class DensityVM(VMModule):
-    def __init__(self, n_comp, gridSize, scale=0.1, dim=3):
-        super(DensityVM, self).__init__(n_comp, gridSize, scale, dim)
+    def __init__(self, n_comp, gridSize, scale=0.1, dim=3, sampler='grid_sample'):
+        super(DensityVM, self).__init__(n_comp, gridSize, scale, dim, sampler)
 
     def compute(self, xyz_sampled):
         feat = self.compute_feature(xyz_sampled)
@@ -215,8 +226,8 @@ class DensityVM(VMModule):
 
 
 class AppVM(VMModule):
-    def __init__(self, n_comp, gridSize, app_dim, scale=0.1, dim=3):
-        super(AppVM, self).__init__(n_comp, gridSize, scale, dim)
+    def __init__(self, n_comp, gridSize, app_dim, scale=0.1, dim=3, sampler='grid_sample'):
+        super(AppVM, self).__init__(n_comp, gridSize, scale, dim, sampler)
         self.app_dim = app_dim
         self.mat = nn.Linear(sum(n_comp), app_dim, bias=False)
 
@@ -1,4 +1,3 @@
-import imageio
 import math
 import nerfacc
 import numpy as np
@@ -9,6 +8,8 @@ import torch.nn.functional as F
 from tqdm import tqdm
 from typing import Callable, Optional
 
+from async_writer import sync_writer
+
 
 class SinusoidalEncoder(nn.Module):
     """Sinusoidal Positional Encoder used in Nerf."""
@@ -258,6 +259,7 @@ class NeRF(nn.Module):
         self.near = args.near_far[0]
         self.far = args.near_far[1]
         self.render_step_size = args.render_step_size
+        self.writer = sync_writer
 
     def get_optparam_groups(self, optim_conf):
         grad_vars = [{
@@ -381,7 +383,7 @@ class NeRF(nn.Module):
                 PSNRs.append(-10.0 * torch.log10(loss))
                 rgb = (rgb.numpy() * 255).astype('uint8')
                 if savePath is not None:
-                    imageio.imwrite(f'{savePath}/{prefix}{idx:03d}.png', rgb)
+                    self.writer.save_image(f'{savePath}/{prefix}{idx:03d}.png', rgb)
 
             self.radiance_field.train()
             self.occ_grid.train()
@@ -389,7 +391,7 @@ class NeRF(nn.Module):
         return PSNRs
 
     def save(self, save_path):
-        torch.save(
+        self.writer.save_checkpoint(
             {
                 "radiance_field_state_dict": self.radiance_field.state_dict(),
                 "estimator_state_dict": self.occ_grid.state_dict(),
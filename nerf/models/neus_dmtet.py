@@ -19,7 +19,7 @@ class NeuS_DMTet(nn.Module):
         self.sdf_net = sdf_net.geometry
         self.device = device
         self.conf = conf
-        self.marching_tets = dmtet.DMTet()
+        self.marching_tets = dmtet.DMTet(incremental=getattr(conf.dmtet, 'incremental', False))
         self.grid_res = conf.dmtet.dmtet_grid
         self.scale = conf.dmtet.mesh_scale
 
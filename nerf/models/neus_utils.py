@@ -1,9 +1,8 @@
-import mcubes
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from geometry.marching_cubes import extract_isosurface, marching_cubes
 from models.myutils import scale_anything
 from models.network_utils import get_encoding, get_mlp
 
@@ -43,7 +42,7 @@ class MarchingCubeHelper(nn.Module):
         self.device = device
         # self.points_range = (-radius, radius)
         self.points_range = (0, 1)
-        self.mc_func = mcubes.marching_cubes
+        self.mc_func = marching_cubes
         self.verts = None
 
     def grid_vertices(self):
@@ -56,9 +55,7 @@ class MarchingCubeHelper(nn.Module):
 
     def forward(self, level, threshold=0.):
         level = level.float().view(self.resolution, self.resolution, self.resolution)
-        verts, faces = self.mc_func(-level.numpy(), threshold) # transform to numpy
-        verts = torch.from_numpy(verts.astype(np.float32))
-        faces = torch.from_numpy(faces.astype(np.int64)) # transform back to pytorch
+        verts, faces = self.mc_func(-level, threshold)
         verts = verts / (self.resolution - 1.)
         return {
             'v_pos': verts,
@@ -111,29 +108,17 @@ class VolumeSDF(nn.Module):
         return sdf
 
     def isosurface_(self, vmin, vmax):
-        vertices = self.helper.grid_vertices()
-        chunk_size = self.config.isosurface.chunk
-        num_vertices = vertices.shape[0]
-
-        level = []
-        for i in range(0, num_vertices, chunk_size):
-            nw_vertices = vertices[i:i+chunk_size]
-            nw_vertices = torch.stack([
-                scale_anything(nw_vertices[...,0], (0, 1), (vmin[0], vmax[0])),
-                scale_anything(nw_vertices[...,1], (0, 1), (vmin[1], vmax[1])),
-                scale_anything(nw_vertices[...,2], (0, 1), (vmin[2], vmax[2])),
-            ], dim=-1).to(self.device)
-            ret = self.forward_level(nw_vertices).cpu()
-            level.append(ret)
-        level = torch.cat(level, dim=0)
-
-        mesh = self.helper(level, threshold=self.config.isosurface.threshold)
-        mesh['v_pos'] = torch.stack([
-            scale_anything(mesh['v_pos'][...,0], (0, 1), (vmin[0], vmax[0])),
-            scale_anything(mesh['v_pos'][...,1], (0, 1), (vmin[1], vmax[1])),
-            scale_anything(mesh['v_pos'][...,2], (0, 1), (vmin[2], vmax[2]))
-        ], dim=-1)
-        return mesh
+        # only the blocks of cells around the surface are evaluated, see geometry/marching_cubes.py. The band
+        # test needs a metric sdf: forward_level is the sdf of the network, set isosurface.band to 0 when it
+        # is far from one (early in training, or with a scaled output)
+        conf = self.config.isosurface
+        verts, faces = extract_isosurface(lambda x: -self.forward_level(x), vmin, vmax, conf.resolution,
+                                          threshold=conf.threshold, block=conf.get('block', 8),
+                                          band=conf.get('band', 1.0), chunk=conf.chunk, device=self.device)
+        return {
+            'v_pos': verts.cpu(),
+            't_pos_idx': faces.cpu()
+        }
 
     @torch.no_grad()
     def isosurface(self):
@@ -4,7 +4,9 @@ import cv2
 import torch
 import torch.nn.functional as F
 from models.myutils import raw2alpha
+import chunking
 import os
+from render import light as envmaps
 
 
 
@@ -105,6 +107,104 @@ def grid_sample(image, optical):
     return out_val
 
 
+def build_alias_table(pdf):
+    '''Vose alias table of a discrete distribution, O(n) to build and O(1) per draw
+    - args:
+        - pdf: [n] non-negative weights
+    - return:
+        - prob: [n] probability of keeping a drawn slot, alias: [n] slot taken otherwise
+    '''
+    p = pdf.detach().double().cpu().numpy().reshape(-1)
+    n = p.shape[0]
+    q = p / p.sum() * n
+    prob = np.ones(n)
+    alias = np.arange(n)
+    small = list(np.nonzero(q < 1.0)[0])
+    large = list(np.nonzero(q >= 1.0)[0])
+    q = q.tolist()
+    while small and large:
+        s = small.pop()
+        l = large[-1]
+        prob[s] = q[s]
+        alias[s] = l
+        q[l] = q[l] + q[s] - 1.0
+        if q[l] < 1.0:
+            small.append(large.pop())
+    return torch.from_numpy(prob).float(), torch.from_numpy(alias).long()
+
+
+class EnvmapSampler():
+    '''Importance sampling of an equirectangular environment map with a precomputed alias table.
+
+    The layout is that of TensoIR.generate_envir_map_dir: rows go from +z (phi = pi/2) to -z,
+    columns from theta = pi to -pi. Pixels are drawn proportionally to luminance x sin, and the
+    direction is jittered uniformly in solid angle inside the pixel, so the returned pdf (per
+    steradian) is exact. Build it once per envmap update and reuse it for every draw.
+    '''
+    def __init__(self, envmap, device='cuda', weights=None):
+        '''- args: envmap: [H, W, 3] linear rgb, weights: [H, W] optional sampling weights in place of the luminance'''
+        self.device = device
+        H, W = envmap.shape[:2]
+        self.H, self.W = H, W
+        self.rgb = envmap.detach().reshape(-1, 3).float().to(device)
+
+        # solid angle of the pixels of every row
+        edges = torch.linspace(np.pi / 2, -np.pi / 2, H + 1, dtype=torch.float64)
+        self.sin_phi_edges = torch.sin(edges).float().to(device)       # [H + 1], decreasing
+        row_area = (2 * np.pi / W) * (torch.sin(edges[:-1]) - torch.sin(edges[1:]))   # [H]
+
+        if weights is None:
+            weights = self.rgb.sum(dim=-1)
+        weight = weights.reshape(H, W).double().cpu().clamp(min=0) * row_area[:, None]
+        if weight.sum() <= 0:
+            weight = row_area[:, None].expand(H, W).clone()
+        pmf = weight / weight.sum()
+        self.pmf = pmf.reshape(-1).float().to(device)                                       # [H * W]
+        self.pdf_table = (pmf / row_area[:, None]).reshape(-1).float().to(device)           # [H * W], per steradian
+        prob, alias = build_alias_table(pmf.reshape(-1))
+        self.prob, self.alias = prob.to(device), alias.to(device)
+
+    def draw(self, num_samples, stratified=False):
+        '''- return: [num_samples] pixel indices. stratified: one draw per 1 / num_samples stratum of [0, 1)'''
+        n = self.prob.shape[0]
+        u = torch.rand(num_samples, device=self.device)
+        if stratified:
+            u = (torch.arange(num_samples, device=self.device) + u) / num_samples
+        slot = (u * n).long().clamp(max=n - 1)
+        # the fractional part of u * n is uniform in [0, 1) given the slot
+        v = u * n - slot
+        return torch.where(v < self.prob[slot], slot, self.alias[slot])
+
+    def pixel_dirs(self, idx):
+        '''directions uniformly distributed in solid angle inside the pixels idx'''
+        row, col = torch.div(idx, self.W, rounding_mode='floor'), idx % self.W
+        u, v = torch.rand(idx.shape, device=self.device), torch.rand(idx.shape, device=self.device)
+        sin_phi = self.sin_phi_edges[row] + (self.sin_phi_edges[row + 1] - self.sin_phi_edges[row]) * u
+        theta = np.pi - (col + v) * (2 * np.pi / self.W)
+        cos_phi = torch.sqrt((1 - sin_phi * sin_phi).clamp(min=0))
+        return torch.stack([torch.cos(theta) * cos_phi, torch.sin(theta) * cos_phi, sin_phi], dim=-1)
+
+    def dir_to_pixel(self, dirs):
+        dirs = dirs.reshape(-1, 3).to(self.device)
+        phi = torch.asin(dirs[:, 2].clamp(-1, 1))
+        theta = torch.atan2(dirs[:, 1], dirs[:, 0])
+        row = ((np.pi / 2 - phi) / (np.pi / self.H)).long().clamp(0, self.H - 1)
+        col = ((np.pi - theta) / (2 * np.pi / self.W)).long().clamp(0, self.W - 1)
+        return row * self.W + col
+
+    def pdf(self, dirs):
+        '''- return: [N, 1] pdf per steradian of the directions'''
+        return self.pdf_table[self.dir_to_pixel(dirs)].unsqueeze(-1)
+
+    def sample(self, num_samples, stratified=False):
+        '''
+        - return:
+            - light_dir: [num_samples, 3], light_rgb: [num_samples, 3] (pixel value), light_pdf: [num_samples, 1] per steradian
+        '''
+        idx = self.draw(num_samples, stratified)
+        return self.pixel_dirs(idx), self.rgb[idx], self.pdf_table[idx].unsqueeze(-1)
+
+
 class Environment_Light():
     def __init__(self, hdr_path, device='cuda'):
         # transverse the hdr image to get the environment light
@@ -117,19 +217,16 @@ class Environment_Light():
             if file.endswith(".hdr"):
                 self.hdr_path = os.path.join(hdr_path, file)
                 light_name = file.split(".")[0]
-                light_rgbs = read_hdr(self.hdr_path)
-                light_rgbs = torch.from_numpy(light_rgbs)
+                # the decoded map and its pdfs, shared by every Environment_Light of the same file
+                entry = envmaps.envmap_cache.fetch(self.hdr_path, ('latlong_pdf',), lambda: latlong_entry(self.hdr_path))
+                light_rgbs = entry['rgb']
                 self.hdr_rgbs[light_name] = light_rgbs.to(device)
-                # compute the pdf of importance sampling of the environment map
                 light_intensity = torch.sum(light_rgbs, dim=2, keepdim=True) # [H, W, 1]
                 env_map_h, env_map_w, _ = light_intensity.shape
                 h_interval = 1.0 / env_map_h
                 sin_theta = torch.sin(torch.linspace(0 + 0.5 * h_interval, np.pi - 0.5 * h_interval, env_map_h))
-                pdf = light_intensity * sin_theta.view(-1, 1, 1) # [H, W, 1]
-                pdf = pdf / torch.sum(pdf)
-                pdf_return = pdf * env_map_h * env_map_w / (2 * np.pi * np.pi * sin_theta.view(-1, 1, 1))
-                self.hdr_pdf_sample[light_name] = pdf.to(device)
-                self.hdr_pdf_return[light_name] = pdf_return.to(device)
+                self.hdr_pdf_sample[light_name] = entry['pdf'].to(device)
+                self.hdr_pdf_return[light_name] = entry['pdf_return'].to(device)
 
                 lat_step_size = np.pi / env_map_h
                 lng_step_size = 2 * np.pi / env_map_w
@@ -144,6 +241,19 @@ class Environment_Light():
         self.envir_map_uniform_pdf = torch.ones_like(light_intensity) * sin_theta.view(-1, 1, 1) / (env_map_h * env_map_w)
         self.envir_map_uniform_pdf = (self.envir_map_uniform_pdf / torch.sum(self.envir_map_uniform_pdf)).to(device)
         self.envir_map_uniform_pdf_return = self.envir_map_uniform_pdf * env_map_h * env_map_w / (2 * np.pi * np.pi  * sin_theta.view(-1, 1, 1).to(device))
+        self.device = device
+        self.samplers = dict()
+
+    def get_sampler(self, light_name, sample_type="importance"):
+        '''alias table sampler of a light, built on first use and shared by every query'''
+        key = (light_name, sample_type)
+        if key not in self.samplers:
+            envmap = self.hdr_rgbs[light_name]
+            # uniform: uniform in solid angle, light_rgb is still the radiance of the hdr
+            weights = torch.ones_like(envmap[..., 0]) if sample_type == "uniform" else None
+            self.samplers[key] = EnvmapSampler(envmap, device=self.device, weights=weights)
+        return self.samplers[key]
+
     @torch.no_grad()
     def sample_light(self, light_name, bs, num_samples, sample_type="importance"):
         '''
@@ -156,32 +266,11 @@ class Environment_Light():
             - light_rgb: the rgb of the light [bs, num_samples, 3]
             - light_pdf: the pdf of the light [bs, num_samples, 1]
         '''
-        if sample_type == "importance":
-            environment_map = self.hdr_rgbs[light_name]
-            environment_map_pdf_sample = self.hdr_pdf_sample[light_name].view(-1).expand(bs, -1) # [bs, env_map_h * env_map_w]
-            environment_map_pdf_return = self.hdr_pdf_return[light_name].view(-1).expand(bs, -1) # [bs, env_map_h * env_map_w]
-            environment_map_dir = self.hdr_dir[light_name].view(-1, 3).expand(bs, -1, -1) # [bs, env_map_h * env_map_w, 3]
-            environment_map_rgb = environment_map.view(-1, 3).expand(bs, -1, -1) # [bs, env_map_h * env_map_w, 3]
-
-            # sampled the light directions
-            light_dir_idx = torch.multinomial(environment_map_pdf_sample, num_samples, replacement=True) # [bs, num_samples]
-            light_dir = environment_map_dir.gather(1, light_dir_idx.unsqueeze(-1).expand(-1, -1, 3)).view(bs, num_samples, 3) # [bs, num_samples, 3]
-            # sampled light rgbs and pdfs
-            light_rgb = environment_map_rgb.gather(1, light_dir_idx.unsqueeze(-1).expand(-1, -1, 3)).view(bs, num_samples, 3) # [bs, num_samples, 3]
-            light_pdf = environment_map_pdf_return.gather(1, light_dir_idx).unsqueeze(-1) # [bs, num_samples, 1]
-        elif sample_type == "uniform":
-            environment_map = self.hdr_rgbs[light_name]
-            environment_map_pdf_sample = self.envir_map_uniform_pdf.view(-1).expand(bs, -1) # [bs, env_map_h * env_map_w]
-            environment_map_pdf_return = self.envir_map_uniform_pdf_return.view(-1).expand(bs, -1) # [bs, env_map_h * env_map_w]
-            environment_map_dir = self.hdr_dir[light_name].view(-1, 3).expand(bs, -1, -1) # [bs, env_map_h * env_map_w, 3]
-            environment_map_rgb = environment_map.view(-1, 3).expand(bs, -1, -1) # [bs, env_map_h * env_map_w, 3]
-
-            # sampled the light directions
-            light_dir_idx = torch.multinomial(environment_map_pdf_sample, num_samples, replacement=True) # [bs, num_samples]
-            light_dir = environment_map_dir.gather(1, light_dir_idx.unsqueeze(-1).expand(-1, -1, 3)).view(bs, num_samples, 3) # [bs, num_samples, 3]
-            # sampled light rgbs and pdfs
-            light_rgb = environment_map_rgb.gather(1, light_dir_idx.unsqueeze(-1).expand(-1, -1, 3)).view(bs, num_samples, 3) # [bs, num_samples, 3]
-            light_pdf = environment_map_pdf_return.gather(1, light_dir_idx).unsqueeze(-1) # [bs, num_samples, 1]
+        sampler = self.get_sampler(light_name, sample_type)
+        light_dir, light_rgb, light_pdf = sampler.sample(bs * num_samples)
+        light_dir = light_dir.view(bs, num_samples, 3) # [bs, num_samples, 3]
+        light_rgb = light_rgb.view(bs, num_samples, 3) # [bs, num_samples, 3]
+        light_pdf = light_pdf.view(bs, num_samples, 1) # [bs, num_samples, 1]
 
         return light_dir, light_rgb, light_pdf
 
@@ -221,7 +310,7 @@ def predict_visibility_by_chunk(vis_model,
 
     # expand the shape for pts to make it the same as light_xyz
     visibility =torch.zeros((surface_pts.shape[0], 1), dtype=torch.float32).to(device) # [N, 1]
-    chunk_idxs = torch.split(torch.arange(surface_pts.shape[0]), chunk_size) # to save memory TODO: chunk size should be configurable
+    chunk_idxs = chunking.split('predict_visibility_by_chunk', surface_pts.shape[0], chunk_size, device) # to save memory
     for chunk_idx in chunk_idxs:
         chunk_surf2light = surf2light[chunk_idx]
         chunk_surface_pts = surface_pts[chunk_idx]
@@ -261,7 +350,7 @@ def get_visibility_and_indirect_light(  visibility_net,
     visibility_compute = torch.zeros((surface_pts.shape[0]), dtype=torch.float32).to(device) # [N, 1]
     indirect_light = torch.zeros((surface_pts.shape[0], 3), dtype=torch.float32).to(device) # [N, 1]
     with torch.enable_grad():
-        chunk_idxs_vis_predict = torch.split(torch.arange(surface_pts.shape[0]), 40960) # TODO: chunk size should be configurable
+        chunk_idxs_vis_predict = chunking.split('get_visibility_and_indirect_light_predict', surface_pts.shape[0], chunk_size, device)
         # predict all directions
         for chunk_idx in chunk_idxs_vis_predict:
             chunk_surf2light = surf2light[chunk_idx]
@@ -277,7 +366,7 @@ def get_visibility_and_indirect_light(  visibility_net,
     light_idx_masked = light_idx[invisibile_to_direct_light_mask] # [masked(N), 1]
     visibility_masked = torch.zeros((surface_pts_masked.shape[0]), dtype=torch.float32).to(device) # [masked(N), 1]
     indirect_light_masked = torch.zeros((surface_pts_masked.shape[0], 3), dtype=torch.float32).to(device) # [masked(N), 1]
-    chunk_idxs_vis_compute = torch.split(torch.arange(surface_pts_masked.shape[0]), 20480) # TODO: chunk size should be configurable
+    chunk_idxs_vis_compute = chunking.split('get_visibility_and_indirect_light_compute', surface_pts_masked.shape[0], 20480, device)
     # compute the directions where the direct light is not visible
     for chunk_idx in chunk_idxs_vis_compute:
         chunk_surface_pts = surface_pts_masked[chunk_idx]  # [chunk_size, 3]
@@ -308,7 +397,7 @@ def get_visibility_and_indirect_light(  visibility_net,
     surface_pts_masked = surface_pts[recompute_visibility_mask] # [masked(N), 3]
     surf2light_masked = surf2light[recompute_visibility_mask] # [masked(N), 3]
     recompute_visibility_masked = torch.zeros((surface_pts_masked.shape[0]), dtype=torch.float32).to(device) # [masked(N), 1]
-    chunk_idxs_vis_recompute = torch.split(torch.arange(surface_pts_masked.shape[0]), 20480) # to save memory; TODO: chunk size should be configurable
+    chunk_idxs_vis_recompute = chunking.split('get_visibility_and_indirect_light_recompute', surface_pts_masked.shape[0], 20480, device) # to save memory
     for chunk_idx in chunk_idxs_vis_recompute:
         chunk_surface_pts = surface_pts_masked[chunk_idx]  # [chunk_size, 3]
         chunk_surf2light = surf2light_masked[chunk_idx]    # [chunk_size, 3]
@@ -349,7 +438,9 @@ def compute_secondary_shading_effects(
                                         vis_near=0.05,
                                         vis_far=1.5,
                                         chunk_size=15000,
-                                        device='cuda'
+                                        device='cuda',
+                                        cache=None,
+                                        marcher='linspace'
                                         ):
     '''compute visibility for each point at each direction without visbility network
     - args:
@@ -358,20 +449,25 @@ def compute_secondary_shading_effects(
         - surf2light: [N, 3], light incident direction for each surface point, pointing from surface to light
         - light_idx: [N, 1], index of lighitng
         - nSample: number of samples for each ray along incident light direction
+        - cache: optional SecondaryShadingCache, looked up instead of marching every ray
+        - marcher: key of radiance_marchers used to march the secondary rays
     - return:
         - visibility_compute: [N, 1] visibility result by choosing some directions and then computing the density
         - indirect_light: [N, 3] indirect light in the corresponding direction
     '''
+    if cache is not None:
+        return cache.query(tensoIR, surface_pts, surf2light, light_idx, nSample, vis_near, vis_far, chunk_size, device,
+                           marcher=marcher)
 
     visibility_compute = torch.zeros((surface_pts.shape[0]), dtype=torch.float32).to(device) # [N, 1]
     indirect_light = torch.zeros((surface_pts.shape[0], 3), dtype=torch.float32).to(device) # [N, 1]
 
-    chunk_idxs_vis_compute = torch.split(torch.arange(surface_pts.shape[0]), chunk_size)
+    chunk_idxs_vis_compute = chunking.split('compute_secondary_shading_effects', surface_pts.shape[0], chunk_size, device)
     for chunk_idx in chunk_idxs_vis_compute:
         chunk_surface_pts = surface_pts[chunk_idx]  # [chunk_size, 3]
         chunk_surf2light = surf2light[chunk_idx]    # [chunk_size, 3]
         chunk_light_idx = light_idx[chunk_idx]      # [chunk_size, 1]
-        nerv_vis_chunk, nerfactor_vis_chunk, indirect_light_chunk = compute_radiance(
+        nerv_vis_chunk, nerfactor_vis_chunk, indirect_light_chunk = radiance_marchers[marcher](
                                                                                         tensoIR=tensoIR,
                                                                                         surf_pts=chunk_surface_pts,
                                                                                         light_in_dir=chunk_surf2light,
@@ -499,6 +595,145 @@ def compute_secondary_shading_effects(
 #     return visualize_vis, surface_xyz
 
 
+def ggx_D(NoH, roughness):
+    '''GGX normal distribution of GGX_specular (alpha = roughness^2), NoH and roughness broadcast'''
+    alpha2 = (roughness * roughness) ** 2
+    d = NoH * NoH * (alpha2 - 1) + 1
+    return alpha2 / (np.pi * d * d).clamp(min=1e-8)
+
+
+def orthonormal_basis(n):
+    '''[N, 3] unit vectors -> two unit tangents t, b with (t, b, n) right handed'''
+    sign = torch.where(n[:, 2:3] >= 0, torch.ones_like(n[:, 2:3]), -torch.ones_like(n[:, 2:3]))
+    a = -1.0 / (sign + n[:, 2:3])
+    b = n[:, 0:1] * n[:, 1:2] * a
+    t = torch.cat([1 + sign * n[:, 0:1] * n[:, 0:1] * a, sign * b, -sign * n[:, 0:1]], dim=-1)
+    bt = torch.cat([b, sign + n[:, 1:2] * n[:, 1:2] * a, -n[:, 1:2]], dim=-1)
+    return t, bt
+
+
+class BRDFLobeSampler():
+    '''Directions drawn from the lobe of the relighting BRDF: a q_spec mixture of GGX half vector
+    sampling (D x NoH) around the normal and of cosine weighted hemisphere sampling.'''
+    def __init__(self, normal, view, roughness, q_spec):
+        '''- args: normal, view: [N, 3] unit vectors, roughness, q_spec: [N, 1]'''
+        self.normal, self.view, self.roughness, self.q_spec = normal, view, roughness, q_spec
+        self.t, self.b = orthonormal_basis(normal)
+
+    def sample(self, pix):
+        '''one direction for each pixel index of pix: [M] -> [M, 3]'''
+        u1, u2, u3 = torch.rand((3, pix.shape[0], 1), device=pix.device)
+        alpha = self.roughness[pix] ** 2
+        # cosine weighted hemisphere
+        cos_d = torch.sqrt(u1)
+        # GGX half vector, then reflected about it
+        cos_h = torch.sqrt((1 - u1) / (1 + (alpha * alpha - 1) * u1).clamp(min=1e-8))
+        cos = torch.where(u3 < self.q_spec[pix], cos_h, cos_d)
+        sin = torch.sqrt((1 - cos * cos).clamp(min=0))
+        phi = 2 * np.pi * u2
+        n = self.normal[pix]
+        local = self.t[pix] * (sin * torch.cos(phi)) + self.b[pix] * (sin * torch.sin(phi)) + n * cos
+        v = self.view[pix]
+        reflected = 2 * torch.sum(v * local, dim=-1, keepdim=True) * local - v
+        return safe_l2_normalize(torch.where(u3 < self.q_spec[pix], reflected, local), dim=-1)
+
+    def pdf(self, pix, dirs):
+        '''- return: [M, 1] pdf per steradian of dirs drawn for the pixels pix'''
+        n, v = self.normal[pix], self.view[pix]
+        NoL = torch.sum(n * dirs, dim=-1, keepdim=True).clamp(min=0)
+        h = safe_l2_normalize(dirs + v, dim=-1)
+        NoH = torch.sum(n * h, dim=-1, keepdim=True).clamp(min=0)
+        VoH = torch.sum(v * h, dim=-1, keepdim=True).clamp(min=1e-6)
+        spec = ggx_D(NoH, self.roughness[pix]) * NoH / (4 * VoH)
+        q = self.q_spec[pix]
+        return q * spec + (1 - q) * NoL / np.pi
+
+
+def render_with_BRDF_adaptive(
+        surface_xyz,
+        normal_map,
+        albedo_map,
+        roughness_map,
+        fresnel_map,
+        surf2c,
+        light_idx,
+        tensoIR,
+        chunk_size=15000,
+        device='cuda',
+        args=None
+):
+    '''linear radiance of the rendering equation estimated with light_samples directions per pixel
+    instead of every envmap direction. The budget of a pixel is split between its BRDF lobe
+    (a larger share for smoother surfaces) and the envmap importance sampler, the two are combined
+    with the balance heuristic of multiple importance sampling; directions below the horizon are
+    dropped and the remaining (pixel, direction) pairs are shaded as one dense batch.
+    - return:
+        - rgb: [bs, 3] linear rgb, stats: {name: value} of the estimate
+    '''
+    bs = surface_xyz.shape[0]
+    K = int(getattr(args, 'light_samples', 128))
+    normal = safe_l2_normalize(normal_map, dim=-1)
+    roughness = roughness_map[:, :1].clamp(0.02, 1.0)    # [bs, 1]
+
+    # directions per pixel from the BRDF lobe, the rest from the envmap
+    brdf_share = (1.0 - roughness).clamp(getattr(args, 'light_brdf_share_min', 0.25), getattr(args, 'light_brdf_share_max', 0.75))
+    n_brdf = torch.round(brdf_share * K)                 # [bs, 1]
+    n_env = K - n_brdf
+    # GGX lobe vs cosine lobe, by the energy of the specular term against the diffuse one
+    spec_energy = fresnel_map.mean(-1, keepdim=True) / roughness.clamp(min=0.1)
+    q_spec = (spec_energy / (spec_energy + albedo_map.mean(-1, keepdim=True))).clamp(0.2, 0.8)
+
+    lobe = BRDFLobeSampler(normal, surf2c, roughness, q_spec)
+    env = tensoIR.get_envmap_sampler(device)
+
+    slot = torch.arange(K, device=device)[None, :].expand(bs, K)
+    pix = torch.arange(bs, device=device)[:, None].expand(bs, K).reshape(-1)
+    from_brdf = (slot < n_brdf).reshape(-1)
+    dirs = torch.empty((bs * K, 3), device=device)
+    dirs[from_brdf] = lobe.sample(pix[from_brdf])
+    dirs[~from_brdf] = env.sample(int((~from_brdf).sum().item()))[0]
+
+    # back-facing directions contribute nothing, compact the others
+    cosine = torch.sum(dirs * normal[pix], dim=-1)
+    keep = cosine > 1e-6
+    pix, dirs, cosine = pix[keep], dirs[keep], cosine[keep, None]
+
+    visibility, indirect_light = compute_secondary_shading_effects(
+        tensoIR=tensoIR,
+        surface_pts=surface_xyz[pix],
+        surf2light=dirs,
+        light_idx=light_idx[pix],
+        nSample=args.second_nSample,
+        vis_near=args.second_near,
+        vis_far=args.second_far,
+        chunk_size=chunk_size,
+        device=device,
+        cache=getattr(tensoIR, 'secondary_cache', None),
+        marcher=getattr(args, 'second_marcher', 'linspace')
+    )
+    direct_light = tensoIR.get_light_rgbs(dirs, device=device)                          # [light_num, M, 3]
+    direct_light = direct_light[light_idx[pix].view(-1).long(), torch.arange(dirs.shape[0], device=device)]
+    specular = brdf_specular(normal[pix], surf2c[pix], dirs[:, None], roughness_map[pix], fresnel_map[pix])[:, 0]
+    brdf = albedo_map[pix] / np.pi + specular
+
+    # balance heuristic over the samples of both techniques
+    mixture = n_brdf[pix] * lobe.pdf(pix, dirs) + n_env[pix] * env.pdf(dirs)
+    contrib = brdf * (visibility * direct_light + indirect_light) * cosine / mixture.clamp(min=1e-8)
+    rgb = torch.zeros((bs, 3), device=device).index_add(0, pix, contrib)
+
+    with torch.no_grad():
+        # variance of the estimate: K x contrib are the single sample estimates
+        y = contrib.mean(-1) * K
+        y_sum = torch.zeros(bs, device=device).index_add_(0, pix, y)
+        y2_sum = torch.zeros(bs, device=device).index_add_(0, pix, y * y)
+        variance = (y2_sum / K - (y_sum / K) ** 2).clamp(min=0) / max(K - 1, 1)
+    stats = {
+        'relight_dirs_per_px': dirs.shape[0] / max(bs, 1),
+        'relight_variance': variance.mean(),
+    }
+    return rgb, stats
+
+
 def render_with_BRDF(
         depth_map,
         normal_map,
@@ -521,10 +756,35 @@ def render_with_BRDF(
     rays_o, rays_d = rays[..., :3].to(device), rays[..., 3:].to(device)  # [bs, 3]
     surface_xyz = rays_o + (surface_z).unsqueeze(-1) * rays_d  # [bs, 3]
 
+    if sample_method == 'adaptive':
+        surf2c = safe_l2_normalize(-rays_d, dim=-1)  # [bs, 3]
+        rgb_with_brdf, stats = render_with_BRDF_adaptive(surface_xyz, normal_map, albedo_map, roughness_map, fresnel_map,
+                                                         surf2c, light_idx, tensoIR, chunk_size, device, args)
+        # every light_check_every calls, the error against the dense estimate on a few pixels
+        check_every = getattr(args, 'light_check_every', 100)
+        tensoIR.relight_calls = getattr(tensoIR, 'relight_calls', 0) + 1
+        if check_every > 0 and tensoIR.relight_calls % check_every == 0 and rgb_with_brdf.shape[0] > 0:
+            n = min(getattr(args, 'light_check_pixels', 256), rgb_with_brdf.shape[0])
+            with torch.no_grad():
+                dense, _ = render_with_BRDF(depth_map[:n], normal_map[:n], albedo_map[:n], roughness_map[:n],
+                                            fresnel_map[:n], rays[:n], tensoIR, sample_method='fixed_envirmap',
+                                            chunk_size=chunk_size, device=device, use_linear2srgb=False, args=args)
+                stats['relight_mse_vs_dense'] = torch.mean((rgb_with_brdf[:n].detach().clamp(0, 1) - dense) ** 2)
+        tensoIR.relight_stats = stats
+        rgb_with_brdf = torch.clamp(rgb_with_brdf, min=0.0, max=1.0)
+        if use_linear2srgb and rgb_with_brdf.shape[0] > 0:
+            rgb_with_brdf = linear2srgb_torch(rgb_with_brdf)
+        return rgb_with_brdf, surface_xyz
+
     ## Get incident light direction
     light_area_weight = tensoIR.light_area_weight.to(device) # [envW * envH, ]
 
-    incident_light_dirs = tensoIR.gen_light_incident_dirs(method=sample_method).to(device)  # [envW * envH, 3]
+    if sample_method == 'importance_sample':
+        # Monte Carlo weights 1 / (n * pdf) in place of the pixel solid angles
+        incident_light_dirs, _, light_pdf = tensoIR.gen_light_incident_dirs(sample_number=light_area_weight.shape[0], method=sample_method, device=device)
+        light_area_weight = 1.0 / (light_pdf.view(-1).clamp(min=1e-8) * incident_light_dirs.shape[0])
+    else:
+        incident_light_dirs = tensoIR.gen_light_incident_dirs(method=sample_method).to(device)  # [envW * envH, 3]
     surf2l = incident_light_dirs.reshape(1, -1, 3).repeat(surface_xyz.shape[0], 1, 1)  # [bs, envW * envH, 3]
     surf2c = -rays_d  # [bs, 3]
     surf2c = safe_l2_normalize(surf2c, dim=-1)  # [bs, 3]
@@ -546,7 +806,9 @@ def render_with_BRDF(
                                                         vis_near=args.second_near,
                                                         vis_far=args.second_far,
                                                         chunk_size=chunk_size,
-                                                        device=device
+                                                        device=device,
+                                                        cache=getattr(tensoIR, 'secondary_cache', None),
+                                                        marcher=getattr(args, 'second_marcher', 'linspace')
                                                     )
     visibility_to_use = visibility_compute
     ## Get BRDF specs
@@ -692,6 +954,19 @@ def sph2cart(pts_sph: np.array, convention='lat-lng'):
 
 
 
+def latlong_entry(path):
+    '''the rgb of a latlong HDR and the pdfs of importance sampling it, as an EnvmapCache entry'''
+    light_rgbs = torch.from_numpy(read_hdr(path))
+    light_intensity = torch.sum(light_rgbs, dim=2, keepdim=True) # [H, W, 1]
+    env_map_h, env_map_w, _ = light_intensity.shape
+    h_interval = 1.0 / env_map_h
+    sin_theta = torch.sin(torch.linspace(0 + 0.5 * h_interval, np.pi - 0.5 * h_interval, env_map_h))
+    pdf = light_intensity * sin_theta.view(-1, 1, 1) # [H, W, 1]
+    pdf = pdf / torch.sum(pdf)
+    pdf_return = pdf * env_map_h * env_map_w / (2 * np.pi * np.pi * sin_theta.view(-1, 1, 1))
+    return {'rgb': light_rgbs, 'pdf': pdf, 'pdf_return': pdf_return}
+
+
 def read_hdr(path):
     """Reads an HDR map from disk.
 
@@ -730,7 +1005,7 @@ def compute_visibility(tensoIR, pts, light_xyz, nSample, vis_near, vis_far, args
     surface_pts = surface_pts.reshape(-1, 3)  # [N*preditected_light_num, 3]
     surf2light = surf2light.reshape(-1, 3)  # [N*preditected_light_num, 3]
     visibility = torch.zeros((surface_pts.shape[0]), dtype=torch.float32).to(device) # [N*preditected_light_num, 1]
-    chunk_idxs = torch.split(torch.arange(surface_pts.shape[0]), 81920) # to save memory TODO: chunk size should be configurable
+    chunk_idxs = chunking.split('compute_visibility', surface_pts.shape[0], 81920, device) # to save memory
     for chunk_idx in chunk_idxs:
         chunk_surface_pts = surface_pts[chunk_idx]  # [chunk_size, 3]
         chunk_surf2light = surf2light[chunk_idx]    # [chunk_size, 3]
@@ -771,7 +1046,8 @@ def compute_transmittance(tensoIR, surf_pts, light_in_dir, nSample=128, vis_near
                                                         light_in_dir,
                                                         nSample=nSample,
                                                         vis_near=vis_near,
-                                                        vis_far=vis_far
+                                                        vis_far=vis_far,
+                                                        device=surf_pts.device
                                                         )
     dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
 
@@ -847,7 +1123,7 @@ def compute_visibility_and_indirect_light(tensoIR, pts, light_xyz, light_idx, nS
 
     visibility = torch.zeros((surface_pts.shape[0]), dtype=torch.float32).to(device) # [N*preditected_light_num, 1]
     indirect_light = torch.zeros((surface_pts.shape[0], 3), dtype=torch.float32).to(device) # [N*preditected_light_num, 1]
-    chunk_idxs = torch.split(torch.arange(surface_pts.shape[0]), 81920) # to save memory TODO: chunk size should be configurable
+    chunk_idxs = chunking.split('compute_visibility_and_indirect_light', surface_pts.shape[0], 81920, device) # to save memory
     for chunk_idx in chunk_idxs:
         chunk_surface_pts = surface_pts[chunk_idx]  # [chunk_size, 3]
         chunk_surf2light = surf2light[chunk_idx]    # [chunk_size, 3]
@@ -891,7 +1167,8 @@ def compute_radiance(tensoIR, surf_pts, light_in_dir, light_idx, nSample=128, vi
                                                         light_in_dir,
                                                         nSample=nSample,
                                                         vis_near=vis_near,
-                                                        vis_far=vis_far
+                                                        vis_far=vis_far,
+                                                        device=surf_pts.device
                                                         )
     dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
 
@@ -931,6 +1208,153 @@ def compute_radiance(tensoIR, surf_pts, light_in_dir, light_idx, nSample=128, vi
     return nerv_vis, nerfactor_vis, indirect_light
 
 
+def alpha_mask_cells(alphaMask, cell_size):
+    '''coarse cells of cell_size^3 voxels over the alphaMask, occupied when sample_alpha can be non zero
+    somewhere in them: trilinear interpolation reads the two voxels around a point, the cells are dilated by
+    one voxel around the nearest one so that rounding never misses them. Cached on the alphaMask, which is
+    replaced whenever it is updated.
+    - return:
+        - [X + 2, Y + 2, Z + 2] voxels padded by one on both sides, pooled into cells, bool
+    '''
+    cached = getattr(alphaMask, 'skip_cells', None)
+    if cached is not None and cached[0] == cell_size:
+        return cached[1]
+    volume = (alphaMask.alpha_volume > 0).float().permute(0, 1, 4, 3, 2)  # [1, 1, X, Y, Z]
+    volume = F.max_pool3d(F.pad(volume, (1, 1) * 3), kernel_size=3, stride=1, padding=1)
+    cells = F.max_pool3d(volume, kernel_size=cell_size, stride=cell_size, ceil_mode=True)[0, 0] > 0
+    alphaMask.skip_cells = (cell_size, cells)
+    return cells
+
+
+def cell_occupancy(tensoIR, xyz, cell_size=4):
+    '''occupancy of the cells the points are in, looked up without interpolation
+    - return:
+        - [N, ] bool, or None when the model has no occupancy information
+        - exact: False when the cells only bound the alphaMask, whose samples in occupied cells are still to be
+            tested, True for the occupancy grid of the sampler, used when there is no alphaMask
+    '''
+    if tensoIR.alphaMask is not None:
+        mask = tensoIR.alphaMask
+        cells = alpha_mask_cells(mask, cell_size)
+        # nearest voxel, shifted by the padding
+        idx = torch.round((xyz - mask.aabb[0]) / mask.aabbSize * (mask.grid_size - 1)).long() + 1
+        inside = ((idx >= 0) & (idx <= mask.grid_size + 1)).all(dim=-1)
+        idx = torch.div(idx.clamp(min=0), cell_size, rounding_mode='floor')
+        idx = torch.minimum(idx, torch.tensor(cells.shape, device=xyz.device) - 1)
+        return cells[idx[:, 0], idx[:, 1], idx[:, 2]] & inside, False
+    occ_grid = getattr(getattr(tensoIR, 'sampler', None), 'occ_grid', None)
+    if occ_grid is not None:
+        binaries = occ_grid.binaries[0]  # [R, R, R] of the finest level
+        roi = occ_grid.aabbs[0].to(xyz.device)
+        reso = torch.tensor(binaries.shape, device=xyz.device)
+        idx = ((xyz - roi[:3]) / (roi[3:] - roi[:3]) * reso).long()
+        inside = ((idx >= 0) & (idx < reso)).all(dim=-1)
+        idx = torch.minimum(idx.clamp(min=0), reso - 1)
+        return binaries[idx[:, 0], idx[:, 1], idx[:, 2]] & inside, True
+    return None, True
+
+
+@torch.no_grad()
+def compute_radiance_skipping(tensoIR, surf_pts, light_in_dir, light_idx, nSample=128, vis_near=0.05, vis_far=1.5,
+                              device=None, segment_size=16, T_thre=1e-4, cell_size=4, stats=None):
+    '''drop-in replacement of compute_radiance that skips empty cells and terminates rays early
+    Samples are the same as in compute_radiance. Instead of interpolating the alphaMask at every sample, the
+    samples are first looked up in coarse cells of the alphaMask (alpha_mask_cells): a sample in an empty cell
+    is skipped without touching the alphaMask or the density, and a ray without an occupied cell is not marched.
+    The other samples are marched segment by segment from the surface outwards; the alphaMask is interpolated
+    only at the samples of a segment that lie in occupied cells, the density only where it is occupied, as in
+    compute_radiance. A ray stops once its transmittance is below T_thre, so the samples behind an opaque
+    surface are not queried at all. Without an alphaMask the occupancy grid of the sampler, if any, is the cells.
+    - args:
+        - segment_size: number of samples marched between two termination checks
+        - T_thre: transmittance below which a ray is terminated
+        - cell_size: edge of the cells in voxels of the alphaMask
+        - stats: optional dict accumulating 'rays', 'samples' (density queries), 'samples_dense' (samples in
+            the aabb), 'samples_cells' (samples in occupied cells) and 'samples_masked' (alphaMask lookups)
+    - return:
+        - same as compute_radiance
+    '''
+    xyz_sampled, z_vals, ray_valid = sample_ray_equally(tensoIR,
+                                                        surf_pts,
+                                                        light_in_dir,
+                                                        nSample=nSample,
+                                                        vis_near=vis_near,
+                                                        vis_far=vis_far,
+                                                        device=surf_pts.device
+                                                        )
+    dists = torch.cat((z_vals[:, 1:] - z_vals[:, :-1], torch.zeros_like(z_vals[:, :1])), dim=-1)
+    dists = dists * tensoIR.distance_scale  # [1, nSample]
+
+    light_idx = light_idx.view(-1, 1, 1).expand((*xyz_sampled.shape[:-1], 1)) # (batch_N, n_sammple, 1)
+    viewdirs = light_in_dir.view(-1, 1, 3).expand(xyz_sampled.shape) # (batch_N, N_samples, 3)
+    n_dense = int(ray_valid.sum())
+    in_cells, exact = cell_occupancy(tensoIR, xyz_sampled[ray_valid], cell_size)
+    if in_cells is not None:
+        ray_valid[ray_valid.clone()] = in_cells
+    n_cells = int(ray_valid.sum())
+
+    sigma = torch.zeros(xyz_sampled.shape[:-1], device=xyz_sampled.device)
+    indirect_light = torch.zeros((*xyz_sampled.shape[:2], 3), device=xyz_sampled.device)
+    transmittance = torch.ones(xyz_sampled.shape[0], device=xyz_sampled.device)
+    alive = ray_valid.any(dim=-1)  # rays that never enter an occupied cell are not marched at all
+    n_queried, n_masked = 0, 0
+    for begin in range(0, nSample, segment_size):
+        end = min(begin + segment_size, nSample)
+        rays = torch.nonzero(alive).squeeze(-1)
+        if rays.shape[0] == 0:
+            break
+        seg_valid = ray_valid[rays, begin:end]
+        if not seg_valid.any():
+            continue
+        seg_xyz = xyz_sampled[rays, begin:end][seg_valid]
+        if not exact:
+            occupied = tensoIR.alphaMask.sample_alpha(seg_xyz) > 0
+            n_masked += seg_xyz.shape[0]
+            seg_valid[seg_valid.clone()] = occupied
+            seg_xyz = seg_xyz[occupied]
+        seg_sigma = torch.zeros(seg_valid.shape, device=xyz_sampled.device)
+        if seg_xyz.shape[0] > 0:
+            seg_xyz = tensoIR.normalize_coord(seg_xyz)
+            seg_sigma[seg_valid] = tensoIR.feature2density(tensoIR.compute_densityfeature(seg_xyz))
+            sigma[rays, begin:end] = seg_sigma
+            n_queried += seg_xyz.shape[0]
+
+        seg_alpha = 1. - torch.exp(-seg_sigma * dists[:, begin:end])
+        transmittance[rays] *= torch.prod(1. - seg_alpha + 1e-10, dim=-1)
+        alive[rays] = transmittance[rays] > T_thre
+
+    # terminated samples keep a zero density, they only carried a weight below T_thre
+    alpha, weight, transmittance = raw2alpha(sigma, dists)
+
+    app_mask = weight > tensoIR.alphaMask_thres
+    if app_mask.any():
+        xyz_sampled = tensoIR.normalize_coord(xyz_sampled)
+        radiance_field_feat = tensoIR.compute_appfeature(xyz_sampled[app_mask], light_idx[app_mask])
+        indirect_light[app_mask] = tensoIR.renderModule(xyz_sampled[app_mask], viewdirs[app_mask], radiance_field_feat)
+
+    acc_map = torch.sum(weight, -1) # [N, ]
+    nerv_vis = transmittance.squeeze(-1)    # NeRV's way to accumulate visibility
+    nerfactor_vis = 1 - acc_map             # nerfactor's way to accumulate visibility
+
+    indirect_light = torch.sum(weight[..., None] * indirect_light, -2)
+
+    if stats is not None:
+        stats['rays'] = stats.get('rays', 0) + xyz_sampled.shape[0]
+        stats['samples'] = stats.get('samples', 0) + n_queried
+        stats['samples_dense'] = stats.get('samples_dense', 0) + n_dense
+        stats['samples_cells'] = stats.get('samples_cells', 0) + n_cells
+        stats['samples_masked'] = stats.get('samples_masked', 0) + n_masked
+
+    return nerv_vis, nerfactor_vis, indirect_light
+
+
+# marchers for the secondary rays, selected with `second_marcher`
+radiance_marchers = {
+    'linspace': compute_radiance,
+    'skipping': compute_radiance_skipping,
+}
+
+
 def render_envmap_sg(lgtSGs, viewdirs):
     viewdirs = viewdirs.to(lgtSGs.device)
     viewdirs = viewdirs.unsqueeze(-2)  # [..., 1, 3]
@@ -0,0 +1,246 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from models.tensoIR.relight_utils import compute_secondary_shading_effects
+
+
+class SecondaryShadingCache():
+    '''Cache of visibility and indirect light for compute_secondary_shading_effects.
+
+    Only the far part of a secondary ray is cached: the samples closer to the surface point than
+    near_cells cell diagonals are always marched from the point itself, so the self-shadowing of the
+    surface (where the interpolation between vertices inside and outside of the object would be
+    biased) is exact. The far part, from there to vis_far, is stored on the vertices of a res^3 grid
+    over the scene aabb, crossed with the envmap pixel the incident direction falls into, and queried
+    by trilinear interpolation over the 8 vertices of the cell. Near and far are joined as along a
+    single ray: visibility = T_near * T_far, indirect = indirect_near + T_near * indirect_far, on the
+    same samples as the exact march.
+    Only vertices around the occupied part of the alphaMask are allocated. A query is a hit when all
+    8 vertices hold a value for its direction bin; misses are computed by the exact march and schedule
+    their missing vertices to be filled. Every `refresh_every` steps the oldest `refresh_ratio` of the
+    entries are recomputed.
+    '''
+    def __init__(self, res=48, envmap_h=16, envmap_w=32, light_num=1, refresh_every=500,
+                 refresh_ratio=0.1, fill_budget=262144, check_ratio=0.01, near_cells=2.0, device='cuda'):
+        self.res = res
+        self.envmap_h = envmap_h
+        self.envmap_w = envmap_w
+        self.n_dirs = envmap_h * envmap_w
+        self.light_num = light_num
+        self.refresh_every = refresh_every
+        self.refresh_ratio = refresh_ratio
+        self.fill_budget = fill_budget
+        self.check_ratio = check_ratio
+        self.near_cells = near_cells
+        self.device = device
+
+        self.alphaMask = None
+        self.march_args = None
+        self.step = 0
+        self.reset_stats()
+
+        lat_step_size = np.pi / envmap_h
+        lng_step_size = 2 * np.pi / envmap_w
+        phi, theta = torch.meshgrid([torch.linspace(np.pi / 2 - 0.5 * lat_step_size, -np.pi / 2 + 0.5 * lat_step_size, envmap_h),
+                                     torch.linspace(np.pi - 0.5 * lng_step_size, -np.pi + 0.5 * lng_step_size, envmap_w)], indexing='ij')
+        self.bin_dirs = torch.stack([torch.cos(theta) * torch.cos(phi),
+                                     torch.sin(theta) * torch.cos(phi),
+                                     torch.sin(phi)], dim=-1).view(-1, 3).to(device)  # [envH * envW, 3]
+
+    def reset_stats(self):
+        self.n_query = 0
+        self.n_hit = 0
+        self.n_check = 0
+        self.check_vis_err = 0.
+        self.check_indirect_err = 0.
+        self.staleness_vis_err = 0.
+        self.staleness_indirect_err = 0.
+
+    def stats(self):
+        '''hit rate of the lookups and mean abs errors since the last report'''
+        n_valid = int((self.stamp >= 0).sum()) if self.alphaMask is not None else 0
+        return {
+            'hit_rate': self.n_hit / max(self.n_query, 1),
+            'check_vis_err': self.check_vis_err / max(self.n_check, 1),
+            'check_indirect_err': self.check_indirect_err / max(self.n_check, 1),
+            'staleness_vis_err': self.staleness_vis_err,
+            'staleness_indirect_err': self.staleness_indirect_err,
+            'entries': n_valid,
+        }
+
+    @torch.no_grad()
+    def build(self, tensoIR, march_args):
+        '''allocate vertices around the occupied cells of tensoIR.alphaMask, dropping all entries'''
+        self.alphaMask = tensoIR.alphaMask
+        self.march_args = march_args
+        self.aabb = tensoIR.aabb.clone().to(self.device)
+
+        res = self.res
+        # the first n_near sample intervals are marched from the surface point, the rest is cached
+        nSample, vis_near, vis_far, _ = march_args
+        step = (vis_far - vis_near) / (nSample - 1)
+        diagonal = ((self.aabb[1] - self.aabb[0]) / (res - 1)).norm().item()
+        self.n_near = min(int(math.ceil(self.near_cells * diagonal / step)), nSample - 2)
+        self.split = vis_near + self.n_near * step
+
+        samples = torch.stack(torch.meshgrid(
+            torch.linspace(0, 1, res), torch.linspace(0, 1, res), torch.linspace(0, 1, res), indexing='ij'), -1).to(self.device)
+        self.vert_xyz = (self.aabb[0] * (1 - samples) + self.aabb[1] * samples).view(-1, 3)  # [res^3, 3]
+        occupied = (self.alphaMask.sample_alpha(self.vert_xyz) > 0).float().view(1, 1, res, res, res)
+        # dilate by one vertex so that every cell touching the surface has all its corners
+        occupied = F.max_pool3d(occupied, kernel_size=3, padding=1, stride=1).view(-1) > 0
+
+        self.vert_slot = torch.full((res ** 3,), -1, dtype=torch.long, device=self.device)
+        self.slot_vert = torch.nonzero(occupied).squeeze(-1)
+        self.vert_slot[self.slot_vert] = torch.arange(self.slot_vert.shape[0], device=self.device)
+        n_slots = self.slot_vert.shape[0]
+
+        # [vis, indirect rgb], and the step at which every entry was computed (-1: empty)
+        self.values = torch.zeros((self.light_num, n_slots, self.n_dirs, 4), dtype=torch.float16, device=self.device)
+        self.stamp = torch.full((self.light_num, n_slots, self.n_dirs), -1, dtype=torch.int32, device=self.device)
+        print(f'secondary shading cache: {n_slots} / {res ** 3} vertices allocated '
+              f'({self.values.numel() * 2 / 2 ** 20:.1f} MB)')
+
+    def dir_bin(self, dirs):
+        phi = torch.asin(dirs[:, 2].clamp(-1, 1))
+        theta = torch.atan2(dirs[:, 1], dirs[:, 0])
+        row = ((np.pi / 2 - phi) / np.pi * self.envmap_h).long().clamp(0, self.envmap_h - 1)
+        col = ((np.pi - theta) / (2 * np.pi) * self.envmap_w).long().clamp(0, self.envmap_w - 1)
+        return row * self.envmap_w + col
+
+    def march(self, tensoIR, pts, dirs, light_idx, chunk_size, device, part='all'):
+        '''the exact march over all samples, or over the near / far ones only
+        near ends with the first far sample, whose interval is zero (the last one of a march) and so adds nothing
+        '''
+        nSample, vis_near, vis_far, marcher = self.march_args
+        if part == 'near':
+            nSample, vis_far = self.n_near + 1, self.split
+        elif part == 'far':
+            nSample, vis_near = nSample - self.n_near, self.split
+        return compute_secondary_shading_effects(tensoIR, pts, dirs, light_idx, nSample=nSample, vis_near=vis_near,
+                                                 vis_far=vis_far, chunk_size=chunk_size, device=device, marcher=marcher)
+
+    @torch.no_grad()
+    def fill(self, tensoIR, light_idx, slot, dir_idx, chunk_size, device):
+        '''compute the far part of the entries (light_idx, slot, dir_idx) with the exact march'''
+        vis, indirect = self.march(tensoIR, self.vert_xyz[self.slot_vert[slot]], self.bin_dirs[dir_idx],
+                                   light_idx.view(-1, 1), chunk_size, device, part='far')
+        new_values = torch.cat([vis, indirect], dim=-1)
+        self.values[light_idx, slot, dir_idx] = new_values.to(self.values.dtype)
+        self.stamp[light_idx, slot, dir_idx] = self.step
+        return new_values
+
+    @torch.no_grad()
+    def query(self, tensoIR, surface_pts, surf2light, light_idx, nSample, vis_near, vis_far, chunk_size, device,
+              marcher='linspace'):
+        '''same interface and return values as compute_secondary_shading_effects'''
+        march_args = (nSample, vis_near, vis_far, marcher)
+        if tensoIR.alphaMask is None:
+            return compute_secondary_shading_effects(tensoIR, surface_pts, surf2light, light_idx, nSample=nSample,
+                                                     vis_near=vis_near, vis_far=vis_far, chunk_size=chunk_size,
+                                                     device=device, marcher=marcher)
+        if tensoIR.alphaMask is not self.alphaMask or march_args != self.march_args:
+            self.build(tensoIR, march_args)
+
+        N = surface_pts.shape[0]
+        res = self.res
+        light_idx = light_idx.view(-1).long()
+        dir_idx = self.dir_bin(surf2light)
+
+        grid = (surface_pts - self.aabb[0]) / (self.aabb[1] - self.aabb[0]) * (res - 1)
+        inside = ((grid >= 0) & (grid <= res - 1)).all(dim=-1)
+        base = grid.floor().long().clamp(0, res - 2)
+        frac = (grid - base).clamp(0, 1)
+
+        corner_slots, corner_weights = [], []
+        for dx in (0, 1):
+            for dy in (0, 1):
+                for dz in (0, 1):
+                    vert = (base[:, 0] + dx) * res * res + (base[:, 1] + dy) * res + (base[:, 2] + dz)
+                    corner_slots.append(self.vert_slot[vert])
+                    corner_weights.append((frac[:, 0] if dx else 1 - frac[:, 0]) *
+                                          (frac[:, 1] if dy else 1 - frac[:, 1]) *
+                                          (frac[:, 2] if dz else 1 - frac[:, 2]))
+        corner_slots = torch.stack(corner_slots, dim=-1)  # [N, 8]
+        corner_weights = torch.stack(corner_weights, dim=-1)  # [N, 8]
+
+        allocated = (corner_slots >= 0).all(dim=-1) & inside
+        corner_stamp = torch.full(corner_slots.shape, -1, dtype=torch.int32, device=corner_slots.device)
+        corner_stamp[allocated] = self.stamp[light_idx[allocated, None], corner_slots[allocated],
+                                             dir_idx[allocated, None]]
+        hit = allocated & (corner_stamp >= 0).all(dim=-1)
+
+        visibility = torch.zeros((N, 1), dtype=torch.float32, device=device)
+        indirect_light = torch.zeros((N, 3), dtype=torch.float32, device=device)
+
+        if hit.any():
+            values = self.values[light_idx[hit, None], corner_slots[hit], dir_idx[hit, None]].float()  # [hit, 8, 4]
+            values = torch.sum(values * corner_weights[hit][..., None], dim=1)
+            near_vis, near_indirect = self.march(tensoIR, surface_pts[hit], surf2light[hit],
+                                                 light_idx[hit].view(-1, 1), chunk_size, device, part='near')
+            visibility[hit] = near_vis * values[:, :1]
+            indirect_light[hit] = near_indirect + near_vis * values[:, 1:]
+
+        miss = ~hit
+        if miss.any():
+            visibility[miss], indirect_light[miss] = self.march(
+                tensoIR, surface_pts[miss], surf2light[miss], light_idx[miss].view(-1, 1), chunk_size, device)
+
+            # schedule the empty corners of the allocated misses, limited by fill_budget per query
+            need = (allocated & miss)[:, None] & (corner_stamp < 0)
+            if need.any():
+                keys = (light_idx[:, None].expand(-1, 8)[need] * self.values.shape[1] + corner_slots[need]) * self.n_dirs \
+                       + dir_idx[:, None].expand(-1, 8)[need]
+                keys = torch.unique(keys)
+                keys = keys[torch.randperm(keys.shape[0], device=keys.device)[:self.fill_budget]]
+                self.fill(tensoIR, keys // (self.values.shape[1] * self.n_dirs),
+                          keys // self.n_dirs % self.values.shape[1], keys % self.n_dirs, chunk_size, device)
+
+        # compare a few hits against the exact march
+        n_hit = int(hit.sum())
+        if n_hit > 0 and self.check_ratio > 0:
+            check = torch.nonzero(hit).squeeze(-1)
+            check = check[torch.randperm(n_hit, device=check.device)[:max(1, int(n_hit * self.check_ratio))]]
+            exact_vis, exact_indirect = self.march(
+                tensoIR, surface_pts[check], surf2light[check], light_idx[check].view(-1, 1), chunk_size, device)
+            self.check_vis_err += (visibility[check] - exact_vis).abs().sum().item()
+            self.check_indirect_err += (indirect_light[check] - exact_indirect).abs().mean(-1).sum().item()
+            self.n_check += check.shape[0]
+
+        self.n_query += N
+        self.n_hit += n_hit
+        return visibility, indirect_light
+
+    @torch.no_grad()
+    def update_step(self, global_step, tensoIR, chunk_size=160000):
+        '''recompute the oldest entries every refresh_every steps and report the statistics'''
+        self.step = global_step
+        if self.alphaMask is None or self.refresh_every <= 0 or global_step % self.refresh_every != 0:
+            return
+        if tensoIR.alphaMask is not self.alphaMask:
+            # the geometry changed, entries are rebuilt lazily by the next query
+            self.alphaMask = None
+            return
+
+        flat_stamp = self.stamp.view(-1)
+        valid = torch.nonzero(flat_stamp >= 0).squeeze(-1)
+        n_refresh = min(int(math.ceil(valid.shape[0] * self.refresh_ratio)), self.fill_budget)
+        if n_refresh > 0:
+            oldest = valid[torch.topk(flat_stamp[valid], n_refresh, largest=False).indices]
+            n_slots = self.values.shape[1]
+            light_idx = oldest // (n_slots * self.n_dirs)
+            slot = oldest // self.n_dirs % n_slots
+            dir_idx = oldest % self.n_dirs
+            old_values = self.values[light_idx, slot, dir_idx].float()
+            new_values = self.fill(tensoIR, light_idx, slot, dir_idx, chunk_size, tensoIR.device)
+            err = (new_values - old_values).abs()
+            self.staleness_vis_err = err[:, 0].mean().item()
+            self.staleness_indirect_err = err[:, 1:].mean().item()
+
+        stats = self.stats()
+        print(f"secondary shading cache: hit rate {stats['hit_rate']:.3f}, entries {stats['entries']}, "
+              f"check err vis {stats['check_vis_err']:.4f} / indirect {stats['check_indirect_err']:.4f}, "
+              f"staleness vis {stats['staleness_vis_err']:.4f} / indirect {stats['staleness_indirect_err']:.4f}")
+        self.reset_stats()
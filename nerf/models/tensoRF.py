@@ -7,8 +7,9 @@ class TensorVM(TensorBase):
         super(TensorVM, self).__init__(args, device, aabb, grid_size=reso_cur)
 
     def init_svd_volume(self, args):
-        self.density = DensityVM(args.density.n_comp, self.grid_size)
-        self.app = AppVM(args.app.n_comp, self.grid_size, args.app.feature_dim)
+        vm_sampler = getattr(args, 'vm_sampler', 'grid_sample')
+        self.density = DensityVM(args.density.n_comp, self.grid_size, sampler=vm_sampler)
+        self.app = AppVM(args.app.n_comp, self.grid_size, args.app.feature_dim, sampler=vm_sampler)
 
     def get_optparam_groups(self, conf, lr_scale=1.0):
         grad_vars = [{'params': self.density.line, 'lr': conf.lr_init * lr_scale},
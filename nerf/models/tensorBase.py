@@ -3,11 +3,13 @@ import nerfacc
 import numpy as np
 import os
 import sys
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from tqdm import tqdm
 
+import chunking
 from models.basemodel import BaseModel
 from models.renderer import SHRender, RGBRender, MLPRender, MLPRender_Fea, MLPRender_PE
 
@@ -171,7 +173,7 @@ class TensorBase(BaseModel):
             ckpt.update({'alphaMask.shape': alpha_volume.shape})
             ckpt.update({'alphaMask.mask': np.packbits(alpha_volume.reshape(-1))})
             ckpt.update({'alphaMask.aabb': self.alphaMask.aabb.cpu()})
-        torch.save(ckpt, path + '/model.pt')
+        self.writer.save_checkpoint(ckpt, path + '/model.pt')
 
     def load(self, ckpt):
         if 'alphaMask.aabb' in ckpt.keys():
@@ -217,30 +219,124 @@ class TensorBase(BaseModel):
                 (grid_size[1], grid_size[2]))
         return alpha, dense_xyz
 
+    def brick_maybe_occupied(self, xyz_min, xyz_max):
+        '''whether the previous alphaMask has an occupied voxel in the box. compute_alpha is zero
+        wherever the previous mask is empty, so a brick without one can be skipped'''
+        if self.alphaMask is None:
+            return True
+        mask = self.alphaMask
+        grid_size = mask.grid_size.float()
+        lo = torch.floor((xyz_min - mask.aabb[0]) / mask.aabbSize * (grid_size - 1)).long()
+        hi = torch.ceil((xyz_max - mask.aabb[0]) / mask.aabbSize * (grid_size - 1)).long()
+        if (hi < 0).any() or (lo > mask.grid_size - 1).any():
+            return False
+        lo, hi = lo.clamp(min=0), torch.minimum(hi, mask.grid_size - 1)
+        return bool(mask.alpha_volume[0, 0, lo[2]:hi[2] + 1, lo[1]:hi[1] + 1, lo[0]:hi[0] + 1].any())
+
+    @torch.no_grad()
+    def getBrickedAlphaMask(self, grid_size, brick_size=64):
+        '''same mask and bbox as thresholding the max-pooled getDenseAlpha, evaluated brick by brick
+        - args:
+            - brick_size: edge of the bricks, bounds the number of points queried at once to (brick_size + 2)^3
+        - return:
+            - alpha: [grid_size[2], grid_size[1], grid_size[0]] bool mask
+            - xyz_min, xyz_max: tight bbox of the mask, the current aabb when the mask is empty
+        peak_mem_mb in alpha_mask_stats is the peak above the memory in use before the call (cuda allocator,
+        or the RSS of the process off cuda), without resetting the peak counters: exact when the call raised
+        the peak (peak_exact), an upper bound otherwise; None when the platform does not tell.
+        '''
+        cuda = torch.device(self.device).type == 'cuda'
+        if cuda:
+            mem_before = torch.cuda.memory_allocated(self.device)
+            peak_before = torch.cuda.max_memory_allocated(self.device)
+        else:
+            mem_before, peak_before = chunking.host_rss(), chunking.host_peak()
+        tt = time.time()
+        lin = [torch.linspace(0, 1, n).to(self.device) for n in grid_size]
+        alpha = torch.zeros(grid_size[::-1], dtype=torch.bool, device=self.device)
+        idx_min = torch.tensor(grid_size, device=self.device)
+        idx_max = torch.full((3,), -1, dtype=torch.long, device=self.device)
+        n_bricks, n_skipped, n_points = 0, 0, 0
+
+        for i0 in range(0, grid_size[0], brick_size):
+            for j0 in range(0, grid_size[1], brick_size):
+                for k0 in range(0, grid_size[2], brick_size):
+                    n_bricks += 1
+                    begin = [i0, j0, k0]
+                    end = [min(b + brick_size, n) for b, n in zip(begin, grid_size)]
+                    # one voxel of halo for the max pooling
+                    halo_begin = [max(b - 1, 0) for b in begin]
+                    halo_end = [min(e + 1, n) for e, n in zip(end, grid_size)]
+                    samples = [lin[d][halo_begin[d]:halo_end[d]] for d in range(3)]
+
+                    lo = torch.stack([samples[d][0] for d in range(3)])
+                    hi = torch.stack([samples[d][-1] for d in range(3)])
+                    if not self.brick_maybe_occupied(self.aabb[0] * (1 - lo) + self.aabb[1] * lo,
+                                                     self.aabb[0] * (1 - hi) + self.aabb[1] * hi):
+                        n_skipped += 1
+                        continue
+
+                    samples = torch.stack(torch.meshgrid(*samples, indexing='ij'), -1)
+                    brick_xyz = self.aabb[0] * (1 - samples) + self.aabb[1] * samples
+                    brick_alpha = self.compute_alpha(brick_xyz.view(-1, 3), self.render_step_size)
+                    n_points += brick_alpha.shape[0]
+                    brick_alpha = brick_alpha.view(brick_xyz.shape[:3]).clamp(0, 1)
+                    brick_alpha = F.max_pool3d(brick_alpha.permute(2, 1, 0)[None, None], kernel_size=3,
+                                               padding=1, stride=1)[0, 0]
+                    brick_alpha = brick_alpha[begin[2] - halo_begin[2]:end[2] - halo_begin[2],
+                                              begin[1] - halo_begin[1]:end[1] - halo_begin[1],
+                                              begin[0] - halo_begin[0]:end[0] - halo_begin[0]] >= self.alphaMask_thres
+                    alpha[begin[2]:end[2], begin[1]:end[1], begin[0]:end[0]] = brick_alpha
+
+                    valid_idx = torch.nonzero(brick_alpha).flip(-1)  # (x, y, z)
+                    if valid_idx.shape[0] > 0:
+                        offset = torch.tensor(begin, device=self.device)
+                        idx_min = torch.minimum(idx_min, valid_idx.amin(0) + offset)
+                        idx_max = torch.maximum(idx_max, valid_idx.amax(0) + offset)
+
+        if (idx_max < 0).any():
+            # empty mask, no bbox to shrink to
+            xyz_min, xyz_max = self.aabb[0].clone(), self.aabb[1].clone()
+        else:
+            s_min = torch.stack([lin[d][idx_min[d]] for d in range(3)])
+            s_max = torch.stack([lin[d][idx_max[d]] for d in range(3)])
+            xyz_min = self.aabb[0] * (1 - s_min) + self.aabb[1] * s_min
+            xyz_max = self.aabb[0] * (1 - s_max) + self.aabb[1] * s_max
+
+        peak = torch.cuda.max_memory_allocated(self.device) if cuda else chunking.host_peak()
+        known = None not in (mem_before, peak_before, peak)
+        self.alpha_mask_stats = {
+            'seconds': time.time() - tt,
+            'bricks': n_bricks,
+            'bricks_skipped': n_skipped,
+            'points': n_points,
+            'peak_mem_mb': (peak - mem_before) / 2 ** 20 if known else None,
+            'peak_exact': known and peak > peak_before,
+        }
+        return alpha, xyz_min, xyz_max
+
     @torch.no_grad()
     def updateAlphaMask(self, grid_size=(200, 200, 200)):
-        alpha, dense_xyz = self.getDenseAlpha(grid_size)
-        dense_xyz = dense_xyz.transpose(0, 2).contiguous()
-        alpha = alpha.clamp(0, 1).transpose(0, 2).contiguous()[None, None]
+        grid_size = [int(n) for n in grid_size]
+        brick_size = getattr(self.config, 'alpha_mask_brick_size', 64)
+        alpha, xyz_min, xyz_max = self.getBrickedAlphaMask(grid_size, brick_size)
         total_voxels = grid_size[0] * grid_size[1] * grid_size[2]
 
-        ks = 3
-        alpha = F.max_pool3d(alpha, kernel_size=ks, padding=ks // 2,
-                             stride=1).view(grid_size[::-1])
-        alpha[alpha >= self.alphaMask_thres] = 1
-        alpha[alpha < self.alphaMask_thres] = 0
-
-        self.alphaMask = AlphaGridMask(self.device, self.aabb, alpha)
-
-        valid_xyz = dense_xyz[alpha > 0.5]
-
-        xyz_min = valid_xyz.amin(0)
-        xyz_max = valid_xyz.amax(0)
+        self.alphaMask = AlphaGridMask(self.device, self.aabb, alpha.float())
 
         new_aabb = torch.stack((xyz_min, xyz_max))
 
         total = torch.sum(alpha)
+        stats = self.alpha_mask_stats
+        if total == 0:
+            print('alpha mask is empty, keeping the current bbox')
         print(f"bbox: {xyz_min, xyz_max} alpha rest %%%f" % (total / total_voxels * 100))
+        if stats['peak_mem_mb'] is None:
+            peak = 'unknown'
+        else:
+            peak = f"{'' if stats['peak_exact'] else '<= '}{stats['peak_mem_mb']:.0f} MB"
+        print(f"alpha mask: {stats['seconds']:.2f}s, {stats['bricks_skipped']}/{stats['bricks']} bricks skipped, "
+              f"{stats['points']} points, peak mem {peak}")
         return new_aabb
 
     def feature2density(self, density_features):
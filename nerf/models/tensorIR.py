@@ -6,6 +6,7 @@ from models.tensorBase import *
 from models.renderer import *
 from models.myutils import *
 from models.tensoIR.relight_utils import *
+from models.tensoIR.secondary_cache import SecondaryShadingCache
 from utils import TVLoss, visualize_depth_numpy
 from models.volrend import rendering
 
@@ -28,6 +29,26 @@ class TensoIR(TensorBase):
 
         self.init_light()
 
+        self.secondary_cache = None
+        if getattr(self.config, 'secondary_cache', False):
+            self.secondary_cache = SecondaryShadingCache(
+                res=getattr(self.config, 'secondary_cache_res', 48),
+                envmap_h=self.envmap_h,
+                envmap_w=self.envmap_w,
+                light_num=self.light_num,
+                refresh_every=getattr(self.config, 'secondary_cache_refresh_every', 500),
+                refresh_ratio=getattr(self.config, 'secondary_cache_refresh_ratio', 0.1),
+                fill_budget=getattr(self.config, 'secondary_cache_fill_budget', 262144),
+                check_ratio=getattr(self.config, 'secondary_cache_check_ratio', 0.01),
+                near_cells=getattr(self.config, 'secondary_cache_near_cells', 2.0),
+                device=self.device,
+            )
+
+    def update_step(self, epoch, global_step, args):
+        super(TensoIR, self).update_step(epoch, global_step, args)
+        if self.secondary_cache is not None:
+            self.secondary_cache.update_step(global_step, self, chunk_size=getattr(self.config, 'relight_chunk_size', 160000))
+
     def init_render_func(self, app_dim, conf):
         super(TensoIR, self).init_render_func(app_dim, conf)
 
@@ -98,8 +119,9 @@ class TensoIR(TensorBase):
         self.light_rotation_matrix = torch.stack(self.light_rotation_matrix, dim=0) # [rotation_num, 3, 3]
 
     def init_svd_volume(self, args):
-        self.density = DensityVM(args.density.n_comp, self.grid_size)
-        self.app = AppVM(args.app.n_comp, self.grid_size, args.app.feature_dim)
+        vm_sampler = getattr(args, 'vm_sampler', 'grid_sample')
+        self.density = DensityVM(args.density.n_comp, self.grid_size, sampler=vm_sampler)
+        self.app = AppVM(args.app.n_comp, self.grid_size, args.app.feature_dim, sampler=vm_sampler)
         self.light_line = nn.Embedding(self.light_num, sum(self.app.n_comp))
         # (light_num, sum(self.app_n_comp)), such as (10, 16+16+16)
 
@@ -212,10 +234,14 @@ class TensoIR(TensorBase):
         init_light_directions = incident_light_directions.to(device).reshape(1, -1, 3) # [1, sample_number, 3]
         rotation_matrix = self.light_rotation_matrix.to(device) # [rotation_num, 3, 3]
         remapped_light_directions = torch.matmul(init_light_directions, rotation_matrix).reshape(-1, 3) # [rotation_num * sample_number, 3]
-        if self.light_kind == 'sg':
+        relight_envmap = getattr(self, 'relight_envmap', None)
+        if self.light_kind == 'sg' and relight_envmap is None:
             light_rgbs = render_envmap_sg(self.lgtSGs.to(device), remapped_light_directions).reshape(self.light_num, -1, 3) # [rotation_num, sample_number, 3]
         else:
-            if self.light_kind == 'pixel':
+            if relight_envmap is not None:
+                # an HDR set by evaluate.py in place of the trained light
+                environment_map = relight_envmap.to(device) # [H, W, 3]
+            elif self.light_kind == 'pixel':
                 environment_map = torch.nn.functional.softplus(self._light_rgbs, beta=5).reshape(self.envmap_h, self.envmap_w, 3).to(device) # [H, W, 3]
             # elif self.light_kind == 'gt':
             #     environment_map = self.dataset.lights_probes.requires_grad_(False).reshape(self.envmap_h, self.envmap_w, 3).to(device) # [H, W, 3]
@@ -233,6 +259,28 @@ class TensoIR(TensorBase):
             light_rgbs = F.grid_sample(environment_map, grid, align_corners=False).squeeze().permute(1, 0).reshape(self.light_num, -1, 3)
         return light_rgbs
 
+    def get_envmap_sampler(self, device='cuda', envmap_h=128, envmap_w=256):
+        '''alias table sampler of the envmap. While the light is optimized the table is rebuilt at most
+        every envmap_sampler_every calls: a slightly stale table is still a valid proposal, the pdf of
+        the draws comes from the same table and the radiance from the current light.
+        '''
+        light = getattr(self, 'relight_envmap', None)
+        if light is None:
+            light = self.lgtSGs if self.light_kind == 'sg' else self._light_rgbs
+        key = (light.data_ptr(), str(device), envmap_h, envmap_w)
+        self.envmap_sampler_calls = getattr(self, 'envmap_sampler_calls', 0) + 1
+        stale = getattr(self, 'envmap_sampler_version', None) != light._version and \
+            self.envmap_sampler_calls >= getattr(self.config, 'envmap_sampler_every', 100)
+        if getattr(self, 'envmap_sampler_key', None) != key or stale:
+            _, view_dirs = self.generate_envir_map_dir(envmap_h, envmap_w)
+            with torch.no_grad():
+                envir_map = self.get_light_rgbs(view_dirs.to(device), device=device)[0].reshape(envmap_h, envmap_w, 3)
+            self.envmap_sampler = EnvmapSampler(envir_map, device=device)
+            self.envmap_sampler_key = key
+            self.envmap_sampler_version = light._version
+            self.envmap_sampler_calls = 0
+        return self.envmap_sampler
+
     def gen_light_incident_dirs(self, sample_number=-1, method='fixed_envirmap', device='cuda'):
 
         ''' This function is used to generate light incident directions per iteraration,
@@ -289,31 +337,9 @@ class TensoIR(TensorBase):
 
 
         elif method == 'importance_sample':
-            _, view_dirs = self.generate_envir_map_dir(128, 256, is_jittor=True)
-            envir_map = self.get_light_rgbs(view_dirs.reshape(-1, 3).to(device))[0]
-            with torch.no_grad():
-                envir_map = envir_map.reshape(128, 256, 3)
-
-                # compute the pdf of importance sampling of the environment map
-                light_intensity = torch.sum(envir_map, dim=2, keepdim=True) # [H, W, 1]
-                env_map_h, env_map_w, _ = light_intensity.shape
-                h_interval = 1.0 / env_map_h
-                sin_theta = torch.sin(torch.linspace(0 + 0.5 * h_interval, np.pi - 0.5 * h_interval, env_map_h)).to(device) # [H, ]
-                pdf = light_intensity * sin_theta.view(-1, 1, 1) # [H, W, 1]
-                pdf_to_sample = pdf / torch.sum(pdf)  # [H, W, 1]
-                pdf_to_compute = pdf_to_sample * env_map_h * env_map_w / (2 * np.pi * np.pi * sin_theta.view(-1, 1, 1))
-
-                light_dir_idx = torch.multinomial(pdf_to_sample.view(-1), sample_number, replacement=True) # [sample_number, ]
-                envir_map_dir = view_dirs.view(-1, 3).to(device)
-
-                light_dir = envir_map_dir.gather(0, light_dir_idx.unsqueeze(-1).expand(-1, 3)).view(-1, 3) # [num_samples, 3]
-                # sample the light rgbs
-                envir_map_rgb = envir_map.view(-1, 3)
-                light_rgb = envir_map_rgb.gather(0, light_dir_idx.unsqueeze(-1).expand(-1, 3)).view(-1, 3) # [num_samples, 3]
-                envir_map_pdf = pdf_to_compute.view(-1, 1)
-                light_pdf = envir_map_pdf.gather(0, light_dir_idx.unsqueeze(-1).expand(-1, 1)).view(-1, 1) # [num_samples, 1]
-
-                return light_dir, light_rgb, light_pdf
+            if sample_number <= 0:
+                sample_number = self.envmap_h * self.envmap_w
+            return self.get_envmap_sampler(device).sample(sample_number)
 
         return light_incident_directions.reshape(-1, 3) # [output_sample_number, 3]
 
@@ -575,8 +601,59 @@ class TensoIR(TensorBase):
         loss_dict['total_loss'] = total_loss
 
         loss_dict['PSNR'] = -10.0 * torch.log10(loss_rgb)
+        # sampling statistics of the adaptive light sampling of render_with_BRDF
+        loss_dict.update(getattr(self, 'relight_stats', None) or {})
+        self.relight_stats = None
         return loss_dict
 
+    eval_keys = ['rgb_map', 'depth_map', 'normal_map', 'albedo_map', 'roughness_map', 'fresnel_map',
+                 'rgb_with_brdf_map', 'normals_diff_map', 'normals_orientation_loss_map', 'acc_map']
+
+    def render_tile(self, rays, args, light_idx=None):
+        self.light_idx = light_idx
+        return self.myforward(rays, args, n_rays=rays.shape[0])
+
+    @staticmethod
+    def eval_images(maps, gt_rgb, H, W, near_far):
+        rgb_map = maps['rgb_map'].clamp(0.0, 1.0).reshape(H, W, 3)
+        rgb_with_brdf_map = maps['rgb_with_brdf_map'].clamp(0.0, 1.0).reshape(H, W, 3)
+        depth_map, _ = visualize_depth_numpy(maps['depth_map'].reshape(H, W).numpy(), near_far)
+        acc_map = maps['acc_map'].reshape(H, W)
+        albedo_map = maps['albedo_map'].reshape(H, W, 3)
+        albedo_gamma_map = (albedo_map.clip(0, 1.)) ** (1.0 / 2.2)
+        roughness_map = maps['roughness_map'].reshape(H, W, 1).repeat(1, 1, 3)
+        fresnel_map = maps['fresnel_map'].reshape(H, W, 3)
+        preds = {'rgb': rgb_map, 'rgb_with_brdf': rgb_with_brdf_map}
+
+        to_uint8 = lambda x: (x.numpy() * 255).astype('uint8')
+        gt_rgb = to_uint8(gt_rgb)
+        albedo_map, albedo_gamma_map = to_uint8(albedo_map), to_uint8(albedo_gamma_map)
+        roughness_map, fresnel_map, acc_map = to_uint8(roughness_map), to_uint8(fresnel_map), to_uint8(acc_map)
+
+        # Visualize normal
+        ## Prediction
+        normal_map = F.normalize(maps['normal_map'], dim=-1)
+        normal_rgb_map = normal_map * 0.5 + 0.5 # map from [-1, 1] to [0, 1] to visualize
+        normal_rgb_map = to_uint8(normal_rgb_map.reshape(H, W, 3))
+        normal_rgb_vis_map = (normal_rgb_map * (acc_map[:, :, None] / 255.0) + (1 -(acc_map[:, :, None] / 255.0)) * 255).astype('uint8') # white background
+
+        # difference between the predicted normals and derived normals
+        normals_diff_map = to_uint8(torch.clamp(maps['normals_diff_map'], 0.0, 1.0).reshape(H, W, 1).repeat(1, 1, 3))
+        # normals orientation loss map
+        normals_orientation_loss_map = to_uint8(torch.clamp(maps['normals_orientation_loss_map'], 0.0, 1.0).reshape(H, W, 1).repeat(1, 1, 3))
+
+        images = {
+            'nvs_with_radiance_field/{}.png': np.concatenate((to_uint8(rgb_map), gt_rgb, depth_map), axis=1),
+            'nvs_with_brdf/{}.png': np.concatenate((to_uint8(rgb_with_brdf_map), gt_rgb), axis=1),
+            'normal/{}.png': np.concatenate((normal_rgb_map, normals_diff_map, normals_orientation_loss_map), axis=1),
+            'normal_vis/{}.png': normal_rgb_vis_map,
+            'brdf/{}.png': np.concatenate((albedo_map, roughness_map, fresnel_map), axis=1),
+            'brdf/{}_albedo.png': albedo_gamma_map,
+            'brdf/{}_roughness.png': roughness_map,
+            'acc_map/{}.png': acc_map,
+        }
+        return images, preds
+
     def evaluation(
         self,
         dataset,
@@ -588,12 +665,7 @@ class TensoIR(TensorBase):
         lst='',
     ):
 
-        PSNRs_rgb, rgb_maps, depth_maps, gt_maps, gt_rgb_brdf_maps = [], [], [], [], []
-        PSNRs_rgb_brdf = []
-        rgb_with_brdf_maps, normal_rgb_maps, normal_rgb_vis_maps = [], [], []
-        albedo_maps, albedo_gamma_maps, roughness_maps, fresnel_maps, normals_diff_maps, normals_orientation_loss_maps = [], [], [], [], [], []
-        ssims, l_alex, l_vgg = [], [], []
-        ssims_rgb_brdf, l_alex_rgb_brdf, l_vgg_rgb_brdf = [], [], []
+        PSNRs_rgb, PSNRs_rgb_brdf = [], []
 
         if savePath is not None:
             os.makedirs(savePath, exist_ok=True)
@@ -610,14 +682,14 @@ class TensoIR(TensorBase):
 
         _, view_dirs = self.generate_envir_map_dir(256, 512)
 
-        predicted_envir_map = self.get_light_rgbs(view_dirs.reshape(-1, 3).to(device))[0]
+        predicted_envir_map = self.get_light_rgbs(view_dirs.reshape(-1, 3).to(device), device=device)[0]
         predicted_envir_map = predicted_envir_map.reshape(256, 512, 3).cpu().detach().numpy()
         predicted_envir_map = np.clip(predicted_envir_map, a_min=0, a_max=np.inf)
         predicted_envir_map = np.uint8(np.clip(np.power(predicted_envir_map, 1./2.2), 0., 1.) * 255.)
         envirmap = predicted_envir_map
 
         # save predicted envir map
-        imageio.imwrite(f'{savePath}/envir_map/{prefix}envirmap.png', envirmap)
+        self.writer.save_image(f'{savePath}/envir_map/{prefix}envirmap.png', envirmap)
 
         img_eval_interval = 1 if N_vis < 0 else max(dataset.all_rays.shape[0] // N_vis, 1)
         idxs = list(range(0, dataset.all_rays.shape[0], img_eval_interval))
@@ -626,124 +698,19 @@ class TensoIR(TensorBase):
             self.eval()
             for idx in tqdm(idxs):
                 data = dataset.__getitem__(idx)
-                data['rays'] = data['rays'].view(-1, data['rays'].shape[-1])
-
-                rgb_map, acc_map, depth_map, normal_map, albedo_map, roughness_map, albedo_gamma_map = [], [], [], [], [], [], []
-                fresnel_map, rgb_with_brdf_map, normals_diff_map, normals_orientation_loss_map = [], [], [], []
-                chunk = 4096
-                N_rays = data['rays'].shape[0]
-
-                pos_map = []
-                dir_map = []
-
-                for i in tqdm(range(N_rays // chunk + int(N_rays % chunk > 0))):
-                    nw_rays = data['rays'][i * chunk:(i + 1) * chunk].to(device)
-                    self.light_idx = data['light_idx'][i * chunk:(i + 1) * chunk].to(device)
-                    ret = self.myforward(nw_rays, args, n_rays=nw_rays.shape[0])
-                    rgb_map.append(ret['rgb_map'].detach().cpu())
-                    depth_map.append(ret['depth_map'].detach().cpu())
-                    normal_map.append(ret['normal_map'].detach().cpu())
-                    albedo_map.append(ret['albedo_map'].detach().cpu())
-                    acc_map.append(ret['acc_map'].detach().cpu())
-                    roughness_map.append(ret['roughness_map'].detach().cpu())
-                    fresnel_map.append(ret['fresnel_map'].detach().cpu())
-                    rgb_with_brdf_map.append(ret['rgb_with_brdf_map'].detach().cpu())
-                    normals_diff_map.append(ret['normals_diff_map'].detach().cpu())
-                    normals_orientation_loss_map.append(ret['normals_orientation_loss_map'].detach().cpu())
-
-                rgb_map = torch.cat(rgb_map)
-                depth_map = torch.cat(depth_map)
-                normal_map = torch.cat(normal_map)
-                albedo_map = torch.cat(albedo_map)
-                roughness_map = torch.cat(roughness_map)
-                fresnel_map = torch.cat(fresnel_map)
-                rgb_with_brdf_map = torch.cat(rgb_with_brdf_map)
-                normals_diff_map = torch.cat(normals_diff_map)
-                normals_orientation_loss_map = torch.cat(normals_orientation_loss_map)
-                acc_map = torch.cat(acc_map)
-
-                rgb_map = rgb_map.clamp(0.0, 1.0)
-                rgb_with_brdf_map = rgb_with_brdf_map.clamp(0.0, 1.0)
-
-                acc_map = acc_map.reshape(H, W).detach().cpu()
-
-                rgb_map, depth_map = rgb_map.reshape(H, W, 3).detach().cpu(), depth_map.reshape(H, W).detach().cpu()
-                rgb_with_brdf_map = rgb_with_brdf_map.reshape(H, W, 3).detach().cpu()
-                albedo_map = albedo_map.reshape(H, W, 3).detach().cpu()
-
-                albedo_gamma_map = (albedo_map.clip(0, 1.)) ** (1.0 / 2.2)
-
-                roughness_map = roughness_map.reshape(H, W, 1).repeat(1, 1, 3).detach().cpu()
-                fresnel_map = fresnel_map.reshape(H, W, 3).detach().cpu()
-                depth_map, _ = visualize_depth_numpy(depth_map.numpy(), near_far)
+                rays = data['rays'].view(-1, data['rays'].shape[-1])
+                maps = self.render_view(rays, args, data['light_idx'].reshape(rays.shape[0], -1))
 
                 gt_rgb = data['rgbs'].view(H, W, 3)
-                gt_rgb_wirh_brdf = gt_rgb.clone()
-                loss_rgb = torch.mean((rgb_map - gt_rgb) ** 2)
-                loss_rgb_brdf = torch.mean((rgb_with_brdf_map - gt_rgb_wirh_brdf) ** 2)
-                print('rgb_with_brdf_map', rgb_with_brdf_map.dtype)
-                print('loss_rgb_brdf', loss_rgb_brdf.dtype, loss_rgb_brdf.item())
+                images, preds = self.eval_images(maps, gt_rgb, H, W, near_far)
+                loss_rgb = torch.mean((preds['rgb'] - gt_rgb) ** 2)
+                loss_rgb_brdf = torch.mean((preds['rgb_with_brdf'] - gt_rgb) ** 2)
                 PSNRs_rgb.append(-10.0 * np.log(loss_rgb.item()) / np.log(10.0))
                 PSNRs_rgb_brdf.append(10 * torch.log10(1 / loss_rgb_brdf))
-                print('PSNRs_rgb_brdf', PSNRs_rgb_brdf[-1])
-
-                rgb_map = (rgb_map.numpy() * 255).astype('uint8')
-                rgb_with_brdf_map = (rgb_with_brdf_map.numpy() * 255).astype('uint8')
-                gt_rgb = (gt_rgb.numpy() * 255).astype('uint8')
-                gt_rgb_wirh_brdf = (gt_rgb_wirh_brdf.numpy() * 255).astype('uint8')
-                albedo_map = (albedo_map.numpy() * 255).astype('uint8')
-                albedo_gamma_map = (albedo_gamma_map.numpy() * 255).astype('uint8')
-                roughness_map = (roughness_map.numpy() * 255).astype('uint8')
-                fresnel_map = (fresnel_map.numpy() * 255).astype('uint8')
-                acc_map = (acc_map.numpy() * 255).astype('uint8')
-
-                # Visualize normal
-                ## Prediction
-                normal_map = F.normalize(normal_map, dim=-1)
-
-                normal_rgb_map = normal_map * 0.5 + 0.5 # map from [-1, 1] to [0, 1] to visualize
-                normal_rgb_map = (normal_rgb_map.reshape(H, W, 3).cpu().numpy() * 255).astype('uint8')
-                normal_rgb_vis_map = (normal_rgb_map * (acc_map[:, :, None] / 255.0) + (1 -(acc_map[:, :, None] / 255.0)) * 255).astype('uint8') # white background
-
-
-                # difference between the predicted normals and derived normals
-                normals_diff_map = (torch.clamp(normals_diff_map, 0.0, 1.0).reshape(H, W, 1).repeat(1, 1, 3).numpy() * 255).astype('uint8')
-
-                # normals orientation loss map
-                normals_orientation_loss_map = (torch.clamp(normals_orientation_loss_map , 0.0, 1.0).reshape(H, W, 1).repeat(1, 1, 3).numpy() * 255).astype('uint8')
-
-                rgb_maps.append(rgb_map)
-                rgb_with_brdf_maps.append(rgb_with_brdf_map)
-                depth_maps.append(depth_map)
-                gt_maps.append(gt_rgb)
-                gt_rgb_brdf_maps.append(gt_rgb_wirh_brdf)
-                normal_rgb_maps.append(normal_rgb_map)
-                normal_rgb_vis_maps.append(normal_rgb_vis_map)
-
-                normals_diff_maps.append(normals_diff_map)
-                normals_orientation_loss_maps.append(normals_orientation_loss_map)
-
-                albedo_maps.append(albedo_map)
-                albedo_gamma_maps.append(albedo_gamma_map)
-                roughness_maps.append(roughness_map)
-                fresnel_maps.append(fresnel_map)
-
 
                 if savePath is not None:
-                    rgb_map = np.concatenate((rgb_map, gt_rgb, depth_map), axis=1)
-                    rgb_with_brdf_map = np.concatenate((rgb_with_brdf_map, gt_rgb_wirh_brdf), axis=1)
-
-                    normal_map = np.concatenate((normal_rgb_map, normals_diff_map, normals_orientation_loss_map), axis=1)
-                    brdf_map = np.concatenate((albedo_map, roughness_map, fresnel_map), axis=1)
-
-                    imageio.imwrite(f'{savePath}/nvs_with_radiance_field/{prefix}{idx:03d}.png', rgb_map)
-                    imageio.imwrite(f'{savePath}/nvs_with_brdf/{prefix}{idx:03d}.png', rgb_with_brdf_map)
-                    imageio.imwrite(f'{savePath}/normal/{prefix}{idx:03d}.png', normal_map)
-                    imageio.imwrite(f'{savePath}/normal_vis/{prefix}{idx:03d}.png', normal_rgb_vis_map)
-                    imageio.imwrite(f'{savePath}/brdf/{prefix}{idx:03d}.png', brdf_map)
-                    imageio.imwrite(f'{savePath}/brdf/{prefix}{idx:03d}_albedo.png', albedo_gamma_map)
-                    imageio.imwrite(f'{savePath}/brdf/{prefix}{idx:03d}_roughness.png', roughness_map)
-                    imageio.imwrite(f'{savePath}/acc_map/{prefix}{idx:03d}.png', acc_map)
+                    for pattern, img in images.items():
+                        self.writer.save_image(f'{savePath}/' + pattern.format(f'{prefix}{idx:03d}'), img)
 
             self.train()
 
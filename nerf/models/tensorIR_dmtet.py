@@ -81,7 +81,7 @@ class TensoIR_DMTet(Basemodel_dmtet):
         if abs(self.conf.normal_smooth_weight) > 1e-4:
             reg_loss = regularizer.normal_consistency(self.opt_mesh.v_pos, self.opt_mesh.t_pos_idx) * self.conf.normal_smooth_weight
         else:
-            reg_loss = torch.Tensor([0.0]).cuda()
+            reg_loss = torch.zeros(1, device=self.verts.device)
 
 
         loss_dict['reg_loss'] = reg_loss
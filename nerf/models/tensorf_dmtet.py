@@ -41,7 +41,7 @@ class TensorVM_DMTet_old(nn.Module):
 
     def generate_edges(self):
         with torch.no_grad():
-            edges = torch.tensor([0,1,0,2,0,3,1,2,1,3,2,3], dtype = torch.long, device = "cuda")
+            edges = torch.tensor([0,1,0,2,0,3,1,2,1,3,2,3], dtype = torch.long, device = self.device)
             print("edges", edges.shape, edges.nelement() * edges.element_size()/1024/1024/1024)
             all_edges = self.indices[:,edges].reshape(-1,2)
             print("all_edges", all_edges.shape, all_edges.nelement() * all_edges.element_size()/1024/1024/1024)
@@ -116,7 +116,7 @@ class TensorVM_DMTet_old(nn.Module):
         if abs(self.conf.normal_smooth_weight) > 1e-4:
             reg_loss = regularizer.normal_consistency(self.opt_mesh.v_pos, self.opt_mesh.t_pos_idx) * self.conf.normal_smooth_weight
         else:
-            reg_loss = torch.Tensor([0.0]).cuda()
+            reg_loss = torch.zeros(1, device=self.verts.device)
 
         return img_loss, reg_loss
 
@@ -139,6 +139,6 @@ class TensorVM_DMTet(Basemodel_dmtet):
         if abs(self.conf.normal_smooth_weight) > 1e-4:
             reg_loss = regularizer.normal_consistency(self.opt_mesh.v_pos, self.opt_mesh.t_pos_idx) * self.conf.normal_smooth_weight
         else:
-            reg_loss = torch.Tensor([0.0]).cuda()
+            reg_loss = torch.zeros(1, device=self.verts.device)
 
         return img_loss, reg_loss
\ No newline at end of file
@@ -0,0 +1,158 @@
+import torch
+import torch.nn.functional as F
+
+
+def pack_vm(planes, lines):
+    '''pack the planes and lines of a VM decomposition into channel-last texel tables
+    - args:
+        - planes: list of [1, C_i, H_i, W_i]
+        - lines: list of [1, C_i, L_i, 1]
+    - return:
+        - plane_table: [sum(H_i * W_i), max(C_i)]
+        - line_table: [sum(L_i), max(C_i)]
+    Channels are zero-padded to max(C_i) when the components differ.
+    '''
+    n_channel = max(p.shape[1] for p in planes)
+
+    def to_table(tensors):
+        table = []
+        for t in tensors:
+            t = t[0].flatten(1).t()  # [H * W, C]
+            if t.shape[1] < n_channel:
+                t = F.pad(t, (0, n_channel - t.shape[1]))
+            table.append(t)
+        return torch.cat(table)
+
+    return to_table(planes), to_table(lines)
+
+
+def packed_tables(planes, lines):
+    '''pack_vm of the current parameters. Without autograd the tables are kept until a parameter
+    is replaced or updated in place (data_ptr / _version), with it they are packed on every call,
+    the graph of a table does not outlive the backward pass of its step.
+    '''
+    params = list(planes) + list(lines)
+    if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+        return pack_vm(planes, lines)
+    if not isinstance(planes, torch.nn.ParameterList):
+        return pack_vm(planes, lines)
+    key = tuple((p.data_ptr(), p._version, tuple(p.shape)) for p in params) + (id(lines),)
+    cached = getattr(planes, '_packed', None)
+    if cached is None or cached[0] != key:
+        with torch.no_grad():
+            cached = (key, pack_vm(planes, lines))
+        planes._packed = cached
+    return cached[1]
+
+
+def _corner(index, size, padding):
+    '''valid mask and clamped index of a corner along one axis'''
+    if padding == 'zeros':
+        valid = (index >= 0) & (index <= size - 1)
+    else:
+        valid = None
+    return valid, torch.minimum(index.clamp(min=0), size - 1)
+
+
+def _blend(table, index, weight, double_backward):
+    '''sum_k table[index[..., k]] * weight[..., k] -> [..., C]
+    embedding_bag gathers and sums in one kernel but its weight gradient is not differentiable
+    again, the derived normals go through plain indexing.
+    '''
+    if double_backward:
+        return sum(table[index[..., k]] * weight[..., k:k + 1] for k in range(index.shape[-1]))
+    shape = index.shape[:-1]
+    out = F.embedding_bag(index.reshape(-1, index.shape[-1]), table,
+                          per_sample_weights=weight.reshape(-1, weight.shape[-1]), mode='sum')
+    return out.view(*shape, table.shape[1])
+
+
+def vm_sample(planes, lines, mat_mode, xyz_sampled, padding='zeros'):
+    '''bilinear plane x linear line features of all three components in one pass
+    - args:
+        - planes, lines: the parameters of a VMModule
+        - mat_mode: [[id_0, id_1], ...] axes of each plane
+        - xyz_sampled: [N, 3] in [-1, 1]
+        - padding: 'zeros' matches F.grid_sample(align_corners=True), 'border' matches
+                   relight_utils.grid_sample, which clamps the corners but keeps their weights
+    - return:
+        - [sum(C_i), N], same layout as VMModule.compute_feature
+    When xyz_sampled requires grad the sampler is made of twice differentiable torch ops
+    (derived normals).
+    '''
+    device = xyz_sampled.device
+    n_comp = [p.shape[1] for p in planes]
+    plane_table, line_table = packed_tables(planes, lines)
+    double_backward = xyz_sampled.requires_grad
+
+    plane_w = torch.tensor([p.shape[3] for p in planes], device=device).view(3, 1)
+    plane_h = torch.tensor([p.shape[2] for p in planes], device=device).view(3, 1)
+    line_l = torch.tensor([l.shape[2] for l in lines], device=device).view(3, 1)
+    plane_offset = torch.cumsum(torch.cat([torch.zeros_like(plane_w[:1]), plane_w * plane_h])[:-1], 0)
+    line_offset = torch.cumsum(torch.cat([torch.zeros_like(line_l[:1]), line_l])[:-1], 0)
+
+    # [3, N] texel coordinates of every component
+    coord_plane = torch.stack([xyz_sampled[:, mat_mode[i]] for i in range(3)])  # [3, N, 2]
+    ix = (coord_plane[..., 0] + 1) / 2 * (plane_w - 1)
+    iy = (coord_plane[..., 1] + 1) / 2 * (plane_h - 1)
+    iz = (xyz_sampled.t() + 1) / 2 * (line_l - 1)
+    with torch.no_grad():
+        ix0, iy0, iz0 = torch.floor(ix), torch.floor(iy), torch.floor(iz)
+    fx, fy, fz = ix - ix0, iy - iy0, iz - iz0
+    ix0, iy0, iz0 = ix0.long(), iy0.long(), iz0.long()
+
+    plane_index, plane_weight = [], []
+    for dx in (0, 1):
+        valid_x, cx = _corner(ix0 + dx, plane_w, padding)
+        wx = fx if dx else 1 - fx
+        for dy in (0, 1):
+            valid_y, cy = _corner(iy0 + dy, plane_h, padding)
+            wy = fy if dy else 1 - fy
+            weight = wx * wy
+            if padding == 'zeros':
+                weight = weight * (valid_x & valid_y)
+            plane_index.append(plane_offset + cy * plane_w + cx)
+            plane_weight.append(weight)
+    plane_feat = _blend(plane_table, torch.stack(plane_index, -1), torch.stack(plane_weight, -1), double_backward)
+
+    line_index, line_weight = [], []
+    for dz in (0, 1):
+        valid_z, cz = _corner(iz0 + dz, line_l, padding)
+        weight = fz if dz else 1 - fz
+        if padding == 'zeros':
+            weight = weight * valid_z
+        line_index.append(line_offset + cz)
+        line_weight.append(weight)
+    line_feat = _blend(line_table, torch.stack(line_index, -1), torch.stack(line_weight, -1), double_backward)
+
+    feat = plane_feat * line_feat  # [3, N, max(C_i)]
+    if all(c == feat.shape[-1] for c in n_comp):
+        return feat.permute(0, 2, 1).reshape(-1, xyz_sampled.shape[0])
+    return torch.cat([feat[i, :, :n_comp[i]].t() for i in range(3)])
+
+
+_compiled_vm_sample = None
+
+
+def compiled_vm_sample(planes, lines, mat_mode, xyz_sampled, padding='zeros'):
+    '''vm_sample through torch.compile, falls back to the eager version when it does not compile
+    torch.compile is lazy, the compilation errors only show up at the first call, which is
+    therefore the one that decides.
+    '''
+    global _compiled_vm_sample
+    if _compiled_vm_sample is None:
+        try:
+            compiled = torch.compile(vm_sample, dynamic=True)
+            out = compiled(planes, lines, mat_mode, xyz_sampled, padding)
+            _compiled_vm_sample = compiled
+            return out
+        except Exception as e:
+            print(f'torch.compile failed ({type(e).__name__}: {e}), using the eager VM sampler')
+            _compiled_vm_sample = vm_sample
+    return _compiled_vm_sample(planes, lines, mat_mode, xyz_sampled, padding)
+
+
+vm_samplers = {
+    'fused': vm_sample,
+    'compiled': compiled_vm_sample,
+}
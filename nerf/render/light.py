@@ -7,12 +7,14 @@
 # without an express license agreement from NVIDIA CORPORATION or 
 # its affiliates is strictly prohibited.
 
+import collections
+import hashlib
 import os
 import numpy as np
 import torch
-import nvdiffrast.torch as dr
 
 from . import util
+from . import raster
 from . import renderutils as ru
 
 ######################################################################################
@@ -27,13 +29,13 @@ class cubemap_mip(torch.autograd.Function):
     @staticmethod
     def backward(ctx, dout):
         res = dout.shape[1] * 2
-        out = torch.zeros(6, res, res, dout.shape[-1], dtype=torch.float32, device="cuda")
+        out = torch.zeros(6, res, res, dout.shape[-1], dtype=torch.float32, device=dout.device)
         for s in range(6):
-            gy, gx = torch.meshgrid(torch.linspace(-1.0 + 1.0 / res, 1.0 - 1.0 / res, res, device="cuda"), 
-                                    torch.linspace(-1.0 + 1.0 / res, 1.0 - 1.0 / res, res, device="cuda"),
+            gy, gx = torch.meshgrid(torch.linspace(-1.0 + 1.0 / res, 1.0 - 1.0 / res, res, device=dout.device), 
+                                    torch.linspace(-1.0 + 1.0 / res, 1.0 - 1.0 / res, res, device=dout.device),
                                     indexing='ij')
             v = util.safe_normalize(util.cube_to_dir(s, gx, gy))
-            out[s, ...] = dr.texture(dout[None, ...] * 0.25, v[None, ...].contiguous(), filter_mode='linear', boundary_mode='cube')
+            out[s, ...] = raster.texture(dout[None, ...] * 0.25, v[None, ...].contiguous(), filter_mode='linear', boundary_mode='cube')
         return out
 
 ######################################################################################
@@ -46,17 +48,21 @@ class EnvironmentLight(torch.nn.Module):
     MIN_ROUGHNESS = 0.08
     MAX_ROUGHNESS = 0.5
 
-    def __init__(self, base):
+    def __init__(self, base, tolerance=0.0):
         super(EnvironmentLight, self).__init__()
         self.mtx = None      
         self.base = torch.nn.Parameter(base.clone().detach(), requires_grad=True)
         self.register_parameter('env_base', self.base)
+        # build_mips() is skipped while base stays within tolerance (max abs difference)
+        # of the base the current mips were filtered from
+        self.tolerance = tolerance
+        self.filtered = None
 
     def xfm(self, mtx):
         self.mtx = mtx
 
     def clone(self):
-        return EnvironmentLight(self.base.clone().detach())
+        return EnvironmentLight(self.base.clone().detach(), self.tolerance)
 
     def clamp_(self, min=None, max=None):
         self.base.clamp_(min, max)
@@ -66,7 +72,22 @@ class EnvironmentLight(torch.nn.Module):
                         , (torch.clamp(roughness, self.MIN_ROUGHNESS, self.MAX_ROUGHNESS) - self.MIN_ROUGHNESS) / (self.MAX_ROUGHNESS - self.MIN_ROUGHNESS) * (len(self.specular) - 2)
                         , (torch.clamp(roughness, self.MAX_ROUGHNESS, 1.0) - self.MAX_ROUGHNESS) / (1.0 - self.MAX_ROUGHNESS) + len(self.specular) - 2)
         
+    def mips_valid(self, cutoff):
+        '''whether the current mips can be kept: same cutoff, base within tolerance, and no
+        gradient needed, a step that optimizes base has to filter it again to get one'''
+        if self.filtered is None or self.filtered[0] != cutoff:
+            return False
+        if torch.is_grad_enabled() and self.base.requires_grad:
+            return False
+        ref = self.filtered[1]
+        if ref.shape != self.base.shape:
+            return False
+        return (self.base.detach() - ref).abs().max().item() <= self.tolerance
+
     def build_mips(self, cutoff=0.99):
+        if self.mips_valid(cutoff):
+            return
+        self.filtered = (cutoff, self.base.detach().clone())
         self.specular = [self.base]
         while self.specular[-1].shape[1] > self.LIGHT_MIN_RES:
             self.specular += [cubemap_mip.apply(self.specular[-1])]
@@ -96,12 +117,12 @@ class EnvironmentLight(torch.nn.Module):
         reflvec = util.safe_normalize(util.reflect(wo, gb_normal))
         nrmvec = gb_normal
         if self.mtx is not None: # Rotate lookup
-            mtx = torch.as_tensor(self.mtx, dtype=torch.float32, device='cuda')
+            mtx = torch.as_tensor(self.mtx, dtype=torch.float32, device=reflvec.device)
             reflvec = ru.xfm_vectors(reflvec.view(reflvec.shape[0], reflvec.shape[1] * reflvec.shape[2], reflvec.shape[3]), mtx).view(*reflvec.shape)
             nrmvec  = ru.xfm_vectors(nrmvec.view(nrmvec.shape[0], nrmvec.shape[1] * nrmvec.shape[2], nrmvec.shape[3]), mtx).view(*nrmvec.shape)
 
         # Diffuse lookup
-        diffuse = dr.texture(self.diffuse[None, ...], nrmvec.contiguous(), filter_mode='linear', boundary_mode='cube')
+        diffuse = raster.texture(self.diffuse[None, ...], nrmvec.contiguous(), filter_mode='linear', boundary_mode='cube')
         shaded_col = diffuse * diff_col
 
         if specular:
@@ -109,12 +130,12 @@ class EnvironmentLight(torch.nn.Module):
             NdotV = torch.clamp(util.dot(wo, gb_normal), min=1e-4)
             fg_uv = torch.cat((NdotV, roughness), dim=-1)
             if not hasattr(self, '_FG_LUT'):
-                self._FG_LUT = torch.as_tensor(np.fromfile('data/irrmaps/bsdf_256_256.bin', dtype=np.float32).reshape(1, 256, 256, 2), dtype=torch.float32, device='cuda')
-            fg_lookup = dr.texture(self._FG_LUT, fg_uv, filter_mode='linear', boundary_mode='clamp')
+                self._FG_LUT = torch.as_tensor(np.fromfile('data/irrmaps/bsdf_256_256.bin', dtype=np.float32).reshape(1, 256, 256, 2), dtype=torch.float32, device=wo.device)
+            fg_lookup = raster.texture(self._FG_LUT, fg_uv, filter_mode='linear', boundary_mode='clamp')
 
             # Roughness adjusted specular env lookup
             miplevel = self.get_mip(roughness)
-            spec = dr.texture(self.specular[0][None, ...], reflvec.contiguous(), mip=list(m[None, ...] for m in self.specular[1:]), mip_level_bias=miplevel[..., 0], filter_mode='linear-mipmap-linear', boundary_mode='cube')
+            spec = raster.texture(self.specular[0][None, ...], reflvec.contiguous(), mip=list(m[None, ...] for m in self.specular[1:]), mip_level_bias=miplevel[..., 0], filter_mode='linear-mipmap-linear', boundary_mode='cube')
 
             # Compute aggregate lighting
             reflectance = spec_col * fg_lookup[...,0:1] + fg_lookup[...,1:2]
@@ -126,19 +147,136 @@ class EnvironmentLight(torch.nn.Module):
 # Load and store
 ######################################################################################
 
-# Load from latlong .HDR file
-def _load_env_hdr(fn, scale=1.0):
-    latlong_img = torch.tensor(util.load_image(fn), dtype=torch.float32, device='cuda')*scale
-    cubemap = util.latlong_to_cubemap(latlong_img, [512, 512])
+class EnvmapCache:
+    '''Converted cubemaps and their prefiltered mips (and any other tensors derived from an HDR file), in
+    memory and as .pt files in cache_dir ('' keeps them in memory only). Entries are keyed by the content
+    of the HDR file and every parameter the conversion and the filtering depend on, so a changed file or
+    setting never hits a stale entry. The entries in memory are a least recently used cache of at most
+    max_bytes, the files on disk are never evicted.
+    '''
+    VERSION = 1
+
+    def __init__(self, cache_dir='', max_bytes=2 ** 30):
+        self.cache_dir = os.path.expanduser(cache_dir) if cache_dir else ''
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+
+    def key(self, fn, params):
+        h = hashlib.sha1()
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        h.update(repr((self.VERSION,) + tuple(params)).encode())
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.pt')
 
-    l = EnvironmentLight(cubemap)
+    @staticmethod
+    def entry_bytes(entry):
+        tensors = [t for v in entry.values() for t in (v if isinstance(v, (list, tuple)) else [v])
+                   if torch.is_tensor(t)]
+        return sum(t.numel() * t.element_size() for t in tensors)
+
+    def remember(self, key, entry):
+        if key in self.entries:
+            self.nbytes -= self.entry_bytes(self.entries.pop(key))
+        self.entries[key] = entry
+        self.nbytes += self.entry_bytes(entry)
+        # the newest entry stays even when it alone is over the limit
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.nbytes -= self.entry_bytes(evicted)
+
+    def get(self, key):
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        if self.cache_dir and os.path.exists(self.path(key)):
+            try:
+                entry = torch.load(self.path(key), map_location='cpu')
+                self.remember(key, entry)
+                return entry
+            except Exception as e:
+                print(f'EnvmapCache: ignoring unreadable {self.path(key)} ({e})')
+        return None
+
+    def put(self, key, entry):
+        '''entry: {name: cpu tensor, list of cpu tensors or plain value}'''
+        self.remember(key, entry)
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f'{self.path(key)}.{os.getpid()}.tmp'
+            torch.save(entry, tmp_path)
+            os.replace(tmp_path, self.path(key))
+
+    def fetch(self, fn, params, build):
+        '''the entry of fn under params, made by build() -> entry on a miss'''
+        key = self.key(fn, params)
+        entry = self.get(key)
+        if entry is None:
+            entry = build()
+            self.put(key, entry)
+        return entry
+
+    def load(self, fn, scale=1.0, res=[512, 512], cutoff=0.99, device='cuda'):
+        '''EnvironmentLight of an HDR file with its mips built. A hit gives the same light as a miss: base is
+        its own Parameter, and the mips are copies of the cached ones, filtered again from base as soon as
+        a step needs gradients w.r.t. it (see mips_valid)'''
+        params = ('cubemap', float(scale), tuple(res), float(cutoff), EnvironmentLight.LIGHT_MIN_RES,
+                  EnvironmentLight.MIN_ROUGHNESS, EnvironmentLight.MAX_ROUGHNESS)
+        key = self.key(fn, params)
+        entry = self.get(key)
+        if entry is None:
+            light = _convert_env_hdr(fn, scale, res, device)
+            light.build_mips(cutoff)
+            self.put(key, {
+                'base': light.base.detach().cpu(),
+                'specular': [m.detach().cpu() for m in light.specular],
+                'diffuse': light.diffuse.detach().cpu(),
+                'cutoff': cutoff,
+            })
+            return light
+        light = EnvironmentLight(entry['base'].to(device))
+        # copies, so that the light never writes into the cached tensors
+        light.specular = [m.to(device, copy=True) for m in entry['specular']]
+        light.diffuse = entry['diffuse'].to(device, copy=True)
+        light.filtered = (entry['cutoff'], light.base.detach().clone())
+        return light
+
+# in memory only until configure_cache() is called
+envmap_cache = EnvmapCache('')
+
+def set_cache_dir(cache_dir, max_bytes=2 ** 30):
+    '''where load_env keeps the converted and prefiltered HDRs, '' keeps them in memory only'''
+    global envmap_cache
+    envmap_cache = EnvmapCache(cache_dir, max_bytes)
+
+def configure_cache(conf):
+    '''set the envmap cache from the envmap_cache options of conf, on disk only when enabled'''
+    opts = getattr(conf, 'envmap_cache', None)
+    enabled = opts is not None and getattr(opts, 'enabled', False)
+    set_cache_dir(opts.dir if enabled else '', getattr(opts, 'max_bytes', 2 ** 30) if opts is not None else 2 ** 30)
+    return envmap_cache
+
+# Load from latlong .HDR file
+def _convert_env_hdr(fn, scale=1.0, res=[512, 512], device='cuda'):
+    latlong_img = torch.tensor(util.load_image(fn), dtype=torch.float32, device=device)*scale
+    cubemap = util.latlong_to_cubemap(latlong_img, res)
+    return EnvironmentLight(cubemap)
+
+def _load_env_hdr(fn, scale=1.0, res=[512, 512], device='cuda', cache=True):
+    if cache:
+        return envmap_cache.load(fn, scale, res, device=device)
+    l = _convert_env_hdr(fn, scale, res, device)
     l.build_mips()
 
     return l
 
-def load_env(fn, scale=1.0):
+def load_env(fn, scale=1.0, res=[512, 512], device='cuda', cache=True):
     if os.path.splitext(fn)[1].lower() == ".hdr":
-        return _load_env_hdr(fn, scale)
+        return _load_env_hdr(fn, scale, res, device, cache)
     else:
         assert False, "Unknown envlight extension %s" % os.path.splitext(fn)[1]
 
@@ -141,9 +141,9 @@ def compute_edge_to_face_mapping(attr_idx, return_inverse=False):
         # Elliminate duplicates and return inverse mapping
         unique_edges, idx_map = torch.unique(sorted_edges, dim=0, return_inverse=True)
 
-        tris = torch.arange(attr_idx.shape[0]).repeat_interleave(3).cuda()
+        tris = torch.arange(attr_idx.shape[0], device=attr_idx.device).repeat_interleave(3)
 
-        tris_per_edge = torch.zeros((unique_edges.shape[0], 2), dtype=torch.int64).cuda()
+        tris_per_edge = torch.zeros((unique_edges.shape[0], 2), dtype=torch.int64, device=attr_idx.device)
 
         # Compute edge to face table
         mask0 = order[:,0] == 0
@@ -153,6 +153,67 @@ def compute_edge_to_face_mapping(attr_idx, return_inverse=False):
 
         return tris_per_edge
 
+######################################################################################
+# Connectivity of a face list, built once and shared by the regularizers and the
+# normal / tangent computation as long as the faces do not change
+######################################################################################
+class MeshTopology:
+    def __init__(self, t_pos_idx, n_verts):
+        with torch.no_grad():
+            self.faces = t_pos_idx
+            self.version = t_pos_idx._version
+            self.n_verts = n_verts
+            device = t_pos_idx.device
+
+            # Unique edges (min index first) and the edge of every face side
+            unique_edges, idx_map = compute_edges(t_pos_idx, return_inverse=True)
+            self.edges = unique_edges                                   # [E, 2]
+            self.face_edges = idx_map.view(-1, 3)                       # [F, 3], sides (0,1) (1,2) (2,0)
+
+            # Edge to face table, as compute_edge_to_face_mapping
+            all_edges = t_pos_idx[:, [0, 1, 1, 2, 2, 0]].reshape(-1, 2)
+            flipped = all_edges[:, 0] > all_edges[:, 1]
+            tris = torch.arange(t_pos_idx.shape[0], device=device).repeat_interleave(3)
+            self.tris_per_edge = torch.zeros((unique_edges.shape[0], 2), dtype=torch.int64, device=device)
+            self.tris_per_edge[idx_map[~flipped], 0] = tris[~flipped]
+            self.tris_per_edge[idx_map[flipped], 1] = tris[flipped]
+
+            # Vertex adjacency in CSR form, one entry per (face, other corner) so that interior
+            # neighbours appear twice, as in the umbrella operator of laplace_regularizer_const
+            rows = t_pos_idx[:, [0, 0, 1, 1, 2, 2]].reshape(-1)
+            cols = t_pos_idx[:, [1, 2, 0, 2, 0, 1]].reshape(-1)
+            order = torch.argsort(rows, stable=True)
+            self.adj_row = rows[order]                                  # row of every entry
+            self.adj_col = cols[order]
+            self.degree = torch.bincount(rows, minlength=n_verts)       # [V]
+            self.adj_rowptr = torch.cat((torch.zeros(1, dtype=torch.long, device=device), torch.cumsum(self.degree, 0)))
+            self.face_count = self.degree // 2                          # faces around every vertex
+
+    def matches(self, t_pos_idx, n_verts):
+        if n_verts != self.n_verts:
+            return False
+        if t_pos_idx is self.faces and t_pos_idx._version == self.version:
+            return True
+        if t_pos_idx.shape != self.faces.shape or t_pos_idx.device != self.faces.device or \
+                self.faces._version != self.version or not torch.equal(t_pos_idx, self.faces):
+            return False
+        # same faces in a new tensor, the next lookup of it is an identity check
+        self.faces, self.version = t_pos_idx, t_pos_idx._version
+        return True
+
+_topologies = []
+
+def topology(t_pos_idx, n_verts):
+    '''MeshTopology of a face list over n_verts vertices, cached for the few most recent face lists'''
+    for i, topo in enumerate(_topologies):
+        if topo.matches(t_pos_idx, n_verts):
+            _topologies.insert(0, _topologies.pop(i))
+            return topo
+    topo = MeshTopology(t_pos_idx, n_verts)
+    _topologies.insert(0, topo)
+    del _topologies[4:]
+    return topo
+
 ######################################################################################
 # Align base mesh to reference mesh:move & rescale to match bounding boxes.
 ######################################################################################
@@ -187,16 +248,16 @@ def auto_normals(imesh):
     v1 = imesh.v_pos[i1, :]
     v2 = imesh.v_pos[i2, :]
 
-    face_normals = torch.cross(v1 - v0, v2 - v0)
+    face_normals = torch.cross(v1 - v0, v2 - v0, dim=-1)
 
     # Splat face normals to vertices
     v_nrm = torch.zeros_like(imesh.v_pos)
-    v_nrm.scatter_add_(0, i0[:, None].repeat(1,3), face_normals)
-    v_nrm.scatter_add_(0, i1[:, None].repeat(1,3), face_normals)
-    v_nrm.scatter_add_(0, i2[:, None].repeat(1,3), face_normals)
+    v_nrm.index_add_(0, i0, face_normals)
+    v_nrm.index_add_(0, i1, face_normals)
+    v_nrm.index_add_(0, i2, face_normals)
 
     # Normalize, replace zero (degenerated) normals with some default value
-    v_nrm = torch.where(util.dot(v_nrm, v_nrm) > 1e-20, v_nrm, torch.tensor([0.0, 0.0, 1.0], dtype=torch.float32, device='cuda'))
+    v_nrm = torch.where(util.dot(v_nrm, v_nrm) > 1e-20, v_nrm, torch.tensor([0.0, 0.0, 1.0], dtype=torch.float32, device=v_nrm.device))
     v_nrm = util.safe_normalize(v_nrm)
 
     if torch.is_anomaly_enabled():
@@ -218,7 +279,8 @@ def compute_tangents(imesh):
         vn_idx[i] = imesh.t_nrm_idx[:, i]
 
     tangents = torch.zeros_like(imesh.v_nrm)
-    tansum   = torch.zeros_like(imesh.v_nrm)
+    # number of faces around every normal, fixed for a topology
+    tansum   = topology(imesh.t_nrm_idx, imesh.v_nrm.shape[0]).face_count[:, None].to(tangents.dtype)
 
     # Compute tangent space for each triangle
     uve1 = tex[1] - tex[0]
@@ -234,9 +296,7 @@ def compute_tangents(imesh):
 
     # Update all 3 vertices
     for i in range(0,3):
-        idx = vn_idx[i][:, None].repeat(1,3)
-        tangents.scatter_add_(0, idx, tang)                # tangents[n_i] = tangents[n_i] + tang
-        tansum.scatter_add_(0, idx, torch.ones_like(tang)) # tansum[n_i] = tansum[n_i] + 1
+        tangents.index_add_(0, vn_idx[i], tang)            # tangents[n_i] = tangents[n_i] + tang
     tangents = tangents / tansum
 
     # Normalize and make sure tangent is perpendicular to normal
@@ -0,0 +1,153 @@
+import gzip
+import numpy as np
+import torch
+
+######################################################################################
+# Vectorized mesh writers: binary little-endian PLY and bulk-formatted OBJ
+######################################################################################
+
+# rows formatted per '%' call, bounds the size of the temporary tuple
+_OBJ_BLOCK = 1 << 18
+
+def _to_numpy(x):
+    if x is None:
+        return None
+    if isinstance(x, torch.Tensor):
+        return x.detach().cpu().numpy()
+    return np.asarray(x)
+
+def _open(path, compress):
+    if compress:
+        if not path.endswith('.gz'):
+            path = path + '.gz'
+        return path, gzip.open(path, 'wb', compresslevel=6)
+    return path, open(path, 'wb')
+
+def _same_index(a, b):
+    return a is not None and b is not None and a.shape == b.shape and np.array_equal(a, b)
+
+######################################################################################
+# PLY
+######################################################################################
+
+def write_ply(path, v_pos, faces, v_nrm=None, v_tex=None, v_color=None, quantize=False, compress=False):
+    '''binary little-endian PLY with per-vertex attributes
+    - args:
+        - v_pos: [N, 3] positions, always stored as float32
+        - faces: [M, 3] vertex indices
+        - v_nrm: [N, 3] normals, v_tex: [N, 2] uv, v_color: [N, 3] colors in [0, 1], optional
+        - quantize: store normals as int16 and uvs as uint16 (PLY has no float16 type)
+        - compress: gzip the file, '.gz' is appended to path
+    - return:
+        - path of the written file
+    '''
+    v_pos, faces = _to_numpy(v_pos), _to_numpy(faces)
+    v_nrm, v_tex, v_color = _to_numpy(v_nrm), _to_numpy(v_tex), _to_numpy(v_color)
+
+    fields, columns = [], []
+    fields += [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    columns += [v_pos[:, i].astype(np.float32) for i in range(3)]
+    if v_nrm is not None:
+        if quantize:
+            q = np.rint(np.clip(v_nrm, -1., 1.) * 32767).astype(np.int16)
+            fields += [('nx', '<i2'), ('ny', '<i2'), ('nz', '<i2')]
+        else:
+            q = v_nrm.astype(np.float32)
+            fields += [('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4')]
+        columns += [q[:, i] for i in range(3)]
+    if v_tex is not None:
+        if quantize:
+            q = np.rint(np.clip(v_tex, 0., 1.) * 65535).astype(np.uint16)
+            fields += [('s', '<u2'), ('t', '<u2')]
+        else:
+            q = v_tex.astype(np.float32)
+            fields += [('s', '<f4'), ('t', '<f4')]
+        columns += [q[:, i] for i in range(2)]
+    if v_color is not None:
+        q = np.rint(np.clip(v_color[:, :3], 0., 1.) * 255).astype(np.uint8)
+        fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+        columns += [q[:, i] for i in range(3)]
+
+    vertex = np.empty(v_pos.shape[0], dtype=fields)
+    for (name, _), col in zip(fields, columns):
+        vertex[name] = col
+    face = np.empty(faces.shape[0], dtype=[('n', 'u1'), ('idx', '<i4', (3,))])
+    face['n'] = 3
+    face['idx'] = faces
+
+    ply_type = {'<f4': 'float', '<i2': 'short', '<u2': 'ushort', 'u1': 'uchar'}
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex %d' % v_pos.shape[0]]
+    header += ['property %s %s' % (ply_type[t], name) for name, t in fields]
+    header += ['element face %d' % faces.shape[0], 'property list uchar int vertex_indices', 'end_header']
+
+    path, f = _open(path, compress)
+    with f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        f.write(vertex.tobytes())
+        f.write(face.tobytes())
+    return path
+
+######################################################################################
+# OBJ
+######################################################################################
+
+def _format_rows(f, fmt, array):
+    '''write fmt % row for every row of array, formatting a whole block with one % call'''
+    for start in range(0, array.shape[0], _OBJ_BLOCK):
+        block = array[start:start + _OBJ_BLOCK]
+        f.write(((fmt * block.shape[0]) % tuple(block.ravel().tolist())).encode('ascii'))
+
+def write_obj(path, v_pos, t_pos_idx, v_tex=None, t_tex_idx=None, v_nrm=None, t_nrm_idx=None,
+              mtllib='mesh.mtl', precision=6, compress=False):
+    '''OBJ with the layout of render/obj.py, formatted in bulk
+    - args:
+        - precision: decimals of the float attributes, e.g. 4 is enough for float16 data
+        - compress: gzip the file, '.gz' is appended to path
+    - return:
+        - path of the written file
+    '''
+    v_pos, t_pos_idx = _to_numpy(v_pos), _to_numpy(t_pos_idx).astype(np.int64)
+    v_tex, v_nrm = _to_numpy(v_tex), _to_numpy(v_nrm)
+    t_tex_idx = _to_numpy(t_tex_idx).astype(np.int64) if v_tex is not None else None
+    t_nrm_idx = _to_numpy(t_nrm_idx).astype(np.int64) if v_nrm is not None else None
+
+    fp = '%%.%df' % precision
+    path, f = _open(path, compress)
+    with f:
+        if mtllib is not None:
+            f.write(('mtllib %s\n' % mtllib).encode('ascii'))
+        f.write(b'g default\n')
+        _format_rows(f, 'v %s %s %s\n' % (fp, fp, fp), v_pos.astype(np.float64))
+        if v_tex is not None:
+            assert len(t_pos_idx) == len(t_tex_idx)
+            uv = np.stack([v_tex[:, 0], 1.0 - v_tex[:, 1]], axis=-1)
+            _format_rows(f, 'vt %s %s\n' % (fp, fp), uv.astype(np.float64))
+        if v_nrm is not None:
+            assert len(t_pos_idx) == len(t_nrm_idx)
+            _format_rows(f, 'vn %s %s %s\n' % (fp, fp, fp), v_nrm.astype(np.float64))
+
+        f.write(b's 1\ng pMesh1\nusemtl defaultMat\n')
+        # [M, 3, K] one-based indices, K = 1 + has_tex + has_nrm
+        indices = [t_pos_idx] + [idx for idx in (t_tex_idx, t_nrm_idx) if idx is not None]
+        indices = np.stack(indices, axis=-1) + 1
+        if v_tex is not None and v_nrm is not None:
+            vert = '%d/%d/%d'
+        elif v_tex is not None:
+            vert = '%d/%d'
+        elif v_nrm is not None:
+            vert = '%d//%d'
+        else:
+            vert = '%d'
+        _format_rows(f, 'f %s %s %s\n' % (vert, vert, vert), indices.reshape(indices.shape[0], -1))
+    return path
+
+def write_mesh_obj(path, mesh, **kwargs):
+    '''write a render.mesh.Mesh with write_obj'''
+    return write_obj(path, mesh.v_pos, mesh.t_pos_idx, mesh.v_tex, mesh.t_tex_idx, mesh.v_nrm, mesh.t_nrm_idx, **kwargs)
+
+def write_mesh_ply(path, mesh, **kwargs):
+    '''write a render.mesh.Mesh with write_ply, normals and uvs are kept when they are indexed like the positions'''
+    t_pos_idx = _to_numpy(mesh.t_pos_idx)
+    v_nrm = mesh.v_nrm if _same_index(t_pos_idx, _to_numpy(mesh.t_nrm_idx)) else None
+    v_tex = mesh.v_tex if _same_index(t_pos_idx, _to_numpy(mesh.t_tex_idx)) else None
+    return write_ply(path, mesh.v_pos, t_pos_idx, v_nrm=v_nrm, v_tex=v_tex, **kwargs)
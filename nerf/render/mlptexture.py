@@ -8,9 +8,13 @@
 # its affiliates is strictly prohibited.
 
 import torch
-import tinycudann as tcnn
+try:
+    import tinycudann as tcnn
+except ImportError:
+    tcnn = None
 import numpy as np
 
+import chunking
 from models.tensoRF import TensorVM, TensorCP
 from utils import *
 from geometry import utils
@@ -21,14 +25,14 @@ from models.tensoIR.relight_utils import compute_secondary_shading_effects, GGX_
 #######################################################################################################################################################
 
 class _MLP(torch.nn.Module):
-    def __init__(self, cfg, loss_scale=1.0):
+    def __init__(self, cfg, loss_scale=1.0, device=None):
         super(_MLP, self).__init__()
         self.loss_scale = loss_scale
         net = (torch.nn.Linear(cfg['n_input_dims'], cfg['n_neurons'], bias=False), torch.nn.ReLU())
         for i in range(cfg['n_hidden_layers']-1):
             net = net + (torch.nn.Linear(cfg['n_neurons'], cfg['n_neurons'], bias=False), torch.nn.ReLU())
         net = net + (torch.nn.Linear(cfg['n_neurons'], cfg['n_output_dims'], bias=False),)
-        self.net = torch.nn.Sequential(*net).cuda()
+        self.net = torch.nn.Sequential(*net).to(device)
 
         self.net.apply(self._init_weights)
 
@@ -74,6 +78,7 @@ class MLPTexture3D(torch.nn.Module):
 	    }
 
         gradient_scaling = 128.0
+        assert tcnn is not None, "MLPTexture3D needs tinycudann"
         self.encoder = tcnn.Encoding(3, enc_cfg)
         self.encoder.register_full_backward_hook(lambda module, grad_i, grad_o: (grad_i[0] / gradient_scaling, ))
 
@@ -84,7 +89,7 @@ class MLPTexture3D(torch.nn.Module):
             "n_hidden_layers" : hidden,
             "n_neurons" : self.internal_dims
         }
-        self.net = _MLP(mlp_cfg, gradient_scaling)
+        self.net = _MLP(mlp_cfg, gradient_scaling, device=AABB[0].device)
         print("Encoder output: %d dims" % (self.encoder.n_output_dims))
 
         # Setup Neural Shader
@@ -94,7 +99,7 @@ class MLPTexture3D(torch.nn.Module):
             "n_hidden_layers" : hidden,
             "n_neurons" : self.internal_dims*2
         }
-        self.neural_shader = _MLP(shader_cfg)
+        self.neural_shader = _MLP(shader_cfg, device=AABB[0].device)
 
     # Sample texture at a given location
     def sample(self, texc):
@@ -151,7 +156,7 @@ class MLPNeuralTex(torch.nn.Module):
             "n_hidden_layers" : 6,
             "n_neurons" : 128
         }
-        self.net = _MLP(mlp_cfg, gradient_scaling)
+        self.net = _MLP(mlp_cfg, gradient_scaling, device=AABB[0].device)
         # print("Encoder output: %d dims" % (self.encoder.n_output_dims))
 
         # Setup Neural Shader
@@ -161,7 +166,7 @@ class MLPNeuralTex(torch.nn.Module):
             "n_hidden_layers" : hidden,
             "n_neurons" : self.internal_dims*2
         }
-        self.neural_shader = _MLP(shader_cfg)
+        self.neural_shader = _MLP(shader_cfg, device=AABB[0].device)
 
         print("net", self.net)
         print("neural_shader", self.neural_shader)
@@ -207,7 +212,7 @@ class VertNeuralTex(torch.nn.Module):
         self.feape = feape
         self.viewpe = viewpe
 
-        self.feats = torch.nn.Parameter(torch.zeros((n_verts, channels), device='cuda'))
+        self.feats = torch.nn.Parameter(torch.zeros((n_verts, channels), device=AABB[0].device))
 
         # Setup Neural Shader
         shader_cfg = {
@@ -218,7 +223,7 @@ class VertNeuralTex(torch.nn.Module):
             "n_hidden_layers" : hidden,
             "n_neurons" : 128
         }
-        self.neural_shader = _MLP(shader_cfg)
+        self.neural_shader = _MLP(shader_cfg, device=AABB[0].device)
 
         print("neural_shader", self.neural_shader)
 
@@ -242,7 +247,7 @@ class VertNeuralTex(torch.nn.Module):
 #######################################################################################################################################################
 
 class VertSHTex(torch.nn.Module):
-    def __init__(self, n_verts, deg = 2, channels = 3, internal_dims = 32, hidden = 2, feape = 4, viewpe = 0, init_feats = None):
+    def __init__(self, n_verts, deg = 2, channels = 3, internal_dims = 32, hidden = 2, feape = 4, viewpe = 0, init_feats = None, device = 'cuda'):
         super(VertSHTex, self).__init__()
 
         self.n_verts = n_verts
@@ -251,12 +256,12 @@ class VertSHTex(torch.nn.Module):
         self.feape = feape
 
         if init_feats is None:
-            self.feats = torch.nn.Parameter(torch.randn((n_verts, channels), device='cuda'))
+            self.feats = torch.nn.Parameter(torch.randn((n_verts, channels), device=device))
         else:
             self.feats = torch.nn.Parameter(init_feats)
 
         # Setup SH Shader
-        self.neural_shader = SHRender(channels=self.channels, deg=deg)
+        self.neural_shader = SHRender(channels=self.channels, deg=deg, device=self.feats.device)
         print("neural_shader", self.neural_shader)
 
     def neural_shade(self, features, viewdirs):
@@ -267,7 +272,7 @@ class VertSHTex(torch.nn.Module):
         pass
 
 class SHRender(torch.nn.Module):
-    def __init__(self, channels, deg = 2):
+    def __init__(self, channels, deg = 2, device = 'cuda'):
         super(SHRender, self).__init__()
 
         chans = [1,3,5,7,9]
@@ -277,7 +282,7 @@ class SHRender(torch.nn.Module):
         output_channels = 0
         for i in range(deg+1):
             output_channels += chans[i]
-        self.linear = torch.nn.Linear(channels, 3*output_channels, bias=False).cuda()
+        self.linear = torch.nn.Linear(channels, 3*output_channels, bias=False, device=device)
 
     def forward(self, features, viewdirs):
         sh_mult = eval_sh_bases(self.deg, viewdirs)[..., None, :]
@@ -373,7 +378,7 @@ class TensorVMSplitNeuralTex(torch.nn.Module):
         super(TensorVMSplitNeuralTex, self).__init__()
 
         self.channels = channels
-        self.aabb = torch.stack((AABB)).cuda()
+        self.aabb = torch.stack((AABB))
         self.pospe = pospe
         self.feape = feape
         self.viewpe = viewpe
@@ -382,7 +387,7 @@ class TensorVMSplitNeuralTex(torch.nn.Module):
 
         # Setup TensorVMSplit
         reso_cur = N_to_reso(N_voxel, self.aabb)
-        self.net = TensorVMSplit_App(self.aabb, reso_cur, 'cuda', app_dim=channels, featureC=shader_internal_dims)
+        self.net = TensorVMSplit_App(self.aabb, reso_cur, self.aabb.device, app_dim=channels, featureC=shader_internal_dims)
 
         print("net", self.net)
         print("neural_shader", self.net.renderModule)
@@ -416,7 +421,7 @@ class TensorSHNeuralTex(torch.nn.Module):
         super(TensorSHNeuralTex, self).__init__()
 
         self.channels = channels
-        self.aabb = torch.stack((AABB)).cuda()
+        self.aabb = torch.stack((AABB))
         self.pospe = pospe
         self.feape = feape
         self.viewpe = viewpe
@@ -425,7 +430,7 @@ class TensorSHNeuralTex(torch.nn.Module):
 
         # Setup TensorVMSplit
         reso_cur = N_to_reso(N_voxel, self.aabb)
-        self.net = TensorVMSplit_App(self.aabb, reso_cur, 'cuda', app_dim=channels, featureC=shader_internal_dims, shadingMode = 'SH')
+        self.net = TensorVMSplit_App(self.aabb, reso_cur, self.aabb.device, app_dim=channels, featureC=shader_internal_dims, shadingMode = 'SH')
 
         print("net", self.net)
         print("neural_shader", self.net.renderModule)
@@ -460,7 +465,7 @@ class TensorVMSplitLoadNeuralTex(torch.nn.Module):
         super(TensorVMSplitLoadNeuralTex, self).__init__()
 
         self.channels = channels
-        self.aabb = tensorf.aabb.float().cuda()
+        self.aabb = tensorf.aabb.float()
         self.pospe = tensorf.pos_pe
         self.feape = tensorf.fea_pe
         self.viewpe = tensorf.view_pe
@@ -514,7 +519,7 @@ class TensoIRPhysicalRendering(torch.nn.Module):
         super(TensoIRPhysicalRendering, self).__init__()
 
         self.channels = channels
-        self.aabb = tensorf.aabb.float().cuda()
+        self.aabb = tensorf.aabb.float()
         self.pospe = tensorf.pos_pe
         self.feape = tensorf.fea_pe
         self.viewpe = tensorf.view_pe
@@ -618,11 +623,11 @@ class TensoIRPhysicalRendering(torch.nn.Module):
         shape = viewdirs.shape
         dirs = viewdirs.view(-1, 3)  # [bs, 3]
 
-        light_area_weight = self.net.light_area_weight.cuda()
+        light_area_weight = self.net.light_area_weight.to(positions.device)
 
-        incident_light_dirs = self.net.gen_light_incident_dirs(method="stratified_sampling").cuda()  # [envW * envH, 3]
+        incident_light_dirs = self.net.gen_light_incident_dirs(method="stratified_sampling", device=positions.device).to(positions.device)  # [envW * envH, 3]
 
-        envir_map_light_rgbs = self.net.get_light_rgbs(incident_light_dirs).cuda()  # [light_num, envW * envH, 3]
+        envir_map_light_rgbs = self.net.get_light_rgbs(incident_light_dirs, device=positions.device)  # [light_num, envW * envH, 3]
 
         # save incident light dirs to image
         # import imageio
@@ -638,18 +643,16 @@ class TensoIRPhysicalRendering(torch.nn.Module):
         ret_wo_visibilty_direct_rgb = []
         ret_indir_rgb = []
 
-        chunk_size = 8192
-        num_chunk = num_ray // chunk_size + int(num_ray % chunk_size != 0)
-        for ind in range(num_chunk):
-            nw_pos = positions[ind * chunk_size:(ind + 1) * chunk_size]
-            nw_albedo = albedo[ind * chunk_size:(ind + 1) * chunk_size]
-            nw_fresnel = fresnel[ind * chunk_size:(ind + 1) * chunk_size]
-            nw_roughness = roughness[ind * chunk_size:(ind + 1) * chunk_size]
-            nw_normal = normal[ind * chunk_size:(ind + 1) * chunk_size]
-            nw_dirs = dirs[ind * chunk_size:(ind + 1) * chunk_size]
+        for chunk in chunking.split('neural_shade', num_ray, 8192, positions.device):
+            nw_pos = positions[chunk]
+            nw_albedo = albedo[chunk]
+            nw_fresnel = fresnel[chunk]
+            nw_roughness = roughness[chunk]
+            nw_normal = normal[chunk]
+            nw_dirs = dirs[chunk]
             nw_num = nw_pos.shape[0]
 
-            light_idx = torch.zeros((nw_num, 1), dtype=torch.int32).cuda()
+            light_idx = torch.zeros((nw_num, 1), dtype=torch.int32, device=nw_pos.device)
 
             surf2l = incident_light_dirs.reshape(1, -1, 3).repeat(nw_num, 1, 1)  # [bs, envW * envH, 3]  148
             surf2c = -nw_dirs  # [bs, 3]
@@ -660,8 +663,8 @@ class TensoIRPhysicalRendering(torch.nn.Module):
             cosine = torch.clamp(cosine, min=0.0)   #
             cosine_mask = (cosine > 1e-6)
 
-            visibility_compute = torch.zeros((*cosine_mask.shape, 1)).cuda()   # [bs, envW * envH, 1]   16
-            indirect_light = torch.zeros((*cosine_mask.shape, 3)).cuda()   # [bs, envW * envH, 3]   48
+            visibility_compute = torch.zeros((*cosine_mask.shape, 1), device=nw_pos.device)   # [bs, envW * envH, 1]   16
+            indirect_light = torch.zeros((*cosine_mask.shape, 3), device=nw_pos.device)   # [bs, envW * envH, 3]   48
 
             visibility_compute[cosine_mask], \
                 indirect_light[cosine_mask] = compute_secondary_shading_effects(
@@ -673,6 +676,9 @@ class TensoIRPhysicalRendering(torch.nn.Module):
                     vis_near=0.05,
                     vis_far=1.5,
                     chunk_size=160000,
+                    device=nw_pos.device,
+                    cache=getattr(self.net, 'secondary_cache', None),
+                    marcher=getattr(self.net.config, 'second_marcher', 'linspace'),
                 )
 
             visibility_to_use = visibility_compute
@@ -682,7 +688,7 @@ class TensoIRPhysicalRendering(torch.nn.Module):
             surface_brdf = nw_albedo.unsqueeze(1).expand(-1, nlights, -1) / np.pi + specular # [bs, envW * envH, 3] 48
 
             ## Compute rendering equation
-            direct_light_rgbs = torch.index_select(envir_map_light_rgbs, dim=0, index=light_idx.squeeze(-1)).cuda()  # [bs, envW * envH, 3]
+            direct_light_rgbs = torch.index_select(envir_map_light_rgbs, dim=0, index=light_idx.squeeze(-1))  # [bs, envW * envH, 3]
 
             # print(visibility_to_use.shape)
             # visualize_vis = visibility_to_use[:, 31, 0]
@@ -751,7 +757,7 @@ class TensoIRPhysicalRendering(torch.nn.Module):
 #######################################################################################################################################################
 
 class UVMapNeuralTex(torch.nn.Module):
-    def __init__(self, channels = 3, internal_dims = 128, pospe=4, feape = 4, viewpe = 0):
+    def __init__(self, channels = 3, internal_dims = 128, pospe=4, feape = 4, viewpe = 0, device = 'cuda'):
         super(UVMapNeuralTex, self).__init__()
 
         self.channels = channels
@@ -764,7 +770,7 @@ class UVMapNeuralTex(torch.nn.Module):
         layer2 = torch.nn.Linear(internal_dims, internal_dims)
         layer3 = torch.nn.Linear(internal_dims,3)
 
-        self.neural_shader = torch.nn.Sequential(layer1, torch.nn.ReLU(inplace=True), layer2, torch.nn.ReLU(inplace=True), layer3).cuda()
+        self.neural_shader = torch.nn.Sequential(layer1, torch.nn.ReLU(inplace=True), layer2, torch.nn.ReLU(inplace=True), layer3).to(device)
         torch.nn.init.constant_(self.neural_shader[-1].bias, 0)
 
         print("neural_shader", self.neural_shader)
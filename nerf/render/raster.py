@@ -0,0 +1,435 @@
+# Copyright (c) 2020-2022 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# NVIDIA CORPORATION, its affiliates and licensors retain all intellectual
+# property and proprietary rights in and to this material, related
+# documentation and any modifications thereto. Any use, reproduction,
+# disclosure or distribution of this material and related documentation
+# without an express license agreement from NVIDIA CORPORATION or
+# its affiliates is strictly prohibited.
+
+import os
+import torch
+
+try:
+    import nvdiffrast.torch as dr
+except ImportError:
+    dr = None
+
+#----------------------------------------------------------------------------
+# Rasterization backends.
+#
+# The functions below take the arguments of their nvdiffrast.torch namesakes.
+# 'cuda' runs nvdiffrast, 'torch' the PyTorch reference implementation of this
+# file, which needs neither a GPU nor nvdiffrast. 'auto' picks 'cuda' for cuda
+# tensors when nvdiffrast is installed. The choice can be forced with the
+# RASTER_BACKEND environment variable or set_backend(); a context made by
+# make_context() keeps the backend it was made with, the other calls follow
+# the tensors they get.
+#
+# Differences of the torch backend:
+# - triangles with a vertex behind the camera (w <= 0) are dropped instead of clipped
+# - cube map lookups filter within a face, without blending across the seams
+# - antialias only looks at the 4-neighbourhood, as nvdiffrast, but treats an edge
+#   as a silhouette whenever the other pixel's triangle does not share it
+
+_BACKENDS = ['auto', 'cuda', 'torch']
+_backend = os.environ.get('RASTER_BACKEND', 'auto')
+
+def set_backend(name):
+    assert name in _BACKENDS, "Unknown raster backend %s" % name
+    global _backend
+    _backend = name
+
+def get_backend(device='cuda'):
+    if _backend == 'auto':
+        return 'cuda' if dr is not None and torch.device(device).type == 'cuda' else 'torch'
+    return _backend
+
+def _use_torch(*tensors):
+    if dr is None or _backend == 'torch':
+        return True
+    return not all(t.is_cuda for t in tensors if torch.is_tensor(t))
+
+class RasterizeTorchContext:
+    '''Counterpart of dr.RasterizeCudaContext for the torch backend.
+    Triangles are binned into tile_size^2 pixel tiles and rasterized tile by tile,
+    at most max_fragments candidate pixels at a time.
+    '''
+    def __init__(self, device='cpu', tile_size=32, max_fragments=1 << 22):
+        self.device = torch.device(device)
+        self.tile_size = tile_size
+        self.max_fragments = max_fragments
+
+def make_context(device='cuda', backend=None):
+    backend = backend or get_backend(device)
+    assert backend in _BACKENDS, "Unknown raster backend %s" % backend
+    if backend == 'auto':
+        backend = 'cuda' if dr is not None and torch.device(device).type == 'cuda' else 'torch'
+    if backend == 'cuda':
+        return dr.RasterizeCudaContext(device=device)
+    return RasterizeTorchContext(device)
+
+#----------------------------------------------------------------------------
+# Rasterize
+
+_EMPTY = torch.iinfo(torch.int64).max
+
+def _screen(pos, resolution):
+    '''clip space [B, V, 4] -> pixel x, y (pixel centers at integers), ndc z and w'''
+    H, W = resolution
+    w = pos[..., 3]
+    x = (pos[..., 0] / w + 1.0) * (W * 0.5) - 0.5
+    y = (pos[..., 1] / w + 1.0) * (H * 0.5) - 0.5
+    return x, y, pos[..., 2] / w, w
+
+def _planes(x, y):
+    '''screen space barycentrics of [N, 3] triangles as planes b_i = A_i x + B_i y + C_i, and the signed area'''
+    x0, x1, x2 = x.unbind(-1)
+    y0, y1, y2 = y.unbind(-1)
+    area = (x1 - x0) * (y2 - y0) - (x2 - x0) * (y1 - y0)
+    inv = 1.0 / torch.where(area == 0, torch.ones_like(area), area)
+    A = torch.stack((y1 - y2, y2 - y0), dim=-1) * inv[..., None]
+    B = torch.stack((x2 - x1, x0 - x2), dim=-1) * inv[..., None]
+    C = torch.stack((x1 * y2 - x2 * y1, x2 * y0 - x0 * y2), dim=-1) * inv[..., None]
+    return A, B, C, area
+
+def _sortable(depth):
+    '''float32 -> int64 with the same order'''
+    bits = depth.float().contiguous().view(torch.int32).long()
+    return torch.where(bits < 0, bits ^ 0x7FFFFFFF, bits)
+
+@torch.no_grad()
+def _visible(ctx, pos, tri, resolution, prev_keys=None):
+    '''per pixel (depth, triangle) key of the nearest fragment, _EMPTY where nothing is drawn.
+    With prev_keys (of the previous layer) only the fragments behind it are kept, for depth peeling.
+    '''
+    H, W = resolution
+    B, T = pos.shape[0], tri.shape[0]
+    ts = ctx.tile_size
+    x, y, z, w = _screen(pos, resolution)
+    tx, ty, tz, tw = x[:, tri], y[:, tri], z[:, tri], w[:, tri]                # [B, T, 3]
+
+    # bounding boxes in pixels, degenerate triangles and triangles crossing w = 0 are dropped
+    A, Bp, C, area = _planes(tx, ty)
+    x_lo = torch.ceil(tx.amin(-1)).clamp(0, W)
+    x_hi = torch.floor(tx.amax(-1)).clamp(-1, W - 1)
+    y_lo = torch.ceil(ty.amin(-1)).clamp(0, H)
+    y_hi = torch.floor(ty.amax(-1)).clamp(-1, H - 1)
+    valid = (tw > 0).all(-1) & (area != 0) & (x_lo <= x_hi) & (y_lo <= y_hi) & torch.isfinite(area)
+    b_idx, t_idx = torch.nonzero(valid, as_tuple=True)
+    x_lo, x_hi, y_lo, y_hi = [v[b_idx, t_idx].long() for v in (x_lo, x_hi, y_lo, y_hi)]
+    A, Bp, C = A[b_idx, t_idx], Bp[b_idx, t_idx], C[b_idx, t_idx]
+    # edge functions with the vertices of every edge in index order, so that the two triangles of a
+    # shared edge compute the same value; a pixel center on the edge goes to the triangle for which
+    # that order is counter-clockwise, which covers every pixel of a closed surface exactly once
+    ea, eb = tri, tri.roll(-1, 1)
+    lo, hi = torch.minimum(ea, eb), torch.maximum(ea, eb)
+    bx, by = b_idx[:, None], b_idx[:, None]
+    ex0, ey0 = x[bx, lo[t_idx]], y[by, lo[t_idx]]
+    edx, edy = x[bx, hi[t_idx]] - ex0, y[by, hi[t_idx]] - ey0
+    esign = torch.sign(area[b_idx, t_idx])[:, None] * torch.where(ea[t_idx] == lo[t_idx], 1.0, -1.0)
+    # ndc depth is affine in screen space
+    zA = (A * (tz[b_idx, t_idx, :2] - tz[b_idx, t_idx, 2:])).sum(-1)
+    zB = (Bp * (tz[b_idx, t_idx, :2] - tz[b_idx, t_idx, 2:])).sum(-1)
+    zC = (C * (tz[b_idx, t_idx, :2] - tz[b_idx, t_idx, 2:])).sum(-1) + tz[b_idx, t_idx, 2]
+
+    # bin the triangles into tiles, one (triangle, tile) pair per overlapped tile
+    tx_lo, tx_hi, ty_lo, ty_hi = x_lo // ts, x_hi // ts, y_lo // ts, y_hi // ts
+    ntx = tx_hi - tx_lo + 1
+    n_tiles = ntx * (ty_hi - ty_lo + 1)
+    pair_tri = torch.repeat_interleave(torch.arange(b_idx.shape[0], device=pos.device), n_tiles)
+    local = torch.arange(pair_tri.shape[0], device=pos.device) - torch.repeat_interleave(torch.cumsum(n_tiles, 0) - n_tiles, n_tiles)
+    tile_x = tx_lo[pair_tri] + local % ntx[pair_tri]
+    tile_y = ty_lo[pair_tri] + local // ntx[pair_tri]
+    # tile major order, consecutive fragments land in the same part of the depth buffer
+    tiles_x = (W + ts - 1) // ts
+    order = torch.argsort((b_idx[pair_tri] * ((H + ts - 1) // ts) + tile_y) * tiles_x + tile_x, stable=True)
+    pair_tri, tile_x, tile_y = pair_tri[order], tile_x[order], tile_y[order]
+    rx0 = torch.maximum(x_lo[pair_tri], tile_x * ts)
+    rx1 = torch.minimum(x_hi[pair_tri], tile_x * ts + ts - 1)
+    ry0 = torch.maximum(y_lo[pair_tri], tile_y * ts)
+    ry1 = torch.minimum(y_hi[pair_tri], tile_y * ts + ts - 1)
+    rw = rx1 - rx0 + 1
+    n_frag = rw * (ry1 - ry0 + 1)
+
+    keys = torch.full((B * H * W,), _EMPTY, dtype=torch.int64, device=pos.device)
+    ends = torch.cumsum(n_frag, 0)
+    start = 0
+    while start < pair_tri.shape[0]:
+        # as many pairs as fit in max_fragments, at least one
+        base = ends[start - 1] if start > 0 else 0
+        end = max(int(torch.searchsorted(ends, base + ctx.max_fragments, right=True)), start + 1)
+        p = torch.arange(start, end, device=pos.device)
+        frag_pair = torch.repeat_interleave(p, n_frag[p])
+        offs = torch.arange(frag_pair.shape[0], device=pos.device) - torch.repeat_interleave(ends[p] - n_frag[p] - base, n_frag[p])
+        px = (rx0[frag_pair] + offs % rw[frag_pair]).float()
+        py = (ry0[frag_pair] + offs // rw[frag_pair]).float()
+        t = pair_tri[frag_pair]
+        e = (edx[t] * (py[:, None] - ey0[t]) - edy[t] * (px[:, None] - ex0[t])) * esign[t]
+        inside = ((e > 0) | ((e == 0) & (esign[t] > 0))).all(-1)
+        depth = zA[t] * px + zB[t] * py + zC[t]
+        inside &= (depth >= -1) & (depth <= 1)
+        pix = (b_idx[t] * H + py.long()) * W + px.long()
+        key = (_sortable(depth) << 32) | t_idx[t]
+        if prev_keys is not None:
+            inside &= key > prev_keys[pix]
+        keys.scatter_reduce_(0, pix[inside], key[inside], reduce='amin')
+        start = end
+    return keys
+
+def _rasterize(ctx, pos, tri, resolution, prev_keys=None):
+    '''rast [B, H, W, 4] = (u, v, z / w, triangle id + 1), rast_db [B, H, W, 4] = (du/dX, du/dY, dv/dX, dv/dY)
+    and the visibility keys of the layer
+    '''
+    H, W = resolution
+    pos = pos[None] if pos.dim() == 2 else pos
+    B = pos.shape[0]
+    tri = tri.long()
+    keys = _visible(ctx, pos.detach(), tri, resolution, prev_keys)
+
+    pix = torch.nonzero(keys != _EMPTY)[:, 0]
+    t = keys[pix] & 0xFFFFFFFF
+    b = pix // (H * W)
+    py = (pix // W % H).float()
+    px = (pix % W).float()
+
+    # perspective correct barycentrics of the covered pixels, differentiable w.r.t. pos
+    x, y, z, w = _screen(pos[b[:, None], tri[t]], resolution)                   # [N, 3]
+    A, Bp, C, _ = _planes(x, y)
+    b01 = A * px[:, None] + Bp * py[:, None] + C
+    bary = torch.cat((b01, 1.0 - b01.sum(-1, keepdim=True)), dim=-1)
+    q = bary / w
+    s = q.sum(-1, keepdim=True)
+    uv = q[:, :2] / s
+    depth = (bary * z).sum(-1, keepdim=True)
+    rast = torch.cat((uv, depth, (t + 1).to(uv.dtype)[:, None]), dim=-1)
+
+    # screen space derivatives of the barycentrics
+    dA = torch.cat((A, -A.sum(-1, keepdim=True)), dim=-1) / w
+    dB = torch.cat((Bp, -Bp.sum(-1, keepdim=True)), dim=-1) / w
+    du_dx = (dA[:, 0] * s[:, 0] - q[:, 0] * dA.sum(-1)) / s[:, 0] ** 2
+    du_dy = (dB[:, 0] * s[:, 0] - q[:, 0] * dB.sum(-1)) / s[:, 0] ** 2
+    dv_dx = (dA[:, 1] * s[:, 0] - q[:, 1] * dA.sum(-1)) / s[:, 0] ** 2
+    dv_dy = (dB[:, 1] * s[:, 0] - q[:, 1] * dB.sum(-1)) / s[:, 0] ** 2
+    db = torch.stack((du_dx, du_dy, dv_dx, dv_dy), dim=-1)
+
+    out = pos.new_zeros((B * H * W, 4)).index_copy(0, pix, rast).view(B, H, W, 4)
+    out_db = pos.new_zeros((B * H * W, 4)).index_copy(0, pix, db).view(B, H, W, 4)
+    return out, out_db, keys
+
+def rasterize(ctx, pos, tri, resolution, ranges=None, grad_db=True):
+    if isinstance(ctx, RasterizeTorchContext):
+        assert ranges is None, "The torch rasterizer only supports instanced mode"
+        return _rasterize(ctx, pos, tri, resolution)[:2]
+    return dr.rasterize(ctx, pos, tri, resolution, ranges=ranges, grad_db=grad_db)
+
+class DepthPeeler:
+    def __init__(self, ctx, pos, tri, resolution):
+        self.peeler = None if isinstance(ctx, RasterizeTorchContext) else dr.DepthPeeler(ctx, pos, tri, resolution)
+        self.ctx, self.pos, self.tri, self.resolution = ctx, pos, tri, resolution
+        self.prev_keys = None
+
+    def __enter__(self):
+        if self.peeler is not None:
+            self.peeler.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        if self.peeler is not None:
+            return self.peeler.__exit__(*args)
+
+    def rasterize_next_layer(self):
+        if self.peeler is not None:
+            return self.peeler.rasterize_next_layer()
+        rast, db, self.prev_keys = _rasterize(self.ctx, self.pos, self.tri, self.resolution, self.prev_keys)
+        return rast, db
+
+#----------------------------------------------------------------------------
+# Interpolate
+
+def interpolate(attr, rast, tri, rast_db=None, diff_attrs=None):
+    if not _use_torch(attr, rast):
+        return dr.interpolate(attr, rast, tri, rast_db=rast_db, diff_attrs=diff_attrs)
+
+    B, H, W = rast.shape[:3]
+    attr = attr[None] if attr.dim() == 2 else attr
+    flat = rast.reshape(-1, 4)
+    pix = torch.nonzero(flat[:, 3] > 0)[:, 0]
+    vi = tri.long()[flat[pix, 3].long() - 1]                                      # [N, 3]
+    a = attr[0][vi] if attr.shape[0] == 1 else attr[(pix // (H * W))[:, None], vi]
+    u, v = flat[pix, 0:1], flat[pix, 1:2]
+    val = a[:, 0] * u + a[:, 1] * v + a[:, 2] * (1.0 - u - v)
+    out = attr.new_zeros((B * H * W, attr.shape[-1])).index_copy(0, pix, val).view(B, H, W, -1)
+
+    if rast_db is None or diff_attrs is None:
+        return out, attr.new_zeros((B, H, W, 0))
+    channels = list(range(attr.shape[-1])) if diff_attrs == 'all' else list(diff_attrs)
+    db = rast_db.reshape(-1, 4)[pix]
+    a = a[..., channels]
+    da_u, da_v = a[:, 0] - a[:, 2], a[:, 1] - a[:, 2]
+    dx = da_u * db[:, 0:1] + da_v * db[:, 2:3]
+    dy = da_u * db[:, 1:2] + da_v * db[:, 3:4]
+    val_da = torch.stack((dx, dy), dim=-1).reshape(pix.shape[0], -1)             # (dA0/dX, dA0/dY, dA1/dX, ...)
+    out_da = attr.new_zeros((B * H * W, 2 * len(channels))).index_copy(0, pix, val_da).view(B, H, W, -1)
+    return out, out_da
+
+#----------------------------------------------------------------------------
+# Texture
+
+def _cube_coords(d):
+    '''directions [N, 3] -> face, x, y in [-1, 1], the inverse of util.cube_to_dir'''
+    ax, ay, az = d.abs().unbind(-1)
+    dx, dy, dz = d.unbind(-1)
+    face = torch.where((ax >= ay) & (ax >= az), torch.where(dx >= 0, 0, 1),
+                       torch.where(ay >= az, torch.where(dy >= 0, 2, 3), torch.where(dz >= 0, 4, 5)))
+    m = torch.stack((ax, ax, ay, ay, az, az), dim=-1).gather(-1, face[:, None])[:, 0].clamp(min=1e-20)
+    x = torch.stack((-dz, dz, dx, dx, dx, -dx), dim=-1).gather(-1, face[:, None])[:, 0] / m
+    y = torch.stack((-dy, -dy, dz, -dz, -dy, -dy), dim=-1).gather(-1, face[:, None])[:, 0] / m
+    return face, x, y
+
+def _sample(tex, b, face, s, t, nearest, boundary):
+    '''filtered lookup of [N] texture coordinates in [0, 1], tex is [B, H, W, C] or [B, 6, H, W, C] (face not None)'''
+    H, W = tex.shape[-3:-1]
+    x, y = s * W - 0.5, t * H - 0.5
+    if nearest:
+        taps = [(torch.floor(x + 0.5), torch.floor(y + 0.5), None)]
+    else:
+        x0, y0 = torch.floor(x), torch.floor(y)
+        fx, fy = (x - x0)[:, None], (y - y0)[:, None]
+        taps = [(x0, y0, (1 - fx) * (1 - fy)), (x0 + 1, y0, fx * (1 - fy)), (x0, y0 + 1, (1 - fx) * fy), (x0 + 1, y0 + 1, fx * fy)]
+    out = 0
+    for xi, yi, wt in taps:
+        xi, yi = xi.long(), yi.long()
+        if boundary == 'wrap':
+            xi, yi = xi % W, yi % H
+        else:
+            inb = (xi >= 0) & (xi < W) & (yi >= 0) & (yi < H)
+            xi, yi = xi.clamp(0, W - 1), yi.clamp(0, H - 1)
+        val = tex[b, yi, xi] if face is None else tex[b, face, yi, xi]
+        if boundary == 'zero':
+            val = val * inb[:, None]
+        out = out + (val if wt is None else val * wt)
+    return out
+
+def _mip_chain(tex, max_mip_level):
+    levels = [tex]
+    while min(levels[-1].shape[-3:-1]) > 1 and (max_mip_level is None or len(levels) <= max_mip_level):
+        lvl = levels[-1]
+        flat = lvl.reshape(-1, *lvl.shape[-3:]).permute(0, 3, 1, 2)
+        flat = torch.nn.functional.avg_pool2d(flat, 2)
+        levels.append(flat.permute(0, 2, 3, 1).reshape(*lvl.shape[:-3], *flat.shape[-2:], lvl.shape[-1]))
+    return levels
+
+def texture(tex, uv, uv_da=None, mip_level_bias=None, mip=None, filter_mode='auto', boundary_mode='wrap', max_mip_level=None):
+    if not _use_torch(tex, uv):
+        return dr.texture(tex, uv, uv_da, mip_level_bias=mip_level_bias, mip=mip, filter_mode=filter_mode,
+                          boundary_mode=boundary_mode, max_mip_level=max_mip_level)
+
+    cube = boundary_mode == 'cube'
+    if filter_mode == 'auto':
+        filter_mode = 'linear-mipmap-linear' if (uv_da is not None or mip_level_bias is not None) else 'linear'
+    nearest = filter_mode == 'nearest'
+    mipmapped = 'mipmap' in filter_mode
+
+    out_shape = uv.shape[:-1]
+    coords = uv.reshape(-1, uv.shape[-1])
+    N = coords.shape[0]
+    b = torch.arange(uv.shape[0], device=uv.device).repeat_interleave(N // uv.shape[0])
+    b = b if tex.shape[0] > 1 else torch.zeros_like(b)
+    if cube:
+        face, x, y = _cube_coords(coords)
+        s, t = (x + 1) * 0.5, (y + 1) * 0.5
+    else:
+        face, s, t = None, coords[:, 0], coords[:, 1]
+    boundary = 'clamp' if cube else boundary_mode
+
+    if not mipmapped:
+        return _sample(tex, b, face, s, t, nearest, boundary).view(*out_shape, -1)
+
+    levels = [tex] + list(mip) if mip is not None else _mip_chain(tex, max_mip_level)
+    if max_mip_level is not None:
+        levels = levels[:max_mip_level + 1]
+    if uv_da is not None:
+        assert not cube, "uv_da is not supported for cube maps by the torch backend"
+        H, W = tex.shape[-3:-1]
+        da = uv_da.reshape(N, 4)
+        lx = (da[:, 0] * W) ** 2 + (da[:, 2] * H) ** 2
+        ly = (da[:, 1] * W) ** 2 + (da[:, 3] * H) ** 2
+        lod = 0.5 * torch.log2(torch.maximum(lx, ly).clamp(min=1e-20))
+        if mip_level_bias is not None:
+            lod = lod + mip_level_bias.reshape(N)
+    elif mip_level_bias is not None:
+        lod = mip_level_bias.reshape(N)
+    else:
+        lod = torch.zeros_like(s)
+    lod = lod.clamp(0, len(levels) - 1)
+    if filter_mode == 'linear-mipmap-nearest':
+        lod = torch.floor(lod + 0.5)
+
+    out = tex.new_zeros((N, tex.shape[-1]))
+    for level, lvl in enumerate(levels):
+        weight = (1.0 - (lod - level).abs()).clamp(min=0)
+        idx = torch.nonzero(weight > 0)[:, 0]
+        if idx.shape[0] == 0:
+            continue
+        val = _sample(lvl, b[idx], None if face is None else face[idx], s[idx], t[idx], nearest, boundary)
+        out = out.index_add(0, idx, val * weight[idx, None])
+    return out.view(*out_shape, -1)
+
+#----------------------------------------------------------------------------
+# Antialias
+
+def antialias(color, rast, pos, tri, topology_hash=None, pos_gradient_boost=1.0):
+    '''blend the pixels next to silhouette edges with the color across the edge, by the
+    fraction of the pixel the edge covers; differentiable w.r.t. color and pos'''
+    if not _use_torch(color, rast, pos):
+        return dr.antialias(color, rast, pos, tri, topology_hash=topology_hash, pos_gradient_boost=pos_gradient_boost)
+
+    B, H, W, Ch = color.shape
+    pos = pos[None] if pos.dim() == 2 else pos
+    tri = tri.long()
+    tid = rast[..., 3].long().reshape(-1)
+    depth = rast[..., 2].reshape(-1)
+    flat = color.reshape(-1, Ch)
+    pix = torch.arange(B * H * W, device=color.device).view(B, H, W)
+    out = flat
+
+    for pa, pb in [(pix[:, :, :-1], pix[:, :, 1:]), (pix[:, :-1, :], pix[:, 1:, :])]:
+        pa, pb = pa.reshape(-1), pb.reshape(-1)
+        ta, tb = tid[pa], tid[pb]
+        sel = ta != tb
+        pa, pb, ta, tb = pa[sel], pb[sel], ta[sel], tb[sel]
+        # f is the pixel of the closer surface, k the one across its edge
+        a_front = (tb == 0) | ((ta > 0) & (depth[pa] < depth[pb]))
+        f, k = torch.where(a_front, pa, pb), torch.where(a_front, pb, pa)
+        tf, tk = torch.where(a_front, ta, tb) - 1, torch.where(a_front, tb, ta) - 1
+        bf = f // (H * W)
+
+        vi = tri[tf]                                                              # [N, 3]
+        x, y, _, _ = _screen(pos[(bf if pos.shape[0] > 1 else torch.zeros_like(bf))[:, None], vi], (H, W))
+        fx, fy = (f % W).float(), (f // W % H).float()
+        kx, ky = (k % W).float(), (k // W % H).float()
+        area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+        sign = torch.sign(area)[:, None]
+        ex, ey = x.roll(-1, 1) - x, y.roll(-1, 1) - y                            # edges j -> j+1
+        e_f = (ex * (fy[:, None] - y) - ey * (fx[:, None] - x)) * sign
+        e_k = (ex * (ky[:, None] - y) - ey * (kx[:, None] - x)) * sign
+        # the first edge crossed on the way from f to k
+        crossing = (e_k < 0) & (e_f >= 0)
+        tcross = torch.where(crossing, e_f / (e_f - e_k).clamp(min=1e-20), torch.full_like(e_f, 2.0))
+        tcross, edge = tcross.min(-1)
+        ok = tcross <= 1.0
+        # an edge shared with the triangle of k is not a silhouette
+        va, vb = vi.gather(1, edge[:, None])[:, 0], vi.gather(1, ((edge + 1) % 3)[:, None])[:, 0]
+        vk = tri[tk.clamp(min=0)]
+        shared = (tk >= 0) & (vk == va[:, None]).any(-1) & (vk == vb[:, None]).any(-1)
+        ok &= ~shared
+        tcross, f, k = tcross[ok], f[ok], k[ok]
+
+        # the half of the segment between the centers the edge lies in is blended
+        into_k = tcross > 0.5
+        alpha = torch.where(into_k, tcross - 0.5, 0.5 - tcross)[:, None]
+        dst = torch.where(into_k, k, f)
+        src = torch.where(into_k, f, k)
+        out = out.index_add(0, dst, (flat[src] - flat[dst]) * alpha)
+    return out.view(B, H, W, Ch)
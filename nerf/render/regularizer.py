@@ -8,20 +8,20 @@
 # its affiliates is strictly prohibited.
 
 import torch
-import nvdiffrast.torch as dr
 
 from . import util
+from . import raster
 from . import mesh
 
 ######################################################################################
 # Computes the image gradient, useful for kd/ks smoothness losses
 ######################################################################################
 def image_grad(buf, std=0.01):
-    t, s = torch.meshgrid(torch.linspace(-1.0 + 1.0 / buf.shape[1], 1.0 - 1.0 / buf.shape[1], buf.shape[1], device="cuda"), 
-                          torch.linspace(-1.0 + 1.0 / buf.shape[2], 1.0 - 1.0 / buf.shape[2], buf.shape[2], device="cuda"),
+    t, s = torch.meshgrid(torch.linspace(-1.0 + 1.0 / buf.shape[1], 1.0 - 1.0 / buf.shape[1], buf.shape[1], device=buf.device), 
+                          torch.linspace(-1.0 + 1.0 / buf.shape[2], 1.0 - 1.0 / buf.shape[2], buf.shape[2], device=buf.device),
                           indexing='ij')
-    tc   = torch.normal(mean=0, std=std, size=(buf.shape[0], buf.shape[1], buf.shape[2], 2), device="cuda") + torch.stack((s, t), dim=-1)[None, ...]
-    tap  = dr.texture(buf, tc, filter_mode='linear', boundary_mode='clamp')
+    tc   = torch.normal(mean=0, std=std, size=(buf.shape[0], buf.shape[1], buf.shape[2], 2), device=buf.device) + torch.stack((s, t), dim=-1)[None, ...]
+    tap  = raster.texture(buf, tc, filter_mode='linear', boundary_mode='clamp')
     return torch.abs(tap[..., :-1] - buf[..., :-1]) * tap[..., -1:] * buf[..., -1:]
 
 ######################################################################################
@@ -29,7 +29,7 @@ def image_grad(buf, std=0.01):
 # Rough estimate of the tessellation of a mesh. Can be used e.g. to clamp gradients
 ######################################################################################
 def avg_edge_length(v_pos, t_pos_idx):
-    e_pos_idx = mesh.compute_edges(t_pos_idx)
+    e_pos_idx = mesh.topology(t_pos_idx, v_pos.shape[0]).edges
     edge_len  = util.length(v_pos[e_pos_idx[:, 0]] - v_pos[e_pos_idx[:, 1]])
     return torch.mean(edge_len)
 
@@ -38,21 +38,12 @@ def avg_edge_length(v_pos, t_pos_idx):
 # https://mgarland.org/class/geom04/material/smoothing.pdf
 ######################################################################################
 def laplace_regularizer_const(v_pos, t_pos_idx):
-    term = torch.zeros_like(v_pos)
-    norm = torch.zeros_like(v_pos[..., 0:1])
+    topo = mesh.topology(t_pos_idx, v_pos.shape[0])
 
-    v0 = v_pos[t_pos_idx[:, 0], :]
-    v1 = v_pos[t_pos_idx[:, 1], :]
-    v2 = v_pos[t_pos_idx[:, 2], :]
-
-    term.scatter_add_(0, t_pos_idx[:, 0:1].repeat(1,3), (v1 - v0) + (v2 - v0))
-    term.scatter_add_(0, t_pos_idx[:, 1:2].repeat(1,3), (v0 - v1) + (v2 - v1))
-    term.scatter_add_(0, t_pos_idx[:, 2:3].repeat(1,3), (v0 - v2) + (v1 - v2))
-
-    two = torch.ones_like(v0) * 2.0
-    norm.scatter_add_(0, t_pos_idx[:, 0:1], two)
-    norm.scatter_add_(0, t_pos_idx[:, 1:2], two)
-    norm.scatter_add_(0, t_pos_idx[:, 2:3], two)
+    # Sum of (neighbour - vertex) over the two other corners of every face around a vertex
+    norm = topo.degree[:, None].to(v_pos.dtype)
+    term = torch.zeros_like(v_pos).index_add_(0, topo.adj_row, v_pos[topo.adj_col])
+    term = term - v_pos * norm
 
     term = term / torch.clamp(norm, min=1.0)
 
@@ -67,9 +58,9 @@ def normal_consistency(v_pos, t_pos_idx):
     v1 = v_pos[t_pos_idx[:, 1], :]
     v2 = v_pos[t_pos_idx[:, 2], :]
 
-    face_normals = util.safe_normalize(torch.cross(v1 - v0, v2 - v0))
+    face_normals = util.safe_normalize(torch.cross(v1 - v0, v2 - v0, dim=-1))
 
-    tris_per_edge = mesh.compute_edge_to_face_mapping(t_pos_idx)
+    tris_per_edge = mesh.topology(t_pos_idx, v_pos.shape[0]).tris_per_edge
 
     # Fetch normals for both faces sharind an edge
     n0 = face_normals[tris_per_edge[:, 0], :]
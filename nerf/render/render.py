@@ -8,9 +8,9 @@
 # its affiliates is strictly prohibited.
 
 import torch
-import nvdiffrast.torch as dr
 
 from . import util
+from . import raster
 from . import renderutils as ru
 from . import light
 from .mlptexture import MLPNeuralTex
@@ -20,14 +20,33 @@ from .mlptexture import positional_encoding
 #  Helper functions
 # ==============================================================================================
 def interpolate(attr, rast, attr_idx, rast_db=None):
-    return dr.interpolate(attr.contiguous(), rast, attr_idx, rast_db=rast_db, diff_attrs=None if rast_db is None else 'all')
+    return raster.interpolate(attr.contiguous(), rast, attr_idx, rast_db=rast_db, diff_attrs=None if rast_db is None else 'all')
+
+def compact_pixels(rast):
+    '''flat indices of the covered pixels (triangle id > 0) of a [B, H, W, 4] rast buffer'''
+    idx = torch.nonzero(rast[..., -1].reshape(-1) > 0)[:, 0]
+    if idx.shape[0] == 0:
+        # keep one pixel so the shaders never see an empty batch, it is masked out when compositing
+        idx = torch.zeros((1,), dtype=torch.long, device=rast.device)
+    return idx
+
+def scatter_pixels(val, idx, n_pix):
+    '''inverse of the gather in shade: [K, C] values of the covered pixels -> [n_pix, C], zero elsewhere'''
+    val = val.reshape(idx.shape[0], -1)
+    return val.new_zeros((n_pix, val.shape[-1])).index_copy(0, idx, val)
 
 def shade(
         attrs,
         view_pos,
         material,
         tex_type,
+        rast=None,
     ):
+    '''
+    - args:
+        - rast: [B, H, W, 4] rasterizer output. When given, only the covered pixels are sampled and shaded,
+                in a dense [K, 3] batch, and the results are scattered back to the full crop.
+    '''
 
     ################################################################################
     # Texture lookups
@@ -35,42 +54,36 @@ def shade(
 
     if 'vert' not in tex_type:
         gb_pos = attrs
-        wo = util.safe_normalize(gb_pos - view_pos)
-        all_tex = material['neural_tex'].sample(gb_pos, wo)
+        all_tex = None
     else:
         gb_pos = attrs[:,:,:,:3]
         all_tex = attrs[:,:,:,3:]
+    wo = util.safe_normalize(gb_pos - view_pos)
 
-    # print('max', gb_pos.max(), 'min', gb_pos.min())
-
-    # albedo = gt_albedo.reshape((200, 200, 3))
-    # print(albedo.max(), albedo.min())
-    # albedo = albedo * 255
-    # import imageio
-    # imageio.imwrite('gt_albedo.png', albedo.detach().cpu().numpy().astype('uint8'))
-    # print(all_tex['albedo'].shape)
-    # exit(0)
-
-    # test_albedo = all_tex['albedo'].reshape((200, 200, 3))
-    # print(test_albedo.max(), test_albedo.min())
-    # print(gt_albedo.max(), gt_albedo.min())
-    # exit(0)
-
-    # all_tex['albedo'] = gt_albedo.reshape((40000, 3))
+    B, H, W = gb_pos.shape[:3]
+    n_pix = B * H * W
+    if rast is not None:
+        idx = compact_pixels(rast)
+        pos, dirs = gb_pos.reshape(n_pix, 3)[idx], wo.reshape(n_pix, 3)[idx]
+        if all_tex is not None:
+            all_tex = all_tex.reshape(n_pix, -1)[idx]
+    else:
+        pos, dirs = gb_pos, wo
 
+    if all_tex is None:
+        all_tex = material['neural_tex'].sample(pos, dirs)
 
-    shaded_col, ret_dict = material['neural_tex'].neural_shade(all_tex, wo)
+    shaded_col, ret_dict = material['neural_tex'].neural_shade(all_tex, dirs)
 
-    # print('albedo', albedo.shape)
+    # per-pixel outputs of a single view are [H, W, C]
+    out_shape = (H, W, -1) if B == 1 else (B, H, W, -1)
     for key, val in ret_dict.items():
-        ret_dict[key] = val.reshape((200, 200, -1))
-
-    # vis_albedo = albedo
-    # print(vis_albedo.max(), vis_albedo.min())
-    # vis_albedo = vis_albedo * 255
-    # import imageio
-    # imageio.imwrite('albedo11.png', vis_albedo.detach().cpu().numpy().astype('uint8'))
-    # exit(0)
+        if rast is not None:
+            val = scatter_pixels(val, idx, n_pix)
+        ret_dict[key] = val.reshape(out_shape)
+    if rast is not None:
+        shaded_col = scatter_pixels(shaded_col, idx, n_pix)
+    shaded_col = shaded_col.reshape(B, H, W, -1)
 
     alpha = torch.ones(list(shaded_col.shape[:3])+[1]).to(shaded_col.device)
 
@@ -133,6 +146,7 @@ def render_layer(
         msaa,
         bsdf,
         tex_type,
+        compact     = True,
     ):
 
     full_res = [resolution[0]*spp, resolution[1]*spp]
@@ -164,7 +178,7 @@ def render_layer(
     ################################################################################
 
     if tex_type != 'uvmap':
-        buffers = shade(attrs, view_pos, mesh.material, tex_type)
+        buffers = shade(attrs, view_pos, mesh.material, tex_type, rast=rast_out_s if compact else None)
     else:
         # Texture coordinate
         assert mesh.v_tex is not None
@@ -209,11 +223,14 @@ def render_mesh(
         tex_type    = 'mlp',
         downsample  = 1,
         anti_aliasing   = False,
-        anti_aliasing_mode = 'bilinear'
+        anti_aliasing_mode = 'bilinear',
+        compact_shading = True,
     ):
 
+    device = mesh.v_pos.device
+
     def prepare_input_vector(x):
-        x = torch.tensor(x, dtype=torch.float32, device='cuda') if not torch.is_tensor(x) else x
+        x = torch.tensor(x, dtype=torch.float32, device=device) if not torch.is_tensor(x) else x
         return x[:, None, None, :] if len(x.shape) == 2 else x
 
     def composite_buffer(key, layers, background, antialias):
@@ -222,7 +239,7 @@ def render_mesh(
             alpha = (rast[..., -1:] > 0).float() * buffers[key][..., -1:]
             accum = torch.lerp(accum, torch.cat((buffers[key][..., :-1], torch.ones_like(buffers[key][..., -1:])), dim=-1), alpha)
             if antialias:
-                accum = dr.antialias(accum.contiguous(), rast, v_pos_clip, mesh.t_pos_idx.int())
+                accum = raster.antialias(accum.contiguous(), rast, v_pos_clip, mesh.t_pos_idx.int())
         return accum
 
     assert mesh.t_pos_idx.shape[0] > 0, "Got empty training triangle mesh (unrecoverable discontinuity)"
@@ -231,7 +248,7 @@ def render_mesh(
     full_res = [resolution[0]*spp, resolution[1]*spp]
 
     # Convert numpy arrays to torch tensors
-    mtx_in      = torch.tensor(mtx_in, dtype=torch.float32, device='cuda') if not torch.is_tensor(mtx_in) else mtx_in
+    mtx_in      = torch.tensor(mtx_in, dtype=torch.float32, device=device) if not torch.is_tensor(mtx_in) else mtx_in
     view_pos    = prepare_input_vector(view_pos)
 
     # clip space transform
@@ -241,10 +258,10 @@ def render_mesh(
 
     # Render all layers front-to-back
     layers = []
-    with dr.DepthPeeler(ctx, v_pos_clip, mesh.t_pos_idx.int(), full_res) as peeler:
+    with raster.DepthPeeler(ctx, v_pos_clip, mesh.t_pos_idx.int(), full_res) as peeler:
         for _ in range(num_layers):
             rast, db = peeler.rasterize_next_layer()
-            layers += [(render_layer(rast, db, mesh, view_pos, resolution, spp, msaa, bsdf, tex_type), rast)]
+            layers += [(render_layer(rast, db, mesh, view_pos, resolution, spp, msaa, bsdf, tex_type, compact_shading), rast)]
 
     # Setup background
     if background is not None:
@@ -252,7 +269,7 @@ def render_mesh(
             background = util.scale_img_nhwc(background, full_res, mag='nearest', min='nearest')
         background = torch.cat((background, torch.zeros_like(background[..., 0:1])), dim=-1)
     else:
-        background = torch.zeros(1, full_res[0], full_res[1], 4, dtype=torch.float32, device='cuda')
+        background = torch.zeros(1, full_res[0], full_res[1], 4, dtype=torch.float32, device=device)
 
     # Composite layers front-to-back
     out_buffers = {}
@@ -289,7 +306,7 @@ def render_uv(ctx, mesh, resolution, mlp_texture):
     # uv_clip4 = torch.cat((uv_clip, torch.zeros_like(uv_clip[...,0:1]), torch.ones_like(uv_clip[...,0:1])), dim = -1)
 
     # # rasterize
-    # rast, _ = dr.rasterize(ctx, uv_clip4, mesh.t_tex_idx.int(), resolution)
+    # rast, _ = raster.rasterize(ctx, uv_clip4, mesh.t_tex_idx.int(), resolution)
 
     # # Interpolate world space position
     # gb_pos, _ = interpolate(mesh.v_pos[None, ...], rast, mesh.t_pos_idx.int())
@@ -0,0 +1,136 @@
+# Copyright (c) 2020-2022 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# NVIDIA CORPORATION, its affiliates and licensors retain all intellectual
+# property and proprietary rights in and to this material, related
+# documentation and any modifications thereto. Any use, reproduction,
+# disclosure or distribution of this material and related documentation
+# without an express license agreement from NVIDIA CORPORATION or
+# its affiliates is strictly prohibited.
+
+import math
+import torch
+
+#----------------------------------------------------------------------------
+# Cubemap filtering, PyTorch versions of the kernels in c_src/cubemap.cu
+#----------------------------------------------------------------------------
+
+# output texels filtered per matrix product, bounds the [chunk, 6*N*N] weight matrix
+CUBEMAP_CHUNK = 1024
+
+def _pixel_area(N, device):
+    '''solid angle (up to a constant) of every texel of a face, [N, N]'''
+    if N == 1:
+        return torch.ones((1, 1), device=device)
+    H = N // 2
+    i = (torch.arange(N, device=device) - H).abs().float()
+    d = torch.atan((i + 1) / H) - torch.atan(i / H)
+    return d[:, None] * d[None, :]
+
+def _face_dirs(fx, fy):
+    '''cube_to_dir of the CUDA kernels for face coordinates fx, fy in [-1, 1], [6, *fx.shape, 3]'''
+    one = torch.ones_like(fx)
+    dirs = torch.stack([
+        torch.stack([ one, -fy, -fx], dim=-1),
+        torch.stack([-one, -fy,  fx], dim=-1),
+        torch.stack([ fx,  one,  fy], dim=-1),
+        torch.stack([ fx, -one, -fy], dim=-1),
+        torch.stack([ fx, -fy,  one], dim=-1),
+        torch.stack([-fx, -fy, -one], dim=-1),
+    ], dim=0)
+    return torch.nn.functional.normalize(dirs, dim=-1)
+
+def _texel_coord(x, N):
+    return 2.0 * (x.float() + 0.5) / N - 1.0
+
+def _cube_dirs(N, device):
+    '''unit direction through the center of every texel, [6, N, N, 3] indexed [side, y, x]'''
+    c = _texel_coord(torch.arange(N, device=device), N)
+    fy, fx = torch.meshgrid(c, c, indexing='ij')
+    return _face_dirs(fx, fy)
+
+def diffuse_cubemap_fn(cubemap):
+    '''cosine weighted irradiance of every texel, [6, N, N, 3] -> [6, N, N, 3]'''
+    N = cubemap.shape[1]
+    dirs = _cube_dirs(N, cubemap.device).reshape(-1, 3)
+    area = _pixel_area(N, cubemap.device).reshape(1, -1).repeat(1, 6) / 3.141592
+    col = cubemap.reshape(-1, cubemap.shape[-1])
+
+    out = []
+    for nrm in torch.split(dirs, CUBEMAP_CHUNK):
+        w = torch.clamp(nrm @ dirs.T, min=0.0, max=0.999) * area
+        out.append(w @ col)
+    return torch.cat(out, dim=0).reshape(cubemap.shape)
+
+def _ndf_ggx(alphaSqr, cosTheta):
+    cosTheta = torch.clamp(cosTheta, min=0.0, max=1.0)
+    d = (cosTheta * alphaSqr - cosTheta) * cosTheta + 1.0
+    return alphaSqr / (d * d * math.pi)
+
+# tiles of the lobe bounds search of the CUDA kernel
+BOUNDS_TILE = 16
+
+def _bounds_tiles(N, device):
+    '''corner directions of the 16x16 tiles culled by SpecularBoundsKernel and the tile of every texel
+    - return:
+        - corner_min, corner_max: [6, T, 3] per axis extent of the four corner directions of every tile
+        - texel_tile: [N * N] tile index of every texel, indexed [y, x]
+    '''
+    n_tiles = (N + BOUNDS_TILE - 1) // BOUNDS_TILE
+    start = torch.arange(n_tiles, device=device) * BOUNDS_TILE
+    end = torch.clamp(start + BOUNDS_TILE, max=N)
+    # tiles are enumerated x major, as the loops of the kernel
+    tx, ty = torch.meshgrid(torch.arange(n_tiles, device=device), torch.arange(n_tiles, device=device), indexing='ij')
+    tx, ty = tx.reshape(-1), ty.reshape(-1)
+    cx = torch.stack([start[tx], end[tx], start[tx], end[tx]], dim=-1)
+    cy = torch.stack([start[ty], start[ty], end[ty], end[ty]], dim=-1)
+    corners = _face_dirs(_texel_coord(cx, N), _texel_coord(cy, N))                # [6, T, 4, 3]
+
+    y, x = torch.meshgrid(torch.arange(N, device=device), torch.arange(N, device=device), indexing='ij')
+    texel_tile = ((x // BOUNDS_TILE) * n_tiles + y // BOUNDS_TILE).reshape(-1)
+    return corners.amin(dim=2), corners.amax(dim=2), texel_tile
+
+def _lobe_mask(vnr, cos, costheta_cutoff, N, tiles):
+    '''texels inside the per face bounds of SpecularBoundsKernel and within costheta_cutoff of vnr
+    The kernel keeps a texel when it is inside the bounding box of its face (found on the tiles that
+    pass a blunt interval test) and its own dot product passes the cutoff, this reproduces both tests.
+    - args:
+        - vnr: [C, 3] reflection vectors
+        - cos: [C, 6 * N * N] dot products with every texel
+    '''
+    corner_min, corner_max, texel_tile = tiles
+    C = vnr.shape[0]
+    v = vnr[:, None, None, :]
+    maxdp = torch.maximum(corner_min * v, corner_max * v).sum(-1)                   # [C, 6, T]
+    tile_pass = (maxdp >= costheta_cutoff)[:, :, texel_tile]                       # [C, 6, N * N]
+
+    lobe = (cos >= costheta_cutoff).view(C, 6, N * N)
+    found = lobe & tile_pass
+    idx = torch.arange(N * N, device=vnr.device)
+    x, y = idx % N, idx // N
+    xmin = torch.where(found, x, torch.full_like(x, N - 1)).amin(-1, keepdim=True)
+    xmax = torch.where(found, x, torch.zeros_like(x)).amax(-1, keepdim=True)
+    ymin = torch.where(found, y, torch.full_like(y, N - 1)).amin(-1, keepdim=True)
+    ymax = torch.where(found, y, torch.zeros_like(y)).amax(-1, keepdim=True)
+    inside = (x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)
+    return (inside & lobe).view(C, 6 * N * N)
+
+def specular_cubemap_fn(cubemap, roughness, costheta_cutoff):
+    '''GGX prefiltered cubemap, [6, N, N, 3] -> [6, N, N, 4] with the sum of the weights in the last channel
+    Only the texels the CUDA kernel visits contribute: inside the per face lobe bounds and within costheta_cutoff.
+    '''
+    N = cubemap.shape[1]
+    dirs = _cube_dirs(N, cubemap.device).reshape(-1, 3)
+    area = _pixel_area(N, cubemap.device).reshape(-1).repeat(6) / 4.0
+    col = cubemap.reshape(-1, cubemap.shape[-1])
+    alphaSqr = roughness ** 4
+    tiles = _bounds_tiles(N, cubemap.device)
+
+    out = []
+    for vnr in torch.split(dirs, CUBEMAP_CHUNK):
+        cos = vnr @ dirs.T                                                          # [chunk, 6*N*N]
+        # dot(VNR, H) for H = normalize(L + VNR), both unit vectors
+        cos_h = torch.sqrt(torch.clamp((1.0 + cos) * 0.5, min=1e-12))
+        w = torch.clamp(cos, min=0.0) * _ndf_ggx(alphaSqr, cos_h) * area
+        w = torch.where(_lobe_mask(vnr, cos, costheta_cutoff, N, tiles), w, torch.zeros_like(w))
+        out.append(torch.cat((w @ col, w.sum(dim=-1, keepdim=True)), dim=-1))
+    return torch.cat(out, dim=0).reshape(6, N, N, -1)
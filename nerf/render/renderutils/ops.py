@@ -7,18 +7,97 @@
 # without an express license agreement from NVIDIA CORPORATION or 
 # its affiliates is strictly prohibited.
 
+import hashlib
 import numpy as np
 import os
+import shutil
 import sys
 import torch
 import torch.utils.cpp_extension
 
 from .bsdf import *
 from .loss import *
+from .cubemap import *
+
+#----------------------------------------------------------------------------
+# Backend selection.
+#
+# 'cuda' runs the compiled plugin, 'torch' the PyTorch implementations of
+# bsdf.py, loss.py and cubemap.py (slower, but needs neither a GPU nor a
+# compiler). 'auto' picks 'cuda' when a GPU is present and the plugin can be
+# built or loaded from the build cache, 'torch' otherwise. The choice can be
+# forced with the RENDERUTILS_BACKEND environment variable or set_backend().
+# Calls on CPU tensors, or with use_python=True, always take the torch path.
+
+_BACKENDS = ['auto', 'cuda', 'torch']
+_backend = os.environ.get('RENDERUTILS_BACKEND', 'auto')
+_plugin_ok = None
+
+def set_backend(name):
+    assert name in _BACKENDS, "Unknown renderutils backend %s" % name
+    global _backend
+    _backend = name
+
+def _compiler_available():
+    cxx = os.environ.get('CXX', 'cl' if os.name == 'nt' else 'c++')
+    return torch.utils.cpp_extension.CUDA_HOME is not None and shutil.which(cxx) is not None
+
+def _plugin_available():
+    global _plugin_ok
+    if _plugin_ok is None:
+        _plugin_ok = False
+        if torch.cuda.is_available() and (_compiler_available() or os.path.exists(_build_paths()[2])):
+            try:
+                _get_plugin()
+                _plugin_ok = True
+            except Exception as e:
+                print("Warning: renderutils plugin unavailable, using the torch backend (%s)" % e)
+    return _plugin_ok
+
+def get_backend():
+    if _backend == 'auto':
+        return 'cuda' if _plugin_available() else 'torch'
+    return _backend
+
+def _use_python(use_python, *tensors):
+    if use_python or get_backend() == 'torch':
+        return True
+    return not all(t.is_cuda for t in tensors if torch.is_tensor(t))
 
 #----------------------------------------------------------------------------
 # C++/Cuda plugin compiler/loader.
 
+# List of sources.
+_source_files = [
+    'c_src/mesh.cu',
+    'c_src/loss.cu',
+    'c_src/bsdf.cu',
+    'c_src/normal.cu',
+    'c_src/cubemap.cu',
+    'c_src/common.cpp',
+    'c_src/torch_bindings.cpp'
+]
+
+def _build_paths():
+    '''module name, build directory and library path of the plugin in the persistent build cache.
+    The version hashes the sources, headers, and the torch / cuda / GPU the plugin is built for.
+    '''
+    src_dir = os.path.join(os.path.dirname(__file__), 'c_src')
+    h = hashlib.sha1()
+    for fn in sorted(os.listdir(src_dir)):
+        with open(os.path.join(src_dir, fn), 'rb') as f:
+            h.update(fn.encode() + f.read())
+    h.update(('%s %s' % (torch.__version__, torch.version.cuda)).encode())
+    if torch.cuda.is_available():
+        h.update(str(torch.cuda.get_device_capability()).encode())
+    version = h.hexdigest()[:12]
+
+    name = 'renderutils_plugin_' + version
+    root = os.environ.get('RENDERUTILS_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'renderutils'))
+    build_dir = os.path.join(root, version)
+    ext = '.pyd' if os.name == 'nt' else '.so'
+    return name, build_dir, os.path.join(build_dir, name + ext)
+
 _cached_plugin = None
 def _get_plugin():
     # Return cached plugin if already loaded.
@@ -51,36 +130,23 @@ def _get_plugin():
     elif os.name == 'nt':
         ldflags = ['cuda.lib', 'advapi32.lib', 'nvrtc.lib']
 
-    # List of sources.
-    source_files = [
-        'c_src/mesh.cu',
-        'c_src/loss.cu',
-        'c_src/bsdf.cu',
-        'c_src/normal.cu',
-        'c_src/cubemap.cu',
-        'c_src/common.cpp',
-        'c_src/torch_bindings.cpp'
-    ]
-
     # Some containers set this to contain old architectures that won't compile. We only need the one installed in the machine.
     os.environ['TORCH_CUDA_ARCH_LIST'] = ''
 
+    # Versioned build directory, reused across runs: ninja only rebuilds what is out of date.
+    name, build_dir, lib_path = _build_paths()
+    os.makedirs(build_dir, exist_ok=True)
+
     # Try to detect if a stray lock file is left in cache directory and show a warning. This sometimes happens on Windows if the build is interrupted at just the right moment.
-    try:
-        lock_fn = os.path.join(torch.utils.cpp_extension._get_build_directory('renderutils_plugin', False), 'lock')
-        if os.path.exists(lock_fn):
-            print("Warning: Lock file exists in build directory: '%s'" % lock_fn)
-    except:
-        pass
+    lock_fn = os.path.join(build_dir, 'lock')
+    if os.path.exists(lock_fn):
+        print("Warning: Lock file exists in build directory: '%s'" % lock_fn)
 
     # Compile and load.
-    source_paths = [os.path.join(os.path.dirname(__file__), fn) for fn in source_files]
-    torch.utils.cpp_extension.load(name='renderutils_plugin', sources=source_paths, extra_cflags=opts,
-         extra_cuda_cflags=opts, extra_ldflags=ldflags, with_cuda=True, verbose=True)
-
-    # Import, cache, and return the compiled module.
-    import renderutils_plugin
-    _cached_plugin = renderutils_plugin
+    source_paths = [os.path.join(os.path.dirname(__file__), fn) for fn in _source_files]
+    _cached_plugin = torch.utils.cpp_extension.load(name=name, sources=source_paths, extra_cflags=opts,
+         extra_cuda_cflags=opts, extra_ldflags=ldflags, build_directory=build_dir, with_cuda=True,
+         verbose=not os.path.exists(lib_path))
     return _cached_plugin
 
 #----------------------------------------------------------------------------
@@ -99,7 +165,7 @@ class _fresnel_shlick_func(torch.autograd.Function):
         return _get_plugin().fresnel_shlick_bwd(f0, f90, cosTheta, dout) + (None,)
 
 def _fresnel_shlick(f0, f90, cosTheta, use_python=False):
-    if use_python:
+    if _use_python(use_python, f0, f90, cosTheta):
         out = bsdf_fresnel_shlick(f0, f90, cosTheta)
     else:
         out = _fresnel_shlick_func.apply(f0, f90, cosTheta)
@@ -122,7 +188,7 @@ class _ndf_ggx_func(torch.autograd.Function):
         return _get_plugin().ndf_ggx_bwd(alphaSqr, cosTheta, dout) + (None,)
 
 def _ndf_ggx(alphaSqr, cosTheta, use_python=False):
-    if use_python:
+    if _use_python(use_python, alphaSqr, cosTheta):
         out = bsdf_ndf_ggx(alphaSqr, cosTheta)
     else:
         out = _ndf_ggx_func.apply(alphaSqr, cosTheta)
@@ -144,7 +210,7 @@ class _lambda_ggx_func(torch.autograd.Function):
         return _get_plugin().lambda_ggx_bwd(alphaSqr, cosTheta, dout) + (None,)
 
 def _lambda_ggx(alphaSqr, cosTheta, use_python=False):
-    if use_python:
+    if _use_python(use_python, alphaSqr, cosTheta):
         out = bsdf_lambda_ggx(alphaSqr, cosTheta)
     else:
         out = _lambda_ggx_func.apply(alphaSqr, cosTheta)
@@ -166,7 +232,7 @@ class _masking_smith_func(torch.autograd.Function):
         return _get_plugin().masking_smith_bwd(alphaSqr, cosThetaI, cosThetaO, dout) + (None,)
 
 def _masking_smith(alphaSqr, cosThetaI, cosThetaO, use_python=False):
-    if use_python:
+    if _use_python(use_python, alphaSqr, cosThetaI, cosThetaO):
         out = bsdf_masking_smith_ggx_correlated(alphaSqr, cosThetaI, cosThetaO)
     else:
         out = _masking_smith_func.apply(alphaSqr, cosThetaI, cosThetaO)
@@ -215,9 +281,9 @@ def prepare_shading_normal(pos, view_pos, perturbed_nrm, smooth_nrm, smooth_tng,
     '''    
 
     if perturbed_nrm is None:
-        perturbed_nrm = torch.tensor([0, 0, 1], dtype=torch.float32, device='cuda', requires_grad=False)[None, None, None, ...]
+        perturbed_nrm = torch.tensor([0, 0, 1], dtype=torch.float32, device=pos.device, requires_grad=False)[None, None, None, ...]
     
-    if use_python:
+    if _use_python(use_python, pos, view_pos, perturbed_nrm, smooth_nrm, smooth_tng, geom_nrm):
         out = bsdf_prepare_shading_normal(pos, view_pos, perturbed_nrm, smooth_nrm, smooth_tng, geom_nrm, two_sided_shading, opengl)
     else:
         out = _prepare_shading_normal_func.apply(pos, view_pos, perturbed_nrm, smooth_nrm, smooth_tng, geom_nrm, two_sided_shading, opengl)
@@ -254,7 +320,7 @@ def lambert(nrm, wi, use_python=False):
         Shaded diffuse value with shape [minibatch_size, height, width, 1]
     '''
 
-    if use_python:
+    if _use_python(use_python, nrm, wi):
         out = bsdf_lambert(nrm, wi)
     else:
         out = _lambert_func.apply(nrm, wi)
@@ -290,7 +356,7 @@ def frostbite_diffuse(nrm, wi, wo, linearRoughness, use_python=False):
         Shaded diffuse value with shape [minibatch_size, height, width, 1]
     '''
 
-    if use_python:
+    if _use_python(use_python, nrm, wi, wo, linearRoughness):
         out = bsdf_frostbite(nrm, wi, wo, linearRoughness)
     else:
         out = _frostbite_diffuse_func.apply(nrm, wi, wo, linearRoughness)
@@ -329,7 +395,7 @@ def pbr_specular(col, nrm, wo, wi, alpha, min_roughness=0.08, use_python=False):
         Shaded specular color
     '''
 
-    if use_python:
+    if _use_python(use_python, col, nrm, wo, wi, alpha):
         out = bsdf_pbr_specular(col, nrm, wo, wi, alpha, min_roughness=min_roughness)
     else:
         out = _pbr_specular_func.apply(col, nrm, wo, wi, alpha, min_roughness)
@@ -376,7 +442,7 @@ def pbr_bsdf(kd, arm, pos, nrm, view_pos, light_pos, min_roughness=0.08, bsdf="l
     if bsdf == 'frostbite':
         BSDF = 1
 
-    if use_python:
+    if _use_python(use_python, kd, arm, pos, nrm, view_pos, light_pos):
         out = bsdf_pbr(kd, arm, pos, nrm, view_pos, light_pos, min_roughness, BSDF)
     else:
         out = _pbr_bsdf_func.apply(kd, arm, pos, nrm, view_pos, light_pos, min_roughness, BSDF)
@@ -402,8 +468,8 @@ class _diffuse_cubemap_func(torch.autograd.Function):
         return cubemap_grad, None
 
 def diffuse_cubemap(cubemap, use_python=False):
-    if use_python:
-        assert False
+    if _use_python(use_python, cubemap):
+        out = diffuse_cubemap_fn(cubemap)
     else:
         out = _diffuse_cubemap_func.apply(cubemap)
     if torch.is_anomaly_enabled():
@@ -424,8 +490,8 @@ class _specular_cubemap(torch.autograd.Function):
         cubemap_grad = _get_plugin().specular_cubemap_bwd(cubemap, bounds, dout, ctx.roughness, ctx.theta_cutoff)
         return cubemap_grad, None, None, None
 
-# Compute the bounds of the GGX NDF lobe to retain "cutoff" percent of the energy
-def __ndfBounds(res, roughness, cutoff):
+# Compute the cosine of the GGX NDF lobe angle retaining "cutoff" percent of the energy
+def __ndfCutoff(roughness, cutoff):
     def ndfGGX(alphaSqr, costheta):
         costheta = np.clip(costheta, 0.0, 1.0)
         d = (costheta * alphaSqr - costheta) * costheta + 1.0
@@ -436,18 +502,26 @@ def __ndfBounds(res, roughness, cutoff):
     costheta = np.cos(np.linspace(0, np.pi/2.0, nSamples))
     D = np.cumsum(ndfGGX(roughness**4, costheta))
     idx = np.argmax(D >= D[..., -1] * cutoff)
+    return costheta[idx]
+__ndfCutoffDict = {}
 
-    # Brute force compute lookup table with bounds
-    bounds = _get_plugin().specular_bounds(res, costheta[idx])
-
-    return costheta[idx], bounds
+# Brute force compute lookup table with bounds
+def __ndfBounds(res, roughness, cutoff):
+    costheta = __ndfCutoff(roughness, cutoff)
+    bounds = _get_plugin().specular_bounds(res, costheta)
+    return costheta, bounds
 __ndfBoundsDict = {}
 
 def specular_cubemap(cubemap, roughness, cutoff=0.99, use_python=False):
+    '''The torch path filters against every texel of the cubemap, O((6*N*N)^2): meant for the small maps of
+    the tests and CPU runs, the CUDA path restricts the lookups to the precomputed lobe bounds.'''
     assert cubemap.shape[0] == 6 and cubemap.shape[1] == cubemap.shape[2], "Bad shape for cubemap tensor: %s" % str(cubemap.shape)
 
-    if use_python:
-        assert False
+    if _use_python(use_python, cubemap):
+        key = (roughness, cutoff)
+        if key not in __ndfCutoffDict:
+            __ndfCutoffDict[key] = __ndfCutoff(*key)
+        out = specular_cubemap_fn(cubemap, roughness, __ndfCutoffDict[key])
     else:
         key = (cubemap.shape[1], roughness, cutoff)
         if key not in __ndfBoundsDict:
@@ -487,7 +561,7 @@ def image_loss(img, target, loss='l1', tonemapper='none', use_python=False):
     Returns:
         Image space loss (scalar value).
     '''
-    if use_python:
+    if _use_python(use_python, img, target):
         out = image_loss_fn(img, target, loss, tonemapper)
     else:
         out = _image_loss_func.apply(img, target, loss, tonemapper)
@@ -521,7 +595,7 @@ def xfm_points(points, matrix, use_python=False):
     Returns:
         Transformed points in homogeneous 4D with shape [minibatch_size, num_vertices, 4].
     '''    
-    if use_python:
+    if _use_python(use_python, points, matrix):
         out = torch.matmul(torch.nn.functional.pad(points, pad=(0,1), mode='constant', value=1.0), torch.transpose(matrix, 1, 2))
     else:
         out = _xfm_func.apply(points, matrix, True)
@@ -541,7 +615,7 @@ def xfm_vectors(vectors, matrix, use_python=False):
         Transformed vectors in homogeneous 4D with shape [minibatch_size, num_vertices, 4].
     '''    
 
-    if use_python:
+    if _use_python(use_python, vectors, matrix):
         out = torch.matmul(torch.nn.functional.pad(vectors, pad=(0,1), mode='constant', value=0.0), torch.transpose(matrix, 1, 2))[..., 0:3].contiguous()
     else:
         out = _xfm_func.apply(vectors, matrix, False)
@@ -0,0 +1,119 @@
+# Copyright (c) 2020-2022 NVIDIA CORPORATION & AFFILIATES. All rights reserved.
+#
+# NVIDIA CORPORATION, its affiliates and licensors retain all intellectual
+# property and proprietary rights in and to this material, related
+# documentation and any modifications thereto. Any use, reproduction,
+# disclosure or distribution of this material and related documentation
+# without an express license agreement from NVIDIA CORPORATION or
+# its affiliates is strictly prohibited.
+
+# Parity and speed of the torch backend against the CUDA plugin. Without a GPU
+# (or with RENDERUTILS_BACKEND=torch) only the torch backend is timed. The error
+# is relative to the largest magnitude of the reference, it fails above tol.
+
+import time
+import torch
+
+import os
+import sys
+sys.path.insert(0, os.path.join(sys.path[0], '../..'))
+import renderutils as ru
+
+BATCH = 2
+RES = 256
+CUBE_RES = 16
+ITR = 10
+DTYPE = torch.float32
+
+torch.manual_seed(0)
+
+HAS_CUDA = ru.get_backend() == 'cuda'
+DEVICE = 'cuda' if HAS_CUDA else 'cpu'
+
+def relative_loss(name, ref, cuda, tol):
+	ref = ref.float()
+	cuda = cuda.float()
+	err = (torch.max(torch.abs(ref - cuda)) / torch.max(torch.abs(ref)).clamp(min=1e-7)).item()
+	print(name, err)
+	assert err < tol, "%s %g >= %g" % (name, err, tol)
+
+def timeit(fn):
+	fn()
+	if HAS_CUDA:
+		torch.cuda.synchronize()
+	start = time.perf_counter()
+	for i in range(ITR):
+		fn()
+	if HAS_CUDA:
+		torch.cuda.synchronize()
+	return (time.perf_counter() - start) / ITR * 1000
+
+def run(name, fn, inputs, tol=1e-4, grad_tol=None):
+	'''fn(*inputs, use_python) -> tensor, compared on outputs and input gradients'''
+	inputs_ref = [x.clone().detach().requires_grad_(True) for x in inputs]
+	out_ref = fn(*inputs_ref, True)
+	out_ref.sum().backward()
+	t_ref = timeit(lambda: fn(*inputs, True))
+
+	print("-------------------------------------------------------------")
+	print("    %s:" % name)
+	print("-------------------------------------------------------------")
+	if HAS_CUDA:
+		inputs_cuda = [x.clone().detach().requires_grad_(True) for x in inputs]
+		out_cuda = fn(*inputs_cuda, False)
+		out_cuda.sum().backward()
+		t_cuda = timeit(lambda: fn(*inputs, False))
+
+		relative_loss("%s out:" % name, out_ref, out_cuda, tol)
+		for i, (x_ref, x_cuda) in enumerate(zip(inputs_ref, inputs_cuda)):
+			relative_loss("%s grad %d:" % (name, i), x_ref.grad, x_cuda.grad, grad_tol or tol)
+		print("torch: %.3f ms, cuda: %.3f ms" % (t_ref, t_cuda))
+	else:
+		print("torch: %.3f ms (no CUDA plugin, parity skipped)" % t_ref)
+
+def rand(*shape):
+	return torch.rand(*shape, dtype=DTYPE, device=DEVICE)
+
+def test_prepare_shading_normal():
+	shape = (BATCH, RES, RES, 3)
+	inputs = [rand(*shape), rand(*shape), rand(*shape), rand(*shape), rand(*shape), rand(*shape)]
+	run("prepare_shading_normal",
+		lambda pos, view_pos, pert, nrm, tng, geom, use_python: ru.prepare_shading_normal(pos, view_pos, pert, nrm, tng, geom, True, True, use_python=use_python),
+		inputs)
+
+def test_pbr_bsdf():
+	shape = (BATCH, RES, RES, 3)
+	inputs = [rand(*shape) for _ in range(6)]
+	for bsdf in ['lambert', 'frostbite']:
+		run("pbr_bsdf (%s)" % bsdf,
+			lambda kd, arm, pos, nrm, view_pos, light_pos, use_python: ru.pbr_bsdf(kd, arm, pos, nrm, view_pos, light_pos, bsdf=bsdf, use_python=use_python),
+			inputs)
+
+def test_xfm_points():
+	inputs = [rand(1, RES * RES, 3), rand(BATCH, 4, 4)]
+	run("xfm_points", lambda points, mtx, use_python: ru.xfm_points(points, mtx, use_python=use_python), inputs)
+
+def test_image_loss():
+	shape = (BATCH, RES, RES, 3)
+	for loss in ['l1', 'mse', 'smape', 'relmse']:
+		for tonemapper in ['none', 'log_srgb']:
+			run("image_loss (%s, %s)" % (loss, tonemapper),
+				lambda img, target, use_python: ru.image_loss(img, target, loss=loss, tonemapper=tonemapper, use_python=use_python),
+				[rand(*shape), rand(*shape)], tol=1e-3)
+
+def test_diffuse_cubemap():
+	run("diffuse_cubemap", lambda cubemap, use_python: ru.diffuse_cubemap(cubemap, use_python=use_python),
+		[rand(6, CUBE_RES, CUBE_RES, 3)], tol=1e-3)
+
+def test_specular_cubemap():
+	for roughness in [0.1, 0.5, 1.0]:
+		run("specular_cubemap (%.1f)" % roughness,
+			lambda cubemap, use_python: ru.specular_cubemap(cubemap, roughness, use_python=use_python),
+			[rand(6, CUBE_RES * 2, CUBE_RES * 2, 3)], tol=1e-3)
+
+test_prepare_shading_normal()
+test_pbr_bsdf()
+test_xfm_points()
+test_image_loss()
+test_diffuse_cubemap()
+test_specular_cubemap()
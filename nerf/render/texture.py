@@ -10,9 +10,9 @@
 import os
 import numpy as np
 import torch
-import nvdiffrast.torch as dr
 
 from . import util
+from . import raster
 
 ######################################################################################
 # Smooth pooling / mip computation with linear gradient upscaling
@@ -25,11 +25,11 @@ class texture2d_mip(torch.autograd.Function):
 
     @staticmethod
     def backward(ctx, dout):
-        gy, gx = torch.meshgrid(torch.linspace(0.0 + 0.25 / dout.shape[1], 1.0 - 0.25 / dout.shape[1], dout.shape[1]*2, device="cuda"), 
-                                torch.linspace(0.0 + 0.25 / dout.shape[2], 1.0 - 0.25 / dout.shape[2], dout.shape[2]*2, device="cuda"),
+        gy, gx = torch.meshgrid(torch.linspace(0.0 + 0.25 / dout.shape[1], 1.0 - 0.25 / dout.shape[1], dout.shape[1]*2, device=dout.device), 
+                                torch.linspace(0.0 + 0.25 / dout.shape[2], 1.0 - 0.25 / dout.shape[2], dout.shape[2]*2, device=dout.device),
                                 indexing='ij')
         uv = torch.stack((gx, gy), dim=-1)
-        return dr.texture(dout * 0.25, uv[None, ...].contiguous(), filter_mode='linear', boundary_mode='clamp')
+        return raster.texture(dout * 0.25, uv[None, ...].contiguous(), filter_mode='linear', boundary_mode='clamp')
 
 ########################################################################################################
 # Simple texture class. A texture can be either 
@@ -64,15 +64,15 @@ class Texture2D(torch.nn.Module):
     # Filtered (trilinear) sample texture at a given location
     def sample(self, texc, texc_deriv, filter_mode='linear-mipmap-linear'):
         if isinstance(self.data, list):
-            out = dr.texture(self.data[0], texc, texc_deriv, mip=self.data[1:], filter_mode=filter_mode)
+            out = raster.texture(self.data[0], texc, texc_deriv, mip=self.data[1:], filter_mode=filter_mode)
         else:
             if self.data.shape[1] > 1 and self.data.shape[2] > 1:
                 mips = [self.data]
                 while mips[-1].shape[1] > 1 and mips[-1].shape[2] > 1:
                     mips += [texture2d_mip.apply(mips[-1])]
-                out = dr.texture(mips[0], texc, texc_deriv, mip=mips[1:], filter_mode=filter_mode)
+                out = raster.texture(mips[0], texc, texc_deriv, mip=mips[1:], filter_mode=filter_mode)
             else:
-                out = dr.texture(self.data, texc, texc_deriv, filter_mode=filter_mode)
+                out = raster.texture(self.data, texc, texc_deriv, filter_mode=filter_mode)
         return out
 
     def getRes(self):
@@ -0,0 +1,233 @@
+import os
+import struct
+import time
+import zlib
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+######################################################################################
+# Streaming texture bake: UV rasterization, chunked queries and seam dilation per tile
+######################################################################################
+
+def rasterize_uv_tile(vt, ft, x0, y0, tw, th, W, H):
+    '''rasterize the UV atlas on the texel centers of one tile, in plain torch (CPU or GPU)
+    - args:
+        - vt: [T, 2] uvs in [0, 1], ft: [M, 3] uv indices of the faces
+        - x0, y0, tw, th: tile origin and size in texels of the W x H texture
+    - return:
+        - pix: [K] flat index of the covered texels inside the tile (row-major, th x tw)
+        - tri: [K] face index covering each texel
+        - bary: [K, 3] barycentric weights
+    Row y of the texture holds v = (y + 0.5) / H, the layout of nvdiffrast with uv * 2 - 1 as clip coords.
+    '''
+    device = vt.device
+    tri_uv = vt[ft.long()] * torch.tensor([W, H], device=device, dtype=vt.dtype) - 0.5  # [M, 3, 2] in texel coords
+    lo = torch.ceil(tri_uv.amin(dim=1)).long()
+    hi = torch.floor(tri_uv.amax(dim=1)).long()
+    lo = torch.maximum(lo, torch.tensor([x0, y0], device=device))
+    hi = torch.minimum(hi, torch.tensor([x0 + tw - 1, y0 + th - 1], device=device))
+    size = (hi - lo + 1).clamp(min=0)
+    count = size[:, 0] * size[:, 1]
+    tri = torch.nonzero(count > 0)[:, 0]
+    if tri.shape[0] == 0:
+        empty = torch.zeros((0,), dtype=torch.long, device=device)
+        return empty, empty, torch.zeros((0, 3), device=device)
+
+    # enumerate the texels of every clipped triangle bbox
+    count = count[tri]
+    tri = torch.repeat_interleave(tri, count)
+    start = torch.cumsum(count, 0) - count
+    local = torch.arange(tri.shape[0], device=device) - torch.repeat_interleave(start, count)
+    bw = size[tri, 0]
+    px = lo[tri, 0] + local % bw
+    py = lo[tri, 1] + local // bw
+
+    a, b, c = tri_uv[tri, 0], tri_uv[tri, 1], tri_uv[tri, 2]
+    p = torch.stack([px, py], dim=-1).to(vt.dtype)
+
+    def edge(p0, p1, q):
+        return (p1[:, 0] - p0[:, 0]) * (q[:, 1] - p0[:, 1]) - (p1[:, 1] - p0[:, 1]) * (q[:, 0] - p0[:, 0])
+
+    area = edge(a, b, c)
+    w0, w1, w2 = edge(b, c, p), edge(c, a, p), edge(a, b, p)
+    valid = area.abs() > 1e-12
+    area = torch.where(valid, area, torch.ones_like(area))
+    bary = torch.stack([w0, w1, w2], dim=-1) / area[:, None]
+    inside = valid & (bary >= -1e-6).all(dim=-1)
+
+    pix = (py - y0) * tw + (px - x0)
+    return pix[inside], tri[inside], bary[inside]
+
+
+def dilate_tile(img, mask, iterations):
+    '''fill empty texels with the mean of their filled neighbours, iterations times
+    - args:
+        - img: [h, w, C] float, mask: [h, w] bool
+    '''
+    img = img.permute(2, 0, 1)[None]
+    mask = mask[None, None].float()
+    kernel = torch.ones((1, 1, 3, 3), dtype=img.dtype, device=img.device)
+    for _ in range(iterations):
+        cnt = F.conv2d(mask, kernel, padding=1)
+        grow = (mask == 0) & (cnt > 0)
+        if not grow.any():
+            break
+        total = F.conv2d((img * mask).reshape(-1, 1, *img.shape[-2:]), kernel, padding=1).reshape(img.shape)
+        img = torch.where(grow, total / cnt.clamp(min=1), img)
+        mask = torch.maximum(mask, grow.float())
+    return img[0].permute(1, 2, 0), mask[0, 0] > 0
+
+
+class TextureBaker():
+    '''Bakes material channels of a UV-unwrapped mesh into textures, one tile at a time.
+
+    Only the texels covered by the atlas are queried, in chunks of at most chunk_size points,
+    and every finished tile is written to uint8 .npy memmaps in out_dir, so neither the
+    texture nor the query buffers need to fit in memory. A second tiled pass dilates the
+    charts by `dilate` texels to hide seams under bilinear filtering / mipmapping, then the
+    maps are encoded to PNGs tile_size rows at a time (write_png).
+
+    channels: {name: (n_channels, encode)} with encode mapping the query output to [0, 1]
+    '''
+    def __init__(self, channels, resolution=2048, tile_size=1024, ssaa=1, chunk_size=262144, dilate=16, device='cpu'):
+        self.channels = channels
+        self.resolution = resolution
+        self.tile_size = min(tile_size, resolution)
+        self.ssaa = ssaa
+        self.chunk_size = chunk_size
+        self.dilate = dilate
+        self.device = torch.device(device)
+
+    def tiles(self):
+        R, T = self.resolution, self.tile_size
+        for y0 in range(0, R, T):
+            for x0 in range(0, R, T):
+                yield x0, y0, min(T, R - x0), min(T, R - y0)
+
+    def bake_tile(self, v, f, vt, ft, query_fn, x0, y0, tw, th):
+        '''- return: {name: [th, tw, C] float}, coverage [th, tw] bool, number of queried points'''
+        s = self.ssaa
+        pix, tri, bary = rasterize_uv_tile(vt, ft, x0 * s, y0 * s, tw * s, th * s,
+                                           self.resolution * s, self.resolution * s)
+        n_pix = (tw * s) * (th * s)
+        buffers = {k: torch.zeros((n_pix, c), device=self.device) for k, (c, _) in self.channels.items()}
+        covered = torch.zeros((n_pix,), device=self.device)
+        for chunk in torch.split(torch.arange(pix.shape[0], device=self.device), self.chunk_size):
+            xyz = (v[f[tri[chunk]].long()] * bary[chunk, :, None]).sum(dim=1)
+            with torch.no_grad():
+                out = query_fn(xyz)
+            for k, (_, encode) in self.channels.items():
+                buffers[k][pix[chunk]] = encode(out[k]).float()
+        covered[pix] = 1
+
+        covered = covered.view(1, 1, th * s, tw * s)
+        if s > 1:
+            weight = F.avg_pool2d(covered, s)
+        else:
+            weight = covered
+        maps = {}
+        for k, buf in buffers.items():
+            buf = buf.view(th * s, tw * s, -1).permute(2, 0, 1)[None] * covered
+            if s > 1:
+                buf = F.avg_pool2d(buf, s) / weight.clamp(min=1e-8)
+            maps[k] = buf[0].permute(1, 2, 0)
+        return maps, weight[0, 0] > 0, pix.shape[0]
+
+    def bake(self, v, f, vt, ft, query_fn, out_dir, prefix=''):
+        '''
+        - args:
+            - v: [N, 3] positions, f: [M, 3] position indices, vt: [T, 2] uvs, ft: [M, 3] uv indices
+            - query_fn: xyz [K, 3] -> {name: [K, C]}
+        - return:
+            - stats: dict with tiles, texels, seconds, texels_per_s
+        '''
+        os.makedirs(out_dir, exist_ok=True)
+        v, f = v.float().to(self.device), f.to(self.device)
+        vt, ft = vt.float().to(self.device), ft.to(self.device)
+        R = self.resolution
+
+        raw = {k: np.lib.format.open_memmap(os.path.join(out_dir, f'{prefix}{k}.raw.npy'), mode='w+',
+                                            dtype=np.uint8, shape=(R, R, c))
+               for k, (c, _) in self.channels.items()}
+        coverage = np.lib.format.open_memmap(os.path.join(out_dir, f'{prefix}coverage.npy'), mode='w+',
+                                             dtype=np.bool_, shape=(R, R))
+
+        tt = time.time()
+        n_tiles, n_texels = 0, 0
+        for x0, y0, tw, th in self.tiles():
+            maps, mask, n = self.bake_tile(v, f, vt, ft, query_fn, x0, y0, tw, th)
+            coverage[y0:y0 + th, x0:x0 + tw] = mask.cpu().numpy()
+            for k, m in maps.items():
+                raw[k][y0:y0 + th, x0:x0 + tw] = to_uint8(m)
+            n_tiles += 1
+            n_texels += n
+            if n > 0:
+                for k in raw:
+                    raw[k].flush()
+                coverage.flush()
+        bake_time = time.time() - tt
+
+        # seam dilation reads a halo around every tile from the raw maps
+        p = self.dilate
+        for k, (c, _) in self.channels.items():
+            final = np.lib.format.open_memmap(os.path.join(out_dir, f'{prefix}{k}.npy'), mode='w+',
+                                              dtype=np.uint8, shape=(R, R, c))
+            for x0, y0, tw, th in self.tiles():
+                ya, yb, xa, xb = max(y0 - p, 0), min(y0 + th + p, R), max(x0 - p, 0), min(x0 + tw + p, R)
+                img = torch.from_numpy(np.asarray(raw[k][ya:yb, xa:xb])).float() / 255.
+                mask = torch.from_numpy(np.asarray(coverage[ya:yb, xa:xb]))
+                if p > 0:
+                    img, _ = dilate_tile(img, mask, p)
+                final[y0:y0 + th, x0:x0 + tw] = to_uint8(img[y0 - ya:y0 - ya + th, x0 - xa:x0 - xa + tw])
+            final.flush()
+            write_png(os.path.join(out_dir, f'{prefix}{k}.png'), final, rows=self.tile_size)
+            del final
+            os.remove(os.path.join(out_dir, f'{prefix}{k}.raw.npy'))
+        elapsed = time.time() - tt
+
+        stats = {
+            'resolution': R,
+            'tiles': n_tiles,
+            'texels': n_texels,
+            'coverage': float(np.count_nonzero(coverage)) / (R * R),
+            'bake_seconds': bake_time,
+            'seconds': elapsed,
+            'texels_per_s': n_texels / max(bake_time, 1e-6),
+        }
+        print(f"Baked {len(self.channels)} maps at {R}x{R}: {n_texels} texels in {bake_time:.2f}s "
+              f"({stats['texels_per_s']:.0f} texels/s), {elapsed:.2f}s with dilation and PNG encoding")
+        return stats
+
+
+def write_png(path, image, rows=1024, level=1):
+    '''write a [H, W, C] uint8 array (C = 1, 2, 3 or 4: gray, gray + alpha, RGB, RGBA) as an 8-bit PNG, rows at a time
+    - args:
+        - image: array or .npy memmap, only rows rows of it are read and filtered at once
+        - level: zlib level, 1 is the default of cv2.imwrite
+    Every row uses the Up filter, the compressed stream goes out as one IDAT chunk per flush of zlib.
+    '''
+    H, W, C = image.shape
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[C]
+
+    def chunk(f, tag, data):
+        f.write(struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data)))
+
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        chunk(f, b'IHDR', struct.pack('>IIBBBBB', W, H, 8, color_type, 0, 0, 0))
+        z = zlib.compressobj(level)
+        prev = np.zeros((1, W * C), dtype=np.uint8)
+        for y0 in range(0, H, rows):
+            block = np.asarray(image[y0:y0 + rows]).reshape(-1, W * C)
+            up = block - np.concatenate([prev, block[:-1]])    # wraps around mod 256
+            prev = block[-1:]
+            data = z.compress(np.concatenate([np.full((up.shape[0], 1), 2, dtype=np.uint8), up], axis=1).tobytes())
+            if data:
+                chunk(f, b'IDAT', data)
+        chunk(f, b'IDAT', z.flush())
+        chunk(f, b'IEND', b'')
+
+
+def to_uint8(x):
+    return (x.clamp(0., 1.) * 255. + 0.5).to(torch.uint8).cpu().numpy()
@@ -10,9 +10,10 @@
 import os
 import numpy as np
 import torch
-import nvdiffrast.torch as dr
 import imageio
 
+from . import raster
+
 #----------------------------------------------------------------------------
 # Vector operations
 #----------------------------------------------------------------------------
@@ -101,10 +102,10 @@ def cube_to_dir(s, x, y):
     return torch.stack((rx, ry, rz), dim=-1)
 
 def latlong_to_cubemap(latlong_map, res):
-    cubemap = torch.zeros(6, res[0], res[1], latlong_map.shape[-1], dtype=torch.float32, device='cuda')
+    cubemap = torch.zeros(6, res[0], res[1], latlong_map.shape[-1], dtype=torch.float32, device=latlong_map.device)
     for s in range(6):
-        gy, gx = torch.meshgrid(torch.linspace(-1.0 + 1.0 / res[0], 1.0 - 1.0 / res[0], res[0], device='cuda'),
-                                torch.linspace(-1.0 + 1.0 / res[1], 1.0 - 1.0 / res[1], res[1], device='cuda'),
+        gy, gx = torch.meshgrid(torch.linspace(-1.0 + 1.0 / res[0], 1.0 - 1.0 / res[0], res[0], device=latlong_map.device),
+                                torch.linspace(-1.0 + 1.0 / res[1], 1.0 - 1.0 / res[1], res[1], device=latlong_map.device),
                                 indexing='ij')
         v = safe_normalize(cube_to_dir(s, gx, gy))
 
@@ -112,12 +113,12 @@ def latlong_to_cubemap(latlong_map, res):
         tv = torch.acos(torch.clamp(v[..., 1:2], min=-1, max=1)) / np.pi
         texcoord = torch.cat((tu, tv), dim=-1)
 
-        cubemap[s, ...] = dr.texture(latlong_map[None, ...], texcoord[None, ...], filter_mode='linear')[0]
+        cubemap[s, ...] = raster.texture(latlong_map[None, ...], texcoord[None, ...], filter_mode='linear')[0]
     return cubemap
 
 def cubemap_to_latlong(cubemap, res):
-    gy, gx = torch.meshgrid(torch.linspace( 0.0 + 1.0 / res[0], 1.0 - 1.0 / res[0], res[0], device='cuda'),
-                            torch.linspace(-1.0 + 1.0 / res[1], 1.0 - 1.0 / res[1], res[1], device='cuda'),
+    gy, gx = torch.meshgrid(torch.linspace( 0.0 + 1.0 / res[0], 1.0 - 1.0 / res[0], res[0], device=cubemap.device),
+                            torch.linspace(-1.0 + 1.0 / res[1], 1.0 - 1.0 / res[1], res[1], device=cubemap.device),
                             indexing='ij')
 
     sintheta, costheta = torch.sin(gy*np.pi), torch.cos(gy*np.pi)
@@ -128,7 +129,7 @@ def cubemap_to_latlong(cubemap, res):
         costheta,
         -sintheta*cosphi
         ), dim=-1)
-    return dr.texture(cubemap[None, ...], reflvec[None, ...].contiguous(), filter_mode='linear', boundary_mode='cube')[0]
+    return raster.texture(cubemap[None, ...], reflvec[None, ...].contiguous(), filter_mode='linear', boundary_mode='cube')[0]
 
 #----------------------------------------------------------------------------
 # Image scaling
@@ -0,0 +1,13 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def nerf_root(monkeypatch):
+    '''configs are loaded relative to nerf/, where train.py and the benchmarks run from'''
+    monkeypatch.chdir(ROOT)
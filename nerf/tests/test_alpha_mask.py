@@ -0,0 +1,31 @@
+'''getBrickedAlphaMask / updateAlphaMask: the bricked mask against the dense one, and an empty mask'''
+import torch
+import torch.nn.functional as F
+
+from benchmarks.fixtures import tiny_tensoIR
+
+GRID = [24, 20, 16]
+
+
+def test_bricks_match_dense():
+    tensoIR = tiny_tensoIR('cpu', 32)
+    alpha, xyz_min, xyz_max = tensoIR.getBrickedAlphaMask(GRID, brick_size=8)
+    dense, _ = tensoIR.getDenseAlpha(GRID)
+    dense = F.max_pool3d(dense.clamp(0, 1).permute(2, 1, 0)[None, None], kernel_size=3, padding=1, stride=1)[0, 0]
+    assert torch.equal(alpha, dense >= tensoIR.alphaMask_thres)
+    assert (tensoIR.aabb[0] <= xyz_min).all() and (xyz_max <= tensoIR.aabb[1]).all()
+
+    stats = tensoIR.alpha_mask_stats
+    # off cuda the peak is the RSS above the one before the call, not the lifetime peak of the process
+    assert stats['peak_mem_mb'] is None or stats['peak_mem_mb'] >= 0
+    assert isinstance(stats['peak_exact'], bool)
+
+
+def test_empty_mask_keeps_the_bbox():
+    tensoIR = tiny_tensoIR('cpu', 32)
+    # alpha is clamped to [0, 1], nothing reaches the threshold
+    tensoIR.alphaMask_thres = 2.0
+    aabb = tensoIR.aabb.clone()
+    new_aabb = tensoIR.updateAlphaMask(GRID)
+    assert not tensoIR.alphaMask.alpha_volume.any()
+    assert torch.equal(new_aabb, aabb)
@@ -0,0 +1,74 @@
+'''ChunkPlanner autotuning against a simulated host process: memory per chunk, not per process lifetime'''
+import types
+
+import pytest
+
+import chunking
+
+BYTES_PER_ITEM = 100
+DEFAULT = 64
+FREE = 2 * BYTES_PER_ITEM * 512     # memory_fraction 0.5: chunks of up to 512 items fit
+
+
+class Process():
+    '''VmRSS / VmHWM of a simulated process and a clock, a chunk of n items costs 1 ms + n us'''
+    def __init__(self, can_reset=True):
+        self.rss = self.hwm = 10 ** 6
+        self.now = 0.
+        self.can_reset = can_reset
+
+    def alloc(self, nbytes):
+        self.rss += nbytes
+        self.hwm = max(self.hwm, self.rss)
+
+    def reset_peak(self):
+        chunking._host_peak_floor = max(chunking._host_peak_floor, self.hwm)
+        if self.can_reset:
+            self.hwm = self.rss
+        return self.can_reset
+
+    def run(self, planner, n=DEFAULT * 64):
+        for s in planner.split('loop', n, DEFAULT, device='cpu'):
+            items = s.stop - s.start
+            self.alloc(items * BYTES_PER_ITEM)
+            self.now += 1e-3 + items * 1e-6
+            self.alloc(-items * BYTES_PER_ITEM)
+
+
+@pytest.fixture
+def simulate(monkeypatch):
+    def simulate(earlier_bytes=0, can_reset=True):
+        process = Process(can_reset)
+        monkeypatch.setattr(chunking, '_host_peak_floor', 0)
+        monkeypatch.setattr(chunking, '_host_rss', lambda peak: process.hwm if peak else process.rss)
+        monkeypatch.setattr(chunking, '_reset_host_peak', process.reset_peak)
+        monkeypatch.setattr(chunking, 'available_memory', lambda device: FREE)
+        monkeypatch.setattr(chunking, 'time', types.SimpleNamespace(perf_counter=lambda: process.now))
+        # e.g. loading a model, far more than any chunk
+        process.alloc(earlier_bytes)
+        process.alloc(-earlier_bytes)
+
+        planner = chunking.ChunkPlanner(autotune=True)
+        for _ in range(4):
+            process.run(planner)
+        return planner.plans['loop@cpu'], process
+    return simulate
+
+
+def test_earlier_allocation_does_not_change_the_chunk(simulate):
+    plan, _ = simulate()
+    assert plan['settled'] and plan['chunk'] == 512
+    assert plan['bytes_per_item'] == BYTES_PER_ITEM
+
+    plan_after_peak, process = simulate(earlier_bytes=10 ** 9)
+    assert plan_after_peak['chunk'] == plan['chunk']
+    assert plan_after_peak['bytes_per_item'] == plan['bytes_per_item']
+    # the other gauges still see the earlier peak
+    assert chunking.host_peak() >= 10 ** 9
+
+
+def test_without_reset_the_settled_chunk_still_fits(simulate):
+    '''chunks below the earlier peak give no measurement, only the ones that raise it do'''
+    plan, _ = simulate(earlier_bytes=BYTES_PER_ITEM * 700, can_reset=False)
+    assert plan['settled'] and plan['chunk'] == 512
+    assert plan['bytes_per_item'] == BYTES_PER_ITEM
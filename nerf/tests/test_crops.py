@@ -0,0 +1,98 @@
+'''get_crop and CropScheduler on a non-square image: crop sizes, placement and projection'''
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+from crop_scheduler import CropScheduler
+from dataset.nerf_synthetic import NerfSyntheticDataset
+from dataset.tensoir_synthetic import TensoirSyntheticDataset
+from render import util
+
+H, W = 24, 40
+
+
+class Views(torch.utils.data.Dataset):
+    '''views whose pixels hold their own (row, col)'''
+    def __init__(self, get_crop, downsample=2, n_views=3):
+        self.get_crop = get_crop.__get__(self)
+        self.h, self.w = H, W
+        self.downsample = downsample
+        self.aspect = W / H
+        self.camera_angle_y = 0.8
+        self.mvs = [util.translate(0, 0, -3.) @ util.rotate_y(a) for a in np.linspace(0, 1, n_views)]
+        self.all_mvs = self.mvs
+        rows, cols = torch.meshgrid(torch.arange(H), torch.arange(W), indexing='ij')
+        img = torch.stack([rows, cols, torch.zeros_like(rows), torch.ones_like(rows)], -1).float()
+        self.all_images = [img.clone() for _ in self.mvs]
+
+    def __len__(self):
+        return len(self.mvs)
+
+    def __getitem__(self, idx):
+        return {'img': self.all_images[idx], 'mv': self.mvs[idx], 'campos': torch.linalg.inv(self.mvs[idx])[:3, 3]}
+
+
+def pixels(mvp, points):
+    '''(row, col) of points in an image of rows x cols pixels, row r at ndc y = 2 r / rows - 1'''
+    clip = torch.cat([points, torch.ones_like(points[:, :1])], -1) @ mvp.T
+    return (clip[:, [1, 0]] / clip[:, 3:4] + 1) / 2
+
+
+def check_crop(views, cx, cy, size, shape):
+    data = {k: v[None] for k, v in views[0].items()}
+    crop = views.get_crop(data, cx, cy, size=size)
+    rows, cols = shape
+    assert crop['img'].shape == (1, rows, cols, 4)
+    # centred on row cx, column cy
+    r0, c0 = cx - rows // 2, cy - cols // 2
+    assert crop['img'][0, 0, 0, :2].tolist() == [r0, c0]
+    assert crop['img'][0, -1, -1, :2].tolist() == [r0 + rows - 1, c0 + cols - 1]
+
+    # a point at pixel (r, c) of the image is at (r - r0, c - c0) in the crop
+    points = torch.rand(200, 3) - 0.5
+    full = pixels(util.perspective(views.camera_angle_y, views.aspect, 0.1, 1000) @ views.mvs[0], points)
+    cropped = pixels(crop['mvp'][0], points)
+    assert torch.allclose(cropped * torch.tensor([rows, cols]), full * torch.tensor([H, W]) - torch.tensor([r0, c0]),
+                          atol=1e-3)
+
+
+def test_get_crop_non_square():
+    for get_crop in [TensoirSyntheticDataset.get_crop, NerfSyntheticDataset.get_crop]:
+        views = Views(get_crop)
+        check_crop(views, 7, 25, None, (H // 2, W // 2))
+        check_crop(views, 12, 20, 20, (12, 20))
+        # against the top left corner
+        check_crop(views, 3, 5, 10, (6, 10))
+
+
+def test_scheduler_crops_stay_inside():
+    views = Views(TensoirSyntheticDataset.get_crop)
+    conf = OmegaConf.create({'stages': [[0.5, 16, 1], [1.0, None, 2]], 'bucket': 8, 'cell': 4, 'importance': 1.0})
+    crops = CropScheduler(views, conf, 10, seed=0)
+    for it in range(10):
+        size, spp = crops.current(it)
+        rows, cols = crops.crop_shape(size)
+        data = crops.draw(it)
+        assert data['img'].shape == (1, rows, cols, 4) and data['spp'] == spp
+        r0, c0 = data['img'][0, 0, 0, :2].long().tolist()
+        assert 0 <= r0 and r0 + rows <= H and 0 <= c0 and c0 + cols <= W
+
+
+def test_scheduler_ranks_by_validation_error():
+    '''the error of a validation point lands in the cells of the training views that see it'''
+    views = Views(TensoirSyntheticDataset.get_crop)
+    crops = CropScheduler(views, OmegaConf.create({'cell': 4}), 10, seed=0)
+    point = torch.tensor([0.1, -0.2, 0.05])
+    pos = torch.zeros(1, 2, 2, 3)
+    pos[0, 0, 0] = point
+    shaded = torch.zeros(2, 2, 4)
+    shaded[0, 0] = torch.tensor([1., 1., 1., 1.])     # only this pixel is covered, with an error of 1
+    crops.observe(pos, shaded, torch.zeros(2, 2, 3))
+    crops.refresh()
+
+    proj = util.perspective(views.camera_angle_y, views.aspect, 0.1, 1000)
+    for v, mv in enumerate(views.mvs):
+        row, col = (pixels(proj @ mv, point[None])[0] * torch.tensor(crops.map_res)).long().tolist()
+        expected = torch.zeros(crops.map_res)
+        expected[row, col] = 1 - crops.error_decay
+        assert torch.allclose(crops.errors[v], expected)
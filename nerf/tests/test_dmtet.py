@@ -0,0 +1,74 @@
+'''DMTet.incremental_call against a full DMTet.__call__ over a sequence of sdfs on one grid'''
+import torch
+
+from benchmarks.fixtures import tet_grid
+from geometry import dmtet
+
+RES = 10
+
+
+def sorted_rows(x):
+    '''rows of x in lexicographic order, to compare meshes up to the order of the faces'''
+    for col in reversed(range(x.shape[1])):
+        x = x[torch.sort(x[:, col], stable=True).indices]
+    return x
+
+
+def sdf_sequence(verts, seed=0):
+    '''random sdfs that move the surface a little, split it, empty it and bring it back'''
+    generator = torch.Generator().manual_seed(seed)
+    noise = lambda scale: (torch.rand(verts.shape[0], generator=generator) * 2 - 1) * scale
+    sphere = 0.3 - verts.norm(dim=-1)
+    two = torch.maximum(0.2 - (verts - torch.tensor([0.2, 0., 0.])).norm(dim=-1),
+                        0.2 - (verts + torch.tensor([0.2, 0., 0.])).norm(dim=-1))
+    return [
+        sphere,
+        sphere,                     # no sign change
+        sphere + noise(0.02),       # a few sign flips near the surface
+        sphere + noise(0.02),
+        two,                        # the surface splits in two
+        two + noise(0.1),           # and grows spurious islands
+        torch.full_like(sphere, -1.0),  # empty
+        sphere + noise(0.3),        # from empty back to a noisy surface
+        torch.rand(verts.shape[0], generator=generator) - 0.5,
+        sphere,
+    ]
+
+
+def test_incremental_matches_full():
+    verts, tets = tet_grid(RES)
+    sdfs = sdf_sequence(verts)
+    verts, tets = verts.to(dmtet.device), tets.to(dmtet.device)
+    full, incremental = dmtet.DMTet(), dmtet.DMTet(incremental=True)
+
+    for step, sdf in enumerate(sdfs):
+        sdf = sdf.to(dmtet.device)
+        v_ref, f_ref, uvs_ref, uv_idx_ref = full(verts, sdf, tets)
+        v, f, uvs, uv_idx = incremental(verts, sdf, tets)
+
+        # crossing edges are numbered the same way, the faces may come in another order
+        assert torch.equal(v, v_ref), step
+        assert torch.equal(uvs, uvs_ref), step
+        assert f.shape == f_ref.shape, step
+        assert torch.equal(sorted_rows(torch.cat([f, uv_idx], -1)), sorted_rows(torch.cat([f_ref, uv_idx_ref], -1))), step
+    assert 0 < incremental.touched_stats()['mean'] < 1
+
+
+def test_incremental_gradients():
+    '''the vertices stay differentiable w.r.t. the sdf and the positions'''
+    verts, tets = tet_grid(RES)
+    sdfs = sdf_sequence(verts, seed=1)
+    verts, tets = verts.to(dmtet.device), tets.to(dmtet.device)
+    full, incremental = dmtet.DMTet(), dmtet.DMTet(incremental=True)
+
+    for step, sdf in enumerate(sdfs[:4]):
+        grads = []
+        for marching_tets in [full, incremental]:
+            pos = verts.clone().requires_grad_(True)
+            sdf_p = sdf.to(dmtet.device).clone().requires_grad_(True)
+            v = marching_tets(pos, sdf_p, tets)[0]
+            v.pow(2).sum().backward()
+            grads.append((pos.grad, sdf_p.grad))
+        (pos_ref, sdf_ref), (pos_grad, sdf_grad) = grads
+        assert torch.allclose(pos_grad, pos_ref), step
+        assert torch.allclose(sdf_grad, sdf_ref), step
@@ -0,0 +1,92 @@
+'''EnvmapCache: the LRU in memory, the cubemap lights of load_env and the latlong maps of Environment_Light'''
+import cv2
+import numpy as np
+import pytest
+import torch
+from omegaconf import OmegaConf
+
+from models.tensoIR.relight_utils import Environment_Light, latlong_entry
+from render import light, util
+
+CUTOFF = 0.99
+
+
+def write_hdr(path, seed):
+    rgb = np.random.default_rng(seed).uniform(0.1, 4.0, (16, 32, 3)).astype(np.float32)
+    cv2.imwrite(str(path), np.ascontiguousarray(rgb[..., ::-1]))
+    return path
+
+
+def test_lru_by_bytes():
+    cache = light.EnvmapCache('', max_bytes=3 * 600)
+    entry = lambda: {'rgb': torch.zeros(100), 'mips': [torch.zeros(25), torch.zeros(25)], 'cutoff': CUTOFF}
+    for key in 'abc':
+        cache.put(key, entry())
+    assert cache.nbytes == 3 * 600 and list(cache.entries) == ['a', 'b', 'c']
+    assert cache.get('a') is not None      # a is now the most recently used
+    cache.put('d', entry())
+    assert list(cache.entries) == ['c', 'a', 'd'] and cache.nbytes <= cache.max_bytes
+    cache.put('e', {'rgb': torch.zeros(1000)})
+    # an entry over the limit on its own is still kept, alone
+    assert list(cache.entries) == ['e'] and cache.get('b') is None
+
+
+def test_environment_light_through_cache(tmp_path, monkeypatch):
+    hdr_dir = tmp_path / 'hdrs'
+    hdr_dir.mkdir()
+    for seed, name in enumerate(['bridge', 'city']):
+        write_hdr(hdr_dir / f'{name}.hdr', seed)
+    monkeypatch.setattr(light, 'envmap_cache', light.EnvmapCache(str(tmp_path / 'cache')))
+
+    first = Environment_Light(str(hdr_dir), device='cpu')
+    assert len(light.envmap_cache.entries) == 2
+    # a new process only has the files on disk
+    monkeypatch.setattr(light, 'envmap_cache', light.EnvmapCache(str(tmp_path / 'cache')))
+    second = Environment_Light(str(hdr_dir), device='cpu')
+    for name in ['bridge', 'city']:
+        ref = latlong_entry(str(hdr_dir / f'{name}.hdr'))
+        assert torch.equal(second.hdr_rgbs[name], ref['rgb'])
+        assert torch.equal(second.hdr_pdf_sample[name], ref['pdf'])
+        assert torch.equal(second.hdr_pdf_return[name], first.hdr_pdf_return[name])
+        assert second.hdr_pdf_sample[name].sum().item() == pytest.approx(1.0, rel=1e-5)
+
+
+def test_cubemap_hit_matches_miss(tmp_path, monkeypatch):
+    fn = str(write_hdr(tmp_path / 'sky.hdr', 2))
+    try:
+        util.load_image(fn)
+    except Exception as e:
+        pytest.skip(f'imageio cannot read .hdr here ({e})')
+    monkeypatch.setattr(light, 'envmap_cache', light.EnvmapCache(str(tmp_path / 'cache')))
+    miss = light.load_env(fn, res=[16, 16], device='cpu')
+    hit = light.load_env(fn, res=[16, 16], device='cpu')
+
+    entry = next(iter(light.envmap_cache.entries.values()))
+    assert torch.equal(hit.base, miss.base)
+    assert torch.equal(hit.diffuse, miss.diffuse.detach())
+    for m_hit, m_miss, m_cached in zip(hit.specular, miss.specular, entry['specular']):
+        assert torch.equal(m_hit, m_miss.detach())
+        assert m_hit.data_ptr() != m_cached.data_ptr()
+
+    # base is the light's own Parameter, a step that optimizes it filters the mips from it again
+    assert isinstance(hit.base, torch.nn.Parameter) and hit.base is dict(hit.named_parameters())['env_base']
+    hit.build_mips(CUTOFF)
+    assert hit.specular[0].grad_fn is not None
+    assert torch.allclose(hit.specular[0], entry['specular'][0], atol=1e-6)
+    hit.specular[0].sum().backward()
+    assert hit.base.grad is not None and hit.base.grad.abs().sum() > 0
+
+
+def test_configure_cache(tmp_path, monkeypatch):
+    '''memory only unless the config turns the disk cache on'''
+    monkeypatch.setattr(light, 'envmap_cache', light.envmap_cache)
+    conf = OmegaConf.load('config/general.yaml')
+    assert light.configure_cache(conf).cache_dir == ''
+    assert light.configure_cache(OmegaConf.create({})).cache_dir == ''
+
+    conf.envmap_cache.enabled = True
+    conf.envmap_cache.dir = str(tmp_path / 'envmaps')
+    conf.envmap_cache.max_bytes = 1234
+    cache = light.configure_cache(conf)
+    assert cache is light.envmap_cache
+    assert cache.cache_dir == str(tmp_path / 'envmaps') and cache.max_bytes == 1234
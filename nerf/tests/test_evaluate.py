@@ -0,0 +1,28 @@
+import json
+
+import pytest
+
+from evaluate import job_name, list_lights, load_records, summarize
+
+
+def test_list_lights(tmp_path):
+    for name in ['city.hdr', 'bridge.hdr', 'notes.txt']:
+        (tmp_path / name).write_bytes(b'')
+    assert list_lights(str(tmp_path), []) == ['bridge', 'city']
+    assert list_lights(str(tmp_path), ['city']) == ['city']
+    with pytest.raises(FileNotFoundError):
+        list_lights(str(tmp_path), ['fireplace'])
+
+
+def test_records_of_views_and_relit_views(tmp_path):
+    path = tmp_path / 'views.jsonl'
+    lines = [{'view': 0, 'render_seconds': 1., 'rgb/psnr': 30.},
+             {'view': 0, 'light': 'city', 'render_seconds': 2., 'rgb_with_brdf/psnr': 20.},
+             {'view': 3, 'light': 'city', 'render_seconds': 4., 'rgb_with_brdf/psnr': 24.}]
+    path.write_text('\n'.join(json.dumps(line) for line in lines) + '\n{"view": 5, "ren')
+
+    records = load_records(str(path))
+    assert set(records) == {(0, None), (0, 'city'), (3, 'city')}
+    assert [job_name(job) for job in sorted(records, key=str)] == ['000_city', '000', '003_city']
+    summary = summarize({job: record for job, record in records.items() if job[1] == 'city'})
+    assert summary['views'] == 2 and summary['rgb_with_brdf/psnr'] == 22.
@@ -0,0 +1,32 @@
+import json
+
+from benchmarks.harness import compare, load_baselines, save_baselines
+
+
+def record(throughput):
+    return {'throughput': throughput, 'latency_ms': {'p50': 1000 / throughput}}
+
+
+def test_compare():
+    baselines = {'a': {'throughput': 100.}, 'b': {'throughput': 100.}, 'c': {'throughput': 100., 'threshold': 0.1}}
+    results = {'a': record(90.), 'b': record(50.), 'c': record(85.), 'd': record(100.),
+               'e': {'error': 'RuntimeError: boom'}}
+    regressions = {r['name']: r['reason'] for r in compare(results, baselines, 0.3)}
+    assert regressions == {'b': 'slower', 'c': 'slower', 'd': 'no baseline', 'e': 'error'}
+    assert results['a']['baseline_ratio'] == 0.9
+
+
+def test_save_baselines_keeps_the_cases_that_did_not_run(tmp_path):
+    path = str(tmp_path / 'baselines.json')
+    save_baselines(path, {'a': record(100.), 'b': record(10.)}, {})
+    with open(path) as f:
+        stored = json.load(f)
+    stored['results']['a']['threshold'] = 0.5
+    with open(path, 'w') as f:
+        json.dump(stored, f)
+
+    save_baselines(path, {'a': record(200.), 'c': {'error': 'ValueError'}}, {})
+    baselines = load_baselines(path)
+    assert set(baselines) == {'a', 'b'}
+    assert baselines['a'] == {'throughput': 200., 'latency_ms_p50': 5., 'threshold': 0.5}
+    assert baselines['b']['throughput'] == 10.
@@ -0,0 +1,106 @@
+'''geometry/marching_cubes.py against mcubes / skimage on analytic signed distance fields'''
+import math
+
+import numpy as np
+import pytest
+import torch
+
+from geometry.marching_cubes import extract_isosurface, marching_cubes
+
+RES = 64
+SHAPES = {
+    # inside where the value is positive, area of the exact surface
+    'sphere': (lambda p: 0.6 - p.norm(dim=-1), 4 * math.pi * 0.6 ** 2),
+    'torus': (lambda p: 0.2 - torch.stack([p[:, :2].norm(dim=-1) - 0.5, p[:, 2]], -1).norm(dim=-1),
+              4 * math.pi ** 2 * 0.5 * 0.2),
+}
+
+
+def grid(level_fn):
+    lin = torch.linspace(-1, 1, RES, dtype=torch.float64)
+    xyz = torch.stack(torch.meshgrid(lin, lin, lin, indexing='ij'), -1).view(-1, 3)
+    return level_fn(xyz).view(RES, RES, RES).float()
+
+
+def area(verts, faces):
+    v = verts.double()[faces]
+    return torch.linalg.cross(v[:, 1] - v[:, 0], v[:, 2] - v[:, 0]).norm(dim=-1).sum().item() / 2
+
+
+def signed_volume(verts, faces):
+    v = verts.double()[faces]
+    return (v[:, 0] * torch.linalg.cross(v[:, 1], v[:, 2])).sum().item() / 6
+
+
+def check_closed_and_oriented(faces):
+    '''every edge is used by two faces, once in each direction'''
+    directed = torch.cat([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])
+    uniq, counts = torch.unique(directed, dim=0, return_counts=True)
+    assert (counts == 1).all(), 'an edge is used twice in the same direction'
+    undirected, counts = torch.unique(directed.sort(dim=-1).values, dim=0, return_counts=True)
+    assert (counts == 2).all(), 'the mesh has a border or a non-manifold edge'
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_dense(shape):
+    level_fn, exact_area = SHAPES[shape]
+    values = grid(level_fn)
+    verts, faces = marching_cubes(values)
+    scale = 2 / (RES - 1)
+
+    check_closed_and_oriented(faces)
+    # outward normals: positive volume, close to the one of the shape
+    assert signed_volume(verts, faces) > 0
+    assert area(verts, faces) * scale ** 2 == pytest.approx(exact_area, rel=3e-2)
+
+    mcubes = pytest.importorskip('mcubes')
+    ref_verts, ref_faces = mcubes.marching_cubes(values.numpy(), 0.)
+    # the same tables, one vertex per crossed grid edge
+    assert verts.shape[0] == ref_verts.shape[0]
+    assert faces.shape[0] == ref_faces.shape[0]
+    ref_verts, ref_faces = torch.from_numpy(ref_verts), torch.from_numpy(ref_faces.astype(np.int64))
+    assert area(verts, faces) == pytest.approx(area(ref_verts, ref_faces), rel=1e-4)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+def test_dense_against_skimage(shape):
+    measure = pytest.importorskip('skimage.measure')
+    level_fn, _ = SHAPES[shape]
+    values = grid(level_fn)
+    verts, faces = marching_cubes(values)
+    ref_verts, ref_faces, _, _ = measure.marching_cubes(values.numpy(), 0.)
+    ref_verts, ref_faces = torch.from_numpy(ref_verts.copy()), torch.from_numpy(ref_faces.astype(np.int64))
+
+    # Lewiner's tables resolve the ambiguous cases differently, the crossed edges are the same
+    assert verts.shape[0] == ref_verts.shape[0]
+    assert area(verts, faces) == pytest.approx(area(ref_verts, ref_faces), rel=5e-3)
+    assert abs(signed_volume(verts, faces)) == pytest.approx(abs(signed_volume(ref_verts, ref_faces)), rel=5e-3)
+
+
+@pytest.mark.parametrize('shape', SHAPES)
+@pytest.mark.parametrize('block', [4, 8])
+def test_sparse_matches_dense(shape, block):
+    level_fn, _ = SHAPES[shape]
+    verts, faces = marching_cubes(grid(level_fn))
+    verts = verts * 2 / (RES - 1) - 1
+
+    sparse_verts, sparse_faces = extract_isosurface(lambda p: level_fn(p.double()), (-1, -1, -1), (1, 1, 1), RES,
+                                                    block=block, batch_blocks=7, device='cpu')
+    check_closed_and_oriented(sparse_faces)
+    assert sparse_verts.shape == verts.shape and sparse_faces.shape == faces.shape
+    # both are welded over the sorted grid edges
+    assert torch.allclose(sparse_verts, verts, atol=1e-5)
+    assert torch.equal(sparse_faces.sort(dim=-1).values.unique(dim=0), faces.sort(dim=-1).values.unique(dim=0))
+
+
+def test_sign_change_only():
+    '''band=0 only keeps the blocks whose corners change sign: a subset of the surface, whatever the scale of level_fn'''
+    level_fn = lambda p: 100 * (0.6 - p.norm(dim=-1))
+    dense_verts, dense_faces = marching_cubes(grid(level_fn))
+    verts, faces = extract_isosurface(lambda p: level_fn(p.double()), (-1, -1, -1), (1, 1, 1), RES, block=4, band=0.,
+                                      device='cpu')
+    assert 0 < faces.shape[0] <= dense_faces.shape[0]
+    dense_verts = dense_verts * 2 / (RES - 1) - 1
+    # every vertex lies on a crossed grid edge of the dense extraction
+    dist = torch.cdist(verts, dense_verts).amin(dim=-1)
+    assert dist.max() < 1e-5
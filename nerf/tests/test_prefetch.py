@@ -0,0 +1,51 @@
+import pytest
+import torch
+
+from dataset.packed import ActiveRaySampler, RandomRaySampler
+from dataset.prefetch import RayPrefetcher
+from utils import RayIndex
+
+
+class Table():
+    def __init__(self, n_rays):
+        self.rays = torch.rand(n_rays, 6)
+
+    def __getitem__(self, idx):
+        return {'rays': self.rays[idx]}
+
+
+def ray_index(n_rays, active):
+    index = RayIndex(n_rays)
+    index.snapshot = (torch.as_tensor(active, dtype=torch.int32), 1)
+    return index
+
+
+def test_short_active_set_gives_a_full_batch():
+    index = ray_index(100, [3, 7, 11])
+    light_idx = torch.arange(100) % 2
+    for sampler in [ActiveRaySampler(index, 8), ActiveRaySampler(index, 8, light_idx=light_idx)]:
+        batches = list(sampler)
+        assert len(batches) == len(sampler) == 1
+        assert batches[0].shape == (8,)
+        assert set(batches[0].tolist()) <= {3, 7, 11}
+    assert len(list(RandomRaySampler(5, 8))) == 1
+
+
+def test_empty_active_set_raises():
+    index = ray_index(100, [])
+    for sampler in [ActiveRaySampler(index, 8), ActiveRaySampler(index, 8, light_idx=torch.zeros(100, dtype=torch.long))]:
+        with pytest.raises(RuntimeError):
+            list(sampler)
+
+
+def test_prefetcher_short_and_empty():
+    table = Table(100)
+    prefetcher = RayPrefetcher(table, ActiveRaySampler(ray_index(100, [1, 2]), 16), 'cpu')
+    for _ in range(3):
+        assert next(prefetcher)['rays'].shape == (16, 6)
+    prefetcher.close()
+
+    prefetcher = RayPrefetcher(table, ActiveRaySampler(ray_index(100, []), 16), 'cpu')
+    with pytest.raises(RuntimeError):
+        next(prefetcher)
+    prefetcher.close()
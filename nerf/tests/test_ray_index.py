@@ -0,0 +1,70 @@
+import torch
+
+from benchmarks.fixtures import SyntheticField, random_rays
+from models.tensorBase import AlphaGridMask
+from utils import RayIndex
+
+
+def shrink_mask(field, keep_ratio, seed):
+    '''the alpha mask of field with a random share of its voxels emptied, as after an updateAlphaMask'''
+    generator = torch.Generator().manual_seed(seed)
+    alpha = field.alphaMask.alpha_volume[0, 0]
+    keep = (torch.rand(alpha.shape, generator=generator) < keep_ratio).float()
+    return AlphaGridMask('cpu', field.aabb, alpha * keep)
+
+
+def test_incremental_filter_matches_full_filter():
+    field = SyntheticField('cpu', alpha_res=48)
+    field.render_step_size = (field.aabb[1] - field.aabb[0]).norm().item() / 256
+    field.near_far = [2.0, 6.0]
+    rays = random_rays(20000, seed=1)
+
+    incremental = RayIndex(rays.shape[0]).filter(field, rays, 'cpu', chunk=4096, bbox_only=True)
+    for step, keep_ratio in enumerate([1.0, 0.7, 0.5]):
+        field.alphaMask = shrink_mask(field, keep_ratio, seed=step) if keep_ratio < 1 else field.alphaMask
+        incremental.filter(field, rays, 'cpu', chunk=4096)
+        full = RayIndex(rays.shape[0]).filter(field, rays, 'cpu', chunk=4096)
+
+        assert 0 < full.n_active < rays.shape[0]
+        assert torch.equal(incremental.mask(), full.mask()), step
+        assert incremental.version == step + 2
+
+
+def test_shrunk_bbox_retraces():
+    field = SyntheticField('cpu', alpha_res=48)
+    field.render_step_size = (field.aabb[1] - field.aabb[0]).norm().item() / 256
+    field.near_far = [2.0, 6.0]
+    rays = random_rays(5000, seed=2)
+
+    index = RayIndex(rays.shape[0]).filter(field, rays, 'cpu')
+    field.aabb = field.aabb * 0.8
+    index.filter(field, rays, 'cpu')
+    assert torch.equal(index.mask(), RayIndex(rays.shape[0]).filter(field, rays, 'cpu').mask())
+
+
+def test_mask_updates_match_a_fresh_filter():
+    '''masks that fill voxels again, change resolution and step size: the rays a coarse early mask dropped come back'''
+    field = SyntheticField('cpu', alpha_res=48)
+    field.render_step_size = (field.aabb[1] - field.aabb[0]).norm().item() / 256
+    field.near_far = [2.0, 6.0]
+    rays = random_rays(20000, seed=3)
+    full_mask = field.alphaMask
+    fine_mask = SyntheticField('cpu', alpha_res=64).alphaMask
+
+    updates = [
+        lambda: shrink_mask(field, 0.3, seed=0),    # a coarse, under-trained mask
+        lambda: full_mask,                          # filled again
+        lambda: fine_mask,                          # another resolution
+        lambda: shrink_mask(field, 0.8, seed=1),    # shrinks the fine one, incremental
+        lambda: field.alphaMask,                    # the same mask with half the step size
+    ]
+    incremental = RayIndex(rays.shape[0])
+    for step, update in enumerate(updates):
+        field.alphaMask = update()
+        if step == 4:
+            # as after upsample_volume_grid
+            field.render_step_size *= 0.5
+        incremental.filter(field, rays, 'cpu', chunk=4096)
+        fresh = RayIndex(rays.shape[0]).filter(field, rays, 'cpu', chunk=4096)
+        assert torch.equal(incremental.mask(), fresh.mask()), step
+        assert torch.equal(incremental.t_hit, fresh.t_hit), step
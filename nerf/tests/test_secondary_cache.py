@@ -0,0 +1,64 @@
+'''SecondaryShadingCache against the uncached compute_secondary_shading_effects'''
+import torch
+
+from benchmarks.fixtures import SyntheticField, surface_rays
+from models.tensoIR.relight_utils import compute_secondary_shading_effects
+from models.tensoIR.secondary_cache import SecondaryShadingCache
+
+MARCH = dict(nSample=96, vis_near=0.05, vis_far=1.5, chunk_size=8192, device='cpu')
+
+
+def setup(n_pts=4000, near_cells=2.0):
+    field = SyntheticField('cpu', alpha_res=64)
+    cache = SecondaryShadingCache(res=32, envmap_h=16, envmap_w=32, refresh_every=0, check_ratio=0.,
+                                  near_cells=near_cells, device='cpu')
+    pts, _ = surface_rays(field, n_pts, seed=3)
+    # directions of the bins, as for the fixed_envirmap rays, so that only the spatial interpolation is tested
+    dirs = cache.bin_dirs[torch.randint(0, cache.n_dirs, (n_pts,), generator=torch.Generator().manual_seed(4))]
+    light_idx = torch.zeros((n_pts, 1), dtype=torch.long)
+    return field, cache, pts, dirs, light_idx
+
+
+def test_split_march_is_exact():
+    '''near then far from the same point gives the samples and the result of the full march'''
+    field, cache, pts, dirs, light_idx = setup(1000)
+    vis, indirect = compute_secondary_shading_effects(field, pts, dirs, light_idx, **MARCH)
+    cache.query(field, pts[:1], dirs[:1], light_idx[:1], **MARCH)
+    assert 0 < cache.n_near < MARCH['nSample'] - 1
+
+    near_vis, near_indirect = cache.march(field, pts, dirs, light_idx, 8192, 'cpu', part='near')
+    far_vis, far_indirect = cache.march(field, pts, dirs, light_idx, 8192, 'cpu', part='far')
+    assert torch.allclose(near_vis * far_vis, vis, atol=1e-5)
+    assert torch.allclose(near_indirect + near_vis * far_indirect, indirect, atol=1e-5)
+
+
+def test_cached_visibility_agrees():
+    field, cache, pts, dirs, light_idx = setup()
+    exact_vis, exact_indirect = compute_secondary_shading_effects(field, pts, dirs, light_idx, **MARCH)
+
+    # the first query marches everything and fills the corners, the second one is answered by the cache
+    first_vis, _ = cache.query(field, pts, dirs, light_idx, **MARCH)
+    assert torch.allclose(first_vis, exact_vis, atol=1e-6)
+    vis, indirect = cache.query(field, pts, dirs, light_idx, **MARCH)
+    assert cache.n_hit > 0.9 * pts.shape[0]
+
+    err = vis - exact_vis
+    # no shadow bias, and the shadow boundaries only move by the interpolation
+    assert err.mean().abs() < 0.02
+    assert err.abs().mean() < 0.05
+    assert ((vis > 0.5) == (exact_vis > 0.5)).float().mean() > 0.95
+    assert (indirect - exact_indirect).abs().mean() < 0.05
+
+
+def test_near_band_removes_the_bias():
+    '''caching the whole ray interpolates vertices inside the spheres, which darkens the shadows'''
+    field, cache, pts, dirs, light_idx = setup()
+    exact_vis, _ = compute_secondary_shading_effects(field, pts, dirs, light_idx, **MARCH)
+    biases = []
+    for near_cells in [0.0, 2.0]:
+        cache = SecondaryShadingCache(res=32, envmap_h=16, envmap_w=32, refresh_every=0, check_ratio=0.,
+                                      near_cells=near_cells, device='cpu')
+        for _ in range(2):
+            vis, _ = cache.query(field, pts, dirs, light_idx, **MARCH)
+        biases.append((vis - exact_vis).mean().abs().item())
+    assert biases[1] < biases[0]
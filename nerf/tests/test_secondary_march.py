@@ -0,0 +1,37 @@
+'''compute_radiance_skipping against compute_radiance, and the cells it skips against the alphaMask'''
+import pytest
+import torch
+
+from benchmarks.fixtures import SyntheticField, surface_rays
+from models.tensoIR.relight_utils import cell_occupancy, compute_radiance, compute_radiance_skipping
+
+MARCH = dict(nSample=96, vis_near=0.05, vis_far=1.5, device='cpu')
+
+
+@pytest.mark.parametrize('cell_size', [1, 4, 7])
+def test_cells_bound_the_alpha_mask(cell_size):
+    field = SyntheticField('cpu', alpha_res=48)
+    # past the aabb too, where grid_sample still reads the border voxels
+    xyz = (torch.rand((200000, 3), generator=torch.Generator().manual_seed(0)) - 0.5) * 3.2
+    occupied, exact = cell_occupancy(field, xyz, cell_size)
+    assert not exact
+    assert occupied[field.alphaMask.sample_alpha(xyz) > 0].all()
+    if cell_size == 1:
+        assert occupied.float().mean() < 0.5
+
+
+@pytest.mark.parametrize('T_thre', [0., 1e-4])
+def test_skipping_matches_linspace(T_thre):
+    field = SyntheticField('cpu', alpha_res=64)
+    pts, dirs = surface_rays(field, 3000, seed=1)
+    light_idx = torch.zeros((pts.shape[0], 1), dtype=torch.long)
+    ref_vis, _, ref_indirect = compute_radiance(field, pts, dirs, light_idx, **MARCH)
+    stats = {}
+    vis, _, indirect = compute_radiance_skipping(field, pts, dirs, light_idx, T_thre=T_thre, stats=stats, **MARCH)
+
+    # without termination the same samples are queried, terminated rays only lose weights below T_thre
+    atol = 1e-6 if T_thre == 0 else 2 * T_thre
+    assert torch.allclose(vis, ref_vis, atol=atol)
+    assert torch.allclose(indirect, ref_indirect, atol=atol)
+    # the alphaMask is only read in occupied cells, the density only where it is occupied
+    assert stats['samples'] <= stats['samples_masked'] <= stats['samples_cells'] < stats['samples_dense']
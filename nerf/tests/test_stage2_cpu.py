@@ -0,0 +1,80 @@
+'''stage-2 validation of the default tensoIR_physical material on the CPU, with the torch rasterizer'''
+import os
+
+import numpy as np
+import torch
+from omegaconf import OmegaConf
+
+import models
+from benchmarks.fixtures import SyntheticField, tet_grid
+from dataset.tensoir_synthetic import TensoirSyntheticDataset
+from render import raster, util
+
+RES = 32
+DOWNSAMPLE = 2
+
+
+class Views(torch.utils.data.Dataset):
+    '''a couple of random RGBA views around the origin, cropped like TensoirSyntheticDataset'''
+    get_crop = TensoirSyntheticDataset.get_crop
+
+    def __init__(self, n_views=2):
+        self.w = self.h = RES
+        self.downsample = DOWNSAMPLE
+        self.aspect = 1.0
+        self.camera_angle_y = 0.8
+        self.mvs = [util.translate(0, 0, -3.) @ util.rotate_y(a) for a in np.linspace(0, np.pi, n_views)]
+
+    def __len__(self):
+        return len(self.mvs)
+
+    def __getitem__(self, idx):
+        mv = self.mvs[idx]
+        return {'img': torch.rand(self.h, self.w, 4), 'mv': mv, 'campos': torch.linalg.inv(mv)[:3, 3]}
+
+
+class SphereDMTet(models.TensoIR_DMTet):
+    '''a sphere instead of the density of the untrained field, so the mesh is never empty'''
+    def cal_sdf(self, v):
+        return 0.8 - v.norm(dim=-1)
+
+
+def test_run_validate_cpu(tmp_path):
+    import train_stage2
+
+    device = torch.device('cpu')
+    torch.manual_seed(0)
+    conf = OmegaConf.load('config/general_second.yaml')
+    conf.data.resolution = [RES, RES]
+    conf.data.downsample = DOWNSAMPLE
+    conf.model.dmtet.dmtet_grid = 8
+    conf.async_writer = False
+
+    tensoIR_conf = OmegaConf.load('config/model/TensoIR.yaml').model
+    tensoIR_conf.sampler = 'vanilla'
+    tensoIR_conf.white_bg = True
+    tensoIR_conf.near_far = [2.0, 6.0]
+    tensoIR_conf.light.envmap_w = 8
+    tensoIR_conf.light.envmap_h = 4
+    field = SyntheticField(device, alpha_res=32)
+    tensoIR = models.TensoIR(tensoIR_conf, device, field.aabb, [32] * 3).to(device)
+    tensoIR.alphaMask = field.alphaMask
+
+    verts, tets = tet_grid(8)
+    os.makedirs(tmp_path / 'data' / 'tets')
+    np.savez(tmp_path / 'data' / 'tets' / '8_tets.npz', vertices=verts.numpy(), indices=tets.numpy())
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        geometry = SphereDMTet(tensoIR, device, conf.model).to(device)
+    finally:
+        os.chdir(cwd)
+
+    mat = train_stage2.initial_guess_material(geometry, conf.model, tensorf_model=tensoIR)
+    glctx = raster.make_context(device, 'torch')
+    psnr = train_stage2.run_validate(glctx, geometry, mat, Views(), str(tmp_path / 'validate'), conf, device)
+
+    assert np.isfinite(psnr)
+    assert os.path.exists(tmp_path / 'validate' / 'val_000000_opt.png')
+    lines = open(tmp_path / 'validate' / 'metrics.txt').read().splitlines()
+    assert len(lines) == 2 + len(Views()) * DOWNSAMPLE * DOWNSAMPLE
@@ -0,0 +1,68 @@
+'''TextureBaker: a tiled, chunked bake against a single-pass one, and the row-streamed PNG writer against cv2'''
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from render.texture_bake import TextureBaker, write_png
+
+CHANNELS = {
+    'albedo': (3, lambda x: x),
+    'roughness': (1, lambda x: x),
+}
+
+
+def quad_mesh():
+    '''two charts of two triangles each, with a gap between them for the dilation to fill'''
+    v = torch.tensor([[-1., -1., 0.], [1., -1., 0.], [1., 1., 0.], [-1., 1., 0.],
+                      [-1., -1., 1.], [1., -1., 1.], [1., 1., 1.], [-1., 1., 1.]])
+    f = torch.tensor([[0, 1, 2], [0, 2, 3], [4, 5, 6], [4, 6, 7]])
+    vt = torch.tensor([[0.05, 0.05], [0.45, 0.1], [0.4, 0.9], [0.1, 0.8],
+                       [0.55, 0.2], [0.95, 0.05], [0.9, 0.95], [0.6, 0.7]])
+    return v, f, vt, f.clone()
+
+
+def query(xyz):
+    return {'albedo': (xyz * 0.5 + 0.5).clamp(0, 1), 'roughness': xyz.norm(dim=-1, keepdim=True) / 2}
+
+
+def read_png(path):
+    img = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    return img[..., ::-1] if img.ndim == 3 else img[..., None]
+
+
+@pytest.mark.parametrize('ssaa', [1, 2])
+def test_tiled_bake_matches_single_pass(tmp_path, ssaa):
+    v, f, vt, ft = quad_mesh()
+    single = TextureBaker(CHANNELS, resolution=64, tile_size=64, ssaa=ssaa, chunk_size=1 << 20, dilate=4)
+    tiled = TextureBaker(CHANNELS, resolution=64, tile_size=16, ssaa=ssaa, chunk_size=37, dilate=4)
+    stats = [baker.bake(v, f, vt, ft, query, str(tmp_path / name)) for name, baker in [('single', single), ('tiled', tiled)]]
+    assert stats[1]['tiles'] == 16 and stats[0]['texels'] == stats[1]['texels'] > 0
+
+    assert np.array_equal(np.load(tmp_path / 'single' / 'coverage.npy'), np.load(tmp_path / 'tiled' / 'coverage.npy'))
+    for k, (c, _) in CHANNELS.items():
+        ref = np.load(tmp_path / 'single' / f'{k}.npy')
+        out = np.load(tmp_path / 'tiled' / f'{k}.npy')
+        # the dilation sums may round differently on a tile and on the whole map
+        assert np.abs(out.astype(np.int16) - ref).max() <= 1, k
+        # the PNGs, written 16 rows at a time by the tiled baker, decode to the maps
+        assert np.array_equal(read_png(tmp_path / 'single' / f'{k}.png'), ref)
+        assert np.array_equal(read_png(tmp_path / 'tiled' / f'{k}.png'), out)
+
+
+@pytest.mark.parametrize('channels', [1, 2, 3, 4])
+@pytest.mark.parametrize('rows', [1, 7, 100])
+def test_write_png(tmp_path, channels, rows):
+    image = np.random.default_rng(channels).integers(0, 256, (33, 50, channels), dtype=np.uint8)
+    path = tmp_path / 'image.png'
+    write_png(str(path), image, rows=rows)
+    decoded = cv2.imread(str(path), cv2.IMREAD_UNCHANGED)
+    if channels == 1:
+        decoded = decoded[..., None]
+    elif channels == 2:
+        # cv2 expands gray + alpha to BGRA
+        assert (decoded[..., 0] == decoded[..., 2]).all()
+        decoded = decoded[..., [0, 3]]
+    else:
+        decoded = np.concatenate([decoded[..., 2::-1], decoded[..., 3:]], axis=-1)
+    assert np.array_equal(decoded, image)
@@ -0,0 +1,71 @@
+'''the fused VM sampler against the grid_sample path of VMModule, and its first and second derivatives'''
+import pytest
+import torch
+
+from models.decompose_field import DensityVM
+from models.vm_sampler import vm_sample
+
+GRID = [7, 9, 11]
+
+
+def vm_module(n_comp, seed=0):
+    torch.manual_seed(seed)
+    return DensityVM(n_comp, GRID, scale=1.0).double()
+
+
+def random_xyz(n, seed=1):
+    generator = torch.Generator().manual_seed(seed)
+    return (torch.rand((n, 3), generator=generator, dtype=torch.float64) * 2 - 1) * 0.98
+
+
+@pytest.mark.parametrize('n_comp', [[4, 4, 4], [2, 3, 5]])
+def test_forward_parity(n_comp):
+    module = vm_module(n_comp)
+    xyz = random_xyz(500)
+    # on and outside the border as well, where 'zeros' padding matters
+    xyz = torch.cat([xyz, torch.tensor([[-1., 1., 0.], [1.05, 0.2, -1.1], [0.3, -1.02, 0.5]], dtype=torch.float64)])
+
+    module.sampler = 'grid_sample'
+    ref = module.compute_feature(xyz)
+    module.sampler = 'fused'
+    out = module.compute_feature(xyz)
+    assert torch.allclose(out, ref, atol=1e-10)
+
+
+@pytest.mark.parametrize('n_comp', [[4, 4, 4], [2, 3, 5]])
+def test_with_grad_parity(n_comp):
+    '''compute_feature_with_grad and the plane / line gradients of the derived normals'''
+    module = vm_module(n_comp)
+    results = []
+    for sampler in ['grid_sample', 'fused']:
+        module.sampler = sampler
+        module.zero_grad()
+        xyz = random_xyz(300).requires_grad_(True)
+        feat = module.compute_feature_with_grad(xyz)
+        sigma = torch.relu(feat.sum(0))
+        gradients = torch.autograd.grad(sigma, xyz, torch.ones_like(sigma), create_graph=True)[0]
+        normals = -torch.nn.functional.normalize(gradients, dim=-1, eps=1e-6)
+        (normals * torch.linspace(-1, 1, 3, dtype=torch.float64)).sum().backward()
+        results.append((feat.detach(), gradients.detach(),
+                        [p.grad.clone() for p in list(module.plane) + list(module.line)]))
+
+    (feat_ref, grad_ref, params_ref), (feat, grad, params) = results
+    assert torch.allclose(feat, feat_ref, atol=1e-10)
+    assert torch.allclose(grad, grad_ref, atol=1e-8)
+    for p, p_ref in zip(params, params_ref):
+        assert torch.allclose(p, p_ref, atol=1e-8)
+
+
+@pytest.mark.parametrize('padding', ['zeros', 'border'])
+def test_gradcheck(padding):
+    module = vm_module([2, 3, 2])
+    params = [p.detach().clone().requires_grad_(True) for p in list(module.plane) + list(module.line)]
+    xyz = random_xyz(20).requires_grad_(True)
+
+    def fn(xyz, *params):
+        return vm_sample(list(params[:3]), list(params[3:]), module.matMode, xyz, padding=padding)
+
+    assert torch.autograd.gradcheck(fn, (xyz, *params))
+    assert torch.autograd.gradgradcheck(fn, (xyz, *params))
+    # without grad w.r.t. the points the planes and lines go through embedding_bag
+    assert torch.autograd.gradcheck(lambda *params: fn(xyz.detach(), *params), tuple(params))
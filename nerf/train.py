@@ -2,13 +2,18 @@ import datetime
 from omegaconf import OmegaConf
 import os
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 import wandb
 
+from async_writer import build_writer
+import chunking
 from dataset.nerf_synthetic import NerfSyntheticDataset
+from dataset.packed import ActiveRaySampler, PackedRayDataset, RandomRaySampler
+from dataset.prefetch import RayPrefetcher
 from dataset.realdata import RealDataset
+from metrics import build_metrics
 import models
+from render import light
 from utils import *
 
 
@@ -50,23 +55,34 @@ def load_data(data_conf, need_test=False):
     TRAIN_DATASET = None
     VAL_DATASET = None
     TEST_DATASET = None
+    packed_cache = getattr(data_conf, 'packed_cache', False)
+    if packed_cache and data_conf.name == 'tensoir_synthetic':
+        # the cache keeps no light index, every ray would be trained against light 0
+        raise ValueError('packed_cache does not support the multi-light tensoir_synthetic data')
 
     print(data_conf)
+    frame_cache = getattr(data_conf, 'frame_cache', None)
+    num_workers = getattr(data_conf, 'num_workers', 8)
 
     if data_conf.name == 'nerf_synthetic' or data_conf.name == 'tensoir_synthetic':
-        TRAIN_DATASET = NerfSyntheticDataset(
-            datadir=data_conf.dir,
-            split='train',
-            downsample=data_conf.downsample,
-            is_stack=False,
-            debug=data_conf.debug,
-        )
+        if not packed_cache:
+            TRAIN_DATASET = NerfSyntheticDataset(
+                datadir=data_conf.dir,
+                split='train',
+                downsample=data_conf.downsample,
+                is_stack=False,
+                debug=data_conf.debug,
+                cache_dir=frame_cache,
+                num_workers=num_workers,
+            )
         VAL_DATASET = NerfSyntheticDataset(
             datadir=data_conf.dir,
             split='val',
             downsample=data_conf.downsample,
             is_stack=True,
             debug=data_conf.debug,
+            cache_dir=frame_cache,
+            num_workers=num_workers,
         )
         if need_test:
             TEST_DATASET = NerfSyntheticDataset(
@@ -75,19 +91,26 @@ def load_data(data_conf, need_test=False):
                 downsample=data_conf.downsample,
                 is_stack=True,
                 debug=data_conf.debug,
+                cache_dir=frame_cache,
+                num_workers=num_workers,
             )
     elif data_conf.name == 'realdata':
-        TRAIN_DATASET = RealDataset(
-            datadir=data_conf.dir,
-            split='train',
-            downsample=data_conf.downsample,
-            is_stack=False,
-        )
+        if not packed_cache:
+            TRAIN_DATASET = RealDataset(
+                datadir=data_conf.dir,
+                split='train',
+                downsample=data_conf.downsample,
+                is_stack=False,
+                cache_dir=frame_cache,
+                num_workers=num_workers,
+            )
         VAL_DATASET = RealDataset(
             datadir=data_conf.dir,
             split='val',
             downsample=data_conf.downsample,
             is_stack=True,
+            cache_dir=frame_cache,
+            num_workers=num_workers,
         )
         if need_test:
             TEST_DATASET = RealDataset(
@@ -95,13 +118,40 @@ def load_data(data_conf, need_test=False):
                 split='test',
                 downsample=data_conf.downsample,
                 is_stack=True,
+                cache_dir=frame_cache,
+                num_workers=num_workers,
             )
     else:
         raise NotImplementedError('Unknown dataset type: %s' % data_conf.name)
 
+    if packed_cache:
+        # only the training split is packed, evaluation still needs whole images
+        TRAIN_DATASET = PackedRayDataset(
+            datadir=data_conf.dir,
+            name=data_conf.name,
+            split='train',
+            downsample=data_conf.downsample,
+            cache_dir=getattr(data_conf, 'cache_dir', ''),
+            white_bg=VAL_DATASET.white_bg,
+            debug=getattr(data_conf, 'debug', False),
+        )
+
     return TRAIN_DATASET, VAL_DATASET, TEST_DATASET
 
 
+def build_train_loader(dataset, args, device, ray_index=None):
+    '''ray batches of the training set, gathered on a background thread'''
+    if ray_index is not None:
+        # batches of the rays left by filtering, the ray tables are indexed in place
+        light_idx = dataset.all_light_idx if getattr(args, 'stratify_lights', False) else None
+        sampler = ActiveRaySampler(ray_index, args.batch_size, light_idx=light_idx)
+    else:
+        if getattr(args, 'stratify_lights', False):
+            raise ValueError('stratify_lights needs the light index of the in-memory datasets, disable packed_cache')
+        sampler = RandomRaySampler(len(dataset), args.batch_size)
+    return RayPrefetcher(dataset, sampler, device, depth=getattr(args, 'prefetch_depth', 2))
+
+
 def train(args):
     if args.wandb:
         wandb.login()
@@ -131,6 +181,8 @@ def train(args):
         backup(logdir, args)
 
     device = set_device(args.gpu)
+    chunking.configure(args)
+    light.configure_cache(args)
 
     TRAIN_DATASET, VAL_DATASET, TEST_DATASET = load_data(args.data, args.render_test)
 
@@ -144,6 +196,8 @@ def train(args):
     print('nSamples: %d' % nSamples)
 
     model = eval('models.' + args.model.name)(args.model, device, aabb, grid_size).to(device)
+    # checkpoints and visualizations are written in the background
+    model.writer = build_writer(args)
     model.nSamples = nSamples
     print('aabb:', model.aabb)
     print('near_far:', model.near_far)
@@ -155,40 +209,30 @@ def train(args):
     optimizer = optim_dict[args.optimizer.name](grad_vars, **args.optimizer.params)
     scheduler = build_scheduler(optimizer, args.scheduler)
 
+    ray_index = None
     if args.model.name in ['TensorCP', 'TensorVM', 'TensorVMSplit', 'TensoIR']:
         N_voxel_list = (torch.round(torch.exp(torch.linspace(
                             np.log(args.N_voxel_init),
                             np.log(args.N_voxel_final),
                             len(args.upsample.iteration) + 1))).long()).tolist()[1:]
 
-        all_rays, all_rgbs, mask_filtered = filtering_rays(
-            model,
-            TRAIN_DATASET.all_rays,
-            TRAIN_DATASET.all_rgbs,
-            device,
-            bbox_only=True,
-        )
-        TRAIN_DATASET.all_rays = all_rays
-        TRAIN_DATASET.all_rgbs = all_rgbs
+        # the packed dataset never materializes all_rays, rays outside the bbox
+        # simply render the background
+        if not isinstance(TRAIN_DATASET, PackedRayDataset):
+            ray_index = RayIndex(len(TRAIN_DATASET))
+            ray_index.filter(model, TRAIN_DATASET.all_rays, device, bbox_only=True)
 
         if args.model.name == 'TensoIR':
-            all_light_idx = TRAIN_DATASET.all_light_idx[mask_filtered, :]
-            TRAIN_DATASET.all_light_idx = all_light_idx
             args.model.update_AlphaMask_list = args.update_AlphaMask_list
             args.model.iteration = args.iteration
 
-    train_loader = DataLoader(
-        TRAIN_DATASET,
-        batch_size=args.batch_size,
-        shuffle=True,
-        num_workers=16,
-        drop_last=True,
-    )
-    train_iter = iter(cycle(train_loader))
+    if ray_index is None and not isinstance(TRAIN_DATASET, PackedRayDataset):
+        ray_index = RayIndex(len(TRAIN_DATASET))
+    train_loader = build_train_loader(TRAIN_DATASET, args, device, ray_index)
 
     print('Number of batches: %d' % len(train_loader))
-    PSNRs, PSNRs_test = [], [0]
-    PSNRs_brdf, PSNRs_brdf_test = [], [0]
+    metrics = build_metrics(args, logdir)
+    metrics.gauges.append(train_loader.stats)
 
     log_time = False
 
@@ -196,18 +240,13 @@ def train(args):
         start_time = time.time()
 
         args.nw_iter = args.model.nw_iter = i
-        data = next(train_iter)
-        data = {k: v.to(device) for k, v in data.items()}
+        data = next(train_loader)
         if args.model.name == 'TensoIR':
             data['normals'] = None
 
         model.update_step(epoch=0, global_step=i, args=args)
         loss_dict = model.cal_loss(data, args.model)
 
-        nw_loss_dict = {}
-        for k, v in loss_dict.items():
-            nw_loss_dict[k] = v.detach().cpu().item()
-
         total_loss = loss_dict['total_loss']
         optimizer.zero_grad()
         total_loss.backward()
@@ -215,18 +254,10 @@ def train(args):
         if scheduler is not None:
             scheduler.step()
 
-        PSNRs.append(nw_loss_dict['PSNR'])
-        if args.model.name == 'TensoIR':
-            if args.model.relight_flag:
-                PSNRs_brdf.append(nw_loss_dict['PSNR_brdf'])
-
-        if args.wandb:
-            wandb.log(nw_loss_dict, step=i)
-        else:
-            print(f'Iter: {i:05d}', end=' | ')
-            for k, v in nw_loss_dict.items():
-                print(k, ': ', v, end=' | ')
-            print()
+        # loss terms stay on the device until the end of the logging window
+        ray_indices = getattr(model, 'ray_indices', None)
+        metrics.step(i, loss_dict, n_rays=data['rays'].shape[0],
+                     n_samples=ray_indices.shape[0] if ray_indices is not None else 0)
 
         if i % 1000 == 0:
             print('step {} model.sampler.aabb {}'.format(i, model.sampler.aabb))
@@ -263,24 +294,10 @@ def train(args):
                         model.tv_weight_density = 0
                         model.tv_weight_app = 0
 
-                if not args.model.ndc_ray and i == args.update_AlphaMask_list[1]:
-                    # filter rays outside the bbox
-                    all_rays, all_rgbs, mask = filtering_rays(
-                        model, all_rays, all_rgbs, device, bbox_only=True)
-                    TRAIN_DATASET.all_rays = all_rays
-                    TRAIN_DATASET.all_rgbs = all_rgbs
-                    if args.model.name == 'TensoIR':
-                        all_light_idx = all_light_idx[mask, :]
-                        TRAIN_DATASET.all_light_idx = all_light_idx
-
-                    train_loader = DataLoader(
-                        TRAIN_DATASET,
-                        batch_size=args.batch_size,
-                        shuffle=True,
-                        num_workers=16,
-                        drop_last=True,
-                    )
-                    train_iter = iter(cycle(train_loader))
+                if not args.model.ndc_ray and i == args.update_AlphaMask_list[1] \
+                        and not isinstance(TRAIN_DATASET, PackedRayDataset):
+                    # filter rays outside the bbox, the sampler picks up the new set by itself
+                    ray_index.filter(model, TRAIN_DATASET.all_rays, device, bbox_only=True)
                     print(len(train_loader))
 
             if i in args.upsample.iteration:
@@ -303,6 +320,7 @@ def train(args):
             print("post process time: ", nw_time - start_time)
             start_time = nw_time
 
+    train_loader.close()
     # save model
     model.save(f'{logdir}')
 
@@ -330,6 +348,8 @@ def train(args):
         wandb.log({'PSNR_test_all': np.mean(PSNRs_test)}, step=args.iteration)
         print(f'======> {args.exp} test all psnr: {np.mean(PSNRs_test)} <========================')
 
+    model.writer.close()
+
 
 if __name__ == '__main__':
     args = load_config()
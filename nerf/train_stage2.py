@@ -1,7 +1,6 @@
 import datetime
 import os
 
-import nvdiffrast.torch as dr
 import torch
 import wandb
 from omegaconf import OmegaConf
@@ -9,11 +8,15 @@ from PIL import Image
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+from async_writer import build_writer, sync_writer
+import chunking
+from crop_scheduler import CropScheduler
+from metrics import build_metrics
 import models
 import render.renderutils as ru
 from dataset.nerf_synthetic import NerfSyntheticDataset
 from dataset.tensoir_synthetic import TensoirSyntheticDataset
-from render import light, material, mlptexture, util
+from render import light, material, mlptexture, raster, util
 from utils import *
 
 
@@ -68,6 +71,8 @@ def load_data(data_conf, need_test=False, is_stack=False):
     VAL_DATASET = None
     TEST_DATASET = None
     print(data_conf)
+    frame_cache = getattr(data_conf, 'frame_cache', None)
+    num_workers = getattr(data_conf, 'num_workers', 8)
 
     if data_conf.name == 'nerf_synthetic':
         TRAIN_DATASET = NerfSyntheticDataset(
@@ -77,6 +82,8 @@ def load_data(data_conf, need_test=False, is_stack=False):
             is_stack=is_stack,
             crop=data_conf.crop_train,
             debug=data_conf.debug,
+            cache_dir=frame_cache,
+            num_workers=num_workers,
         )
         VAL_DATASET = NerfSyntheticDataset(
             datadir=data_conf.dir,
@@ -85,6 +92,8 @@ def load_data(data_conf, need_test=False, is_stack=False):
             is_stack=True,
             crop=data_conf.crop_val,
             debug=data_conf.debug,
+            cache_dir=frame_cache,
+            num_workers=num_workers,
         )
         if need_test:
             TEST_DATASET = NerfSyntheticDataset(
@@ -94,6 +103,8 @@ def load_data(data_conf, need_test=False, is_stack=False):
                 is_stack=True,
                 crop=data_conf.crop_val,
             debug=data_conf.debug,
+                cache_dir=frame_cache,
+                num_workers=num_workers,
             )
     elif data_conf.name == 'tensoir_synthetic':
         TRAIN_DATASET = TensoirSyntheticDataset(
@@ -103,6 +114,8 @@ def load_data(data_conf, need_test=False, is_stack=False):
             is_stack=is_stack,
             crop=data_conf.crop_train,
             debug=data_conf.debug,
+            cache_dir=frame_cache,
+            num_workers=num_workers,
         )
         VAL_DATASET = TensoirSyntheticDataset(
             datadir=data_conf.dir,
@@ -111,6 +124,8 @@ def load_data(data_conf, need_test=False, is_stack=False):
             is_stack=True,
             crop=data_conf.crop_val,
             debug=data_conf.debug,
+            cache_dir=frame_cache,
+            num_workers=num_workers,
         )
         if need_test:
             TEST_DATASET = TensoirSyntheticDataset(
@@ -120,6 +135,8 @@ def load_data(data_conf, need_test=False, is_stack=False):
                 is_stack=True,
                 crop=data_conf.crop_val,
                 debug=data_conf.debug,
+                cache_dir=frame_cache,
+                num_workers=num_workers,
             )
     else:
         raise NotImplementedError('Unknown dataset type: %s' % data_conf.name)
@@ -146,7 +163,7 @@ def initial_guess_material(geometry, FLAGS, base_mesh=None, init_mat=None, tenso
     elif FLAGS.tex_type == "vert" and base_mesh is not None:
         mlp_map_opt = mlptexture.VertNeuralTex(geometry.getAABB(), n_verts=base_mesh.v_pos.shape[0], channels=FLAGS.tex_dim, feape=FLAGS.feape, viewpe=FLAGS.viewpe)
     elif FLAGS.tex_type == "vert_sh" and base_mesh is not None:
-        mlp_map_opt = mlptexture.VertSHTex(n_verts=base_mesh.v_pos.shape[0], deg=FLAGS.deg, channels=FLAGS.tex_dim, feape=FLAGS.feape, viewpe=FLAGS.viewpe)
+        mlp_map_opt = mlptexture.VertSHTex(n_verts=base_mesh.v_pos.shape[0], deg=FLAGS.deg, channels=FLAGS.tex_dim, feape=FLAGS.feape, viewpe=FLAGS.viewpe, device=base_mesh.v_pos.device)
     elif FLAGS.tex_type == "tensorVM":
         mlp_map_opt = mlptexture.TensorVMSplitNeuralTex(geometry.getAABB(), channels=FLAGS.tex_dim, pospe=FLAGS.pospe, feape=FLAGS.feape, viewpe=FLAGS.viewpe, shader_internal_dims=FLAGS.shader_internal_dims)
     elif FLAGS.tex_type == "tensorVM_SH":
@@ -156,7 +173,7 @@ def initial_guess_material(geometry, FLAGS, base_mesh=None, init_mat=None, tenso
     elif FLAGS.tex_type == "neus_preload" and tensorf_model is not None:
         mlp_map_opt = mlptexture.NeuSLoadNeuralTex(tensorf_model, channels=FLAGS.tex_dim)
     elif FLAGS.tex_type == "uvmap":
-        mlp_map_opt = mlptexture.UVMapNeuralTex(channels=FLAGS.tex_dim, pospe=FLAGS.pospe, feape=FLAGS.feape, viewpe=FLAGS.viewpe)
+        mlp_map_opt = mlptexture.UVMapNeuralTex(channels=FLAGS.tex_dim, pospe=FLAGS.pospe, feape=FLAGS.feape, viewpe=FLAGS.viewpe, device=geometry.getAABB()[0].device)
     elif FLAGS.tex_type == "tensoIR_physical":
         mlp_map_opt = mlptexture.TensoIRPhysicalRendering(tensorf_model, channels=FLAGS.tex_dim, unbounded=FLAGS.unbounded)
     else:
@@ -252,7 +269,7 @@ def validate_itr(glctx, target, geometry, opt_material, FLAGS):
         return result_image, result_dict
 
 
-def run_validate(glctx, geometry, opt_material, dataset_validate, out_dir, FLAGS, device):
+def run_validate(glctx, geometry, opt_material, dataset_validate, out_dir, FLAGS, device, writer=sync_writer):
     # ==============================================================================================
     #  Validation loop
     # ==============================================================================================
@@ -276,8 +293,8 @@ def run_validate(glctx, geometry, opt_material, dataset_validate, out_dir, FLAGS
             # Mix validation background
             for i in range(FLAGS.data.downsample):
                 for j in range(FLAGS.data.downsample):
-                    cx = dataset_validate.w // FLAGS.data.downsample
-                    cy = dataset_validate.h // FLAGS.data.downsample
+                    cx = dataset_validate.h // FLAGS.data.downsample
+                    cy = dataset_validate.w // FLAGS.data.downsample
                     cx = cx // 2 + i * cx
                     cy = cy // 2 + j * cy
                     target = prepare_batch(dataset_validate.get_crop(nwdata, cx, cy), FLAGS.data)
@@ -321,7 +338,7 @@ def run_validate(glctx, geometry, opt_material, dataset_validate, out_dir, FLAGS
                     for k in result_dict.keys():
                         if k != "time":
                             np_img = result_dict[k].detach().cpu().numpy()
-                            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, k)), np_img)
+                            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, k)), np_img)
 
         avg_mse = np.mean(np.array(mse_values))
         avg_psnr = np.mean(np.array(psnr_values))
@@ -334,7 +351,13 @@ def run_validate(glctx, geometry, opt_material, dataset_validate, out_dir, FLAGS
     return avg_psnr
 
 
-def run_validate_crop(glctx, geometry, opt_material, dataset_validate, out_dir, FLAGS, device):
+def write_mesh_ply(folder, tensors):
+    '''obj.write_ply of the geometry in tensors, which went through to_host in place of the live mesh'''
+    from render import mesh, obj
+    obj.write_ply(folder, mesh.Mesh(**tensors), save_material=False)
+
+
+def run_validate_crop(glctx, geometry, opt_material, dataset_validate, out_dir, FLAGS, device, writer=sync_writer, crops=None):
     mse_values = []
     psnr_values = []
 
@@ -347,9 +370,9 @@ def run_validate_crop(glctx, geometry, opt_material, dataset_validate, out_dir,
     print('validate downsample', dataset_validate.downsample)
     os.makedirs(out_dir, exist_ok=True)
 
-    from render import obj
     opt_mesh = geometry.getMesh(opt_material)
-    obj.write_ply(out_dir, opt_mesh, save_material=False)
+    mesh_tensors = {k: getattr(opt_mesh, k) for k in ('v_pos', 't_pos_idx', 'v_nrm', 't_nrm_idx', 'v_tex', 't_tex_idx')}
+    writer.submit(write_mesh_ply, out_dir, mesh_tensors)
 
 
     _, view_dirs = opt_mesh.material['neural_tex'].net.generate_envir_map_dir(256, 512)
@@ -361,8 +384,7 @@ def run_validate_crop(glctx, geometry, opt_material, dataset_validate, out_dir,
     envirmap = predicted_envir_map
 
     # save predicted envir map
-    import imageio
-    imageio.imwrite(f'{out_dir}/envirmap.png', envirmap)
+    writer.save_image(f'{out_dir}/envirmap.png', envirmap)
 
     with open(os.path.join(out_dir, 'metrics.txt'), 'w') as fout:
         fout.write('ID, MSE, PSNR\n')
@@ -370,8 +392,9 @@ def run_validate_crop(glctx, geometry, opt_material, dataset_validate, out_dir,
         total_time = 0
         print("Running validation")
 
-        tx = dataset_validate.w // FLAGS.data.downsample
-        ty = dataset_validate.h // FLAGS.data.downsample
+        # rows and columns of a crop
+        tx = dataset_validate.h // FLAGS.data.downsample
+        ty = dataset_validate.w // FLAGS.data.downsample
 
         for it, nwdata in enumerate(dataloader_validate):
             # Mix validation background
@@ -411,6 +434,8 @@ def run_validate_crop(glctx, geometry, opt_material, dataset_validate, out_dir,
                     opt = torch.clamp(result_dict['opt'], 0.0, 1.0)
                     ref = torch.clamp(result_dict['ref'], 0.0, 1.0)
                     # mse = torch.nn.functional.mse_loss(opt, ref, size_average=None, reduce=None, reduction='mean').item()
+                    if crops is not None:
+                        crops.observe(result_dict['pos'], result_dict['full_opt'], ref)
 
                     my_img[i * tx:(i + 1) * tx, j * ty:(j + 1) * ty, :] = opt.detach().cpu().numpy()
                     ref_img[i * tx:(i + 1) * tx, j * ty:(j + 1) * ty, :] = ref.detach().cpu().numpy()
@@ -425,17 +450,17 @@ def run_validate_crop(glctx, geometry, opt_material, dataset_validate, out_dir,
                     indirect_rgb_img[i * tx:(i + 1) * tx, j * ty:(j + 1) * ty, :] = result_dict['indirect_rgb'].detach().cpu().numpy()
                     normal_img[i * tx:(i + 1) * tx, j * ty:(j + 1) * ty, :] = result_dict['normal'].detach().cpu().numpy()
 
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "my_img")), my_img)
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "ref_img")), ref_img)
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "albedo_img")), albedo_img)
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "roughness_img")), roughness_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "my_img")), my_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "ref_img")), ref_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "albedo_img")), albedo_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "roughness_img")), roughness_img)
 
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "my_full_img")), my_full_img)
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "ref_full_img")), ref_full_img)
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "wo_indir_img")), wo_indir_img)
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "direct_rgb_img")), direct_rgb_img)
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "indirect_rgb_img")), indirect_rgb_img)
-            util.save_image(out_dir + '/' + ('val_%06d_%s.png' % (it, "normal_img")), normal_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "my_full_img")), my_full_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "ref_full_img")), ref_full_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "wo_indir_img")), wo_indir_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "direct_rgb_img")), direct_rgb_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "indirect_rgb_img")), indirect_rgb_img)
+            writer.submit(util.save_image, out_dir + '/' + ('val_%06d_%s.png' % (it, "normal_img")), normal_img)
 
             # mse = torch.nn.functional.mse_loss(my_img, ref_img, size_average=None, reduce=None, reduction='mean').item()
             mse = np.mean(np.square(my_img - ref_img))
@@ -476,6 +501,9 @@ def test(args):
     print('Logdir: %s' % logdir)
     os.makedirs(logdir, exist_ok=True)
     device = set_device(args.gpu)
+    writer = build_writer(args)
+    chunking.configure(args)
+    light.configure_cache(args)
 
     TRAIN_DATASET, VAL_DATASET, TEST_DATASET = load_data(args.data, need_test=True, is_stack=True)
 
@@ -539,18 +567,19 @@ def test(args):
     geo_dmtet = eval('models.' + geo_model_dmtet_name)(geo_model, device, args.model).to(device)
 
     mat = initial_guess_material(geo_dmtet, args.model, tensorf_model=app_model)
-    glctx = dr.RasterizeCudaContext()
+    glctx = raster.make_context(device, getattr(args, 'raster_backend', None))
 
     ckpt_pth = args.ckpt
     ckpt = torch.load(ckpt_pth, map_location=device)
     geo_dmtet.load_state_dict(ckpt['geo_dmtet'])
     mat['neural_tex'].load_state_dict(ckpt['neural_tex_state_dict'])
 
-    psnr_test = run_validate_crop(glctx, geo_dmtet, mat, TEST_DATASET, os.path.join(logdir, "test"), args, device)
+    psnr_test = run_validate_crop(glctx, geo_dmtet, mat, TEST_DATASET, os.path.join(logdir, "test"), args, device, writer)
     if args.wandb:
         wandb.log({'psnr_test': psnr_test})
     else:
         print(f'psnr_test: {psnr_test}')
+    writer.close()
 
 
 def train(args):
@@ -579,6 +608,9 @@ def train(args):
         backup(logdir, args)
 
     device = set_device(args.gpu)
+    writer = build_writer(args)
+    chunking.configure(args)
+    light.configure_cache(args)
 
     TRAIN_DATASET, VAL_DATASET, TEST_DATASET = load_data(args.data, args.render_test, is_stack=True)
 
@@ -591,6 +623,10 @@ def train(args):
     )
 
     train_iter = iter(cycle(train_loader))
+    crop_conf = getattr(args, 'crop_schedule', None)
+    crops = None
+    if crop_conf is not None and getattr(crop_conf, 'enabled', False):
+        crops = CropScheduler(TRAIN_DATASET, crop_conf, args.iteration, args.data.anti_aliasing, args.seed)
 
     aabb = TRAIN_DATASET.scene_bbox
     args.model.geo_model.near_far = TRAIN_DATASET.near_far
@@ -655,7 +691,7 @@ def train(args):
     print("Total number of parameters: {}M".format(total_params/1024/1024))
 
     mat = initial_guess_material(geo_dmtet, args.model, tensorf_model=app_model)
-    glctx = dr.RasterizeCudaContext()
+    glctx = raster.make_context(device, getattr(args, 'raster_backend', None))
 
     optim_dict = {
         'Adam': torch.optim.Adam,
@@ -673,20 +709,31 @@ def train(args):
 
     loss_fn = createLoss(args)
 
-    psnr_test = run_validate_crop(glctx, geo_dmtet, mat, VAL_DATASET, os.path.join(logdir, "validate_ini"), args, device)
+    psnr_test = run_validate_crop(glctx, geo_dmtet, mat, VAL_DATASET, os.path.join(logdir, "validate_ini"), args, device, writer, crops)
+    if crops is not None:
+        crops.refresh()
     if args.wandb:
         wandb.log({'psnr_test': psnr_test})
     else:
         print(f'psnr_test: {psnr_test}')
 
+    metrics = build_metrics(args, logdir)
+    if crops is not None:
+        metrics.gauges.append(crops.stats)
     for i in tqdm(range(args.iteration)):
         args.nw_iter = i
-        data = next(train_iter)
-        cx = np.random.randint(100, 700)
-        cy = np.random.randint(100, 700)
-        data = TRAIN_DATASET.get_crop(data, cx, cy)
-        data = prepare_batch(data, args.data)
-        data['spp'] = 1
+        if crops is not None:
+            # the crops of a stage share a size, the cached blocks only change with the stage
+            if crops.step(i):
+                torch.cuda.empty_cache()
+            data = prepare_batch(crops.draw(i), args.data)
+        else:
+            data = next(train_iter)
+            cx = np.random.randint(100, 700)
+            cy = np.random.randint(100, 700)
+            data = TRAIN_DATASET.get_crop(data, cx, cy)
+            data = prepare_batch(data, args.data)
+            data['spp'] = 1
         for k, v in data.items():
             if isinstance(v, torch.Tensor):
                 data[k] = v.to(device)
@@ -698,27 +745,21 @@ def train(args):
         optimizer.step()
         if scheduler is not None:
             scheduler.step()
-        torch.cuda.empty_cache()
+        if crops is None:
+            torch.cuda.empty_cache()
 
-        for k, v in loss_dict.items():
-            loss_dict[k] = v.detach().cpu().item()
-
-        if args.wandb:
-            wandb.log(loss_dict, step=i)
-        else:
-            print(f'Iter: {i:05d}', end=' | ')
-            for k, v in loss_dict.items():
-                print(k, ': ', v, end=' | ')
-            print()
+        metrics.step(i, loss_dict, n_rays=data['img'].shape[:3].numel())
 
         if (i + 1) % 2000 == 0:
-            psnr_test = run_validate_crop(glctx, geo_dmtet, mat, VAL_DATASET, os.path.join(logdir, "validate_{}".format(i)), args, device)
+            psnr_test = run_validate_crop(glctx, geo_dmtet, mat, VAL_DATASET, os.path.join(logdir, "validate_{}".format(i)), args, device, writer, crops)
+            if crops is not None:
+                crops.refresh()
             if args.wandb:
                 wandb.log({'psnr_test': psnr_test})
             else:
                 print(f'psnr_test: {psnr_test}')
 
-    psnr_test = run_validate_crop(glctx, geo_dmtet, mat, VAL_DATASET, os.path.join(logdir, "validate"), args, device)
+    psnr_test = run_validate_crop(glctx, geo_dmtet, mat, VAL_DATASET, os.path.join(logdir, "validate"), args, device, writer)
     if args.wandb:
         wandb.log({'psnr_test': psnr_test})
     else:
@@ -729,7 +770,8 @@ def train(args):
         'neural_tex_state_dict': mat['neural_tex'].state_dict(),
         'geo_dmtet': geo_dmtet.state_dict(),
     }
-    torch.save(ckpt, pth)
+    writer.save_checkpoint(ckpt, pth)
+    writer.close()
 
 
 if __name__ == '__main__':
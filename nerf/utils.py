@@ -179,8 +179,8 @@ class TVLoss(nn.Module):
 
 
 
-import plyfile
 import skimage.measure
+from render import mesh_io
 def convert_sdf_samples_to_ply(
     pytorch_3d_sdf_tensor,
     ply_filename_out,
@@ -221,27 +221,8 @@ def convert_sdf_samples_to_ply(
     if offset is not None:
         mesh_points = mesh_points - offset
 
-    # try writing to the ply file
-
-    num_verts = verts.shape[0]
-    num_faces = faces.shape[0]
-
-    verts_tuple = np.zeros((num_verts,), dtype=[("x", "f4"), ("y", "f4"), ("z", "f4")])
-
-    for i in range(0, num_verts):
-        verts_tuple[i] = tuple(mesh_points[i, :])
-
-    faces_building = []
-    for i in range(0, num_faces):
-        faces_building.append(((faces[i, :].tolist(),)))
-    faces_tuple = np.array(faces_building, dtype=[("vertex_indices", "i4", (3,))])
-
-    el_verts = plyfile.PlyElement.describe(verts_tuple, "vertex")
-    el_faces = plyfile.PlyElement.describe(faces_tuple, "face")
-
-    ply_data = plyfile.PlyData([el_verts, el_faces])
     print("saving mesh to %s" % (ply_filename_out))
-    ply_data.write(ply_filename_out)
+    mesh_io.write_ply(ply_filename_out, mesh_points, np.ascontiguousarray(faces))
 
 
 def backup(logdir, args):
@@ -344,45 +325,145 @@ def sample_ray(rays_o, rays_d, render_step_size, near_far, aabb, is_train=True,
     return rays_pts
 
 
-@torch.no_grad()
-def filtering_rays(model, all_rays, all_rgbs, device, chunk=10240 * 5, bbox_only=False):
-    print('========> filtering rays ...')
-    tt = time.time()
-    mask_filtered = []
-    N = torch.tensor(all_rays.shape[:-1]).prod()
-    idx_chunks = torch.split(torch.arange(int(N)), chunk)
+def ray_hits(model, rays_o, rays_d, bbox_only=False, N_samples=256):
+    '''whether the rays intersect the bbox, or reach a non-empty voxel of the alpha mask
+    - return:
+        - hit: [N] bool
+        - t_hit: [N] distance along the ray of the first non-empty sample, nan for bbox_only
+    '''
+    vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)  # avoid div 0
+    rate_a = (model.aabb[1] - rays_o) / vec
+    rate_b = (model.aabb[0] - rays_o) / vec
+    if bbox_only:
+        # only consider whether the ray intersects with the bounding box
+        t_min = torch.minimum(rate_a, rate_b).amax(-1)  #.clamp(min=near, max=far)
+        t_max = torch.maximum(rate_a, rate_b).amin(-1)  #.clamp(min=near, max=far)
+        return t_max > t_min, torch.full_like(t_min, float('nan'))
+
+    xyz_sampled = sample_ray(
+        rays_o,
+        rays_d,
+        model.render_step_size,
+        model.near_far,
+        model.aabb,
+        is_train=False,
+        N_samples=N_samples,
+    )
+    occupied = model.alphaMask.sample_alpha(xyz_sampled).view(xyz_sampled.shape[:-1]) > 0
+    # the same steps as sample_ray
+    near, far = model.near_far
+    t_min = torch.minimum(rate_a, rate_b).amax(-1).clamp(min=near, max=far)
+    t_hit = t_min + model.render_step_size * occupied.float().argmax(-1)
+    return occupied.any(-1), torch.where(occupied.any(-1), t_hit, torch.full_like(t_hit, float('nan')))
+
+
+class RayIndex():
+    '''Rays of a flat ray table that are still trained on, kept as int32 indices into the table.
+
+    filter() only tests the rays that are still active, so the table (and the rgbs, masks, light
+    indices aligned with it) is never copied, and a sampler drawing from active always sees the
+    current set. In the alpha mask test a kept ray remembers where it hit the first non-empty
+    voxel; after an alpha mask update it is only traced again when that voxel became empty.
+    That is only exact while the test can only drop more rays: when the bbox, the step size, the
+    grid of the mask or the kind of test changed, or the new mask fills a voxel the previous one
+    left empty, filter() tests the whole table again instead.
+    The samplers run on the prefetch thread: filter() builds new tensors and publishes them as
+    one (active, version) snapshot, a published active tensor is never written again.
+    '''
+    def __init__(self, n_rays):
+        self.n_rays = n_rays
+        # t_hit of the rays of active, only used by filter()
+        self.t_hit = torch.full((n_rays,), float('nan'))
+        # what the last filter() tested against, see trace_state()
+        self.state = None
+        self.occupied = None
+        self.snapshot = (torch.arange(n_rays, dtype=torch.int32), 0)
+
+    def __len__(self):
+        return self.snapshot[0].shape[0]
+
+    @property
+    def active(self):
+        return self.snapshot[0]
+
+    @property
+    def n_active(self):
+        return self.snapshot[0].shape[0]
+
+    @property
+    def version(self):
+        '''bumped by every filter(), samplers restart their epoch on a new version'''
+        return self.snapshot[1]
+
+    def mask(self):
+        mask = torch.zeros(self.n_rays, dtype=torch.bool)
+        mask[self.active.long()] = True
+        return mask
+
+    @staticmethod
+    def trace_state(model, bbox_only):
+        '''everything the samples of a trace depend on besides the values of the alpha mask'''
+        aabb = tuple(model.aabb.detach().cpu().flatten().tolist())
+        if bbox_only:
+            return ('bbox', aabb)
+        alpha_mask = model.alphaMask
+        return ('alpha', aabb, float(model.render_step_size), tuple(model.near_far),
+                tuple(alpha_mask.aabb.detach().cpu().flatten().tolist()), tuple(alpha_mask.alpha_volume.shape))
+
+    def incremental(self, state, occupied):
+        '''whether the active rays and their hits are still valid starting points for state'''
+        if state != self.state:
+            return False
+        # a voxel filled since the last test could bring back a dropped ray
+        return occupied is None or not (occupied & ~self.occupied).any()
+
+    @torch.no_grad()
+    def filter(self, model, all_rays, device, chunk=10240 * 5, bbox_only=False):
+        print('========> filtering rays ...')
+        tt = time.time()
+        all_rays = all_rays.view(-1, all_rays.shape[-1])
+        state = self.trace_state(model, bbox_only)
+        occupied = None if bbox_only else (model.alphaMask.alpha_volume > 0).cpu()
+        active, version = self.snapshot
+        t_hit = self.t_hit.clone()
+        if not self.incremental(state, occupied):
+            active = torch.arange(self.n_rays, dtype=torch.int32)
+            t_hit = torch.full((self.n_rays,), float('nan'))
+        keep = torch.zeros(active.shape[0], dtype=torch.bool)
+        n_traced = 0
+
+        for i in range(0, active.shape[0], chunk):
+            rays_chunk = all_rays[active[i:i+chunk].long()].to(device)
+            rays_o, rays_d = rays_chunk[..., :3], rays_chunk[..., 3:6]
+            if bbox_only:
+                hit, t_new = ray_hits(model, rays_o, rays_d, bbox_only=True)
+            else:
+                # rays whose first non-empty voxel is still non-empty are kept as they are
+                t_old = t_hit[i:i+chunk].to(device)
+                known = ~torch.isnan(t_old)
+                pts = rays_o[known] + rays_d[known] * t_old[known, None]
+                hit, t_new = known.clone(), t_old.clone()
+                hit[known] = model.alphaMask.sample_alpha(pts) > 0
+                retrace = ~hit
+                if retrace.any():
+                    hit[retrace], t_new[retrace] = ray_hits(model, rays_o[retrace], rays_d[retrace])
+                    n_traced += int(retrace.sum())
+            keep[i:i+chunk] = hit.cpu()
+            t_hit[i:i+chunk] = t_new.cpu()
+
+        n_keep = int(keep.sum())
+        self.t_hit = t_hit[keep]
+        self.state, self.occupied = state, occupied
+        print(f'Ray filtering done! takes {time.time()-tt} s. traced {n_traced if not bbox_only else active.shape[0]} '
+              f'rays, ray mask ratio: {n_keep / self.n_rays}')
+        # a single reference swap, a sampler sees either the old or the new set
+        self.snapshot = (active[keep], version + 1)
+        return self
 
-    for idx_chunk in idx_chunks:
-        rays_chunk = all_rays[idx_chunk].to(device)
-        rays_o, rays_d = rays_chunk[..., :3], rays_chunk[..., 3:6]
 
-        if bbox_only:
-            # only consider whether the ray intersects with the bounding box
-            vec = torch.where(rays_d == 0, torch.full_like(rays_d, 1e-6), rays_d)  # avoid div 0
-            rate_a = (model.aabb[1] - rays_o) / vec
-            rate_b = (model.aabb[0] - rays_o) / vec
-            t_min = torch.minimum(rate_a, rate_b).amax(-1)  #.clamp(min=near, max=far)
-            t_max = torch.maximum(rate_a, rate_b).amin(-1)  #.clamp(min=near, max=far)
-            mask_inbbox = t_max > t_min
-        else:
-            xyz_sampled = sample_ray(
-                rays_o,
-                rays_d,
-                model.render_step_size,
-                model.near_far,
-                model.aabb,
-                is_train=False,
-                N_samples=256,
-            )
-            mask_inbbox = (model.alphaMask.sample_alpha(xyz_sampled).view(
-                xyz_sampled.shape[:-1]) > 0).any(-1)
-
-        mask_filtered.append(mask_inbbox.cpu())
-
-    mask_filtered = torch.cat(mask_filtered).view(all_rgbs.shape[:-1])
-    print(mask_filtered.shape)
-    print(
-        f'Ray filtering done! takes {time.time()-tt} s. ray mask ratio: {torch.sum(mask_filtered) / N}'
-    )
+@torch.no_grad()
+def filtering_rays(model, all_rays, all_rgbs, device, chunk=10240 * 5, bbox_only=False):
+    mask_filtered = RayIndex(int(torch.tensor(all_rays.shape[:-1]).prod())).filter(
+        model, all_rays, device, chunk=chunk, bbox_only=bbox_only).mask().view(all_rgbs.shape[:-1])
     return all_rays[mask_filtered], all_rgbs[mask_filtered], mask_filtered
 